@@ -42,6 +42,11 @@ Usage:  add_img_to_target_files [flag] target_files
   --is_signing
       Skip building & adding the images for "userdata" and "cache" if we
       are signing the target files.
+
+  --jobs <jobs>
+      Build up to <jobs> partition images (system, vendor, product, ...,
+      custom images) concurrently. Images that don't fit in the free disk space
+      left by the ones in progress wait for them to finish. Default to 1.
 """
 
 from __future__ import print_function
@@ -53,9 +58,11 @@ import shlex
 import shutil
 import stat
 import sys
+import threading
+import time
 import uuid
-import tempfile
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import build_image
 import build_super_image
@@ -64,7 +71,7 @@ import verity_utils
 import ota_metadata_pb2
 
 from apex_utils import GetApexInfoFromTargetFiles
-from common import AddCareMapForAbOta, ZipDelete
+from common import AddCareMapForAbOta, ZipRewriter
 
 if sys.hexversion < 0x02070000:
   print("Python 2.7 or newer is required.", file=sys.stderr)
@@ -79,6 +86,7 @@ OPTIONS.replace_updated_files_list = []
 OPTIONS.replace_verity_public_key = False
 OPTIONS.replace_verity_private_key = False
 OPTIONS.is_signing = False
+OPTIONS.jobs = 1
 
 # Use a fixed timestamp (01/01/2009 00:00:00 UTC) for files when packaging
 # images. (b/24377993, b/80600931)
@@ -107,8 +115,49 @@ class OutputFile(object):
 
   def Write(self, compress_type=None):
     if self._output_zip:
-      common.ZipWrite(self._output_zip, self.name,
-                      self._zip_name, compress_type=compress_type)
+      ZipWrite(self._output_zip, self.name, self._zip_name,
+               compress_type=compress_type)
+
+
+class DeferredZipWriter(object):
+  """Records the writes to an output zip, to be replayed into it later.
+
+  zipfile.ZipFile doesn't support concurrent writers, and common.ZipWrite()
+  temporarily changes the global zipfile.ZIP64_LIMIT. When partition images
+  are built concurrently, each build records its writes into its own
+  DeferredZipWriter instead (see ZipWrite() below), and the main thread
+  replays them one by one, in a fixed order, so that the output zip stays
+  deterministic.
+  """
+
+  def __init__(self, output_zip):
+    self._output_zip = output_zip
+    self._writes = []
+
+  def namelist(self):
+    return self._output_zip.namelist() + [
+        arcname for _, arcname, _ in self._writes]
+
+  def Defer(self, filename, arcname, compress_type=None):
+    self._writes.append((filename, arcname, compress_type))
+
+  def Replay(self):
+    for filename, arcname, compress_type in self._writes:
+      common.ZipWrite(self._output_zip, filename, arcname,
+                      compress_type=compress_type)
+    self._writes = []
+
+
+def ZipWrite(output_zip, filename, arcname, compress_type=None):
+  """Writes the file into output_zip, which may be a DeferredZipWriter."""
+  if isinstance(output_zip, DeferredZipWriter):
+    output_zip.Defer(filename, arcname, compress_type=compress_type)
+  else:
+    common.ZipWrite(output_zip, filename, arcname, compress_type=compress_type)
+
+
+# Guards OPTIONS.info_dict, which the concurrent image builds read and update.
+info_dict_lock = threading.Lock()
 
 
 def AddSystem(output_zip, recovery_img=None, boot_img=None):
@@ -130,7 +179,7 @@ def AddSystem(output_zip, recovery_img=None, boot_img=None):
       if arc_name in output_zip.namelist():
         OPTIONS.replace_updated_files_list.append(arc_name)
       else:
-        common.ZipWrite(output_zip, output_file, arc_name)
+        ZipWrite(output_zip, output_file, arc_name)
 
   board_uses_vendorimage = OPTIONS.info_dict.get(
       "board_uses_vendorimage") == "true"
@@ -179,7 +228,7 @@ def AddVendor(output_zip, recovery_img=None, boot_img=None):
       if arc_name in output_zip.namelist():
         OPTIONS.replace_updated_files_list.append(arc_name)
       else:
-        common.ZipWrite(output_zip, output_file, arc_name)
+        ZipWrite(output_zip, output_file, arc_name)
 
   board_uses_vendorimage = OPTIONS.info_dict.get(
       "board_uses_vendorimage") == "true"
@@ -417,10 +466,98 @@ def AddCustomImages(output_zip, partition_name):
   return default
 
 
+def EstimateImageSize(partition):
+  """Returns the estimated disk space needed to build the partition image."""
+  partition_size = OPTIONS.info_dict.get(partition + "_size")
+  if partition_size:
+    return int(partition_size)
+  total = 0
+  for dirpath, _, filenames in os.walk(
+      os.path.join(OPTIONS.input_tmp, partition.upper())):
+    for fn in filenames:
+      path = os.path.join(dirpath, fn)
+      if not os.path.islink(path):
+        total += os.path.getsize(path)
+  return total
+
+
+def BuildPartitionImages(output_zip, build_calls, partitions):
+  """Builds the given partition images, up to OPTIONS.jobs at a time.
+
+  The partition images (other than the ones built later, such as vbmeta and
+  super) are independent of each other. With OPTIONS.jobs > 1, they're built
+  in worker threads; the heavy lifting happens in the external tools invoked by
+  build_image. An image only starts if its estimated size fits in the free disk
+  space left by the builds in progress, unless nothing else is running. The
+  writes to output_zip are deferred, and replayed in the order of build_calls
+  once all the builds finish.
+
+  Args:
+    output_zip: The output zip file (needs to be already open), or None to
+        write images to OPTIONS.input_tmp/.
+    build_calls: A list of (partition, add_func, add_args) tuples. Each
+        add_func is called as add_func(output_zip, *add_args), and returns the
+        path to the image.
+    partitions: The dict to store the image path of each partition into.
+  """
+
+  def Build(partition, add_func, add_args, build_output_zip):
+    logger.info("\n\n++++ %s  ++++\n\n", partition)
+    start = time.time()
+    image = add_func(build_output_zip, *add_args)
+    return image, time.time() - start
+
+  elapsed_times = {}
+  if OPTIONS.jobs <= 1 or len(build_calls) <= 1:
+    for partition, add_func, add_args in build_calls:
+      partitions[partition], elapsed_times[partition] = Build(
+          partition, add_func, add_args, output_zip)
+  else:
+    deferred_zips = [DeferredZipWriter(output_zip) if output_zip else None
+                     for _ in build_calls]
+    pending = list(zip(build_calls, deferred_zips))
+    free_space = shutil.disk_usage(
+        os.path.join(OPTIONS.input_tmp, "IMAGES")).free
+    running = {}
+    with ThreadPoolExecutor(max_workers=OPTIONS.jobs) as executor:
+      try:
+        while pending or running:
+          while pending and len(running) < OPTIONS.jobs:
+            (partition, add_func, add_args), deferred_zip = pending[0]
+            size = EstimateImageSize(partition)
+            in_progress = sum(size for _, size in running.values())
+            if running and in_progress + size > free_space:
+              break
+            pending.pop(0)
+            future = executor.submit(
+                Build, partition, add_func, add_args, deferred_zip)
+            running[future] = (partition, size)
+
+          done, _ = wait(running, return_when=FIRST_COMPLETED)
+          for future in done:
+            partition, _ = running.pop(future)
+            partitions[partition], elapsed_times[partition] = future.result()
+      except:
+        for future in running:
+          future.cancel()
+        raise
+
+    for deferred_zip in deferred_zips:
+      if deferred_zip:
+        deferred_zip.Replay()
+
+  logger.info(
+      "Partition image build times:\n%s",
+      "\n".join("  %-20s %8.1fs" % (partition, elapsed_times[partition])
+                for partition, _, _ in build_calls))
+
+
 def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
   logger.info("creating %s.img...", what)
 
-  image_props = build_image.ImagePropFromGlobalDict(info_dict, what)
+  with info_dict_lock:
+    image_props = build_image.ImagePropFromGlobalDict(info_dict, what)
+    build_info = common.BuildInfo(info_dict, use_legacy_id=True)
   image_props["timestamp"] = FIXED_FILE_TIMESTAMP
 
   if what == "system":
@@ -442,7 +579,6 @@ def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
   # Use repeatable ext4 FS UUID and hash_seed UUID (based on partition name and
   # build fingerprint). Also use the legacy build id, because the vbmeta digest
   # isn't available at this point.
-  build_info = common.BuildInfo(info_dict, use_legacy_id=True)
   uuid_seed = what + "-" + build_info.GetPartitionFingerprint(what)
   image_props["uuid"] = str(uuid.uuid5(uuid.NAMESPACE_URL, uuid_seed))
   hash_seed = "hash_seed-" + uuid_seed
@@ -460,17 +596,19 @@ def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
   verity_supported = (image_props.get("verity") == "true" or
                       image_props.get("avb_enable") == "true")
   is_avb_enable = image_props.get("avb_hashtree_enable") == "true"
-  if verity_supported and (is_verity_partition or is_avb_enable):
-    image_size = image_props.get("image_size")
-    if image_size:
-      image_size_key = what + "_image_size"
-      info_dict[image_size_key] = int(image_size)
+  with info_dict_lock:
+    if verity_supported and (is_verity_partition or is_avb_enable):
+      image_size = image_props.get("image_size")
+      if image_size:
+        image_size_key = what + "_image_size"
+        info_dict[image_size_key] = int(image_size)
 
-  use_dynamic_size = (
-      info_dict.get("use_dynamic_partition_size") == "true" and
-      what in shlex.split(info_dict.get("dynamic_partition_list", "").strip()))
-  if use_dynamic_size:
-    info_dict.update(build_image.GlobalDictFromImageProp(image_props, what))
+    use_dynamic_size = (
+        info_dict.get("use_dynamic_partition_size") == "true" and
+        what in shlex.split(
+            info_dict.get("dynamic_partition_list", "").strip()))
+    if use_dynamic_size:
+      info_dict.update(build_image.GlobalDictFromImageProp(image_props, what))
 
 
 def AddUserdata(output_zip):
@@ -687,15 +825,12 @@ def ReplaceUpdatedFiles(zip_filename, files_list):
   For now the list includes META/care_map.pb, and the related files under
   SYSTEM/ after rebuilding recovery.
   """
-  common.ZipDelete(zip_filename, files_list)
-  output_zip = zipfile.ZipFile(zip_filename, "a",
-                               compression=zipfile.ZIP_DEFLATED,
-                               allowZip64=True)
-  for item in files_list:
-    file_path = os.path.join(OPTIONS.input_tmp, item)
-    assert os.path.exists(file_path)
-    common.ZipWrite(output_zip, file_path, arcname=item)
-  common.ZipClose(output_zip)
+  with common.ZipRewriter(zip_filename, files_list,
+                          compression=zipfile.ZIP_DEFLATED) as output_zip:
+    for item in files_list:
+      file_path = os.path.join(OPTIONS.input_tmp, item)
+      assert os.path.exists(file_path)
+      common.ZipWrite(output_zip, file_path, arcname=item)
 
 
 def HasPartition(partition_name):
@@ -924,8 +1059,21 @@ def AddImagesToTargetFiles(filename):
       ("system_dlkm", has_system_dlkm, AddSystemDlkm, []),
       ("system_other", has_system_other, AddSystemOther, []),
   )
-  for call in add_partition_calls:
-    add_partition(*call)
+
+  # Custom images.
+  custom_partitions = OPTIONS.info_dict.get(
+      "avb_custom_images_partition_list", "").strip().split()
+
+  # These images don't depend on each other, so they can be built
+  # concurrently.
+  build_calls = [
+      (partition, add_func, add_args)
+      for partition, has_partition, add_func, add_args in add_partition_calls
+      if has_partition]
+  build_calls.extend(
+      (partition_name.strip(), AddCustomImages, [partition_name.strip()])
+      for partition_name in custom_partitions)
+  BuildPartitionImages(output_zip, build_calls, partitions)
 
   AddApexInfo(output_zip)
 
@@ -944,14 +1092,6 @@ def AddImagesToTargetFiles(filename):
   add_partition("pvmfw",
                 OPTIONS.info_dict.get("has_pvmfw") == "true", AddPvmfw, [])
 
-  # Custom images.
-  custom_partitions = OPTIONS.info_dict.get(
-      "avb_custom_images_partition_list", "").strip().split()
-  for partition_name in custom_partitions:
-    partition_name = partition_name.strip()
-    banner("custom images for " + partition_name)
-    partitions[partition_name] = AddCustomImages(output_zip, partition_name)
-
   if OPTIONS.info_dict.get("avb_enable") == "true":
     # vbmeta_partitions includes the partitions that should be included into
     # top-level vbmeta.img, which are the ones that are not included in any
@@ -1037,24 +1177,21 @@ def OptimizeCompressedEntries(zipfile_path):
   if not zipfile.is_zipfile(zipfile_path):
     return
   entries_to_store = []
-  with tempfile.TemporaryDirectory() as tmpdir:
-    with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
-      for zinfo in zfp.filelist:
-        if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
-          continue
-        # Don't try to store userdata.img uncompressed, it's usually huge.
-        if zinfo.filename.endswith("userdata.img"):
-          continue
-        if zinfo.compress_size > zinfo.file_size * 0.80 and zinfo.compress_type != zipfile.ZIP_STORED:
-          entries_to_store.append(zinfo)
-          zfp.extract(zinfo, tmpdir)
-    if len(entries_to_store) == 0:
-      return
-    # Remove these entries, then re-add them as ZIP_STORED
-    ZipDelete(zipfile_path, [entry.filename for entry in entries_to_store])
-    with zipfile.ZipFile(zipfile_path, "a", allowZip64=True) as zfp:
-      for entry in entries_to_store:
-        zfp.write(os.path.join(tmpdir, entry.filename), entry.filename, compress_type=zipfile.ZIP_STORED)
+  with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
+    for zinfo in zfp.filelist:
+      if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
+        continue
+      # Don't try to store userdata.img uncompressed, it's usually huge.
+      if zinfo.filename.endswith("userdata.img"):
+        continue
+      if zinfo.compress_size > zinfo.file_size * 0.80 and zinfo.compress_type != zipfile.ZIP_STORED:
+        entries_to_store.append(zinfo)
+  if len(entries_to_store) == 0:
+    return
+  # Convert these entries to ZIP_STORED in place; the others are copied as is.
+  with ZipRewriter(zipfile_path, compress_types={
+      entry.filename: zipfile.ZIP_STORED for entry in entries_to_store}):
+    pass
 
 
 def main(argv):
@@ -1069,6 +1206,10 @@ def main(argv):
       OPTIONS.replace_verity_public_key = (True, a)
     elif o == "--is_signing":
       OPTIONS.is_signing = True
+    elif o == "--jobs":
+      OPTIONS.jobs = int(a)
+      if OPTIONS.jobs < 1:
+        raise ValueError("Invalid --jobs: {}".format(a))
     else:
       return False
     return True
@@ -1078,7 +1219,8 @@ def main(argv):
       extra_long_opts=["add_missing", "rebuild_recovery",
                        "replace_verity_public_key=",
                        "replace_verity_private_key=",
-                       "is_signing"],
+                       "is_signing",
+                       "jobs="],
       extra_option_handler=option_handler)
 
   if len(args) != 1:
@@ -14,12 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import contextlib
 import logging
-import os.path
+import os
 import re
 import shlex
 import shutil
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import apex_manifest
 import common
@@ -51,10 +55,44 @@ class ApexSigningError(Exception):
     Exception.__init__(self, message)
 
 
+class StageTimer(object):
+  """Accumulates the wall time spent in each stage of signing an APEX."""
+
+  def __init__(self):
+    self.timings = collections.OrderedDict()
+
+  @contextlib.contextmanager
+  def Time(self, stage):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.timings[stage] = (
+          self.timings.get(stage, 0.0) + time.time() - start)
+
+  def Report(self, apex_path):
+    """Logs the timings of the stages."""
+    if not self.timings:
+      return
+    logger.info(
+        'Signed %s in %.2fs (%s)', apex_path, sum(self.timings.values()),
+        ', '.join('{} {:.2f}s'.format(stage, seconds)
+                  for stage, seconds in self.timings.items()))
+
+
 class ApexApkSigner(object):
-  """Class to sign the apk files and other files in an apex payload image and repack the apex"""
+  """Class to sign the apk files and other files in an apex payload image and repack the apex
+
+  The APK files are signed concurrently with up to 'jobs' (defaults to 1)
+  signers, each of which runs a signapk.jar JVM. The payload is extracted and
+  repacked in a scratch directory, which is reused for each step and emptied
+  once the APEX is repacked, so that signing many large APEXes doesn't pile up
+  their extracted payloads until Cleanup(). The time spent in each step is
+  recorded in 'timer'.
+  """
 
-  def __init__(self, apex_path, key_passwords, codename_to_api_level_map, avbtool=None, sign_tool=None):
+  def __init__(self, apex_path, key_passwords, codename_to_api_level_map,
+               avbtool=None, sign_tool=None, jobs=1):
     self.apex_path = apex_path
     if not key_passwords:
       self.key_passwords = dict()
@@ -65,6 +103,24 @@ class ApexApkSigner(object):
         OPTIONS.search_path, "bin", "debugfs_static")
     self.avbtool = avbtool if avbtool else "avbtool"
     self.sign_tool = sign_tool
+    self.jobs = max(1, jobs)
+    self.timer = StageTimer()
+    self._scratch_dir = None
+
+  def _GetScratchDir(self, name):
+    """Returns an empty directory with the given name in the scratch dir."""
+    if self._scratch_dir is None:
+      self._scratch_dir = common.MakeTempDir(prefix='apex-signer-')
+    path = os.path.join(self._scratch_dir, name)
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+  def _CleanupScratchDir(self):
+    if self._scratch_dir is not None:
+      shutil.rmtree(self._scratch_dir, ignore_errors=True)
+      self._scratch_dir = None
 
   def ProcessApexFile(self, apk_keys, payload_key, signing_args=None):
     """Scans and signs the payload files and repack the apex
@@ -82,7 +138,8 @@ class ApexApkSigner(object):
           "Make sure bin/debugfs_static can be found in -p <path>")
     list_cmd = ['deapexer', '--debugfs_path',
                 self.debugfs_path, 'list', self.apex_path]
-    entries_names = common.RunAndCheckOutput(list_cmd).split()
+    with self.timer.Time('list'):
+      entries_names = common.RunAndCheckOutput(list_cmd).split()
     apk_entries = [name for name in entries_names if name.endswith('.apk')]
 
     # No need to sign and repack, return the original apex path.
@@ -101,13 +158,16 @@ class ApexApkSigner(object):
         logger.warning('Apk path does not contain the intended directory name:'
                        ' %s', entry)
 
-    payload_dir, has_signed_content = self.ExtractApexPayloadAndSignContents(
-        apk_entries, apk_keys, payload_key, signing_args)
-    if not has_signed_content:
-      logger.info('No contents has been signed in %s', self.apex_path)
-      return self.apex_path
+    try:
+      payload_dir, has_signed_content = self.ExtractApexPayloadAndSignContents(
+          apk_entries, apk_keys, payload_key, signing_args)
+      if not has_signed_content:
+        logger.info('No contents has been signed in %s', self.apex_path)
+        return self.apex_path
 
-    return self.RepackApexPayload(payload_dir, payload_key, signing_args)
+      return self.RepackApexPayload(payload_dir, payload_key, signing_args)
+    finally:
+      self._CleanupScratchDir()
 
   def ExtractApexPayloadAndSignContents(self, apk_entries, apk_keys, payload_key, signing_args):
     """Extracts the payload image and signs the containing apk files."""
@@ -116,30 +176,16 @@ class ApexApkSigner(object):
           "Couldn't find location of debugfs_static: " +
           "Path {} does not exist. ".format(self.debugfs_path) +
           "Make sure bin/debugfs_static can be found in -p <path>")
-    payload_dir = common.MakeTempDir()
+    payload_dir = self._GetScratchDir('payload')
     extract_cmd = ['deapexer', '--debugfs_path',
                    self.debugfs_path, 'extract', self.apex_path, payload_dir]
-    common.RunAndCheckOutput(extract_cmd)
-
-    has_signed_content = False
-    for entry in apk_entries:
-      apk_path = os.path.join(payload_dir, entry)
-      assert os.path.exists(self.apex_path)
-
-      key_name = apk_keys.get(os.path.basename(entry))
-      if key_name in common.SPECIAL_CERT_STRINGS:
-        logger.info('Not signing: %s due to special cert string', apk_path)
-        continue
+    with self.timer.Time('extract'):
+      common.RunAndCheckOutput(extract_cmd)
 
-      logger.info('Signing apk file %s in apex %s', apk_path, self.apex_path)
-      # Rename the unsigned apk and overwrite the original apk path with the
-      # signed apk file.
-      unsigned_apk = common.MakeTempFile()
-      os.rename(apk_path, unsigned_apk)
-      common.SignFile(
-          unsigned_apk, apk_path, key_name, self.key_passwords.get(key_name),
-          codename_to_api_level_map=self.codename_to_api_level_map)
-      has_signed_content = True
+    assert os.path.exists(self.apex_path)
+    with self.timer.Time('sign_apks'):
+      has_signed_content = self.SignPayloadApks(
+          payload_dir, apk_entries, apk_keys)
 
     if self.sign_tool:
       logger.info('Signing payload contents in apex %s with %s', self.apex_path, self.sign_tool)
@@ -149,16 +195,57 @@ class ApexApkSigner(object):
       if signing_args:
         cmd.extend(['--signing_args', '"{}"'.format(signing_args)])
       cmd.extend([payload_key, payload_dir])
-      common.RunAndCheckOutput(cmd)
+      with self.timer.Time('sign_tool'):
+        common.RunAndCheckOutput(cmd)
       has_signed_content = True
 
     return payload_dir, has_signed_content
 
+  def SignPayloadApks(self, payload_dir, apk_entries, apk_keys):
+    """Signs the APK files in the extracted payload in place.
+
+    Returns:
+      Whether any of the APK files has been signed.
+    """
+    unsigned_dir = self._GetScratchDir('unsigned')
+    tasks = []
+    for index, entry in enumerate(apk_entries):
+      apk_path = os.path.join(payload_dir, entry)
+      key_name = apk_keys.get(os.path.basename(entry))
+      if key_name in common.SPECIAL_CERT_STRINGS:
+        logger.info('Not signing: %s due to special cert string', apk_path)
+        continue
+      # Rename the unsigned apk and overwrite the original apk path with the
+      # signed apk file.
+      unsigned_apk = os.path.join(
+          unsigned_dir, '{}-{}'.format(index, os.path.basename(entry)))
+      tasks.append((apk_path, unsigned_apk, key_name))
+
+    def SignPayloadApk(task):
+      apk_path, unsigned_apk, key_name = task
+      logger.info('Signing apk file %s in apex %s', apk_path, self.apex_path)
+      os.rename(apk_path, unsigned_apk)
+      common.SignFile(
+          unsigned_apk, apk_path, key_name, self.key_passwords.get(key_name),
+          codename_to_api_level_map=self.codename_to_api_level_map)
+
+    jobs = min(self.jobs, len(tasks))
+    if jobs <= 1:
+      for task in tasks:
+        SignPayloadApk(task)
+    else:
+      with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Consume the results to propagate any failure.
+        for _ in executor.map(SignPayloadApk, tasks):
+          pass
+    return bool(tasks)
+
   def RepackApexPayload(self, payload_dir, payload_key, signing_args=None):
     """Rebuilds the apex file with the updated payload directory."""
-    apex_dir = common.MakeTempDir()
+    apex_dir = self._GetScratchDir('apex')
     # Extract the apex file and reuse its meta files as repack parameters.
-    common.UnzipToDir(self.apex_path, apex_dir)
+    with self.timer.Time('unzip'):
+      common.UnzipToDir(self.apex_path, apex_dir)
     arguments_dict = {
         'manifest': os.path.join(apex_dir, 'apex_manifest.pb'),
         'build_info': os.path.join(apex_dir, 'apex_build_info.pb'),
@@ -198,13 +285,15 @@ class ApexApkSigner(object):
     generate_image_cmd.extend([payload_dir, payload_img])
     if OPTIONS.verbose:
       generate_image_cmd.append('-v')
-    common.RunAndCheckOutput(generate_image_cmd)
+    with self.timer.Time('repack'):
+      common.RunAndCheckOutput(generate_image_cmd)
 
     # Add the payload image back to the apex file.
-    common.ZipDelete(self.apex_path, APEX_PAYLOAD_IMAGE)
-    with zipfile.ZipFile(self.apex_path, 'a', allowZip64=True) as output_apex:
-      common.ZipWrite(output_apex, payload_img, APEX_PAYLOAD_IMAGE,
-                      compress_type=zipfile.ZIP_STORED)
+    with self.timer.Time('rewrite_apex'):
+      common.ZipDelete(self.apex_path, APEX_PAYLOAD_IMAGE)
+      with zipfile.ZipFile(self.apex_path, 'a', allowZip64=True) as output_apex:
+        common.ZipWrite(output_apex, payload_img, APEX_PAYLOAD_IMAGE,
+                        compress_type=zipfile.ZIP_STORED)
     return self.apex_path
 
 
@@ -324,7 +413,8 @@ def ParseApexPayloadInfo(avbtool, payload_path):
 
 def SignUncompressedApex(avbtool, apex_file, payload_key, container_key,
                          container_pw, apk_keys, codename_to_api_level_map,
-                         no_hashtree, signing_args=None, sign_tool=None):
+                         no_hashtree, signing_args=None, sign_tool=None,
+                         apk_signing_jobs=1):
   """Signs the current uncompressed APEX with the given payload/container keys.
 
   Args:
@@ -337,6 +427,7 @@ def SignUncompressedApex(avbtool, apex_file, payload_key, container_key,
     no_hashtree: Don't include hashtree in the signed APEX.
     signing_args: Additional args to be passed to the payload signer.
     sign_tool: A tool to sign the contents of the APEX.
+    apk_signing_jobs: The number of APKs in the APEX to sign concurrently.
 
   Returns:
     The path to the signed APEX file.
@@ -345,8 +436,9 @@ def SignUncompressedApex(avbtool, apex_file, payload_key, container_key,
   # the apex file after signing.
   apk_signer = ApexApkSigner(apex_file, container_pw,
                              codename_to_api_level_map,
-                             avbtool, sign_tool)
+                             avbtool, sign_tool, jobs=apk_signing_jobs)
   apex_file = apk_signer.ProcessApexFile(apk_keys, payload_key, signing_args)
+  timer = apk_signer.timer
 
   # 2a. Extract and sign the APEX_PAYLOAD_IMAGE entry with the given
   # payload_key.
@@ -355,29 +447,33 @@ def SignUncompressedApex(avbtool, apex_file, payload_key, container_key,
     payload_file = apex_fd.extract(APEX_PAYLOAD_IMAGE, payload_dir)
     zip_items = apex_fd.namelist()
 
-  payload_info = ParseApexPayloadInfo(avbtool, payload_file)
-  if no_hashtree is None:
-    no_hashtree = payload_info.get("Tree Size", 0) == 0
-  SignApexPayload(
-      avbtool,
-      payload_file,
-      payload_key,
-      payload_info['apex.key'],
-      payload_info['Algorithm'],
-      payload_info['Salt'],
-      payload_info['Hash Algorithm'],
-      no_hashtree,
-      signing_args)
+  with timer.Time('sign_payload'):
+    payload_info = ParseApexPayloadInfo(avbtool, payload_file)
+    if no_hashtree is None:
+      no_hashtree = payload_info.get("Tree Size", 0) == 0
+    SignApexPayload(
+        avbtool,
+        payload_file,
+        payload_key,
+        payload_info['apex.key'],
+        payload_info['Algorithm'],
+        payload_info['Salt'],
+        payload_info['Hash Algorithm'],
+        no_hashtree,
+        signing_args)
 
   # 2b. Update the embedded payload public key.
-  payload_public_key = common.ExtractAvbPublicKey(avbtool, payload_key)
-  common.ZipDelete(apex_file, APEX_PAYLOAD_IMAGE)
-  if APEX_PUBKEY in zip_items:
-    common.ZipDelete(apex_file, APEX_PUBKEY)
-  apex_zip = zipfile.ZipFile(apex_file, 'a', allowZip64=True)
-  common.ZipWrite(apex_zip, payload_file, arcname=APEX_PAYLOAD_IMAGE)
-  common.ZipWrite(apex_zip, payload_public_key, arcname=APEX_PUBKEY)
-  common.ZipClose(apex_zip)
+  with timer.Time('rewrite_apex'):
+    payload_public_key = common.ExtractAvbPublicKey(avbtool, payload_key)
+    common.ZipDelete(apex_file, APEX_PAYLOAD_IMAGE)
+    if APEX_PUBKEY in zip_items:
+      common.ZipDelete(apex_file, APEX_PUBKEY)
+    apex_zip = zipfile.ZipFile(apex_file, 'a', allowZip64=True)
+    common.ZipWrite(apex_zip, payload_file, arcname=APEX_PAYLOAD_IMAGE)
+    common.ZipWrite(apex_zip, payload_public_key, arcname=APEX_PUBKEY)
+    common.ZipClose(apex_zip)
+  # The signed payload has been written back into the APEX.
+  shutil.rmtree(payload_dir, ignore_errors=True)
 
   # 3. Sign the APEX container with container_key.
   signed_apex = common.MakeTempFile(prefix='apex-container-', suffix='.apex')
@@ -387,20 +483,23 @@ def SignUncompressedApex(avbtool, apex_file, payload_key, container_key,
   extra_signapk_args.extend(['-a', '4096', '--align-file-size'])
 
   password = container_pw.get(container_key) if container_pw else None
-  common.SignFile(
-      apex_file,
-      signed_apex,
-      container_key,
-      password,
-      codename_to_api_level_map=codename_to_api_level_map,
-      extra_signapk_args=extra_signapk_args)
-
+  with timer.Time('sign_container'):
+    common.SignFile(
+        apex_file,
+        signed_apex,
+        container_key,
+        password,
+        codename_to_api_level_map=codename_to_api_level_map,
+        extra_signapk_args=extra_signapk_args)
+
+  timer.Report(apk_signer.apex_path)
   return signed_apex
 
 
 def SignCompressedApex(avbtool, apex_file, payload_key, container_key,
                        container_pw, apk_keys, codename_to_api_level_map,
-                       no_hashtree, signing_args=None, sign_tool=None):
+                       no_hashtree, signing_args=None, sign_tool=None,
+                       apk_signing_jobs=1):
   """Signs the current compressed APEX with the given payload/container keys.
 
   Args:
@@ -412,6 +511,7 @@ def SignCompressedApex(avbtool, apex_file, payload_key, container_key,
     codename_to_api_level_map: A dict that maps from codename to API level.
     no_hashtree: Don't include hashtree in the signed APEX.
     signing_args: Additional args to be passed to the payload signer.
+    apk_signing_jobs: The number of APKs in the APEX to sign concurrently.
 
   Returns:
     The path to the signed APEX file.
@@ -438,7 +538,8 @@ def SignCompressedApex(avbtool, apex_file, payload_key, container_key,
       codename_to_api_level_map,
       no_hashtree,
       signing_args,
-      sign_tool)
+      sign_tool,
+      apk_signing_jobs)
 
   # 3. Compress signed original apex.
   compressed_apex_file = common.MakeTempFile(prefix='apex-container-',
@@ -466,7 +567,8 @@ def SignCompressedApex(avbtool, apex_file, payload_key, container_key,
 
 def SignApex(avbtool, apex_data, payload_key, container_key, container_pw,
              apk_keys, codename_to_api_level_map,
-             no_hashtree, signing_args=None, sign_tool=None):
+             no_hashtree, signing_args=None, sign_tool=None,
+             apk_signing_jobs=1):
   """Signs the current APEX with the given payload/container keys.
 
   Args:
@@ -478,6 +580,7 @@ def SignApex(avbtool, apex_data, payload_key, container_key, container_pw,
     codename_to_api_level_map: A dict that maps from codename to API level.
     no_hashtree: Don't include hashtree in the signed APEX.
     signing_args: Additional args to be passed to the payload signer.
+    apk_signing_jobs: The number of APKs in the APEX to sign concurrently.
 
   Returns:
     The path to the signed APEX file.
@@ -503,7 +606,8 @@ def SignApex(avbtool, apex_data, payload_key, container_key, container_pw,
           no_hashtree=no_hashtree,
           apk_keys=apk_keys,
           signing_args=signing_args,
-          sign_tool=sign_tool)
+          sign_tool=sign_tool,
+          apk_signing_jobs=apk_signing_jobs)
     elif apex_type == 'COMPRESSED':
       return SignCompressedApex(
           avbtool,
@@ -515,7 +619,8 @@ def SignApex(avbtool, apex_data, payload_key, container_key, container_pw,
           no_hashtree=no_hashtree,
           apk_keys=apk_keys,
           signing_args=signing_args,
-          sign_tool=sign_tool)
+          sign_tool=sign_tool,
+          apk_signing_jobs=apk_signing_jobs)
     else:
       # TODO(b/172912232): support signing compressed apex
       raise ApexInfoError('Unsupported apex type {}'.format(apex_type))
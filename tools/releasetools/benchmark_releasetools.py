@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks the performance-sensitive parts of releasetools on synthetic inputs.
+
+The timings depend on the host, so they're reported rather than checked; the
+unit tests cover the behavior.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import statistics
+import time
+import tracemalloc
+import zlib
+from collections import OrderedDict
+from hashlib import sha1
+
+import common
+from blockimgdiff import (BlockImageDiff, SourceRangesIndex, Transfer,
+                          TransferListWriter)
+from images import EmptyImage
+from rangelib import RangeSet
+
+OPTIONS = common.OPTIONS
+
+
+def MakeTransferGraph(count, seed):
+  """Returns a BlockImageDiff with 'count' interdependent transfers.
+
+  Transfer i writes block i and reads 4 blocks at random, which makes about 4
+  ordering dependencies per transfer, with plenty of cycles.
+  """
+  rng = random.Random(seed)
+  block_image_diff = BlockImageDiff(EmptyImage(), EmptyImage(), version=3)
+  transfers = block_image_diff.transfers
+  for index in range(count):
+    src_blocks = sorted(set(rng.randrange(count) for _ in range(4)))
+    src_ranges = RangeSet(data=[b for block in src_blocks
+                                for b in (block, block + 1)])
+    Transfer("t%d" % index, "t%d" % index, RangeSet(data=(index, index + 1)),
+             src_ranges, "hash", "hash", "diff", transfers)
+  return block_image_diff
+
+
+def BenchmarkFindSequenceForTransfers():
+  """Times ordering the transfers, which should scale (almost) linearly."""
+  for count in (10000, 100000):
+    block_image_diff = MakeTransferGraph(count, count)
+    block_image_diff.GenerateDigraph()
+    start = time.time()
+    block_image_diff.FindVertexSequence()
+    block_image_diff.ReverseBackwardEdges()
+    block_image_diff.ImproveVertexSequence()
+    print("Ordered {} transfers in {:.2f}s".format(
+        count, time.time() - start))
+
+
+def BenchmarkParallelDeflater():
+  """Compares ParallelDeflater with a single deflate stream."""
+  # Text-like data that deflates to about a third, with long-range matches
+  # across the chunk boundaries.
+  size = 32 * 1024 * 1024
+  words = [sha1(b"%d" % index).hexdigest()[:index % 7 + 2].encode()
+           for index in range(1000)]
+  data = b" ".join(random.Random(0).choices(words, k=size // 2 + 1))[:size]
+  input_file = common.MakeTempFile()
+  with open(input_file, "wb") as f:
+    f.write(data)
+
+  start = time.time()
+  compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+  single_size = len(compressor.compress(data) + compressor.flush())
+  print("Single stream: {} bytes in {:.2f}s".format(
+      single_size, time.time() - start))
+
+  threads = os.cpu_count() or 1
+  start = time.time()
+  _, _, parallel_size = common.ParallelDeflater(threads).Compress(
+      input_file, common.MakeTempFile())
+  print("{} threads: {} bytes in {:.2f}s ({:+.2%} size)".format(
+      threads, parallel_size, time.time() - start,
+      parallel_size / single_size - 1))
+
+
+def FindReadersPerBlock(transfers):
+  """Finds the readers of each transfer's target with a per-block list.
+
+  This is how GenerateDigraph() used to do it, before SourceRangesIndex.
+  """
+  source_ranges = []
+  for b in transfers:
+    for s, e in b.src_ranges:
+      if e > len(source_ranges):
+        source_ranges.extend([None] * (e - len(source_ranges)))
+      for i in range(s, e):
+        if source_ranges[i] is None:
+          source_ranges[i] = OrderedDict.fromkeys([b])
+        else:
+          source_ranges[i][b] = None
+
+  results = []
+  for a in transfers:
+    intersections = OrderedDict()
+    for s, e in a.tgt_ranges:
+      for i in range(s, e):
+        if i >= len(source_ranges):
+          break
+        if source_ranges[i] is not None:
+          for j in source_ranges[i]:
+            intersections[j] = None
+    results.append(list(intersections))
+  return results
+
+
+def FindReadersIndexed(transfers):
+  """Finds the readers of each transfer's target with a SourceRangesIndex."""
+  index = SourceRangesIndex(transfers)
+  return [list(index.FindReaders(a.tgt_ranges)) for a in transfers]
+
+
+def BenchmarkSourceRangesIndex():
+  """Compares SourceRangesIndex with the per-block list it replaced.
+
+  The image has 1M blocks, written by transfers of 1-64 blocks that each read
+  the location of another, shuffled, transfer.
+  """
+  rng = random.Random(0)
+  chunks = []
+  block = 0
+  while block < 1 << 20:
+    size = rng.randint(1, 64)
+    chunks.append(RangeSet(data=(block, block + size)))
+    block += size
+  sources = chunks[:]
+  rng.shuffle(sources)
+  transfers = []
+  for index, (tgt_ranges, src_ranges) in enumerate(zip(chunks, sources)):
+    Transfer("t%d" % index, "t%d" % index, tgt_ranges, src_ranges, "hash",
+             "hash", "diff", transfers)
+
+  results = []
+  for name, find_readers in (("per-block list", FindReadersPerBlock),
+                             ("SourceRangesIndex", FindReadersIndexed)):
+    start = time.time()
+    results.append(find_readers(transfers))
+    duration = time.time() - start
+    # Tracing the allocations slows things down, so it gets a separate run.
+    tracemalloc.start()
+    try:
+      find_readers(transfers)
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    print("{}: {:.2f}s, {:.1f} MiB peak for {} transfers".format(
+        name, duration, peak / (1 << 20), len(transfers)))
+  assert results[0] == results[1], "The readers differ"
+
+
+def BenchmarkSignApkServer():
+  """Compares the per-APK latency of signapk.jar with and without a server.
+
+  It signs testdata/TestApp.apk with testdata/testkey, so it needs java on the
+  PATH, and signapk.jar under the search path (-p, defaulting to
+  $ANDROID_HOST_OUT).
+  """
+  testdata_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "testdata")
+  apk = os.path.join(testdata_dir, "TestApp.apk")
+  key = os.path.join(testdata_dir, "testkey")
+  count = 20
+
+  saved_signapk_server = OPTIONS.signapk_server
+  try:
+    for use_server in (False, True):
+      OPTIONS.signapk_server = use_server
+      latencies = []
+      for _ in range(count):
+        output_file = common.MakeTempFile(suffix=".apk")
+        start = time.time()
+        common.SignFile(apk, output_file, key, None, min_api_level=23)
+        latencies.append(time.time() - start)
+      # The first request also starts the server.
+      print("{} server: {:.3f}s mean, {:.3f}s p50 per APK ({} APKs)".format(
+          "With" if use_server else "Without", statistics.mean(latencies),
+          statistics.median(latencies), count))
+  finally:
+    OPTIONS.signapk_server = saved_signapk_server
+    common.SignApkServer.StopAll()
+
+
+class InMemoryTransferListWriter(TransferListWriter):
+  """Collects the commands in a list and joins them at the end.
+
+  This is how WriteTransfers() used to do it, before TransferListWriter.
+  """
+
+  def __init__(self, path, version):  # pylint: disable=super-init-not-called
+    self.path = path
+    self.version = version
+    self._out = []
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+  def Write(self, command):
+    self._out.append(command)
+
+  def Finish(self, total, max_stashed_blocks, erase_first=None):
+    header = ["%d\n" % (self.version,), "%d\n" % (total,), "0\n",
+              "%d\n" % (max_stashed_blocks,)]
+    if erase_first:
+      header.append("erase %s\n" % (erase_first.to_string_raw(),))
+    with open(self.path, "w") as f:
+      f.write("".join(header + self._out))
+
+
+def BenchmarkWriteTransfers():
+  """Compares TransferListWriter with joining all the commands in memory.
+
+  The transfer list has 50000 'new' and 'zero' commands, each writing 40
+  single-block ranges.
+  """
+  count = 50000
+  tgt = EmptyImage()
+  block_image_diff = BlockImageDiff(tgt)
+  for index in range(count):
+    start = index * 80
+    Transfer("t%d" % index, "t%d" % index,
+             RangeSet(data=range(start, start + 80)), RangeSet(), "hash",
+             "hash", "new" if index % 2 else "zero",
+             block_image_diff.transfers)
+  tgt.total_blocks = count * 80
+  tgt.care_map = RangeSet(data=(0, tgt.total_blocks))
+
+  results = []
+  for name, writer_class in (("in-memory list", InMemoryTransferListWriter),
+                             ("TransferListWriter", TransferListWriter)):
+    path = common.MakeTempFile(suffix=".transfer.list")
+
+    def WriteTransferList():
+      # pylint: disable=protected-access
+      with writer_class(path, block_image_diff.version) as out:
+        block_image_diff._WriteTransfers(out)
+
+    start = time.time()
+    WriteTransferList()
+    duration = time.time() - start
+    # Tracing the allocations slows things down, so it gets a separate run.
+    tracemalloc.start()
+    try:
+      WriteTransferList()
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    print("{}: {:.2f}s, {:.1f} MiB peak for a {:.1f} MiB transfer list".format(
+        name, duration, peak / (1 << 20), os.path.getsize(path) / (1 << 20)))
+    with open(path) as f:
+      results.append(f.read())
+  assert results[0] == results[1], "The transfer lists differ"
+
+
+BENCHMARKS = {
+    "find_sequence": BenchmarkFindSequenceForTransfers,
+    "parallel_deflate": BenchmarkParallelDeflater,
+    "signapk_server": BenchmarkSignApkServer,
+    "source_ranges_index": BenchmarkSourceRangesIndex,
+    "write_transfers": BenchmarkWriteTransfers,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "-p", "--path",
+      help="The search path for the host tools, e.g. signapk.jar.")
+  parser.add_argument(
+      "benchmarks", nargs="*", metavar="benchmark",
+      help="The benchmarks to run ({}); all of them by default.".format(
+          ", ".join(sorted(BENCHMARKS))))
+  args = parser.parse_args()
+  for name in args.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error("unknown benchmark: {}".format(name))
+  if args.path:
+    OPTIONS.search_path = args.path
+
+  common.InitLogging()
+
+  for name in args.benchmarks or sorted(BENCHMARKS):
+    print("== {} ==".format(name))
+    BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+  try:
+    main()
+  finally:
+    common.Cleanup()
@@ -15,19 +15,23 @@
 from __future__ import print_function
 
 import array
+import bisect
 import copy
-import functools
 import heapq
 import itertools
 import logging
 import multiprocessing
 import os
 import os.path
+import pickle
 import re
+import shutil
 import sys
 import threading
+import time
 import zlib
 from collections import deque, namedtuple, OrderedDict
+from hashlib import sha1
 
 import common
 from images import EmptyImage
@@ -41,23 +45,151 @@ logger = logging.getLogger(__name__)
 PatchInfo = namedtuple("PatchInfo", ["imgdiff", "content"])
 
 
+def _FileSha1(filename):
+  h = sha1()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
 def compute_patch(srcfile, tgtfile, imgdiff=False):
-  """Calls bsdiff|imgdiff to compute the patch data, returns a PatchInfo."""
-  patchfile = common.MakeTempFile(prefix='patch-')
+  """Calls bsdiff|imgdiff to compute the patch data, returns a PatchInfo.
 
+  If common.OPTIONS.patch_cache_dir is set, the patch is looked up from (and
+  added to) the patch cache first.
+  """
   cmd = ['imgdiff', '-z'] if imgdiff else ['bsdiff']
-  cmd.extend([srcfile, tgtfile, patchfile])
 
+  patch_cache = common.GetPatchCache()
+  if patch_cache:
+    src_sha1 = _FileSha1(srcfile)
+    tgt_sha1 = _FileSha1(tgtfile)
+    patch = patch_cache.Get(cmd, src_sha1, tgt_sha1)
+    if patch is not None:
+      return PatchInfo(imgdiff, patch)
+
+  patchfile = common.MakeTempFile(prefix='patch-')
   # Don't dump the bsdiff/imgdiff commands, which are not useful for the case
   # here, since they contain temp filenames only.
-  proc = common.Run(cmd, verbose=False)
+  proc = common.Run(cmd + [srcfile, tgtfile, patchfile], verbose=False)
   output, _ = proc.communicate()
 
   if proc.returncode != 0:
     raise ValueError(output)
 
   with open(patchfile, 'rb') as f:
-    return PatchInfo(imgdiff, f.read())
+    patch = f.read()
+  if patch_cache:
+    patch_cache.Put(cmd, src_sha1, tgt_sha1, patch)
+  return PatchInfo(imgdiff, patch)
+
+
+def _ComputeTransferPatch(src, tgt, name, tgt_ranges, src_ranges, imgdiff,
+                          patch_info, compress_target):
+  """Computes the patch and/or the compressed target size of a transfer.
+
+  Args:
+    src: The source image.
+    tgt: The target image.
+    name: The transfer name, used in the error messages only.
+    tgt_ranges: The target RangeSet of the transfer.
+    src_ranges: The source RangeSet of the transfer.
+    imgdiff: Whether to use imgdiff instead of bsdiff.
+    patch_info: The existing PatchInfo of the transfer, if any. The patch will
+        only be computed if it's None.
+    compress_target: Whether to compress the target ranges.
+
+  Returns:
+    A tuple of (patch_info, compressed_size, error_messages, input_bytes),
+    where input_bytes is the amount of image data that has been read.
+  """
+  messages = []
+  compressed_size = None
+  input_bytes = 0
+
+  if not patch_info:
+    src_file = common.MakeTempFile(prefix="src-")
+    with open(src_file, "wb") as fd:
+      src.WriteRangeDataToFd(src_ranges, fd)
+
+    tgt_file = common.MakeTempFile(prefix="tgt-")
+    with open(tgt_file, "wb") as fd:
+      tgt.WriteRangeDataToFd(tgt_ranges, fd)
+    input_bytes += (src_ranges.size() + tgt_ranges.size()) * tgt.blocksize
+
+    try:
+      patch_info = compute_patch(src_file, tgt_file, imgdiff)
+    except ValueError as e:
+      messages.append(
+          "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
+              "imgdiff" if imgdiff else "bsdiff", name, tgt_ranges,
+              src_ranges, e))
+
+  if compress_target:
+    tgt_data = tgt.ReadRangeSet(tgt_ranges)
+    input_bytes += tgt_ranges.size() * tgt.blocksize
+    try:
+      # Compresses with the default level
+      compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+      compressed_data = (compress_obj.compress(b"".join(tgt_data))
+                         + compress_obj.flush())
+      compressed_size = len(compressed_data)
+    except zlib.error as e:
+      messages.append(
+          "Failed to compress the data in target range {} for {}:\n"
+          "{}".format(tgt_ranges, name, e))
+
+  return patch_info, compressed_size, messages, input_bytes
+
+
+# The (src, tgt) images in a patch worker process. They are unpickled, i.e.
+# reopened by their paths, once per worker in _InitPatchWorker().
+_patch_worker_images = None
+
+
+def _InitPatchWorker(images_state):
+  global _patch_worker_images  # pylint: disable=global-statement
+  # Don't inherit (and later delete) the temp files of the parent process.
+  common.OPTIONS.tempfiles = []
+  _patch_worker_images = pickle.loads(images_state)
+
+
+def _PatchWorker(task):
+  """Runs _ComputeTransferPatch() for one task in a patch worker process.
+
+  Returns:
+    A tuple of the patch index, the result of _ComputeTransferPatch(), the
+    worker name, the elapsed time, and the (hits, misses, hit_bytes) of the
+    PatchCache lookups by the task, or None without a PatchCache.
+  """
+  patch_index, args = task
+  src, tgt = _patch_worker_images
+  patch_cache = common.GetPatchCache()
+  cache_stats = patch_cache.GetStats() if patch_cache else None
+  tempfiles = set(common.OPTIONS.tempfiles)
+  start = time.time()
+  try:
+    result = _ComputeTransferPatch(src, tgt, *args)
+  finally:
+    # Remove the src/tgt/patch files of the task right away, as workers may
+    # live through thousands of transfers. Unlike common.Cleanup(), leave
+    # anything else the process holds alone.
+    for path in common.OPTIONS.tempfiles:
+      if path in tempfiles:
+        continue
+      if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+      elif os.path.exists(path):
+        os.remove(path)
+    common.OPTIONS.tempfiles[:] = [
+        path for path in common.OPTIONS.tempfiles if path in tempfiles]
+  if patch_cache:
+    cache_stats = tuple(
+        after - before
+        for before, after in zip(cache_stats, patch_cache.GetStats()))
+  return (patch_index, result, "worker-%d" % os.getpid(), time.time() - start,
+          cache_stats)
 
 
 class Transfer(object):
@@ -110,29 +242,65 @@ class Transfer(object):
             " to " + str(self.tgt_ranges) + ">")
 
 
-@functools.total_ordering
-class HeapItem(object):
-  def __init__(self, item):
-    self.item = item
-    # Negate the score since python's heap is a min-heap and we want the
-    # maximum score.
-    self.score = -item.score
-
-  def clear(self):
-    self.item = None
+class SourceRangesIndex(object):
+  """An index from blocks to the transfers that read them.
 
-  def __bool__(self):
-    return self.item is not None
+  It answers the same question as a per-block list of transfer sets would,
+  but stores the block space as sorted, non-overlapping segments that share
+  the same set of readers. The memory use is therefore proportional to the
+  number of source ranges rather than the number of blocks, and a lookup
+  costs a binary search plus the number of segments it touches.
+  """
 
-  # Python 2 uses __nonzero__, while Python 3 uses __bool__.
-  __nonzero__ = __bool__
+  def __init__(self, transfers):
+    events = []
+    for index, xf in enumerate(transfers):
+      for s, e in xf.src_ranges:
+        events.append((s, 1, index))
+        events.append((e, 0, index))
+    # At the same block, ranges ending there are removed before the ones
+    # starting there are added.
+    events.sort()
+
+    self._starts = array.array("q")
+    self._ends = array.array("q")
+    self._readers = []
+
+    active = set()
+    last = None
+    for pos, is_start, index in events:
+      if active and pos != last:
+        readers = tuple(transfers[i] for i in sorted(active))
+        if (self._ends and self._ends[-1] == last and
+            self._readers[-1] == readers):
+          self._ends[-1] = pos
+        else:
+          self._starts.append(last)
+          self._ends.append(pos)
+          self._readers.append(readers)
+      if is_start:
+        active.add(index)
+      else:
+        active.discard(index)
+      last = pos
 
-  # The rest operations are generated by functools.total_ordering decorator.
-  def __eq__(self, other):
-    return self.score == other.score
+  def FindReaders(self, ranges):
+    """Returns the transfers that read any block in the given RangeSet.
 
-  def __le__(self, other):
-    return self.score <= other.score
+    The result is an OrderedDict (used as an ordered set). The transfers are
+    ordered by the first block in 'ranges' they read, and then by their order
+    in the transfer list, so that the output is repeatable.
+    """
+    readers = OrderedDict()
+    starts, ends = self._starts, self._ends
+    count = len(starts)
+    for s, e in ranges:
+      i = bisect.bisect_right(ends, s)
+      while i < count and starts[i] < e:
+        for xf in self._readers[i]:
+          readers[xf] = None
+        i += 1
+    return readers
 
 
 class ImgdiffStats(object):
@@ -199,6 +367,168 @@ class ImgdiffStats(object):
       logger.info(''.join(['  {}\n'.format(name) for name in values]))
 
 
+class PatchWorkerStats(object):
+  """A class that collects the throughput of each patch worker.
+
+  A worker is either a thread or a process (with --patch_workers) that runs
+  bsdiff/imgdiff and/or compresses the target data in
+  BlockImageDiff.ComputePatchesForInputList().
+  """
+
+  def __init__(self):
+    self.stats = OrderedDict()
+
+  def Log(self, worker, input_bytes, elapsed):
+    """Logs one transfer done by the given worker.
+
+    Args:
+      worker: The worker name string.
+      input_bytes: The amount of image data read for the transfer.
+      elapsed: The time spent on the transfer, in seconds.
+    """
+    count, total_bytes, total_time = self.stats.get(worker, (0, 0, 0.0))
+    self.stats[worker] = (count + 1, total_bytes + input_bytes,
+                          total_time + elapsed)
+
+  def Report(self):
+    """Prints a report of the collected per-worker stats."""
+    if not self.stats:
+      return
+    header = '  Patch Worker Stats Report  '
+    logger.info(header)
+    logger.info('%s\n', '=' * len(header))
+    for worker, (count, total_bytes, total_time) in sorted(
+        self.stats.items()):
+      logger.info(
+          '  %s: %d transfers, %d bytes in %.2fs (%.2f MiB/s)', worker, count,
+          total_bytes, total_time,
+          total_bytes / total_time / (1 << 20) if total_time else 0.0)
+
+
+class TransferListWriter(object):
+  """Writes a transfer list as the commands are generated.
+
+  The header (the total number of blocks written and the maximum number of
+  blocks stashed at once) and the initial erase command are only known once
+  all the commands have been generated. So the commands are streamed to a
+  temp file next to the transfer list first, which Finish() then appends to
+  the header, instead of holding the whole list in memory.
+  """
+
+  # Limit the size of operand in command 'new' and 'zero' to 1024 blocks. This
+  # prevents the target size of one command from being too large; and might
+  # help to avoid fsync errors on some devices.
+  SPLIT_BLOCKS_LIMIT = 1024
+
+  def __init__(self, path, version):
+    self.path = path
+    self.version = version
+    self._commands_path = path + ".commands"
+    self._commands = open(self._commands_path, "w")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if not self._commands.closed:
+      self._commands.close()
+    if os.path.exists(self._commands_path):
+      os.remove(self._commands_path)
+
+  def Write(self, command):
+    """Writes one or more newline-terminated commands."""
+    self._commands.write(command)
+
+  def WriteSplit(self, style, target_blocks):
+    """Writes a 'new' or 'zero' command in chunks of SPLIT_BLOCKS_LIMIT blocks.
+
+    Returns:
+      The number of blocks written.
+    """
+    assert style == "new" or style == "zero"
+    total = 0
+    while target_blocks:
+      blocks_to_write = target_blocks.first(self.SPLIT_BLOCKS_LIMIT)
+      self.Write("%s %s\n" % (style, blocks_to_write.to_string_raw()))
+      total += blocks_to_write.size()
+      target_blocks = target_blocks.subtract(blocks_to_write)
+    return total
+
+  def Finish(self, total, max_stashed_blocks, erase_first=None):
+    """Writes the transfer list with the given header values.
+
+    Args:
+      total: The total number of blocks written by the commands.
+      max_stashed_blocks: The maximum number of blocks stashed at once.
+      erase_first: The RangeSet to erase before all the other commands, if
+          any.
+    """
+    self._commands.close()
+    with open(self.path, "w") as f:
+      f.write("%d\n" % (self.version,))   # format version number
+      f.write("%d\n" % (total,))
+      # v3+: the number of stash slots is unused.
+      f.write("0\n")
+      f.write("%d\n" % (max_stashed_blocks,))
+      if erase_first:
+        f.write("erase %s\n" % (erase_first.to_string_raw(),))
+      with open(self._commands_path) as commands:
+        for chunk in iter(lambda: commands.read(1 << 16), ""):
+          f.write(chunk)
+
+
+class PatchDataWriter(object):
+  """Writes the patches to patch.dat as they get computed.
+
+  The patches are laid out in the transfer order, while the workers finish
+  them in any order. Each patch is written (and its content dropped) as soon
+  as the ones before it are written, instead of holding all of them in memory
+  until the end. Only the patches that finish ahead of their turn are kept.
+  """
+
+  def __init__(self, patch_fd, transfers, blocksize):
+    self.patch_fd = patch_fd
+    self.transfers = transfers
+    self.blocksize = blocksize
+    self.offset = 0
+    self.max_pending_bytes = 0
+    self._pending = {}
+    self._pending_bytes = 0
+    self._next_index = 0
+
+  def Add(self, patch_index, xf_index, patch_info):
+    """Adds the patch with the given index in patch.dat."""
+    self._pending[patch_index] = (xf_index, patch_info)
+    self._pending_bytes += len(patch_info.content)
+    self.max_pending_bytes = max(self.max_pending_bytes, self._pending_bytes)
+    while self._next_index in self._pending:
+      xf_index, patch_info = self._pending.pop(self._next_index)
+      self._pending_bytes -= len(patch_info.content)
+      self._next_index += 1
+      self._Write(self.transfers[xf_index], patch_info)
+
+  def _Write(self, xf, patch_info):
+    xf.patch_len = len(patch_info.content)
+    xf.patch_start = self.offset
+    self.offset += xf.patch_len
+    self.patch_fd.write(patch_info.content)
+    # The content is no longer needed once it's written.
+    xf.patch_info = None
+
+    tgt_size = xf.tgt_ranges.size() * self.blocksize
+    logger.info(
+        "%10d %10d (%6.2f%%) %7s %s %s %s", xf.patch_len, tgt_size,
+        xf.patch_len * 100.0 / tgt_size, xf.style,
+        xf.tgt_name if xf.tgt_name == xf.src_name else (
+            xf.tgt_name + " (from " + xf.src_name + ")"),
+        xf.tgt_ranges, xf.src_ranges)
+
+  def Finish(self, count):
+    """Checks that all the 'count' patches have been written."""
+    assert not self._pending and self._next_index == count, \
+        "Missing patches: wrote %d of %d" % (self._next_index, count)
+
+
 class BlockImageDiff(object):
   """Generates the diff of two block image objects.
 
@@ -222,13 +552,18 @@ class BlockImageDiff(object):
 
      ReadRangeSet(): a function that takes a RangeSet and returns the data
          contained in the image blocks of that RangeSet. The data is returned as
-         a list or tuple of strings; concatenating the elements together should
-         produce the requested data. Implementations are free to break up the
-         data into list/tuple elements in any way that is convenient.
+         a list or tuple of bytes-like objects (e.g. memoryviews);
+         concatenating the elements together should produce the requested
+         data. Implementations are free to break up the data into list/tuple
+         elements in any way that is convenient.
 
      RangeSha1(): a function that returns (as a hex string) the SHA-1 hash of
          all the data in the specified range.
 
+     PrecomputeRangeSha1s(): optional; a function that takes a list of
+         RangeSets and a thread count, and computes (and caches) the SHA-1 of
+         each RangeSet ahead of the RangeSha1() calls.
+
      TotalSha1(): a function that returns (as a hex string) the SHA-1 hash of
          all the data in the image (ie, all the blocks in the care_map minus
          clobbered_blocks, or including the clobbered blocks if
@@ -236,15 +571,20 @@ class BlockImageDiff(object):
 
   When creating a BlockImageDiff, the src image may be None, in which case the
   list of transfers produced will never read from the original image.
+
+  If patch_workers is set, the patches are computed in that many worker
+  processes instead of 'threads' threads. Each worker reopens the images by
+  their paths, so they must be picklable (see SparseImage.__getstate__()).
   """
 
   def __init__(self, tgt, src=None, threads=None, version=4,
-               disable_imgdiff=False):
+               disable_imgdiff=False, patch_workers=None):
     if threads is None:
       threads = multiprocessing.cpu_count() // 2
       if threads == 0:
         threads = 1
     self.threads = threads
+    self.patch_workers = patch_workers
     self.version = version
     self.transfers = []
     self.src_basenames = {}
@@ -377,23 +717,33 @@ class BlockImageDiff(object):
       self.imgdiff_stats.Report()
 
   def WriteTransfers(self, prefix):
-    def WriteSplitTransfers(out, style, target_blocks):
-      """Limit the size of operand in command 'new' and 'zero' to 1024 blocks.
-
-      This prevents the target size of one command from being too large; and
-      might help to avoid fsync errors on some devices."""
-
-      assert style == "new" or style == "zero"
-      blocks_limit = 1024
-      total = 0
-      while target_blocks:
-        blocks_to_write = target_blocks.first(blocks_limit)
-        out.append("%s %s\n" % (style, blocks_to_write.to_string_raw()))
-        total += blocks_to_write.size()
-        target_blocks = target_blocks.subtract(blocks_to_write)
-      return total
-
-    out = []
+    """Writes the transfer list to prefix.transfer.list.
+
+    The commands are streamed to the file (see TransferListWriter) in the same
+    pass that computes the maximum number of stashed blocks.
+    """
+    with TransferListWriter(prefix + ".transfer.list", self.version) as out:
+      max_stashed_blocks = self._WriteTransfers(out)
+
+    self._max_stashed_size = max_stashed_blocks * self.tgt.blocksize
+    OPTIONS = common.OPTIONS
+    if OPTIONS.cache_size is not None:
+      max_allowed = OPTIONS.cache_size * OPTIONS.stash_threshold
+      logger.info(
+          "max stashed blocks: %d  (%d bytes), limit: %d bytes (%.2f%%)\n",
+          max_stashed_blocks, self._max_stashed_size, max_allowed,
+          self._max_stashed_size * 100.0 / max_allowed)
+    else:
+      logger.info(
+          "max stashed blocks: %d  (%d bytes), limit: <unknown>\n",
+          max_stashed_blocks, self._max_stashed_size)
+
+  def _WriteTransfers(self, out):
+    """Writes the commands with the given TransferListWriter.
+
+    Returns:
+      The maximum number of stashed blocks.
+    """
     total = 0
 
     # In BBOTA v3+, it uses the hash of the stashed blocks as the stash slot
@@ -413,7 +763,7 @@ class BlockImageDiff(object):
           stashes[sh] = 1
           stashed_blocks += sr.size()
           self.touched_src_ranges = self.touched_src_ranges.union(sr)
-          out.append("stash %s %s\n" % (sh, sr.to_string_raw()))
+          out.Write("stash %s %s\n" % (sh, sr.to_string_raw()))
 
       if stashed_blocks > max_stashed_blocks:
         max_stashed_blocks = stashed_blocks
@@ -470,7 +820,7 @@ class BlockImageDiff(object):
 
       if xf.style == "new":
         assert xf.tgt_ranges
-        assert tgt_size == WriteSplitTransfers(out, xf.style, xf.tgt_ranges)
+        assert tgt_size == out.WriteSplit(xf.style, xf.tgt_ranges)
         total += tgt_size
       elif xf.style == "move":
         assert xf.tgt_ranges
@@ -485,7 +835,7 @@ class BlockImageDiff(object):
           self.touched_src_ranges = self.touched_src_ranges.union(
               xf.src_ranges)
 
-          out.append("%s %s %s %s\n" % (
+          out.Write("%s %s %s %s\n" % (
               xf.style,
               xf.tgt_sha1,
               xf.tgt_ranges.to_string_raw(), src_str))
@@ -501,7 +851,7 @@ class BlockImageDiff(object):
 
         self.touched_src_ranges = self.touched_src_ranges.union(xf.src_ranges)
 
-        out.append("%s %d %d %s %s %s %s\n" % (
+        out.Write("%s %d %d %s %s %s %s\n" % (
             xf.style,
             xf.patch_start, xf.patch_len,
             xf.src_sha1,
@@ -511,13 +861,13 @@ class BlockImageDiff(object):
       elif xf.style == "zero":
         assert xf.tgt_ranges
         to_zero = xf.tgt_ranges.subtract(xf.src_ranges)
-        assert WriteSplitTransfers(out, xf.style, to_zero) == to_zero.size()
+        assert out.WriteSplit(xf.style, to_zero) == to_zero.size()
         total += to_zero.size()
       else:
         raise ValueError("unknown transfer style '%s'\n" % xf.style)
 
       if free_string:
-        out.append("".join(free_string))
+        out.Write("".join(free_string))
         stashed_blocks -= free_size
 
       if common.OPTIONS.cache_size is not None:
@@ -538,7 +888,7 @@ class BlockImageDiff(object):
     self.touched_src_sha1 = self.src.RangeSha1(self.touched_src_ranges)
 
     if self.tgt.hashtree_info:
-      out.append("compute_hash_tree {} {} {} {} {}\n".format(
+      out.Write("compute_hash_tree {} {} {} {} {}\n".format(
           self.tgt.hashtree_info.hashtree_range.to_string_raw(),
           self.tgt.hashtree_info.filesystem_range.to_string_raw(),
           self.tgt.hashtree_info.hash_algorithm,
@@ -547,7 +897,7 @@ class BlockImageDiff(object):
 
     # Zero out extended blocks as a workaround for bug 20881595.
     if self.tgt.extended:
-      assert (WriteSplitTransfers(out, "zero", self.tgt.extended) ==
+      assert (out.WriteSplit("zero", self.tgt.extended) ==
               self.tgt.extended.size())
       total += self.tgt.extended.size()
 
@@ -562,35 +912,13 @@ class BlockImageDiff(object):
     new_dontcare = all_tgt_minus_extended.subtract(self.tgt.care_map)
 
     erase_first = new_dontcare.subtract(self.touched_src_ranges)
-    if erase_first:
-      out.insert(0, "erase %s\n" % (erase_first.to_string_raw(),))
 
     erase_last = new_dontcare.subtract(erase_first)
     if erase_last:
-      out.append("erase %s\n" % (erase_last.to_string_raw(),))
-
-    out.insert(0, "%d\n" % (self.version,))   # format version number
-    out.insert(1, "%d\n" % (total,))
-    # v3+: the number of stash slots is unused.
-    out.insert(2, "0\n")
-    out.insert(3, str(max_stashed_blocks) + "\n")
-
-    with open(prefix + ".transfer.list", "w") as f:
-      for i in out:
-        f.write(i)
+      out.Write("erase %s\n" % (erase_last.to_string_raw(),))
 
-    self._max_stashed_size = max_stashed_blocks * self.tgt.blocksize
-    OPTIONS = common.OPTIONS
-    if OPTIONS.cache_size is not None:
-      max_allowed = OPTIONS.cache_size * OPTIONS.stash_threshold
-      logger.info(
-          "max stashed blocks: %d  (%d bytes), limit: %d bytes (%.2f%%)\n",
-          max_stashed_blocks, self._max_stashed_size, max_allowed,
-          self._max_stashed_size * 100.0 / max_allowed)
-    else:
-      logger.info(
-          "max stashed blocks: %d  (%d bytes), limit: <unknown>\n",
-          max_stashed_blocks, self._max_stashed_size)
+    out.Finish(total, max_stashed_blocks, erase_first)
+    return max_stashed_blocks
 
   def ReviseStashSize(self, ignore_stash_limit=False):
     """ Revises the transfers to keep the stash size within the size limit.
@@ -631,6 +959,9 @@ class BlockImageDiff(object):
 
     # See the comments for 'stashes' in WriteTransfers().
     stashes = {}
+    # The SHA-1 of each stash, computed at its def point and reused at its use
+    # point.
+    stash_sha1 = {}
     stashed_blocks = 0
     new_blocks = 0
     max_stashed_blocks = 0
@@ -647,6 +978,7 @@ class BlockImageDiff(object):
         # Check the post-command stashed_blocks.
         stashed_blocks_after = stashed_blocks
         sh = self.src.RangeSha1(sr)
+        stash_sha1[stash_raw_id] = sh
         if sh not in stashes:
           stashed_blocks_after += sr.size()
 
@@ -694,8 +1026,8 @@ class BlockImageDiff(object):
         cmd.ConvertToNew()
 
       # xf.use_stash may generate free commands.
-      for _, sr in xf.use_stash:
-        sh = self.src.RangeSha1(sr)
+      for stash_raw_id, sr in xf.use_stash:
+        sh = stash_sha1[stash_raw_id]
         assert sh in stashes
         stashes[sh] -= 1
         if stashes[sh] == 0:
@@ -765,32 +1097,22 @@ class BlockImageDiff(object):
         else:
           assert False, "unknown style " + xf.style
 
-    patches = self.ComputePatchesForInputList(diff_queue, False)
-
-    offset = 0
     with open(prefix + ".patch.dat", "wb") as patch_fd:
-      for index, patch_info, _ in patches:
-        xf = self.transfers[index]
-        xf.patch_len = len(patch_info.content)
-        xf.patch_start = offset
-        offset += xf.patch_len
-        patch_fd.write(patch_info.content)
-
-        tgt_size = xf.tgt_ranges.size() * self.tgt.blocksize
-        logger.info(
-            "%10d %10d (%6.2f%%) %7s %s %s %s", xf.patch_len, tgt_size,
-            xf.patch_len * 100.0 / tgt_size, xf.style,
-            xf.tgt_name if xf.tgt_name == xf.src_name else (
-                xf.tgt_name + " (from " + xf.src_name + ")"),
-            xf.tgt_ranges, xf.src_ranges)
+      patch_writer = PatchDataWriter(patch_fd, self.transfers,
+                                     self.tgt.blocksize)
+      # ComputePatchesForInputList() consumes diff_queue.
+      patch_count = len(diff_queue)
+      self.ComputePatchesForInputList(diff_queue, False, patch_writer)
+      patch_writer.Finish(patch_count)
 
   def AssertSha1Good(self):
     """Check the SHA-1 of the src & tgt blocks in the transfer list.
 
     Double check the SHA-1 value to avoid the issue in b/71908713, where
     SparseImage.RangeSha1() messed up with the hash calculation in multi-thread
-    environment. That specific problem has been fixed by protecting the
-    underlying generator function 'SparseImage._GetRangeData()' with lock.
+    environment. That specific problem has been fixed in the underlying
+    generator function 'SparseImage._GetRangeData()', which no longer shares a
+    file position between readers.
     """
     for xf in self.transfers:
       tgt_sha1 = self.tgt.RangeSha1(xf.tgt_ranges)
@@ -878,11 +1200,10 @@ class BlockImageDiff(object):
     # using a greedy algorithm to choose which vertex goes next
     # whenever we have a choice.
 
-    # Make a copy of the edge set; this copy will get destroyed by the
-    # algorithm.
-    for xf in self.transfers:
-      xf.incoming = xf.goes_after.copy()
-      xf.outgoing = xf.goes_before.copy()
+    # Count the incoming edges of each vertex (indexed by its current order)
+    # that haven't been visited yet, instead of destroying a copy of the edge
+    # set.
+    pending = [len(xf.goes_after) for xf in self.transfers]
 
     L = []   # the new vertex order
 
@@ -890,15 +1211,15 @@ class BlockImageDiff(object):
     # the one that leaves the least amount of stashed data after it's
     # executed.
     S = [(u.NetStashChange(), u.order, u) for u in self.transfers
-         if not u.incoming]
+         if not pending[u.order]]
     heapq.heapify(S)
 
     while S:
       _, _, xf = heapq.heappop(S)
       L.append(xf)
-      for u in xf.outgoing:
-        del u.incoming[xf]
-        if not u.incoming:
+      for u in xf.goes_before:
+        pending[u.order] -= 1
+        if not pending[u.order]:
           heapq.heappush(S, (u.NetStashChange(), u.order, u))
 
     # if this fails then our graph had a cycle.
@@ -927,30 +1248,30 @@ class BlockImageDiff(object):
     stash_size = 0
 
     for xf in self.transfers:
-      for u in xf.goes_before.copy():
-        # xf should go before u
-        if xf.order < u.order:
-          # it does, hurray!
-          in_order += 1
-        else:
-          # it doesn't, boo.  modify u to stash the blocks that it
-          # writes that xf wants to read, and then require u to go
-          # before xf.
-          out_of_order += 1
-
-          overlap = xf.src_ranges.intersect(u.tgt_ranges)
-          assert overlap
-
-          u.stash_before.append((stash_raw_id, overlap))
-          xf.use_stash.append((stash_raw_id, overlap))
-          stash_raw_id += 1
-          stash_size += overlap.size()
-
-          # reverse the edge direction; now xf must go after u
-          del xf.goes_before[u]
-          del u.goes_after[xf]
-          xf.goes_after[u] = None    # value doesn't matter
-          u.goes_before[xf] = None
+      # xf should go before each u in goes_before. Only the backward edges,
+      # where it doesn't, need any work; pick them out rather than copying the
+      # whole edge set of every transfer.
+      order = xf.order
+      backward = [u for u in xf.goes_before if u.order < order]
+      in_order += len(xf.goes_before) - len(backward)
+      out_of_order += len(backward)
+
+      for u in backward:
+        # modify u to stash the blocks that it writes that xf wants to
+        # read, and then require u to go before xf.
+        overlap = xf.src_ranges.intersect(u.tgt_ranges)
+        assert overlap
+
+        u.stash_before.append((stash_raw_id, overlap))
+        xf.use_stash.append((stash_raw_id, overlap))
+        stash_raw_id += 1
+        stash_size += overlap.size()
+
+        # reverse the edge direction; now xf must go after u
+        del xf.goes_before[u]
+        del u.goes_after[xf]
+        xf.goes_after[u] = None    # value doesn't matter
+        u.goes_before[xf] = None
 
     logger.info(
         "  %d/%d dependencies (%.2f%%) were violated; %d source blocks "
@@ -972,70 +1293,87 @@ class BlockImageDiff(object):
     # we'll lose if that edge is removed; we try to minimize the total
     # weight rather than just the number of edges.
 
-    # Make a copy of the edge set; this copy will get destroyed by the
-    # algorithm.
-    for xf in self.transfers:
-      xf.incoming = xf.goes_after.copy()
-      xf.outgoing = xf.goes_before.copy()
-      xf.score = sum(xf.outgoing.values()) - sum(xf.incoming.values())
-
-    # We use an OrderedDict instead of just a set so that the output
-    # is repeatable; otherwise it would depend on the hash values of
-    # the transfer objects.
-    G = OrderedDict()
-    for xf in self.transfers:
-      G[xf] = None
+    # Work on an indexed copy of the edge set, where vertex i stands for
+    # self.transfers[i]: out_edges[i] and in_edges[i] list the (vertex, weight)
+    # pairs of its outgoing and incoming edges. Rather than deleting the edges
+    # of each vertex we take out of the graph, we count the edges that every
+    # vertex still has within the remaining graph.
+    transfers = self.transfers
+    index = {xf: i for i, xf in enumerate(transfers)}
+    out_edges = [[(index[u], w) for u, w in xf.goes_before.items()]
+                 for xf in transfers]
+    in_edges = [[(index[u], w) for u, w in xf.goes_after.items()]
+                for xf in transfers]
+    out_degree = [len(edges) for edges in out_edges]
+    in_degree = [len(edges) for edges in in_edges]
+    score = [sum(w for _, w in outgoing) - sum(w for _, w in incoming)
+             for outgoing, incoming in zip(out_edges, in_edges)]
+
+    in_graph = [True] * len(transfers)
+    remaining = len(transfers)
     s1 = deque()  # the left side of the sequence, built from left to right
     s2 = deque()  # the right side of the sequence, built from right to left
 
-    heap = []
-    for xf in self.transfers:
-      xf.heap_item = HeapItem(xf)
-      heap.append(xf.heap_item)
+    # A max-heap of (-score, vertex). A vertex whose score changes gets a new
+    # entry rather than having its old one updated in place; the stale entries
+    # (those not matching the current score, or of vertices no longer in the
+    # graph) are skipped when popped. Ties go to the lowest vertex so that the
+    # output is repeatable.
+    heap = [(-vertex_score, i) for i, vertex_score in enumerate(score)]
     heapq.heapify(heap)
 
-    # Use OrderedDict() instead of set() to preserve the insertion order. Need
-    # to use 'sinks[key] = None' to add key into the set. sinks will look like
-    # { key1: None, key2: None, ... }.
-    sinks = OrderedDict.fromkeys(u for u in G if not u.outgoing)
-    sources = OrderedDict.fromkeys(u for u in G if not u.incoming)
-
-    def adjust_score(iu, delta):
-      iu.score += delta
-      iu.heap_item.clear()
-      iu.heap_item = HeapItem(iu)
-      heapq.heappush(heap, iu.heap_item)
-
-    while G:
+    # A vertex becomes a sink (resp. source) only once, when its last
+    # outgoing (resp. incoming) edge goes away, so lists preserve the
+    # insertion order without repeats.
+    sinks = [i for i in range(len(transfers)) if not out_degree[i]]
+    sources = [i for i in range(len(transfers)) if not in_degree[i]]
+
+    def remove_outgoing(u, new_sinks):
+      # Removes the edges to u from the vertices still in the graph.
+      for iu, w in in_edges[u]:
+        if in_graph[iu]:
+          score[iu] -= w
+          heapq.heappush(heap, (-score[iu], iu))
+          out_degree[iu] -= 1
+          if not out_degree[iu]:
+            new_sinks.append(iu)
+
+    def remove_incoming(u, new_sources):
+      # Removes the edges from u to the vertices still in the graph.
+      for iu, w in out_edges[u]:
+        if in_graph[iu]:
+          score[iu] += w
+          heapq.heappush(heap, (-score[iu], iu))
+          in_degree[iu] -= 1
+          if not in_degree[iu]:
+            new_sources.append(iu)
+
+    while remaining:
       # Put all sinks at the end of the sequence.
       while sinks:
-        new_sinks = OrderedDict()
+        new_sinks = []
         for u in sinks:
-          if u not in G:
+          if not in_graph[u]:
             continue
           s2.appendleft(u)
-          del G[u]
-          for iu in u.incoming:
-            adjust_score(iu, -iu.outgoing.pop(u))
-            if not iu.outgoing:
-              new_sinks[iu] = None
+          in_graph[u] = False
+          remaining -= 1
+          remove_outgoing(u, new_sinks)
         sinks = new_sinks
 
       # Put all the sources at the beginning of the sequence.
       while sources:
-        new_sources = OrderedDict()
+        new_sources = []
         for u in sources:
-          if u not in G:
+          if not in_graph[u]:
             continue
           s1.append(u)
-          del G[u]
-          for iu in u.outgoing:
-            adjust_score(iu, +iu.incoming.pop(u))
-            if not iu.incoming:
-              new_sources[iu] = None
+          in_graph[u] = False
+          remaining -= 1
+          remove_incoming(u, new_sources)
         sources = new_sources
 
-      if not G:
+      if not remaining:
         break
 
       # Find the "best" vertex to put next.  "Best" is the one that
@@ -1043,62 +1381,34 @@ class BlockImageDiff(object):
       # pretending it's a source rather than a sink.
 
       while True:
-        u = heapq.heappop(heap)
-        if u and u.item in G:
-          u = u.item
+        neg_score, u = heapq.heappop(heap)
+        if in_graph[u] and -neg_score == score[u]:
           break
 
       s1.append(u)
-      del G[u]
-      for iu in u.outgoing:
-        adjust_score(iu, +iu.incoming.pop(u))
-        if not iu.incoming:
-          sources[iu] = None
-
-      for iu in u.incoming:
-        adjust_score(iu, -iu.outgoing.pop(u))
-        if not iu.outgoing:
-          sinks[iu] = None
+      in_graph[u] = False
+      remaining -= 1
+      remove_incoming(u, sources)
+      remove_outgoing(u, sinks)
 
     # Now record the sequence in the 'order' field of each transfer,
     # and by rearranging self.transfers to be in the chosen sequence.
 
     new_transfers = []
-    for x in itertools.chain(s1, s2):
+    for i in itertools.chain(s1, s2):
+      x = transfers[i]
       x.order = len(new_transfers)
       new_transfers.append(x)
-      del x.incoming
-      del x.outgoing
 
     self.transfers = new_transfers
 
   def GenerateDigraph(self):
     logger.info("Generating digraph...")
 
-    # Each item of source_ranges will be:
-    #   - None, if that block is not used as a source,
-    #   - an ordered set of transfers.
-    source_ranges = []
-    for b in self.transfers:
-      for s, e in b.src_ranges:
-        if e > len(source_ranges):
-          source_ranges.extend([None] * (e-len(source_ranges)))
-        for i in range(s, e):
-          if source_ranges[i] is None:
-            source_ranges[i] = OrderedDict.fromkeys([b])
-          else:
-            source_ranges[i][b] = None
+    source_ranges = SourceRangesIndex(self.transfers)
 
     for a in self.transfers:
-      intersections = OrderedDict()
-      for s, e in a.tgt_ranges:
-        for i in range(s, e):
-          if i >= len(source_ranges):
-            break
-          # Add all the Transfers in source_ranges[i] to the (ordered) set.
-          if source_ranges[i] is not None:
-            for j in source_ranges[i]:
-              intersections[j] = None
+      intersections = source_ranges.FindReaders(a.tgt_ranges)
 
       for b in intersections:
         if a is b:
@@ -1116,13 +1426,17 @@ class BlockImageDiff(object):
           b.goes_before[a] = size
           a.goes_after[b] = size
 
-  def ComputePatchesForInputList(self, diff_queue, compress_target):
+  def ComputePatchesForInputList(self, diff_queue, compress_target,
+                                 patch_writer=None):
     """Returns a list of patch information for the input list of transfers.
 
       Args:
         diff_queue: a list of transfers with style 'diff'
         compress_target: If True, compresses the target ranges of each
             transfers; and save the size.
+        patch_writer: If set, a PatchDataWriter that the patches are handed
+            to as they get computed. They're not kept in the returned list
+            then, i.e. the patch_info there is None.
 
       Returns:
         A list of (transfer order, patch_info, compressed_size) tuples.
@@ -1131,81 +1445,103 @@ class BlockImageDiff(object):
     if not diff_queue:
       return []
 
-    if self.threads > 1:
-      logger.info("Computing patches (using %d threads)...", self.threads)
-    else:
-      logger.info("Computing patches...")
-
     diff_total = len(diff_queue)
     patches = [None] * diff_total
     error_messages = []
+    worker_stats = PatchWorkerStats()
+
+    def transfer_name(xf):
+      return (xf.tgt_name if xf.tgt_name == xf.src_name else
+              xf.tgt_name + " (from " + xf.src_name + ")")
+
+    if self.patch_workers:
+      logger.info("Computing patches (using %d processes)...",
+                  self.patch_workers)
+
+      # The tasks are handed out in the same order as the threads below pop
+      # them from diff_queue.
+      tasks = []
+      for xf_index, imgdiff, patch_index in reversed(diff_queue):
+        xf = self.transfers[xf_index]
+        tasks.append((patch_index, (transfer_name(xf), xf.tgt_ranges,
+                                    xf.src_ranges, imgdiff, xf.patch_info,
+                                    compress_target)))
+        patches[patch_index] = (xf_index, None, None)
+
+      # Each worker reads, writes and compresses the range data on its own,
+      # instead of going through the shared image objects (and their locks) in
+      # this process.
+      pool = multiprocessing.Pool(
+          self.patch_workers, initializer=_InitPatchWorker,
+          initargs=(pickle.dumps((self.src, self.tgt)),))
+      try:
+        patch_cache = common.GetPatchCache()
+        for (patch_index, result, worker, elapsed,
+             cache_stats) in pool.imap_unordered(_PatchWorker, tasks):
+          # The lookups in the workers count towards the parent's stats.
+          if patch_cache and cache_stats:
+            patch_cache.AddStats(cache_stats)
+          patch_info, compressed_size, message, input_bytes = result
+          error_messages.extend(message)
+          worker_stats.Log(worker, input_bytes, elapsed)
+          xf_index = patches[patch_index][0]
+          if patch_writer and patch_info:
+            patch_writer.Add(patch_index, xf_index, patch_info)
+            patch_info = None
+          patches[patch_index] = (xf_index, patch_info, compressed_size)
+      except:
+        # Don't wait for the queued tasks after a failure.
+        pool.terminate()
+        raise
+      else:
+        pool.close()
+      finally:
+        pool.join()
+    else:
+      if self.threads > 1:
+        logger.info("Computing patches (using %d threads)...", self.threads)
+      else:
+        logger.info("Computing patches...")
+
+      # Using multiprocessing doesn't give additional benefits, due to the
+      # pattern of the code. The diffing work is done by subprocess.call, which
+      # already runs in a separate process (not affected much by the GIL -
+      # Global Interpreter Lock). Using multiprocess also requires either a)
+      # writing the diff input files in the main process before forking, or b)
+      # reopening the image file (SparseImage) in the worker processes. The
+      # latter is available with patch_workers, which mostly pays off when the
+      # reading and compression of the target data dominate.
+      lock = threading.Lock()
+
+      def diff_worker():
+        while True:
+          with lock:
+            if not diff_queue:
+              return
+            xf_index, imgdiff, patch_index = diff_queue.pop()
+            xf = self.transfers[xf_index]
 
-    # Using multiprocessing doesn't give additional benefits, due to the
-    # pattern of the code. The diffing work is done by subprocess.call, which
-    # already runs in a separate process (not affected much by the GIL -
-    # Global Interpreter Lock). Using multiprocess also requires either a)
-    # writing the diff input files in the main process before forking, or b)
-    # reopening the image file (SparseImage) in the worker processes. Doing
-    # neither of them further improves the performance.
-    lock = threading.Lock()
+          start = time.time()
+          patch_info, compressed_size, message, input_bytes = (
+              _ComputeTransferPatch(
+                  self.src, self.tgt, transfer_name(xf), xf.tgt_ranges,
+                  xf.src_ranges, imgdiff, xf.patch_info, compress_target))
 
-    def diff_worker():
-      while True:
-        with lock:
-          if not diff_queue:
-            return
-          xf_index, imgdiff, patch_index = diff_queue.pop()
-          xf = self.transfers[xf_index]
-
-        message = []
-        compressed_size = None
-
-        patch_info = xf.patch_info
-        if not patch_info:
-          src_file = common.MakeTempFile(prefix="src-")
-          with open(src_file, "wb") as fd:
-            self.src.WriteRangeDataToFd(xf.src_ranges, fd)
-
-          tgt_file = common.MakeTempFile(prefix="tgt-")
-          with open(tgt_file, "wb") as fd:
-            self.tgt.WriteRangeDataToFd(xf.tgt_ranges, fd)
-
-          try:
-            patch_info = compute_patch(src_file, tgt_file, imgdiff)
-          except ValueError as e:
-            message.append(
-                "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
-                    "imgdiff" if imgdiff else "bsdiff",
-                    xf.tgt_name if xf.tgt_name == xf.src_name else
-                    xf.tgt_name + " (from " + xf.src_name + ")",
-                    xf.tgt_ranges, xf.src_ranges, e.message))
-
-        if compress_target:
-          tgt_data = self.tgt.ReadRangeSet(xf.tgt_ranges)
-          try:
-            # Compresses with the default level
-            compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
-            compressed_data = (compress_obj.compress("".join(tgt_data))
-                               + compress_obj.flush())
-            compressed_size = len(compressed_data)
-          except zlib.error as e:
-            message.append(
-                "Failed to compress the data in target range {} for {}:\n"
-                "{}".format(xf.tgt_ranges, xf.tgt_name, e.message))
-
-        if message:
           with lock:
             error_messages.extend(message)
-
-        with lock:
-          patches[patch_index] = (xf_index, patch_info, compressed_size)
-
-    threads = [threading.Thread(target=diff_worker)
-               for _ in range(self.threads)]
-    for th in threads:
-      th.start()
-    while threads:
-      threads.pop().join()
+            worker_stats.Log(threading.current_thread().name, input_bytes,
+                             time.time() - start)
+            if patch_writer and patch_info:
+              patch_writer.Add(patch_index, xf_index, patch_info)
+              patch_info = None
+            patches[patch_index] = (xf_index, patch_info, compressed_size)
+
+      threads = [threading.Thread(target=diff_worker)
+                 for _ in range(self.threads)]
+      for th in threads:
+        th.start()
+      while threads:
+        threads.pop().join()
 
     if error_messages:
       logger.error('ERROR:')
@@ -1213,6 +1549,7 @@ class BlockImageDiff(object):
       logger.error('\n\n\n')
       sys.exit(1)
 
+    worker_stats.Report()
     return patches
 
   def SelectAndConvertDiffTransfersToNew(self, violated_stash_blocks):
@@ -1561,6 +1898,17 @@ class BlockImageDiff(object):
     assert cache_size is not None
     max_blocks_per_transfer = int(cache_size * split_threshold /
                                   self.tgt.blocksize)
+    # Most transfers use the whole-file ranges as is, so hash them in parallel
+    # up front. The split pieces are still hashed on demand.
+    for image, ranges_list in (
+        (self.tgt, [ranges for fn, ranges in self.tgt.file_map.items()
+                    if fn != "__HASHTREE"]),
+        (self.src, [ranges for fn, ranges in self.src.file_map.items()
+                    if fn in self.tgt.file_map])):
+      precompute = getattr(image, "PrecomputeRangeSha1s", None)
+      if precompute:
+        precompute(ranges_list, self.threads)
+
     empty = RangeSet()
     for tgt_fn, tgt_ranges in sorted(self.tgt.file_map.items()):
       if tgt_fn == "__ZERO":
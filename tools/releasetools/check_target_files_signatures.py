@@ -37,17 +37,45 @@ Usage:  check_target_file_signatures [flags] target_files
       Dump the certificate information for both packages in comparison
       mode (this output is normally suppressed).
 
+  --in_memory
+      Read the APK certs (from the APK Signing Block, or the v1 signature) and
+      the binary manifests straight from the zip entries in memory, instead of
+      extracting the APKs and running apksigner and aapt2 on each of them.
+
+  --apk_workers <int>
+      The number of worker processes that read the APKs with --in_memory.
+      Defaults to the number of CPUs.
+
+  --cert_db_dir <dir>
+      Keep an index of the parsed APKs (package name, sharedUserId and certs,
+      by the digest of the APK content) and of the cert subjects in this
+      directory, which is reused across runs. APKs that have been indexed
+      before, e.g. those of a previously checked release being compared
+      against, aren't parsed again.
+
+  --cert_db_size <bytes>
+      The size limit of the index in --cert_db_dir (defaults to 1 GiB). The
+      least recently used entries get evicted.
+
 """
 
 from __future__ import print_function
 
+import fnmatch
+import gzip
+import io
+import json
 import logging
+import multiprocessing
 import os
 import os.path
 import re
+import shutil
+import struct
 import subprocess
 import sys
 import zipfile
+from hashlib import sha256
 
 import common
 
@@ -80,6 +108,10 @@ OPTIONS = common.OPTIONS
 OPTIONS.text = False
 OPTIONS.compare_with = None
 OPTIONS.local_cert_dirs = ("vendor", "build")
+OPTIONS.in_memory = False
+OPTIONS.apk_workers = None
+OPTIONS.cert_db_dir = None
+OPTIONS.cert_db_size = 1 << 30
 
 PROBLEMS = []
 PROBLEM_PREFIX = []
@@ -90,6 +122,26 @@ def AddProblem(msg):
   PROBLEMS.append(" ".join(PROBLEM_PREFIX) + " " + msg)
 
 
+def TakeProblems(start, filename):
+  """Returns the problems of the file since PROBLEMS[start], without prefix.
+
+  The problems must have been added under Push(filename + ":"), on top of the
+  current prefix.
+  """
+  prefix = " ".join(PROBLEM_PREFIX + [filename + ":"]) + " "
+  return [problem[len(prefix):] for problem in PROBLEMS[start:]]
+
+
+def AddProblems(problems, filename):
+  """Adds the problems from TakeProblems() for the file (possibly renamed)."""
+  Push(filename + ":")
+  try:
+    for msg in problems:
+      PROBLEMS.append(" ".join(PROBLEM_PREFIX) + " " + msg)
+  finally:
+    Pop()
+
+
 def Push(msg):
   PROBLEM_PREFIX.append(msg)
 
@@ -153,13 +205,95 @@ class CertDB(object):
       name, _ = os.path.splitext(name)
 
       cert_sha1 = common.sha1(cert).hexdigest()
-      cert_subject = GetCertSubject(cert)
+      cert_subject = GetCachedCertSubject(cert)
       self.Add(cert_sha1, cert_subject, name)
 
 
 ALL_CERTS = CertDB()
 
 
+class ApkIndex(common.BlobCache):
+  """An on-disk index of the APKs parsed in earlier runs.
+
+  Each entry holds the package name, the sharedUserId, the cert digests (with
+  the cert subjects) and the problems found in an APK, by the SHA-256 of the
+  APK content and the way it was parsed (--in_memory or not). The problems
+  don't include the APK name, as the same APK may show up under another name.
+  The subjects of certs are kept as well, by the SHA-256 of the cert. See
+  common.BlobCache for the eviction.
+  """
+
+  DESCRIPTION = "APK index"
+  # Bump this when the format of the entries or the parsing changes.
+  VERSION = 2
+
+  def GetKey(self, data):
+    """Returns the key of the APK with the given content."""
+    return sha256(json.dumps(
+        ["apk", self.VERSION, OPTIONS.in_memory,
+         sha256(data).hexdigest()]).encode()).hexdigest()
+
+  def GetApk(self, key, filename):
+    """Returns the indexed (APK, problems) for the key, or None."""
+    blob = self.GetBlob(key)
+    if blob is None:
+      return None
+    entry = json.loads(blob.decode())
+    # Certs without a subject were named after a local cert at the time, but
+    # the local cert dirs may have changed since.
+    if any(subject is None and ALL_CERTS.Get(digest) is None
+           for digest, subject in entry["cert_subjects"].items()):
+      return None
+    apk = APK.FromIndexEntry(filename, entry)
+    for digest, subject in apk.cert_subjects.items():
+      if subject is not None:
+        ALL_CERTS.Add(digest, subject)
+    return apk, entry["problems"]
+
+  def PutApk(self, key, apk, problems):
+    """Indexes the APK (and the problems found in it) under the key."""
+    entry = {
+        "package": apk.package,
+        "shared_uid": apk.shared_uid,
+        "cert_digests": sorted(apk.cert_digests),
+        "cert_subjects": apk.cert_subjects,
+        "problems": problems,
+    }
+    self.PutBlob(key, json.dumps(entry, sort_keys=True).encode())
+
+  def GetCertSubject(self, cert):
+    """Returns the subject of a DER-encoded cert, running openssl on misses."""
+    key = sha256(json.dumps(
+        ["cert", self.VERSION, sha256(cert).hexdigest()]).encode()).hexdigest()
+    blob = self.GetBlob(key)
+    if blob is not None:
+      return blob.decode()
+    subject = GetCertSubject(cert)
+    self.PutBlob(key, subject.encode())
+    return subject
+
+
+_apk_index = None
+
+
+def GetApkIndex():
+  """Returns the ApkIndex for OPTIONS.cert_db_dir, or None if not set."""
+  global _apk_index  # pylint: disable=global-statement
+  if not OPTIONS.cert_db_dir:
+    return None
+  if _apk_index is None or _apk_index.cache_dir != OPTIONS.cert_db_dir:
+    _apk_index = ApkIndex(OPTIONS.cert_db_dir, OPTIONS.cert_db_size)
+  return _apk_index
+
+
+def GetCachedCertSubject(cert):
+  """Returns the subject of a cert, from the ApkIndex if there's one."""
+  index = GetApkIndex()
+  if index:
+    return index.GetCertSubject(cert)
+  return GetCertSubject(cert)
+
+
 def CertFromPKCS7(data, filename):
   """Read the cert out of a PKCS#7-format file (which is what is
   stored in a signed .apk)."""
@@ -186,21 +320,253 @@ def CertFromPKCS7(data, filename):
     Pop()
 
 
+APK_SIG_BLOCK_MAGIC = b"APK Sig Block 42"
+APK_SIGNATURE_SCHEME_V2_BLOCK_ID = 0x7109871a
+APK_SIGNATURE_SCHEME_V3_BLOCK_ID = 0xf05368c0
+APK_SIGNATURE_SCHEME_V31_BLOCK_ID = 0x1b93ad61
+
+
+def _ReadLengthPrefixed(buf, offset):
+  """Returns the (value, next offset) of a uint32 length-prefixed value."""
+  if offset + 4 > len(buf):
+    raise ValueError("Truncated length-prefixed value")
+  (length,) = struct.unpack_from("<I", buf, offset)
+  end = offset + 4 + length
+  if end > len(buf):
+    raise ValueError("Truncated length-prefixed value")
+  return buf[offset + 4:end], end
+
+
+def _ReadLengthPrefixedSequence(buf):
+  """Yields the values of a sequence of length-prefixed values."""
+  offset = 0
+  while offset < len(buf):
+    value, offset = _ReadLengthPrefixed(buf, offset)
+    yield value
+
+
+def GetApkSignerCerts(data):
+  """Returns the certificates of the signers of an APK.
+
+  The certificates are read from the APK Signature Scheme v3.1/v3 blocks, or
+  the v2 block, of the APK Signing Block that precedes the ZIP Central
+  Directory. Same as apksigner, only the first certificate (i.e. the signing
+  one) of each signer is returned.
+
+  Args:
+    data: The content of the APK.
+
+  Returns:
+    A list of DER-encoded certificates, or None if the APK isn't signed with
+    APK Signature Scheme v2 or later.
+
+  Raises:
+    ValueError: On malformed input.
+  """
+  # The End of Central Directory record is at the end, unless there's a
+  # comment of up to 64KiB.
+  eocd = data.rfind(b"PK\x05\x06", max(0, len(data) - 65535 - 22))
+  if eocd < 0 or eocd + 22 > len(data):
+    raise ValueError("Failed to find the ZIP End of Central Directory")
+  (cd_offset,) = struct.unpack_from("<I", data, eocd + 16)
+  if (cd_offset < 32 or cd_offset > eocd or
+      data[cd_offset - 16:cd_offset] != APK_SIG_BLOCK_MAGIC):
+    return None
+
+  # The block starts and ends with its size (excluding the first size field).
+  (block_size,) = struct.unpack_from("<Q", data, cd_offset - 24)
+  block_start = cd_offset - block_size - 8
+  if (block_start < 0 or
+      struct.unpack_from("<Q", data, block_start)[0] != block_size):
+    raise ValueError("Invalid APK Signing Block size")
+
+  # The block holds a sequence of uint64 length-prefixed (uint32 ID, value)
+  # pairs.
+  blocks = {}
+  offset = block_start + 8
+  end = cd_offset - 24
+  while offset < end:
+    length, block_id = struct.unpack_from("<QI", data, offset)
+    if length < 4 or offset + 8 + length > end:
+      raise ValueError("Invalid APK Signing Block entry")
+    blocks[block_id] = memoryview(data)[offset + 12:offset + 8 + length]
+    offset += 8 + length
+
+  if (APK_SIGNATURE_SCHEME_V31_BLOCK_ID in blocks or
+      APK_SIGNATURE_SCHEME_V3_BLOCK_ID in blocks):
+    block_ids = (APK_SIGNATURE_SCHEME_V31_BLOCK_ID,
+                 APK_SIGNATURE_SCHEME_V3_BLOCK_ID)
+  elif APK_SIGNATURE_SCHEME_V2_BLOCK_ID in blocks:
+    block_ids = (APK_SIGNATURE_SCHEME_V2_BLOCK_ID,)
+  else:
+    return None
+
+  certs = []
+  for block_id in block_ids:
+    if block_id not in blocks:
+      continue
+    signers, _ = _ReadLengthPrefixed(blocks[block_id], 0)
+    for signer in _ReadLengthPrefixedSequence(signers):
+      # signer: signed data, (v3: min/max SDK versions,) signatures, public
+      # key. signed data: digests, certificates, ...
+      signed_data, _ = _ReadLengthPrefixed(signer, 0)
+      _, offset = _ReadLengthPrefixed(signed_data, 0)
+      signer_certs, _ = _ReadLengthPrefixed(signed_data, offset)
+      for cert in _ReadLengthPrefixedSequence(signer_certs):
+        cert = bytes(cert)
+        if cert not in certs:
+          certs.append(cert)
+        break
+  return certs
+
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+# The resource ID of android:sharedUserId.
+SHARED_USER_ID_ATTR = 0x0101000b
+
+
+def _ReadStringPool(data, offset, header_size):
+  """Returns a function that decodes the strings of a ResStringPool chunk."""
+  string_count, _, flags, strings_start = struct.unpack_from(
+      "<4I", data, offset + 8)
+  string_offsets = struct.unpack_from(
+      "<%dI" % string_count, data, offset + header_size)
+  strings_start += offset
+  is_utf8 = flags & (1 << 8)
+
+  def GetString(index):
+    if index >= string_count:
+      return None
+    pos = strings_start + string_offsets[index]
+    if is_utf8:
+      # The UTF-16 length, then the UTF-8 length, both in 1 or 2 bytes.
+      for _ in range(2):
+        length = data[pos]
+        if length & 0x80:
+          length = ((length & 0x7f) << 8) | data[pos + 1]
+          pos += 2
+        else:
+          pos += 1
+      return bytes(data[pos:pos + length]).decode("utf-8")
+    (length,) = struct.unpack_from("<H", data, pos)
+    pos += 2
+    if length & 0x8000:
+      length = ((length & 0x7fff) << 16) | struct.unpack_from(
+          "<H", data, pos)[0]
+      pos += 2
+    return bytes(data[pos:pos + length * 2]).decode("utf-16-le")
+
+  return GetString
+
+
+def ParseBinaryManifest(data):
+  """Returns the package name and the sharedUserId of a binary manifest.
+
+  Args:
+    data: The content of the compiled AndroidManifest.xml in an APK.
+
+  Returns:
+    A tuple of (package, shared_uid), where either may be None if the
+    <manifest> element doesn't have the attribute (as a raw string).
+
+  Raises:
+    ValueError: On malformed input.
+  """
+  try:
+    chunk_type, header_size, _ = struct.unpack_from("<HHI", data, 0)
+    if chunk_type != RES_XML_TYPE:
+      raise ValueError("Not a binary XML file")
+
+    get_string = lambda index: None
+    resource_ids = ()
+    offset = header_size
+    while offset + 8 <= len(data):
+      chunk_type, header_size, chunk_size = struct.unpack_from(
+          "<HHI", data, offset)
+      if chunk_size < 8 or offset + chunk_size > len(data):
+        raise ValueError("Invalid chunk size")
+
+      if chunk_type == RES_STRING_POOL_TYPE:
+        get_string = _ReadStringPool(data, offset, header_size)
+      elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+        resource_ids = struct.unpack_from(
+            "<%dI" % ((chunk_size - header_size) // 4), data,
+            offset + header_size)
+      elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+        # The first element is <manifest>.
+        ext = offset + header_size
+        _, _, attr_start, attr_size, attr_count = struct.unpack_from(
+            "<IIHHH", data, ext)
+        package = None
+        shared_uid = None
+        for i in range(attr_count):
+          attr_ns, attr_name, raw_value = struct.unpack_from(
+              "<3I", data, ext + attr_start + i * attr_size)
+          value = get_string(raw_value) if raw_value != 0xffffffff else None
+          if attr_name < len(resource_ids):
+            if resource_ids[attr_name] == SHARED_USER_ID_ATTR:
+              shared_uid = value
+          elif (get_string(attr_ns) == ANDROID_NS and
+                get_string(attr_name) == "sharedUserId"):
+            shared_uid = value
+          elif attr_ns == 0xffffffff and get_string(attr_name) == "package":
+            package = value
+        return package, shared_uid
+
+      offset += chunk_size
+  except (struct.error, IndexError, UnicodeDecodeError) as e:
+    raise ValueError("Malformed binary XML: {}".format(e))
+
+  raise ValueError("Failed to find the <manifest> element")
+
+
 class APK(object):
 
-  def __init__(self, full_filename, filename):
+  def __init__(self, full_filename, filename, data=None):
+    """Reads the certs and the manifest of an APK.
+
+    Args:
+      full_filename: The path to the APK, which is read with external tools.
+      filename: The name of the APK to display.
+      data: The content of the APK. If given, the certs and the manifest are
+          parsed from it in memory instead, and full_filename is ignored.
+    """
     self.filename = filename
     self.cert_digests = frozenset()
     self.shared_uid = None
     self.package = None
+    # The subjects of the certs, by digest. When reading 'data', the subjects
+    # of the certs already known to ALL_CERTS aren't looked up (and are None),
+    # while the caller adds the others to ALL_CERTS, as the APK may be read in
+    # a worker process.
+    self.cert_subjects = {}
 
     Push(filename+":")
     try:
-      self.RecordCerts(full_filename)
-      self.ReadManifest(full_filename)
+      if data is None:
+        self.RecordCerts(full_filename)
+        self.ReadManifest(full_filename)
+      else:
+        self.RecordCertsFromData(data)
+        self.ReadManifestFromData(data)
     finally:
       Pop()
 
+  @classmethod
+  def FromIndexEntry(cls, filename, entry):
+    """Returns an APK with the info of an ApkIndex entry, without parsing."""
+    apk = cls.__new__(cls)
+    apk.filename = filename
+    apk.cert_digests = frozenset(entry["cert_digests"])
+    apk.shared_uid = entry["shared_uid"]
+    apk.package = entry["package"]
+    apk.cert_subjects = entry["cert_subjects"]
+    return apk
+
   def ReadCertsDeprecated(self, full_filename):
     print("reading certs in deprecated way for {}".format(full_filename))
     cert_digests = set()
@@ -214,8 +580,9 @@ class APK(object):
           if not cert:
             continue
           cert_sha1 = common.sha1(cert).hexdigest()
-          cert_subject = GetCertSubject(cert)
+          cert_subject = GetCachedCertSubject(cert)
           ALL_CERTS.Add(cert_sha1, cert_subject)
+          self.cert_subjects[cert_sha1] = cert_subject
           cert_digests.add(cert_sha1)
     if not cert_digests:
       AddProblem("No signature found")
@@ -263,9 +630,57 @@ class APK(object):
         AddProblem("Failed to parse cert subject or digest")
         return
       ALL_CERTS.Add(digest, subject)
+      self.cert_subjects[digest] = subject
       cert_digests.add(digest)
     self.cert_digests = frozenset(cert_digests)
 
+  def RecordCertsFromData(self, data):
+    """Parses and saves the signature of an APK in memory."""
+    try:
+      certs = GetApkSignerCerts(data)
+    except ValueError as e:
+      AddProblem("Failed to parse the APK Signing Block: {}".format(e))
+      return
+
+    # Not signed with APK Signature Scheme v2+; read the v1 signature.
+    if certs is None:
+      certs = []
+      with zipfile.ZipFile(io.BytesIO(data)) as apk:
+        for info in apk.infolist():
+          filename = info.filename
+          if (filename.startswith("META-INF/") and
+                  filename.endswith((".DSA", ".RSA"))):
+            cert = CertFromPKCS7(apk.read(filename), filename)
+            if cert:
+              certs.append(cert)
+
+    if not certs:
+      AddProblem("No signature found")
+      return
+
+    cert_digests = set()
+    for cert in certs:
+      cert_sha1 = common.sha1(cert).hexdigest()
+      if cert_sha1 not in self.cert_subjects:
+        self.cert_subjects[cert_sha1] = (
+            GetCachedCertSubject(cert)
+            if ALL_CERTS.Get(cert_sha1) is None else None)
+      cert_digests.add(cert_sha1)
+    self.cert_digests = frozenset(cert_digests)
+
+  def ReadManifestFromData(self, data):
+    """Reads the package name and sharedUserId from the binary manifest."""
+    try:
+      with zipfile.ZipFile(io.BytesIO(data)) as apk:
+        manifest = apk.read("AndroidManifest.xml")
+      self.package, self.shared_uid = ParseBinaryManifest(manifest)
+    except (KeyError, ValueError, zipfile.BadZipfile):
+      AddProblem("failed to read manifest " + self.filename)
+      return
+
+    if self.package is None:
+      AddProblem("no package declaration " + self.filename)
+
   def ReadManifest(self, full_filename):
     p = common.Run(["aapt2", "dump", "xmltree", full_filename, "--file",
                     "AndroidManifest.xml"],
@@ -296,6 +711,46 @@ class APK(object):
       AddProblem("no package declaration " + full_filename)
 
 
+# The target-files opened by each APK worker process.
+_apk_worker_target_files = None
+
+
+def _InitApkWorker(path):
+  global _apk_worker_target_files  # pylint: disable=global-statement
+  # Don't inherit (and later delete) the temp files of the parent process.
+  OPTIONS.tempfiles = []
+  _apk_worker_target_files = common.TargetFiles(path)
+
+
+def _ReadApkInMemory(task):
+  """Reads an APK from the target-files in an APK worker process.
+
+  Returns:
+    A tuple of (APK, problems, indexed), where the problems are as returned by
+    TakeProblems(), and 'indexed' tells whether the APK was found in the
+    ApkIndex.
+  """
+  name, displayname, compressed_extension = task
+  del PROBLEMS[:]
+  del PROBLEM_PREFIX[:]
+  data = _apk_worker_target_files.read(name)
+  if compressed_extension and name.endswith(compressed_extension):
+    data = gzip.decompress(data)
+
+  index = GetApkIndex()
+  if index:
+    key = index.GetKey(data)
+    indexed = index.GetApk(key, displayname)
+    if indexed:
+      return indexed + (True,)
+
+  apk = APK(None, displayname, data=data)
+  problems = TakeProblems(0, displayname)
+  if index:
+    index.PutApk(key, apk, problems)
+  return apk, problems, False
+
+
 class TargetFiles(object):
   def __init__(self):
     self.max_pkg_len = 30
@@ -312,41 +767,116 @@ class TargetFiles(object):
     # This is the list of wildcards of files we extract from |filename|.
     apk_extensions = ['*.apk', '*.apex']
 
-    with zipfile.ZipFile(filename) as input_zip:
-      self.certmap, compressed_extension = common.ReadApkCerts(input_zip)
+    # Only the APKs get extracted, one by one, from the shared archive.
+    target_files = common.TargetFiles(filename)
+    self.certmap, compressed_extension = common.ReadApkCerts(target_files)
     if compressed_extension:
       apk_extensions.append('*.apk' + compressed_extension)
 
-    d = common.UnzipTemp(filename, apk_extensions)
     self.apks = {}
     self.apks_by_basename = {}
-    for dirpath, _, filenames in os.walk(d):
-      for fn in filenames:
-        # Decompress compressed APKs before we begin processing them.
-        if compressed_extension and fn.endswith(compressed_extension):
-          # First strip the compressed extension from the file.
-          uncompressed_fn = fn[:-len(compressed_extension)]
-
-          # Decompress the compressed file to the output file.
-          common.Gunzip(os.path.join(dirpath, fn),
-                        os.path.join(dirpath, uncompressed_fn))
-
-          # Finally, delete the compressed file and use the uncompressed file
-          # for further processing. Note that the deletion is not strictly
-          # required, but is done here to ensure that we're not using too much
-          # space in the temporary directory.
-          os.remove(os.path.join(dirpath, fn))
-          fn = uncompressed_fn
-
-        if fn.endswith(('.apk', '.apex')):
-          fullname = os.path.join(dirpath, fn)
-          displayname = fullname[len(d)+1:]
-          apk = APK(fullname, displayname)
-          self.apks[apk.filename] = apk
-          self.apks_by_basename[os.path.basename(apk.filename)] = apk
-          if apk.package:
-            self.max_pkg_len = max(self.max_pkg_len, len(apk.package))
-          self.max_fn_len = max(self.max_fn_len, len(apk.filename))
+    if OPTIONS.in_memory:
+      names = target_files.namelist()
+      target_files.close()
+      self._LoadApksInMemory(filename, names, apk_extensions,
+                             compressed_extension)
+      return
+
+    index = GetApkIndex()
+    d = common.MakeTempDir(prefix="targetfiles-")
+    for name in sorted(target_files.namelist()):
+      if not any(fnmatch.fnmatch(name, ext) for ext in apk_extensions):
+        continue
+      fullname = os.path.join(d, *name.split('/'))
+      compressed = compressed_extension and name.endswith(compressed_extension)
+      if compressed:
+        fullname = fullname[:-len(compressed_extension)]
+      displayname = fullname[len(d)+1:]
+
+      # With an index, the APKs are read into memory to look them up, and only
+      # extracted if they haven't been indexed.
+      if index:
+        data = target_files.read(name)
+        if compressed:
+          data = gzip.decompress(data)
+        key = index.GetKey(data)
+        indexed = index.GetApk(key, displayname)
+        if indexed:
+          apk, problems = indexed
+          AddProblems(problems, displayname)
+          self._AddApk(apk)
+          continue
+
+      if not os.path.isdir(os.path.dirname(fullname)):
+        os.makedirs(os.path.dirname(fullname))
+
+      # Decompress compressed APKs before we begin processing them, straight
+      # from the archive.
+      if index:
+        with open(fullname, 'wb') as out_file:
+          out_file.write(data)
+      elif compressed:
+        with target_files.open(name) as compressed_file, \
+            gzip.open(compressed_file, 'rb') as in_file, \
+            open(fullname, 'wb') as out_file:
+          shutil.copyfileobj(in_file, out_file)
+      else:
+        with target_files.open(name) as in_file, \
+            open(fullname, 'wb') as out_file:
+          shutil.copyfileobj(in_file, out_file)
+
+      if fullname.endswith(('.apk', '.apex')):
+        start = len(PROBLEMS)
+        apk = APK(fullname, displayname)
+        if index:
+          index.PutApk(key, apk, TakeProblems(start, displayname))
+        self._AddApk(apk)
+    target_files.close()
+
+  def _LoadApksInMemory(self, filename, names, apk_extensions,
+                        compressed_extension):
+    """Reads the APKs straight from the target-files, in worker processes."""
+    tasks = []
+    for name in sorted(names):
+      if not any(fnmatch.fnmatch(name, ext) for ext in apk_extensions):
+        continue
+      displayname = os.path.join(*name.split('/'))
+      if compressed_extension and name.endswith(compressed_extension):
+        displayname = displayname[:-len(compressed_extension)]
+      if displayname.endswith(('.apk', '.apex')):
+        tasks.append((name, displayname, compressed_extension))
+
+    index = GetApkIndex()
+    workers = OPTIONS.apk_workers or multiprocessing.cpu_count()
+    logger.info("Reading %d APKs in memory with %d workers", len(tasks),
+                workers)
+    pool = multiprocessing.get_context("fork").Pool(
+        workers, initializer=_InitApkWorker, initargs=(filename,))
+    try:
+      # Keep the order of the APKs, as in LoadZipFile().
+      for apk, problems, indexed in pool.imap(
+          _ReadApkInMemory, tasks, chunksize=4):
+        AddProblems(problems, apk.filename)
+        for digest, subject in apk.cert_subjects.items():
+          if subject is not None:
+            ALL_CERTS.Add(digest, subject)
+        # The lookups were made in the workers; count them here.
+        if index:
+          if indexed:
+            index.hits += 1
+          else:
+            index.misses += 1
+        self._AddApk(apk)
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def _AddApk(self, apk):
+    self.apks[apk.filename] = apk
+    self.apks_by_basename[os.path.basename(apk.filename)] = apk
+    if apk.package:
+      self.max_pkg_len = max(self.max_pkg_len, len(apk.package))
+    self.max_fn_len = max(self.max_fn_len, len(apk.filename))
 
   def CheckSharedUids(self):
     """Look for any instances where packages signed with different
@@ -481,6 +1011,22 @@ def main(argv):
       OPTIONS.local_cert_dirs = [i.strip() for i in a.split(",")]
     elif o in ("-t", "--text"):
       OPTIONS.text = True
+    elif o == "--in_memory":
+      OPTIONS.in_memory = True
+    elif o == "--apk_workers":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.apk_workers = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
+    elif o == "--cert_db_dir":
+      OPTIONS.cert_db_dir = a
+    elif o == "--cert_db_size":
+      if a.isdigit():
+        OPTIONS.cert_db_size = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
     else:
       return False
     return True
@@ -488,7 +1034,11 @@ def main(argv):
   args = common.ParseOptions(argv, __doc__,
                              extra_opts="c:l:t",
                              extra_long_opts=["compare_with=",
-                                              "local_cert_dirs="],
+                                              "local_cert_dirs=",
+                                              "in_memory",
+                                              "apk_workers=",
+                                              "cert_db_dir=",
+                                              "cert_db_size="],
                              extra_option_handler=option_handler)
 
   if len(args) != 1:
@@ -515,6 +1065,10 @@ def main(argv):
     finally:
       Pop()
 
+  index = GetApkIndex()
+  if index:
+    index.Report()
+
   if OPTIONS.text or not compare_files:
     Banner("target files")
     target_files.PrintCerts()
@@ -32,12 +32,15 @@ import platform
 import re
 import shlex
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1, sha256
 
 import images
@@ -73,6 +76,9 @@ class Options(object):
         self.search_path = os.environ["ANDROID_HOST_OUT"]
     self.signapk_shared_library_path = "lib64"   # Relative to search_path
     self.extra_signapk_args = []
+    # If set, sign files with long-lived signapk.jar processes (see
+    # SignApkServer) instead of starting one per file.
+    self.signapk_server = False
     self.aapt2_path = "aapt2"
     self.java_path = "java"  # Use the one on the path by default.
     self.java_args = ["-Xmx2048m"]  # The default JVM args.
@@ -92,6 +98,27 @@ class Options(object):
     self.source_info_dict = None
     self.target_info_dict = None
     self.worker_threads = None
+    # If set, compute block-based patches in that many worker processes
+    # instead of worker_threads threads.
+    self.patch_workers = None
+    # If set, compute the BlockDifferences of non-A/B OTAs for that many
+    # partitions concurrently, in separate processes.
+    self.partition_workers = None
+    # If set, deflate the new data of non-A/B block-based OTAs on that many
+    # threads (see ParallelDeflater), instead of brotli for full OTAs.
+    self.new_data_compression_threads = None
+    # If set, bsdiff/imgdiff results are cached in that directory (see
+    # PatchCache), which is trimmed to patch_cache_size bytes.
+    self.patch_cache_dir = None
+    self.patch_cache_size = 16 * (1 << 30)
+    # The time limit (in seconds) of each bsdiff/imgdiff run, and the estimated
+    # memory the concurrent runs may use (see DiffScheduler). The latter
+    # defaults to most of the available memory.
+    self.diff_timeout = 300
+    self.diff_memory_budget = None
+    # If set, the stats of all the ComputeDifferences() calls are written to
+    # that file as JSON.
+    self.diff_stats_file = None
     # Stash size cannot exceed cache_size * threshold.
     self.cache_size = None
     self.stash_threshold = 0.8
@@ -692,8 +719,8 @@ class BuildInfo(object):
 
 
 def ReadFromInputFile(input_file, fn):
-  """Reads the contents of fn from input zipfile or directory."""
-  if isinstance(input_file, zipfile.ZipFile):
+  """Reads the contents of fn from input zipfile, TargetFiles or directory."""
+  if isinstance(input_file, (zipfile.ZipFile, TargetFiles)):
     return input_file.read(fn).decode()
   else:
     path = os.path.join(input_file, *fn.split("/"))
@@ -707,6 +734,8 @@ def ReadFromInputFile(input_file, fn):
 
 def ExtractFromInputFile(input_file, fn):
   """Extracts the contents of fn from input zipfile or directory into a file."""
+  if isinstance(input_file, TargetFiles):
+    return input_file.Extract(fn)
   if isinstance(input_file, zipfile.ZipFile):
     tmp_file = MakeTempFile(os.path.basename(fn))
     with open(tmp_file, 'wb') as f:
@@ -2074,6 +2103,139 @@ def UnzipTemp(filename, patterns=None):
   return tmp
 
 
+class TargetFiles(object):
+  """Lazy access to the entries of a target-files package.
+
+  Unlike UnzipTemp(), which unpacks (all or part of) the package upfront, a
+  TargetFiles serves the entries from a single open zip file as they get read.
+  Tools that need a path to an entry (e.g. to pass it to an external tool) can
+  call Extract(), which unpacks just that entry, once, into a temp dir.
+
+  An already extracted target-files directory is supported as well, in which
+  case the files are used in place.
+
+  Instances can be shared between threads.
+  """
+
+  def __init__(self, path):
+    """Initializes a TargetFiles.
+
+    Args:
+      path: The target-files zip file, or the directory it's extracted into.
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    self._extracted = {}
+    self._extract_dir = None
+    if os.path.isdir(path):
+      self._zip = None
+      self._dir = path
+    else:
+      self._zip = zipfile.ZipFile(path, allowZip64=True)
+      self._dir = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._zip:
+      self._zip.close()
+      self._zip = None
+
+  @property
+  def zip_file(self):
+    """The underlying ZipFile, or None for an extracted directory."""
+    return self._zip
+
+  def _GetPath(self, name):
+    return os.path.join(self._dir, *name.split("/"))
+
+  def namelist(self):
+    """Returns the names of all the entries, in the zip file format."""
+    if self._zip:
+      return self._zip.namelist()
+    names = []
+    for dirpath, _, filenames in os.walk(self._dir):
+      for fn in filenames:
+        names.append(os.path.relpath(
+            os.path.join(dirpath, fn), self._dir).replace(os.sep, "/"))
+    return names
+
+  def __contains__(self, name):
+    if self._zip:
+      try:
+        self._zip.getinfo(name)
+      except KeyError:
+        return False
+      return True
+    return os.path.isfile(self._GetPath(name))
+
+  def open(self, name):
+    """Opens the given entry for reading (in binary mode).
+
+    Raises:
+      KeyError: If the entry doesn't exist.
+    """
+    if self._zip:
+      return self._zip.open(name)
+    path = self._GetPath(name)
+    if not os.path.isfile(path):
+      raise KeyError(name)
+    return open(path, "rb")
+
+  def read(self, name):
+    """Returns the content of the given entry as bytes."""
+    with self.open(name) as f:
+      return f.read()
+
+  def Extract(self, name):
+    """Returns the path to a file with the content of the given entry.
+
+    The entries of a zip file are extracted at most once, into a temp dir that
+    follows the target-files layout, and are removed by Cleanup().
+
+    Raises:
+      KeyError: If the entry doesn't exist.
+    """
+    if not self._zip:
+      if name not in self:
+        raise KeyError(name)
+      return self._GetPath(name)
+
+    with self._lock:
+      path = self._extracted.get(name)
+      if path:
+        return path
+      if not self._extract_dir:
+        self._extract_dir = MakeTempDir(prefix="targetfiles-")
+      path = self._zip.extract(name, self._extract_dir)
+      self._extracted[name] = path
+      return path
+
+  def ExtractAll(self, patterns=None):
+    """Extracts the entries that match any of the patterns (or all entries).
+
+    Returns:
+      The directory that holds the extracted entries, laid out as in the
+      target-files. For an extracted directory, that's the directory itself.
+    """
+    if not self._zip:
+      return self._dir
+    for name in self.namelist():
+      if name.endswith("/"):
+        continue
+      if patterns is None or any(
+          fnmatch.fnmatch(name, pattern) for pattern in patterns):
+        self.Extract(name)
+    with self._lock:
+      if not self._extract_dir:
+        self._extract_dir = MakeTempDir(prefix="targetfiles-")
+      return self._extract_dir
+
+
 def GetUserImage(which, tmpdir, input_zip,
                  info_dict=None,
                  allow_shared_blocks=None,
@@ -2184,6 +2346,7 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
   # block.map may contain less blocks, because mke2fs may skip allocating blocks
   # if they contain all zeros. We can't reconstruct such a file from its block
   # list. Tag such entries accordingly. (Bug: 65213616)
+  namelist = set(input_zip.namelist())
   for entry in image.file_map:
     # Skip artificial names, such as "__ZERO", "__NONZERO-1".
     if not entry.startswith('/'):
@@ -2201,7 +2364,7 @@ def GetSparseImage(which, tmpdir, input_zip, allow_shared_blocks,
     else:
       arcname = arcname.replace(which, which.upper(), 1)
 
-    assert arcname in input_zip.namelist(), \
+    assert arcname in namelist, \
         "Failed to find the ZIP entry for {}".format(entry)
 
     info = input_zip.getinfo(arcname)
@@ -2368,12 +2531,12 @@ def SignFile(input_name, output_name, key, password, min_api_level=None,
   java_library_path = os.path.join(
       OPTIONS.search_path, OPTIONS.signapk_shared_library_path)
 
-  cmd = ([OPTIONS.java_path] + OPTIONS.java_args +
-         ["-Djava.library.path=" + java_library_path,
-          "-jar", os.path.join(OPTIONS.search_path, OPTIONS.signapk_path)] +
-         extra_signapk_args)
+  jvm_cmd = ([OPTIONS.java_path] + OPTIONS.java_args +
+             ["-Djava.library.path=" + java_library_path,
+              "-jar", os.path.join(OPTIONS.search_path, OPTIONS.signapk_path)])
+  signapk_args = list(extra_signapk_args)
   if whole_file:
-    cmd.append("-w")
+    signapk_args.append("-w")
 
   min_sdk_version = min_api_level
   if min_sdk_version is None:
@@ -2381,20 +2544,159 @@ def SignFile(input_name, output_name, key, password, min_api_level=None,
       min_sdk_version = GetMinSdkVersionInt(
           input_name, codename_to_api_level_map)
   if min_sdk_version is not None:
-    cmd.extend(["--min-sdk-version", str(min_sdk_version)])
-
-  cmd.extend([key + OPTIONS.public_key_suffix,
-              key + OPTIONS.private_key_suffix,
-              input_name, output_name])
-
-  proc = Run(cmd, stdin=subprocess.PIPE)
-  if password is not None:
-    password += "\n"
-  stdoutdata, _ = proc.communicate(password)
-  if proc.returncode != 0:
+    signapk_args.extend(["--min-sdk-version", str(min_sdk_version)])
+
+  signapk_args.extend([key + OPTIONS.public_key_suffix,
+                       key + OPTIONS.private_key_suffix,
+                       input_name, output_name])
+
+  result = None
+  if OPTIONS.signapk_server:
+    result = SignApkServer.SignWithServer(jvm_cmd, signapk_args, password)
+  if result is None:
+    proc = Run(jvm_cmd + signapk_args, stdin=subprocess.PIPE)
+    if password is not None:
+      password += "\n"
+    stdoutdata, _ = proc.communicate(password)
+    result = (proc.returncode, stdoutdata)
+
+  returncode, stdoutdata = result
+  if returncode != 0:
     raise ExternalError(
         "Failed to run signapk.jar: return code {}:\n{}".format(
-            proc.returncode, stdoutdata))
+            returncode, stdoutdata))
+
+
+class SignApkServer(object):
+  """A long-lived signapk.jar process that signs files on request.
+
+  Starting a JVM and loading the keys dominate the time to sign a small APK.
+  'signapk.jar --server' instead signs the files it's asked to on stdin, and
+  keeps the parsed keys around. See SignApk.runServer() for the protocol.
+
+  A server handles one request at a time. SignWithServer() keeps a pool of
+  idle servers for each JVM command line, and starts a new one when all of
+  them are busy, so that concurrent callers (e.g. sign_target_files_apks with
+  --signing_jobs) sign in parallel. The servers are stopped by Cleanup().
+
+  A signapk.jar that doesn't support --server exits right away with its usage
+  error; SignWithServer() then returns None and the caller falls back to running
+  signapk.jar per file. A server that fails otherwise is only dropped.
+  """
+
+  # signapk.jar's exit status when it doesn't recognize its arguments.
+  USAGE_EXIT_STATUS = 2
+
+  _lock = threading.Lock()
+  _idle_servers = collections.defaultdict(list)
+  _all_servers = []
+  _unsupported = set()
+
+  def __init__(self, jvm_cmd):
+    self.jvm_cmd = tuple(jvm_cmd)
+    self._proc = Run(list(jvm_cmd) + ["--server"], stdin=subprocess.PIPE,
+                     stdout=subprocess.PIPE, universal_newlines=False)
+    self.served = 0
+
+  def Sign(self, signapk_args, password):
+    """Sends a signing request to the server.
+
+    Returns:
+      A tuple of (returncode, output) of the request, as if signapk.jar was run
+      with signapk_args.
+
+    Raises:
+      ExternalError: If the server is gone.
+    """
+    fields = ["-" if password is None else "+" + password] + signapk_args
+    request = "\0".join(fields) + "\n"
+    try:
+      self._proc.stdin.write(request.encode())
+      self._proc.stdin.flush()
+      header = self._proc.stdout.readline().split()
+      returncode, length = int(header[0]), int(header[1])
+      output = self._proc.stdout.read(length)
+    except (OSError, ValueError, IndexError) as e:
+      raise ExternalError("signapk server exited: {}".format(e))
+    if len(output) != length:
+      raise ExternalError("signapk server exited")
+    self.served += 1
+    return returncode, output.decode(errors="replace")
+
+  def Stop(self):
+    """Stops the server, which exits at the end of its requests.
+
+    Returns:
+      The exit status of the server.
+    """
+    try:
+      self._proc.stdin.close()
+    except OSError:
+      pass
+    return self._proc.wait()
+
+  @classmethod
+  def SignWithServer(cls, jvm_cmd, signapk_args, password):
+    """Signs a file with an idle server for the given JVM command line.
+
+    Returns:
+      A tuple of (returncode, output) as in Sign(), or None if the request
+      can't be served by a server, in which case the caller should run
+      signapk.jar itself.
+    """
+    # The requests are NUL-separated lines, which the server reads with
+    # BufferedReader.readLine() that also ends a line at '\r'.
+    fields = signapk_args + ([password] if password is not None else [])
+    if any(c in field for field in fields for c in "\0\n\r"):
+      return None
+
+    key = tuple(jvm_cmd)
+    with cls._lock:
+      if key in cls._unsupported:
+        return None
+      idle_servers = cls._idle_servers[key]
+      server = idle_servers.pop() if idle_servers else None
+
+    if server is None:
+      server = cls(jvm_cmd)
+      with cls._lock:
+        cls._all_servers.append(server)
+
+    try:
+      result = server.Sign(signapk_args, password)
+    except ExternalError as e:
+      # Only a signapk.jar that rejects --server makes the later requests skip
+      # the server; other failures (e.g. a crashed JVM) just drop this one.
+      unsupported = (server.Stop() == cls.USAGE_EXIT_STATUS and
+                     server.served == 0)
+      with cls._lock:
+        cls._all_servers.remove(server)
+        if unsupported:
+          cls._unsupported.add(key)
+      if unsupported:
+        logger.warning(
+            "signapk.jar doesn't support --server; running it per file "
+            "instead")
+      else:
+        logger.warning(
+            "Failed to sign with signapk server (%s); running signapk.jar for "
+            "this file instead", e)
+      return None
+
+    with cls._lock:
+      idle_servers.append(server)
+    return result
+
+  @classmethod
+  def StopAll(cls):
+    """Stops all the servers."""
+    with cls._lock:
+      servers = cls._all_servers[:]
+      del cls._all_servers[:]
+      cls._idle_servers.clear()
+      cls._unsupported.clear()
+    for server in servers:
+      server.Stop()
 
 
 def CheckSize(data, target, info_dict):
@@ -2458,7 +2760,7 @@ def ReadApkCerts(tf_zip):
   (e.g ".gz", ".bro").
 
   Args:
-    tf_zip: The input target_files ZipFile (already open).
+    tf_zip: The input target_files ZipFile (already open), or a TargetFiles.
 
   Returns:
     (certmap, ext): certmap is a dictionary that maps packages to certs; ext is
@@ -2550,6 +2852,23 @@ Global options
 
   --logfile <file>
       Put verbose logs to specified file (regardless of --verbose option.)
+
+  --signapk_server
+      Sign files with long-lived signapk.jar processes instead of starting one
+      per file. Falls back to the latter if signapk.jar doesn't support it.
+
+  --diff_timeout <secs>
+      Give up on a bsdiff/imgdiff run after that many seconds (defaults to
+      300), falling back to the full file.
+
+  --diff_memory_budget <bytes>
+      Don't start a bsdiff/imgdiff run if the estimated memory of the runs in
+      progress would exceed that (defaults to 3/4 of the available memory). A
+      single run larger than the budget still runs on its own.
+
+  --diff_stats_file <file>
+      Write the per-file timings and patch sizes of bsdiff/imgdiff as JSON to
+      the given file.
 """
 
 
@@ -2576,7 +2895,8 @@ def ParseOptions(argv,
          "java_path=", "java_args=", "android_jar_path=", "public_key_suffix=",
          "private_key_suffix=", "boot_signer_path=", "boot_signer_args=",
          "verity_signer_path=", "verity_signer_args=", "device_specific=",
-         "extra=", "logfile="] + list(extra_long_opts))
+         "extra=", "logfile=", "signapk_server", "diff_timeout=",
+         "diff_memory_budget=", "diff_stats_file="] + list(extra_long_opts))
   except getopt.GetoptError as err:
     Usage(docstring)
     print("**", str(err), "**")
@@ -2596,6 +2916,8 @@ def ParseOptions(argv,
       OPTIONS.signapk_shared_library_path = a
     elif o in ("--extra_signapk_args",):
       OPTIONS.extra_signapk_args = shlex.split(a)
+    elif o in ("--signapk_server",):
+      OPTIONS.signapk_server = True
     elif o in ("--aapt2_path",):
       OPTIONS.aapt2_path = a
     elif o in ("--java_path",):
@@ -2623,6 +2945,12 @@ def ParseOptions(argv,
       OPTIONS.extras[key] = value
     elif o in ("--logfile",):
       OPTIONS.logfile = a
+    elif o in ("--diff_timeout",):
+      OPTIONS.diff_timeout = int(a)
+    elif o in ("--diff_memory_budget",):
+      OPTIONS.diff_memory_budget = int(a)
+    elif o in ("--diff_stats_file",):
+      OPTIONS.diff_stats_file = a
     else:
       if extra_option_handler is None or not extra_option_handler(o, a):
         assert False, "unknown option \"%s\"" % (o,)
@@ -2655,6 +2983,7 @@ def MakeTempDir(prefix='tmp', suffix=''):
 
 
 def Cleanup():
+  SignApkServer.StopAll()
   for i in OPTIONS.tempfiles:
     if os.path.isdir(i):
       shutil.rmtree(i, ignore_errors=True)
@@ -2875,26 +3204,300 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   zipfile.ZIP64_LIMIT = saved_zip64_limit
 
 
+class ParallelDeflater(object):
+  """Deflates a file in chunks on multiple threads, into one deflate stream.
+
+  Each chunk is compressed independently (zlib releases the GIL while doing
+  so), with the last 32 KiB of the previous chunk as its preset dictionary,
+  and ends with a sync flush instead of the final block. So the concatenated
+  chunks form a single raw deflate stream, which inflates like the one of
+  ZipFile.write() does, at about the same compression ratio. This is the
+  scheme of pigz.
+  """
+
+  CHUNK_SIZE = 1 << 20
+  DICTIONARY_SIZE = 32 * 1024
+
+  def __init__(self, threads, level=6, chunk_size=None):
+    self.threads = max(1, threads)
+    self.level = level
+    self.chunk_size = chunk_size or self.CHUNK_SIZE
+
+  def _CompressChunk(self, fd, offset, last):
+    data = os.pread(fd, self.chunk_size, offset)
+    dictionary_offset = max(0, offset - self.DICTIONARY_SIZE)
+    dictionary = os.pread(fd, offset - dictionary_offset, dictionary_offset)
+    if dictionary:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                    zdict=dictionary)
+    else:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, compressed
+
+  def Compress(self, input_path, output_path):
+    """Deflates input_path into output_path.
+
+    Returns:
+      A tuple of (CRC-32, input size, output size).
+    """
+    input_size = os.path.getsize(input_path)
+    offsets = list(range(0, input_size, self.chunk_size)) or [0]
+    crc = 0
+    output_size = 0
+    with open(input_path, "rb") as input_file, \
+        open(output_path, "wb") as output_file, \
+        ThreadPoolExecutor(max_workers=self.threads) as executor:
+      fd = input_file.fileno()
+
+      def WriteChunk(future):
+        data, compressed = future.result()
+        output_file.write(compressed)
+        return zlib.crc32(data, crc), output_size + len(compressed)
+
+      # Keep a bounded number of chunks in flight, and write them in order.
+      pending = collections.deque()
+      for index, offset in enumerate(offsets):
+        pending.append(executor.submit(
+            self._CompressChunk, fd, offset, index == len(offsets) - 1))
+        if len(pending) >= 2 * self.threads:
+          crc, output_size = WriteChunk(pending.popleft())
+      while pending:
+        crc, output_size = WriteChunk(pending.popleft())
+    return crc, input_size, output_size
+
+
+def ZipWriteParallelDeflated(zip_file, filename, arcname, threads,
+                             perms=0o644):
+  """Adds a file to zip_file, deflated by ParallelDeflater on 'threads' threads.
+
+  The entry is the same as that of ZipWrite() with ZIP_DEFLATED (apart from
+  the compressed bytes), i.e. any unzip implementation can read it.
+
+  Returns:
+    A tuple of (input size, compressed size, seconds taken).
+  """
+  start = time.time()
+  deflated = MakeTempFile(prefix="deflated-")
+  crc, input_size, output_size = ParallelDeflater(threads).Compress(
+      filename, deflated)
+
+  zinfo = zipfile.ZipInfo(filename=arcname, date_time=(2009, 1, 1, 0, 0, 0))
+  zinfo.compress_type = zipfile.ZIP_DEFLATED
+  zinfo.external_attr = (0o100000 | perms) << 16
+  zinfo.CRC = crc
+  zinfo.file_size = input_size
+  zinfo.compress_size = output_size
+
+  # See the comments in ZipWrite() for the zip64 limit.
+  saved_zip64_limit = zipfile.ZIP64_LIMIT
+  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+  try:
+    output_fp = zip_file.fp
+    zinfo.header_offset = output_fp.tell()
+    output_fp.write(zinfo.FileHeader())
+    with open(deflated, "rb") as deflated_file:
+      shutil.copyfileobj(deflated_file, output_fp, ZipRewriter.COPY_CHUNK_SIZE)
+  finally:
+    zipfile.ZIP64_LIMIT = saved_zip64_limit
+  os.remove(deflated)
+  OPTIONS.tempfiles.remove(deflated)
+
+  # Register the entry, as in ZipCopyRawEntry().
+  zip_file.filelist.append(zinfo)
+  zip_file.NameToInfo[zinfo.filename] = zinfo
+  zip_file.start_dir = output_fp.tell()
+  # pylint: disable=protected-access
+  zip_file._didModify = True
+  return input_size, output_size, time.time() - start
+
+
+class ZipRewriter(object):
+  """Rewrites a ZIP file in place, in a single pass.
+
+  Deleting or replacing entries isn't supported by zipfile, and shelling out
+  to 'zip -d' rewrites the whole archive each time. ZipRewriter copies the
+  retained entries into a new archive as is (the raw compressed data is
+  copied, without decompressing or recompressing it), and then lets the
+  caller append the new entries before the result replaces the original file.
+
+    with ZipRewriter(zip_filename, [METADATA_NAME]) as output_zip:
+      ZipWriteStr(output_zip, METADATA_NAME, metadata)
+
+  The retained entries keep their original order, followed by the ones added
+  by the caller. The original file is left untouched if anything fails.
+  """
+
+  # The size of the chunks to copy the raw entry data in.
+  COPY_CHUNK_SIZE = 1 << 20
+
+  def __init__(self, zip_filename, entries_to_delete=None, compress_types=None,
+               compression=zipfile.ZIP_STORED):
+    """Initializes a ZipRewriter.
+
+    Args:
+      zip_filename: The name of the ZIP file to rewrite.
+      entries_to_delete: The name of the entry, or the list of names to be
+          deleted (or replaced by the caller).
+      compress_types: A dict that maps entry names to the compress_type to
+          convert the entries to. Entries whose compress_type already matches
+          are copied as is.
+      compression: The default compress_type for the entries added by the
+          caller.
+    """
+    if isinstance(entries_to_delete, str):
+      entries_to_delete = [entries_to_delete]
+    self.zip_filename = zip_filename
+    self.entries_to_delete = set(entries_to_delete or [])
+    self.compress_types = compress_types or {}
+    self.compression = compression
+    self._output_filename = None
+    self._output_zip = None
+
+  def __enter__(self):
+    fd, self._output_filename = tempfile.mkstemp(
+        suffix=".zip",
+        dir=os.path.dirname(os.path.abspath(self.zip_filename)))
+    os.close(fd)
+    try:
+      self._output_zip = zipfile.ZipFile(
+          self._output_filename, "w", compression=self.compression,
+          allowZip64=True)
+      self._CopyEntries()
+    except:
+      self._Abort()
+      raise
+    return self._output_zip
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self._Abort()
+      return
+    ZipClose(self._output_zip)
+    shutil.copymode(self.zip_filename, self._output_filename)
+    os.replace(self._output_filename, self.zip_filename)
+
+  def _Abort(self):
+    if self._output_zip:
+      self._output_zip.close()
+    os.remove(self._output_filename)
+
+  def _CopyEntries(self):
+    with zipfile.ZipFile(self.zip_filename, allowZip64=True) as input_zip:
+      # Like 'zip -d', only fail if none of the entries is found.
+      missing = self.entries_to_delete.difference(input_zip.namelist())
+      if missing and missing == self.entries_to_delete:
+        raise ExternalError(
+            "Failed to find {} in {}".format(
+                sorted(missing), self.zip_filename))
+      if missing:
+        logger.warning(
+            "Failed to find %s in %s", sorted(missing), self.zip_filename)
+      self._output_zip.comment = input_zip.comment
+
+      for info in input_zip.infolist():
+        if info.filename in self.entries_to_delete:
+          continue
+        compress_type = self.compress_types.get(
+            info.filename, info.compress_type)
+        if compress_type == info.compress_type:
+          ZipCopyRawEntry(input_zip, info, self._output_zip)
+        else:
+          self._RecompressEntry(input_zip, info, compress_type)
+
+  def _RecompressEntry(self, input_zip, info, compress_type):
+    output_info = zipfile.ZipInfo(info.filename, info.date_time)
+    output_info.compress_type = compress_type
+    output_info.external_attr = info.external_attr
+    output_info.create_system = info.create_system
+    output_info.comment = info.comment
+    force_zip64 = info.file_size > zipfile.ZIP64_LIMIT
+    with input_zip.open(info) as input_entry, \
+        self._output_zip.open(output_info, "w", force_zip64=force_zip64) \
+        as output_entry:
+      shutil.copyfileobj(input_entry, output_entry, self.COPY_CHUNK_SIZE)
+
+
+def ZipCopyRawEntry(input_zip, info, output_zip):
+  """Copies an entry into output_zip byte for byte, without recompressing it.
+
+  The local header and the raw (compressed) data of the entry are copied, and
+  the entry is registered in output_zip as ZipFile.write() would have done.
+
+  Args:
+    input_zip: The ZipFile to copy the entry from.
+    info: The ZipInfo of the entry in input_zip.
+    output_zip: The ZipFile (opened for writing) to copy the entry to.
+  """
+  input_fp = input_zip.fp
+  input_fp.seek(info.header_offset)
+  header = input_fp.read(zipfile.sizeFileHeader)
+  if header[:4] != zipfile.stringFileHeader:
+    raise ExternalError(
+        "Bad local header for {} in {}".format(
+            info.filename, input_zip.filename))
+  name_length, extra_length = struct.unpack("<HH", header[26:30])
+  extra = input_fp.read(name_length + extra_length)[name_length:]
+  size = (zipfile.sizeFileHeader + name_length + extra_length +
+          info.compress_size)
+
+  # Entries written in streaming mode are followed by a data descriptor,
+  # which has an optional signature, and 64-bit sizes for zip64 entries.
+  if info.flag_bits & 0x08:
+    input_fp.seek(info.header_offset + size)
+    descriptor_size = 20 if _HasZip64Extra(extra) else 12
+    if input_fp.read(4) == b"PK\x07\x08":
+      descriptor_size += 4
+    size += descriptor_size
+
+  output_fp = output_zip.fp
+  output_info = copy.copy(info)
+  output_info.header_offset = output_fp.tell()
+  input_fp.seek(info.header_offset)
+  while size > 0:
+    data = input_fp.read(min(size, ZipRewriter.COPY_CHUNK_SIZE))
+    if not data:
+      raise ExternalError(
+          "Truncated data for {} in {}".format(
+              info.filename, input_zip.filename))
+    output_fp.write(data)
+    size -= len(data)
+
+  # Register the entry, so that it's listed in the central directory.
+  output_zip.filelist.append(output_info)
+  output_zip.NameToInfo[output_info.filename] = output_info
+  output_zip.start_dir = output_fp.tell()
+  # pylint: disable=protected-access
+  output_zip._didModify = True
+
+
+def _HasZip64Extra(extra):
+  while len(extra) >= 4:
+    header_id, data_size = struct.unpack("<HH", extra[:4])
+    if header_id == 0x0001:
+      return True
+    extra = extra[4 + data_size:]
+  return False
+
+
 def ZipDelete(zip_filename, entries):
   """Deletes entries from a ZIP file.
 
-  Since deleting entries from a ZIP file is not supported, it shells out to
-  'zip -d'.
-
   Args:
     zip_filename: The name of the ZIP file.
     entries: The name of the entry, or the list of names to be deleted.
 
   Raises:
-    AssertionError: In case of non-zero return from 'zip'.
+    ExternalError: In case none of the entries exists.
   """
   if isinstance(entries, str):
     entries = [entries]
   # If list is empty, nothing to do
   if not entries:
     return
-  cmd = ["zip", "-d", zip_filename] + entries
-  RunAndCheckOutput(cmd)
+  with ZipRewriter(zip_filename, entries):
+    pass
 
 
 def ZipClose(zip_file):
@@ -3053,37 +3656,307 @@ DIFF_PROGRAM_BY_EXT = {
 }
 
 
+class BlobCache(object):
+  """An on-disk cache of blobs addressed by keys (hex digests).
+
+  The cache is trimmed to 'max_size' bytes by evicting the least recently used
+  entries, where a cache hit refreshes the mtime of the entry.
+
+  The directory may be shared by concurrent builds; entries are written
+  atomically, and a missing entry is simply a miss. The hit/miss stats only
+  cover the lookups done in the current process.
+  """
+
+  # Used by Report().
+  DESCRIPTION = "Blob cache"
+
+  # The temp files of the entries being written, possibly by another process.
+  TEMP_PREFIX = ".tmp-"
+
+  # A temp file that hasn't been renamed in this many seconds was left behind,
+  # e.g. by a killed build, and gets evicted like a regular entry.
+  STALE_TEMP_AGE = 3600
+
+  def __init__(self, cache_dir, max_size):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.hit_bytes = 0
+    self._lock = threading.Lock()
+    os.makedirs(cache_dir, exist_ok=True)
+    self._size = sum(size for _, size, _ in self._ListEntries())
+
+  def _ListEntries(self):
+    """Returns a list of (mtime, size, path) of all the cache entries.
+
+    The temp files of the entries being written are left out, unless they are
+    stale.
+    """
+    entries = []
+    stale_time = time.time() - self.STALE_TEMP_AGE
+    for root, _, files in os.walk(self.cache_dir):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if name.startswith(self.TEMP_PREFIX) and st.st_mtime > stale_time:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+  def _GetEntryPath(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def GetBlob(self, key):
+    """Returns the cached blob for the key, or None on a cache miss.
+
+    A None key always misses.
+    """
+    blob = None
+    if key:
+      path = self._GetEntryPath(key)
+      try:
+        with open(path, 'rb') as f:
+          blob = f.read()
+        os.utime(path, None)
+      except (IOError, OSError):
+        blob = None
+    with self._lock:
+      if blob is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.hit_bytes += len(blob)
+    return blob
+
+  def PutBlob(self, key, blob):
+    """Stores the blob for the key, evicting old entries as needed.
+
+    A None key is ignored. Failing to write the entry, e.g. on a full disk, only
+    loses the entry.
+    """
+    if not key or len(blob) > self.max_size:
+      return
+    path = self._GetEntryPath(key)
+    entry_dir = os.path.dirname(path)
+    temp_path = None
+    try:
+      os.makedirs(entry_dir, exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(dir=entry_dir, prefix=self.TEMP_PREFIX)
+      with os.fdopen(fd, 'wb') as f:
+        f.write(blob)
+      # An overwritten entry no longer takes its space.
+      try:
+        old_size = os.path.getsize(path)
+      except OSError:
+        old_size = 0
+      os.rename(temp_path, path)
+    except OSError as e:
+      logger.warning("Failed to write %s to %s: %s", key, self.cache_dir, e)
+      if temp_path:
+        try:
+          os.remove(temp_path)
+        except OSError:
+          pass
+      return
+
+    with self._lock:
+      self._size += len(blob) - old_size
+      if self._size > self.max_size:
+        self._Evict()
+
+  def _Evict(self):
+    entries = self._ListEntries()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total -= size
+    self._size = total
+
+  def GetStats(self):
+    """Returns the (hits, misses, hit_bytes) of the lookups so far."""
+    with self._lock:
+      return self.hits, self.misses, self.hit_bytes
+
+  def AddStats(self, stats):
+    """Adds the stats of the lookups done elsewhere, e.g. in a worker process.
+
+    Args:
+      stats: A tuple of (hits, misses, hit_bytes), as from GetStats().
+    """
+    hits, misses, hit_bytes = stats
+    with self._lock:
+      self.hits += hits
+      self.misses += misses
+      self.hit_bytes += hit_bytes
+
+  def Report(self):
+    """Prints the hit/miss stats."""
+    lookups = self.hits + self.misses
+    if not lookups:
+      return
+    logger.info(
+        "%s %s: %d hits, %d misses (%.2f%% hit rate), %d bytes reused.",
+        self.DESCRIPTION, self.cache_dir, self.hits, self.misses,
+        self.hits * 100.0 / lookups, self.hit_bytes)
+
+
+class PatchCache(BlobCache):
+  """An on-disk cache of bsdiff/imgdiff patches.
+
+  Patches are stored by a key derived from the diff command, the digest of the
+  diff tool binary (so that a rebuilt tool invalidates its entries), and the
+  SHA-1s of the source and target data. See BlobCache for the eviction.
+  """
+
+  DESCRIPTION = "Patch cache"
+
+  def __init__(self, cache_dir, max_size):
+    super(PatchCache, self).__init__(cache_dir, max_size)
+    self._tool_digests = {}
+
+  def _GetToolDigest(self, tool):
+    with self._lock:
+      if tool not in self._tool_digests:
+        path = shutil.which(tool)
+        digest = None
+        if path:
+          h = sha1()
+          with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+              h.update(chunk)
+          digest = h.hexdigest()
+        self._tool_digests[tool] = digest
+      return self._tool_digests[tool]
+
+  def _GetKey(self, diff_cmd, src_sha1, tgt_sha1):
+    """Returns the key of the entry, or None if the tool can't be found.
+
+    The bonus file of imgdiff (-b) is keyed by its content rather than its
+    path, which usually stays the same across builds.
+    """
+    tool_digest = self._GetToolDigest(diff_cmd[0])
+    if tool_digest is None:
+      return None
+    diff_cmd = list(diff_cmd)
+    for i, arg in enumerate(diff_cmd[:-1]):
+      if arg == "-b":
+        try:
+          with open(diff_cmd[i + 1], 'rb') as f:
+            diff_cmd[i + 1] = sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+          return None
+    return sha256(" ".join(
+        [tool_digest, src_sha1, tgt_sha1] + diff_cmd).encode()).hexdigest()
+
+  def Get(self, diff_cmd, src_sha1, tgt_sha1):
+    """Returns the cached patch data, or None on a cache miss.
+
+    Args:
+      diff_cmd: The diff command without the file arguments, e.g.
+          ["imgdiff", "-z"].
+      src_sha1: The SHA-1 (hex string) of the source data.
+      tgt_sha1: The SHA-1 (hex string) of the target data.
+    """
+    return self.GetBlob(self._GetKey(diff_cmd, src_sha1, tgt_sha1))
+
+  def Put(self, diff_cmd, src_sha1, tgt_sha1, patch):
+    """Stores the patch data, evicting old entries as needed."""
+    self.PutBlob(self._GetKey(diff_cmd, src_sha1, tgt_sha1), patch)
+
+
+_patch_cache = None
+
+
+def GetPatchCache():
+  """Returns the PatchCache for OPTIONS.patch_cache_dir, or None if unset."""
+  global _patch_cache  # pylint: disable=global-statement
+  if not OPTIONS.patch_cache_dir:
+    return None
+  if (_patch_cache is None or
+      _patch_cache.cache_dir != OPTIONS.patch_cache_dir):
+    _patch_cache = PatchCache(OPTIONS.patch_cache_dir,
+                              OPTIONS.patch_cache_size)
+  return _patch_cache
+
+
 class Difference(object):
+  # Rough peak memory of the diff tools per input byte, for DiffScheduler:
+  # bsdiff keeps a suffix array of 8 bytes per source byte next to both
+  # inputs, and imgdiff does the same on the inflated chunks, which are a few
+  # times larger than the files.
+  BSDIFF_MEMORY_PER_SOURCE_BYTE = 9
+  IMGDIFF_INFLATION = 4
+
   def __init__(self, tf, sf, diff_program=None):
     self.tf = tf
     self.sf = sf
     self.patch = None
     self.diff_program = diff_program
+    # Set by ComputePatch().
+    self.cached = False
+    self.timed_out = False
+
+  def GetDiffCommand(self):
+    """Returns the diff command without the file arguments."""
+    if self.diff_program:
+      diff_program = self.diff_program
+    else:
+      ext = os.path.splitext(self.tf.name)[1]
+      diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
+
+    if isinstance(diff_program, list):
+      return copy.copy(diff_program)
+    return [diff_program]
+
+  def EstimateMemory(self):
+    """Returns the estimated peak memory (in bytes) of ComputePatch()."""
+    memory = (self.BSDIFF_MEMORY_PER_SOURCE_BYTE * self.sf.size +
+              self.tf.size)
+    if os.path.basename(self.GetDiffCommand()[0]) == "imgdiff":
+      memory *= self.IMGDIFF_INFLATION
+    return memory
 
-  def ComputePatch(self):
+  def ComputePatch(self, timeout=None):
     """Compute the patch (as a string of data) needed to turn sf into
-    tf.  Returns the same tuple as GetPatch()."""
+    tf.  Returns the same tuple as GetPatch().
+
+    Args:
+      timeout: The time limit (in seconds) of the diff command. Defaults to
+          OPTIONS.diff_timeout.
+    """
 
     tf = self.tf
     sf = self.sf
 
-    if self.diff_program:
-      diff_program = self.diff_program
-    else:
-      ext = os.path.splitext(tf.name)[1]
-      diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
+    if timeout is None:
+      timeout = OPTIONS.diff_timeout
+
+    diff_cmd = self.GetDiffCommand()
+    self.cached = False
+    self.timed_out = False
+
+    patch_cache = GetPatchCache()
+    if patch_cache:
+      self.patch = patch_cache.Get(diff_cmd, sf.sha1, tf.sha1)
+      if self.patch is not None:
+        self.cached = True
+        return self.tf, self.sf, self.patch
 
     ttemp = tf.WriteToTemp()
     stemp = sf.WriteToTemp()
 
-    ext = os.path.splitext(tf.name)[1]
-
     try:
       ptemp = tempfile.NamedTemporaryFile()
-      if isinstance(diff_program, list):
-        cmd = copy.copy(diff_program)
-      else:
-        cmd = [diff_program]
+      cmd = copy.copy(diff_cmd)
       cmd.append(stemp.name)
       cmd.append(ttemp.name)
       cmd.append(ptemp.name)
@@ -3096,9 +3969,10 @@ class Difference(object):
           err.append(e)
       th = threading.Thread(target=run)
       th.start()
-      th.join(timeout=300)   # 5 mins
+      th.join(timeout=timeout)
       if th.is_alive():
-        logger.warning("diff command timed out")
+        logger.warning("diff command timed out after %d sec", timeout)
+        self.timed_out = True
         p.terminate()
         th.join(5)
         if th.is_alive():
@@ -3115,6 +3989,8 @@ class Difference(object):
       stemp.close()
       ttemp.close()
 
+    if patch_cache:
+      patch_cache.Put(diff_cmd, sf.sha1, tf.sha1, diff)
     self.patch = diff
     return self.tf, self.sf, self.patch
 
@@ -3127,51 +4003,304 @@ class Difference(object):
     return self.tf, self.sf, self.patch
 
 
+class DiffStats(object):
+  """Collects the per-file results of ComputeDifferences().
+
+  The stats of all the calls in a run are aggregated (see GetDiffStats()) and
+  written to OPTIONS.diff_stats_file as JSON, if set.
+  """
+
+  # The status of each diff.
+  OK = "ok"
+  CACHED = "cached"
+  FAILED = "failed"
+  TIMED_OUT = "timed_out"
+
+  def __init__(self):
+    self.diffs = []
+    self.wall_time = 0.0
+    self.steals = 0
+    self.admission_waits = 0
+    self.peak_memory = 0
+    self._lock = threading.Lock()
+
+  def Add(self, name, diff, duration, worker, stolen):
+    """Records the result of the given (computed) Difference."""
+    tf, sf, patch = diff.GetPatch()
+    if diff.timed_out:
+      status = self.TIMED_OUT
+    elif patch is None:
+      status = self.FAILED
+    elif diff.cached:
+      status = self.CACHED
+    else:
+      status = self.OK
+    with self._lock:
+      self.diffs.append({
+          "name": name,
+          "program": " ".join(diff.GetDiffCommand()),
+          "status": status,
+          "source_size": sf.size,
+          "target_size": tf.size,
+          "patch_size": None if patch is None else len(patch),
+          "estimated_memory": diff.EstimateMemory(),
+          "duration": round(duration, 3),
+          "worker": worker,
+          "stolen": stolen,
+      })
+
+  def Merge(self, other):
+    """Adds the results of another DiffStats to this one."""
+    with self._lock:
+      self.diffs.extend(other.diffs)
+      self.wall_time += other.wall_time
+      self.steals += other.steals
+      self.admission_waits += other.admission_waits
+      self.peak_memory = max(self.peak_memory, other.peak_memory)
+
+  def ToDict(self):
+    """Returns the stats as a JSON-serializable dict."""
+    with self._lock:
+      counts = collections.Counter(d["status"] for d in self.diffs)
+      return {
+          "count": len(self.diffs),
+          "status": {status: counts[status] for status in
+                     (self.OK, self.CACHED, self.FAILED, self.TIMED_OUT)},
+          "wall_time": round(self.wall_time, 3),
+          "cpu_time": round(sum(d["duration"] for d in self.diffs), 3),
+          "target_bytes": sum(d["target_size"] for d in self.diffs),
+          "patch_bytes": sum(d["patch_size"] or 0 for d in self.diffs),
+          "steals": self.steals,
+          "admission_waits": self.admission_waits,
+          "peak_estimated_memory": self.peak_memory,
+          "diffs": sorted(self.diffs, key=lambda d: d["duration"],
+                          reverse=True),
+      }
+
+  def WriteJson(self, path):
+    """Writes the stats to the given file."""
+    with open(path, "w") as f:
+      json.dump(self.ToDict(), f, indent=2, sort_keys=True)
+
+  def Report(self):
+    """Prints a summary of the stats."""
+    stats = self.ToDict()
+    if not stats["count"]:
+      return
+    logger.info(
+        "Computed %d diffs (%d cached, %d failed, %d timed out) in %.2f sec "
+        "(%.2f sec of diffing), %d work steals, %d waits for memory.",
+        stats["count"], stats["status"][self.CACHED],
+        stats["status"][self.FAILED], stats["status"][self.TIMED_OUT],
+        stats["wall_time"], stats["cpu_time"], stats["steals"],
+        stats["admission_waits"])
+
+
+_diff_stats = None
+
+
+def GetDiffStats():
+  """Returns the DiffStats aggregated over all ComputeDifferences() calls."""
+  global _diff_stats  # pylint: disable=global-statement
+  if _diff_stats is None:
+    _diff_stats = DiffStats()
+  return _diff_stats
+
+
+def GetAvailableMemory():
+  """Returns the available memory (in bytes), or None if unknown."""
+  try:
+    with open("/proc/meminfo") as f:
+      for line in f:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024
+  except (IOError, ValueError):
+    pass
+  return None
+
+
+class DiffScheduler(object):
+  """Computes Differences on a pool of work-stealing worker threads.
+
+  The diffs are dealt round-robin, largest first, into one deque per worker.
+  Each worker takes the largest diff of its own deque; once that's empty (or
+  its diffs don't fit in the memory budget), it steals the smallest one that
+  fits from the worker with the most bytes left.
+
+  A diff is only started while the estimated memory of the diffs in progress
+  (see Difference.EstimateMemory()) stays within memory_budget, as large
+  imgdiff runs can take gigabytes. One diff at a time may exceed the budget on
+  its own, so that every diff eventually runs.
+  """
+
+  def __init__(self, threads, memory_budget=None, timeout=None):
+    self.threads = max(1, threads)
+    self.memory_budget = memory_budget
+    self.timeout = timeout
+    self._cv = threading.Condition()
+    self._queues = []
+    self._memory_in_use = 0
+    self._total = 0
+    self._total_bytes = 0
+    self._done = 0
+    self._done_bytes = 0
+    self._next_progress = 0
+    self._start = 0
+    self.stats = None
+
+  def _Fits(self, diff):
+    return (self.memory_budget is None or self._memory_in_use == 0 or
+            self._memory_in_use + diff.EstimateMemory() <= self.memory_budget)
+
+  def _TakeLocked(self, index):
+    """Returns (diff, stolen), (None, False) to wait, or None when done."""
+    if not any(self._queues):
+      return None
+
+    own = self._queues[index]
+    for i, diff in enumerate(own):
+      if self._Fits(diff):
+        del own[i]
+        return diff, False
+
+    victims = sorted(
+        (queue for i, queue in enumerate(self._queues) if i != index and queue),
+        key=lambda queue: sum(d.tf.size for d in queue), reverse=True)
+    for queue in victims:
+      for i in range(len(queue) - 1, -1, -1):
+        if self._Fits(queue[i]):
+          diff = queue[i]
+          del queue[i]
+          return diff, True
+    return None, False
+
+  @staticmethod
+  def _GetName(diff):
+    tf, sf, _ = diff.GetPatch()
+    if sf.name == tf.name:
+      return tf.name
+    return "%s (%s)" % (tf.name, sf.name)
+
+  def _LogProgressLocked(self, diff, name, duration):
+    _, _, patch = diff.GetPatch()
+    tf = diff.tf
+    if patch is None:
+      logger.error("patching failed! %40s", name)
+    else:
+      logger.info(
+          "%8.2f sec %8d / %8d bytes (%6.2f%%) %s", duration, len(patch),
+          tf.size, 100.0 * len(patch) / max(tf.size, 1), name)
+
+    # Report the overall progress at every 10% of the target bytes.
+    percent = 100 * self._done_bytes // max(self._total_bytes, 1)
+    if percent >= self._next_progress or self._done == self._total:
+      elapsed = time.time() - self._start
+      remaining = (elapsed * (self._total_bytes - self._done_bytes) /
+                   max(self._done_bytes, 1))
+      logger.info(
+          "Computed %d/%d diffs (%d%% of the bytes) in %.1f sec, ~%.1f sec "
+          "left", self._done, self._total, percent, elapsed, remaining)
+      self._next_progress = percent - percent % 10 + 10
+
+  def _Worker(self, index):
+    while True:
+      with self._cv:
+        while True:
+          task = self._TakeLocked(index)
+          if task is None:
+            return
+          diff, stolen = task
+          if diff is not None:
+            break
+          self.stats.admission_waits += 1
+          self._cv.wait()
+        memory = diff.EstimateMemory()
+        self._memory_in_use += memory
+        self.stats.peak_memory = max(self.stats.peak_memory,
+                                     self._memory_in_use)
+        if stolen:
+          self.stats.steals += 1
+
+      start = time.time()
+      try:
+        diff.ComputePatch(timeout=self.timeout)
+      finally:
+        duration = time.time() - start
+        with self._cv:
+          self._memory_in_use -= memory
+          self._cv.notify_all()
+
+      name = self._GetName(diff)
+      self.stats.Add(name, diff, duration, index, stolen)
+      with self._cv:
+        self._done += 1
+        self._done_bytes += diff.tf.size
+        self._LogProgressLocked(diff, name, duration)
+
+  def Run(self, diffs):
+    """Computes all the diffs, and returns the DiffStats of this run."""
+    self.stats = DiffStats()
+    self._start = time.time()
+    self._total = len(diffs)
+    self._total_bytes = sum(d.tf.size for d in diffs)
+
+    # Do the largest files first, to try and reduce the long-pole effect.
+    by_size = sorted(diffs, key=lambda d: d.tf.size, reverse=True)
+    threads = min(self.threads, len(by_size)) or 1
+    self._queues = [collections.deque(by_size[i::threads])
+                    for i in range(threads)]
+
+    errors = []
+
+    def worker(index):
+      try:
+        self._Worker(index)
+      except Exception as e:  # pylint: disable=broad-except
+        logger.exception("Failed to compute diff from worker")
+        errors.append(e)
+        # Let the others finish up.
+        with self._cv:
+          self._cv.notify_all()
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for th in workers:
+      th.start()
+    for th in workers:
+      th.join()
+
+    self.stats.wall_time = time.time() - self._start
+    if errors:
+      raise errors[0]
+    return self.stats
+
+
 def ComputeDifferences(diffs):
-  """Call ComputePatch on all the Difference objects in 'diffs'."""
+  """Call ComputePatch on all the Difference objects in 'diffs'.
+
+  The diffs are computed by a DiffScheduler with OPTIONS.worker_threads
+  threads. Returns the DiffStats of this call, which are also added to
+  GetDiffStats() (and written to OPTIONS.diff_stats_file, if set).
+  """
   logger.info("%d diffs to compute", len(diffs))
 
-  # Do the largest files first, to try and reduce the long-pole effect.
-  by_size = [(i.tf.size, i) for i in diffs]
-  by_size.sort(reverse=True)
-  by_size = [i[1] for i in by_size]
+  memory_budget = OPTIONS.diff_memory_budget
+  if memory_budget is None:
+    available = GetAvailableMemory()
+    if available is not None:
+      memory_budget = available * 3 // 4
 
-  lock = threading.Lock()
-  diff_iter = iter(by_size)   # accessed under lock
+  scheduler = DiffScheduler(OPTIONS.worker_threads or 1,
+                            memory_budget=memory_budget,
+                            timeout=OPTIONS.diff_timeout)
+  stats = scheduler.Run(diffs)
+  stats.Report()
 
-  def worker():
-    try:
-      lock.acquire()
-      for d in diff_iter:
-        lock.release()
-        start = time.time()
-        d.ComputePatch()
-        dur = time.time() - start
-        lock.acquire()
-
-        tf, sf, patch = d.GetPatch()
-        if sf.name == tf.name:
-          name = tf.name
-        else:
-          name = "%s (%s)" % (tf.name, sf.name)
-        if patch is None:
-          logger.error("patching failed! %40s", name)
-        else:
-          logger.info(
-              "%8.2f sec %8d / %8d bytes (%6.2f%%) %s", dur, len(patch),
-              tf.size, 100.0 * len(patch) / tf.size, name)
-      lock.release()
-    except Exception:
-      logger.exception("Failed to compute diff from worker")
-      raise
-
-  # start worker threads; wait for them all to finish.
-  threads = [threading.Thread(target=worker)
-             for i in range(OPTIONS.worker_threads)]
-  for th in threads:
-    th.start()
-  while threads:
-    threads.pop().join()
+  total_stats = GetDiffStats()
+  total_stats.Merge(stats)
+  if OPTIONS.diff_stats_file:
+    total_stats.WriteJson(OPTIONS.diff_stats_file)
+  return stats
 
 
 class BlockDifference(object):
@@ -3192,7 +4321,8 @@ class BlockDifference(object):
 
     b = BlockImageDiff(tgt, src, threads=OPTIONS.worker_threads,
                        version=self.version,
-                       disable_imgdiff=self.disable_imgdiff)
+                       disable_imgdiff=self.disable_imgdiff,
+                       patch_workers=OPTIONS.patch_workers)
     self.path = os.path.join(MakeTempDir(), partition)
     b.Compute(self.path)
     self._required_cache = b.max_stashed_size
@@ -3394,7 +4524,14 @@ class BlockDifference(object):
     #   compression_time:   75s  | 265s               | 719s
     #   decompression_time: 15s  | 25s                | 25s
 
-    if not self.src:
+    # With new_data_compression_threads, the new.dat is deflated on multiple
+    # threads instead, into an entry that reads like the one of ZipWrite().
+    # This gives up the brotli savings of full OTAs for the compression time.
+    compression_threads = OPTIONS.new_data_compression_threads
+    if output_zip.compression != zipfile.ZIP_DEFLATED:
+      compression_threads = None
+
+    if not self.src and not compression_threads:
       brotli_cmd = ['brotli', '--quality=6',
                     '--output={}.new.dat.br'.format(self.path),
                     '{}.new.dat'.format(self.path)]
@@ -3406,6 +4543,16 @@ class BlockDifference(object):
                '{}.new.dat.br'.format(self.path),
                new_data_name,
                compress_type=zipfile.ZIP_STORED)
+    elif compression_threads:
+      new_data_name = '{}.new.dat'.format(self.partition)
+      input_size, output_size, duration = ZipWriteParallelDeflated(
+          output_zip, '{}.new.dat'.format(self.path), new_data_name,
+          compression_threads)
+      logger.info(
+          "Compressed %s: %d -> %d bytes (%.2f%%) in %.2f sec using %d "
+          "threads", new_data_name, input_size, output_size,
+          output_size * 100.0 / max(input_size, 1), duration,
+          compression_threads)
     else:
       new_data_name = '{}.new.dat'.format(self.partition)
       ZipWrite(output_zip, '{}.new.dat'.format(self.path), new_data_name)
@@ -3622,7 +4769,8 @@ def MakeRecoveryPatch(input_dir, output_sink, recovery_img, boot_img,
         bonus_args = ""
 
     d = Difference(recovery_img, boot_img, diff_program=diff_program)
-    _, _, patch = d.ComputePatch()
+    ComputeDifferences([d])
+    _, _, patch = d.GetPatch()
     output_sink("recovery-from-boot.p", patch)
 
   try:
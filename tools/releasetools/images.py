@@ -12,18 +12,78 @@
 # See the License for the specific
 
 import os
-import threading
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 
 from rangelib import RangeSet
 
-__all__ = ["EmptyImage", "DataImage", "FileImage"]
+__all__ = ["EmptyImage", "DataImage", "FileImage", "RangeSha1Cache"]
+
+
+class RangeSha1Cache(object):
+  """Memoizes the SHA-1 digests of the ranges of an image.
+
+  BlockImageDiff asks for the digest of the same ranges many times (once while
+  finding the transfers, again for the stashes and while double-checking its
+  work), and TotalSha1() hashes the whole care map. Each distinct RangeSet is
+  hashed only once with this cache. The digests can also be computed ahead of
+  time for many ranges in parallel with Precompute(); hashlib releases the GIL
+  while hashing, so this scales with the number of cores as long as the image
+  reads don't serialize (which holds for SparseImage and FileImage).
+
+  Note that the digest of a range can't be derived from the digests of its
+  blocks, so the cache is keyed by the ranges themselves.
+  """
+
+  def __init__(self):
+    self._digests = {}
+
+  def Get(self, ranges, get_range_data):
+    """Returns the SHA-1 (hex string) of the data in 'ranges'.
+
+    Args:
+      ranges: A RangeSet.
+      get_range_data: A generator function that yields the data in the given
+          RangeSet, e.g. the image's _GetRangeData().
+    """
+    key = ranges.data.tobytes()
+    digest = self._digests.get(key)
+    if digest is None:
+      h = sha1()
+      for data in get_range_data(ranges):
+        h.update(data)
+      digest = h.hexdigest()
+      # Concurrent callers may compute the same digest; either one is fine.
+      self._digests[key] = digest
+    return digest
+
+  def Precompute(self, ranges_list, get_range_data, threads=None):
+    """Computes the digests of all the given RangeSets with 'threads' threads.
+    """
+    pending = {}
+    for ranges in ranges_list:
+      key = ranges.data.tobytes()
+      if key not in self._digests:
+        pending[key] = ranges
+    if not pending:
+      return
+    # Hash the largest ranges first to reduce the long-pole effect.
+    ordered = sorted(pending.values(), key=lambda r: r.size(), reverse=True)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      for _ in executor.map(lambda r: self.Get(r, get_range_data), ordered):
+        pass
 
 
 class Image(object):
   def RangeSha1(self, ranges):
     raise NotImplementedError
 
+  def PrecomputeRangeSha1s(self, ranges_list, threads=None):
+    """Hints that RangeSha1() will be called for all the given RangeSets.
+
+    Images that cache the digests compute them in parallel; others ignore it.
+    """
+
   def ReadRangeSet(self, ranges):
     raise NotImplementedError
 
@@ -164,7 +224,7 @@ class FileImage(Image):
     self.clobbered_blocks = RangeSet()
     self.extended = RangeSet()
 
-    self.generator_lock = threading.Lock()
+    self._sha1_cache = RangeSha1Cache()
 
     self.hashtree_info = None
     if hashtree_info_generator:
@@ -196,20 +256,34 @@ class FileImage(Image):
   def __del__(self):
     self._file.close()
 
+  def __getstate__(self):
+    # See SparseImage.__getstate__(); the copy reopens the file by its path.
+    state = self.__dict__.copy()
+    del state["_file"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._file = open(self.path, 'rb')
+
+  # The maximum number of blocks returned by a single read.
+  MAX_READ_BLOCKS = 256
+
   def _GetRangeData(self, ranges):
-    # Use a lock to protect the generator so that we will not run two
-    # instances of this generator on the same object simultaneously.
-    with self.generator_lock:
-      for s, e in ranges:
-        self._file.seek(s * self.blocksize)
-        for _ in range(s, e):
-          yield self._file.read(self.blocksize)
+    # Use positional reads, so that multiple instances of this generator can
+    # run on the same object simultaneously.
+    fd = self._file.fileno()
+    for s, e in ranges:
+      while s < e:
+        this_read = min(e - s, self.MAX_READ_BLOCKS)
+        yield os.pread(fd, this_read * self.blocksize, s * self.blocksize)
+        s += this_read
 
   def RangeSha1(self, ranges):
-    h = sha1()
-    for data in self._GetRangeData(ranges): # pylint: disable=not-an-iterable
-      h.update(data)
-    return h.hexdigest()
+    return self._sha1_cache.Get(ranges, self._GetRangeData)
+
+  def PrecomputeRangeSha1s(self, ranges_list, threads=None):
+    self._sha1_cache.Precompute(ranges_list, self._GetRangeData, threads)
 
   def ReadRangeSet(self, ranges):
     return list(self._GetRangeData(ranges))
@@ -14,8 +14,10 @@
 
 import collections
 import logging
+import multiprocessing
 import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 import common
 import edify_generator
@@ -27,11 +29,84 @@ from ota_utils import UNZIP_PATTERN, FinalizeMetadata, GetPackageMetadata, Prope
 logger = logging.getLogger(__name__)
 
 
+def _ComputeBlockDifference(args):
+  """Computes a BlockDifference in a partition worker process."""
+  partition, tgt, src, kwargs, threads, patch_workers = args
+  # Don't inherit (and later delete) the temp files of the parent process. The
+  # output directory of the BlockDifference is handed over to the parent.
+  OPTIONS.tempfiles = []
+  OPTIONS.worker_threads = threads
+  OPTIONS.patch_workers = patch_workers
+  try:
+    diff = common.BlockDifference(partition, tgt, src, **kwargs)
+    OPTIONS.tempfiles.remove(os.path.dirname(diff.path))
+  finally:
+    common.Cleanup()
+  return diff
+
+
+def ComputeBlockDifferences(partition_args):
+  """Returns an ordered dict of BlockDifferences with partition name as key.
+
+  If OPTIONS.partition_workers is set, the partitions are computed concurrently
+  in that many worker processes, largest first, each of which gets an equal
+  share of OPTIONS.worker_threads (and of OPTIONS.patch_workers, if set). The
+  returned dict follows the order of partition_args regardless, so that the
+  generated script doesn't depend on which partition finishes first.
+
+  Args:
+    partition_args: An ordered dict of (tgt, src, kwargs) tuples, i.e. the
+        arguments of common.BlockDifference, with partition name as key.
+  """
+  block_diff_dict = collections.OrderedDict()
+  workers = min(OPTIONS.partition_workers or 1, len(partition_args))
+  if workers <= 1:
+    for partition, (tgt, src, kwargs) in partition_args.items():
+      block_diff_dict[partition] = common.BlockDifference(
+          partition, tgt, src, **kwargs)
+    return block_diff_dict
+
+  threads = max(1, (OPTIONS.worker_threads or 1) // workers)
+  patch_workers = None
+  if OPTIONS.patch_workers:
+    patch_workers = max(1, OPTIONS.patch_workers // workers)
+  logger.info("Computing block differences of %d partitions (using %d "
+              "processes with %d threads and %s patch workers each)...",
+              len(partition_args), workers, threads, patch_workers or "no")
+
+  # Start the largest partitions first, to try and reduce the long-pole effect.
+  by_size = sorted(partition_args,
+                   key=lambda name: partition_args[name][0].total_blocks,
+                   reverse=True)
+  futures = {}
+  with ProcessPoolExecutor(
+      workers, mp_context=multiprocessing.get_context("fork")) as executor:
+    for partition in by_size:
+      tgt, src, kwargs = partition_args[partition]
+      futures[partition] = executor.submit(
+          _ComputeBlockDifference,
+          (partition, tgt, src, kwargs, threads, patch_workers))
+
+  error = None
+  for partition in partition_args:
+    try:
+      diff = futures[partition].result()
+    except Exception as e:  # pylint: disable=broad-except
+      logger.error("Failed to compute the block difference of %s", partition)
+      error = error or e
+      continue
+    OPTIONS.tempfiles.append(os.path.dirname(diff.path))
+    block_diff_dict[partition] = diff
+  if error:
+    raise error
+  return block_diff_dict
+
+
 def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
                         device_specific):
   """Returns a ordered dict of block differences with partition name as key."""
 
-  def GetIncrementalBlockDifferenceForPartition(name):
+  def GetIncrementalBlockDifferenceArgsForPartition(name):
     if not HasPartition(source_zip, name):
       raise RuntimeError(
           "can't generate incremental that adds {}".format(name))
@@ -58,10 +133,11 @@ def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
     partition_target_info = target_info["fstab"]["/" + name]
     disable_imgdiff = (partition_source_info.fs_type == "squashfs" or
                        partition_target_info.fs_type == "squashfs")
-    return common.BlockDifference(name, partition_tgt, partition_src,
-                                  check_first_block,
-                                  version=blockimgdiff_version,
-                                  disable_imgdiff=disable_imgdiff)
+    return partition_tgt, partition_src, {
+        "check_first_block": check_first_block,
+        "version": blockimgdiff_version,
+        "disable_imgdiff": disable_imgdiff,
+    }
 
   if source_zip:
     # See notes in common.GetUserImage()
@@ -72,7 +148,7 @@ def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
             "blockimgdiff_versions", "1").split(","))
     assert blockimgdiff_version >= 3
 
-  block_diff_dict = collections.OrderedDict()
+  partition_args = collections.OrderedDict()
   partition_names = ["system", "vendor", "product", "odm", "system_ext",
                      "vendor_dlkm", "odm_dlkm", "system_dlkm"]
   for partition in partition_names:
@@ -83,12 +159,12 @@ def GetBlockDifferences(target_zip, source_zip, target_info, source_info,
       tgt = common.GetUserImage(partition, OPTIONS.input_tmp, target_zip,
                                 info_dict=target_info,
                                 reset_file_map=True)
-      block_diff_dict[partition] = common.BlockDifference(partition, tgt,
-                                                          src=None)
+      partition_args[partition] = (tgt, None, {})
     # Incremental OTA update.
     else:
-      block_diff_dict[partition] = GetIncrementalBlockDifferenceForPartition(
-          partition)
+      partition_args[partition] = (
+          GetIncrementalBlockDifferenceArgsForPartition(partition))
+  block_diff_dict = ComputeBlockDifferences(partition_args)
   assert "system" in block_diff_dict
 
   # Get the block diffs from the device specific script. If there is a
@@ -475,7 +551,8 @@ else if get_stage("%(bcb_dev)s") != "3/3" then
     boot_type, boot_device_expr = common.GetTypeAndDeviceExpr("/boot",
                                                               source_info)
     d = common.Difference(target_boot, source_boot)
-    _, _, d = d.ComputePatch()
+    common.ComputeDifferences([d])
+    _, _, d = d.GetPatch()
     if d is None:
       include_full_boot = True
       common.ZipWriteStr(output_zip, "boot.img", target_boot.data)
@@ -135,6 +135,31 @@ Non-A/B OTA specific options
       Specify the number of worker-threads that will be used when generating
       patches for incremental updates (defaults to 3).
 
+  --patch_workers <int>
+      Compute the block-based patches for non-A/B incremental updates in the
+      given number of worker processes instead of worker threads. Each worker
+      reopens the images and reads and compresses the block data on
+      its own. Per-worker throughput is logged at the end.
+
+  --partition_workers <int>
+      Compute the block-based updates of that many partitions concurrently, in
+      separate processes that split the --worker_threads (and the
+      --patch_workers) among them. Non-A/B OTAs only.
+
+  --new_data_compression_threads <int>
+      Deflate the new data of non-A/B OTAs in chunks on that many threads. For
+      full OTAs, this replaces the single-threaded brotli compression, which
+      gives a smaller package but takes several times longer.
+
+  --patch_cache_dir <dir>
+      Cache the bsdiff/imgdiff patches of incremental updates in the given
+      directory, keyed by the diff tool and the source/target digests, so that
+      repeated builds between the same inputs skip recomputing them.
+
+  --patch_cache_size <bytes>
+      The size limit of the patch cache (defaults to 16 GiB). The least
+      recently used patches are evicted beyond that.
+
   --verify
       Verify the checksums of the updated system and vendor (if any) partitions.
       Non-A/B incremental OTAs only.
@@ -592,8 +617,11 @@ class AbOtaPropertyFiles(StreamingPropertyFiles):
     super(AbOtaPropertyFiles, self).__init__()
     self.name = 'ota-property-files'
 
-  def _GetPrecomputed(self, input_zip):
+  def _GetPrecomputed(self, input_zip, layout=None):
     offset, size = self._GetPayloadMetadataOffsetAndSize(input_zip)
+    # The payload metadata sits at the beginning of payload.bin.
+    if layout:
+      offset, _ = layout.GetEntryOffset('payload.bin')
     return ['payload_metadata.bin:{}:{}'.format(offset, size)]
 
   @staticmethod
@@ -1101,16 +1129,13 @@ def SupportsMainlineGkiUpdates(target_file):
   """
   if target_file is None:
     return False
-  if os.path.isfile(target_file):
-    target_file = common.UnzipTemp(target_file, ["IMAGES/product.img"])
-  if not os.path.isdir(target_file):
-    assert os.path.isdir(target_file), \
-        "{} must be a path to zip archive or dir containing extracted"\
-        " target_files".format(target_file)
-  image_file = os.path.join(target_file, "IMAGES", "product.img")
-
-  if not os.path.isfile(image_file):
-    return False
+  assert os.path.isfile(target_file) or os.path.isdir(target_file), \
+      "{} must be a path to zip archive or dir containing extracted"\
+      " target_files".format(target_file)
+  with common.TargetFiles(target_file) as target_files:
+    if "IMAGES/product.img" not in target_files:
+      return False
+    image_file = target_files.Extract("IMAGES/product.img")
 
   if IsSparseImage(image_file):
     # Unsparse the image
@@ -1228,10 +1253,11 @@ def GenerateAbOtaPackage(target_file, output_file, source_file=None):
                       str(OPTIONS.enable_lz4diff).lower()]
 
   if source_file and OPTIONS.enable_lz4diff:
-    input_tmp = common.UnzipTemp(source_file, ["META/liblz4.so"])
-    liblz4_path = os.path.join(input_tmp, "META", "liblz4.so")
-    assert os.path.exists(
-        liblz4_path), "liblz4.so not found in META/ dir of target file {}".format(liblz4_path)
+    with common.TargetFiles(source_file) as source_files:
+      assert "META/liblz4.so" in source_files, \
+          "liblz4.so not found in META/ dir of target file {}".format(
+              source_file)
+      liblz4_path = source_files.Extract("META/liblz4.so")
     logger.info("Enabling lz4diff %s", liblz4_path)
     additional_args += ["--liblz4_path", liblz4_path]
     erofs_compression_param = OPTIONS.target_info_dict.get(
@@ -1354,6 +1380,32 @@ def main(argv):
       else:
         raise ValueError("Cannot parse value %r for option %r - only "
                          "integers are allowed." % (a, o))
+    elif o == "--patch_workers":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.patch_workers = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
+    elif o == "--partition_workers":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.partition_workers = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
+    elif o == "--new_data_compression_threads":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.new_data_compression_threads = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
+    elif o == "--patch_cache_dir":
+      OPTIONS.patch_cache_dir = a
+    elif o == "--patch_cache_size":
+      if a.isdigit():
+        OPTIONS.patch_cache_size = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
     elif o in ("-2", "--two_step"):
       OPTIONS.two_step = True
     elif o == "--include_secondary":
@@ -1451,6 +1503,11 @@ def main(argv):
                                  "override_timestamp",
                                  "extra_script=",
                                  "worker_threads=",
+                                 "patch_workers=",
+                                 "partition_workers=",
+                                 "new_data_compression_threads=",
+                                 "patch_cache_dir=",
+                                 "patch_cache_size=",
                                  "two_step",
                                  "include_secondary",
                                  "no_signing",
@@ -1635,6 +1692,10 @@ def main(argv):
         output_file=args[1],
         source_file=OPTIONS.incremental_source)
 
+  patch_cache = common.GetPatchCache()
+  if patch_cache:
+    patch_cache.Report()
+
   # Post OTA generation works.
   if OPTIONS.incremental_source is not None and OPTIONS.log_diff:
     logger.info("Generating diff logs...")
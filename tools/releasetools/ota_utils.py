@@ -16,11 +16,12 @@ import copy
 import itertools
 import logging
 import os
+import re
 import struct
 import zipfile
 
 import ota_metadata_pb2
-from common import (ZipDelete, ZipClose, OPTIONS, MakeTempFile,
+from common import (ZipRewriter, ZipClose, OPTIONS, MakeTempFile,
                     ZipWriteStr, BuildInfo, LoadDictionaryFromFile,
                     SignFile, PARTITIONS_WITH_BUILD_PROP, PartitionBuildProps)
 
@@ -56,6 +57,10 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
   system update client. System update client can then fetch individual ZIP
   entries (ZIP_STORED) directly at the given offset of the URL.
 
+  The final offsets are predicted with SignedZipLayout, so that the package
+  only needs to be signed once. If the prediction can't be made or turns out to
+  be wrong, it falls back to a preliminary signing to learn the offsets.
+
   Args:
     metadata: The metadata dict for the package.
     input_file: The input ZIP filename that doesn't contain the package METADATA
@@ -64,19 +69,27 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
     needed_property_files: The list of PropertyFiles' to be generated.
   """
 
+  def ReplaceMetadata(zip_filename):
+    with zipfile.ZipFile(zip_filename, allowZip64=True) as zip_file:
+      namelist = zip_file.namelist()
+    entries_to_delete = [name for name in (METADATA_NAME, METADATA_PROTO_NAME)
+                         if name in namelist]
+    if entries_to_delete:
+      with ZipRewriter(zip_filename, entries_to_delete) as output_zip:
+        WriteMetadata(metadata, output_zip)
+    else:
+      output_zip = zipfile.ZipFile(zip_filename, 'a', allowZip64=True)
+      WriteMetadata(metadata, output_zip)
+      ZipClose(output_zip)
+
   def ComputeAllPropertyFiles(input_file, needed_property_files):
     # Write the current metadata entry with placeholders.
     with zipfile.ZipFile(input_file, allowZip64=True) as input_zip:
       for property_files in needed_property_files:
         metadata.property_files[property_files.name] = property_files.Compute(
             input_zip)
-      namelist = input_zip.namelist()
 
-    if METADATA_NAME in namelist or METADATA_PROTO_NAME in namelist:
-      ZipDelete(input_file, [METADATA_NAME, METADATA_PROTO_NAME])
-    output_zip = zipfile.ZipFile(input_file, 'a', allowZip64=True)
-    WriteMetadata(metadata, output_zip)
-    ZipClose(output_zip)
+    ReplaceMetadata(input_file)
 
     if OPTIONS.no_signing:
       return input_file
@@ -92,6 +105,70 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
             prelim_signing_zip,
             len(metadata.property_files[property_files.name]))
 
+  def PlanAllPropertyFiles(input_file, needed_property_files):
+    """Computes the final property-files without signing the package.
+
+    Returns:
+      True if the final property-files could be computed from the predicted
+      layout of the signed package, or False otherwise.
+    """
+    with zipfile.ZipFile(input_file, allowZip64=True) as input_zip:
+      entries = [(info.filename, info.compress_type, info.file_size)
+                 for info in input_zip.infolist()
+                 if info.filename not in (METADATA_NAME, METADATA_PROTO_NAME)]
+
+      # Reserve the space with placeholders as in the two-pass flow, but
+      # compute the other offsets from the predicted layout. The final strings
+      # get padded to the reserved length, so the metadata sizes (and hence the
+      # layout) stay the same.
+      layout = None
+      for _ in range(2):
+        try:
+          for property_files in needed_property_files:
+            metadata.property_files[property_files.name] = (
+                property_files.Compute(input_zip, layout=layout))
+          layout = SignedZipLayout(entries + GetMetadataEntries(metadata))
+          for property_files in needed_property_files:
+            metadata.property_files[property_files.name] = (
+                property_files.Finalize(
+                    input_zip,
+                    len(metadata.property_files[property_files.name]),
+                    layout=layout))
+          return True
+        except PropertyFiles.InsufficientSpaceException:
+          continue
+        except KeyError as e:
+          logger.warning(
+              "Unable to predict the offset of %s in the signed package", e)
+          return False
+    return False
+
+  def VerifyAllPropertyFiles(output_file, needed_property_files):
+    with zipfile.ZipFile(output_file, allowZip64=True) as output_zip:
+      for property_files in needed_property_files:
+        property_files.Verify(
+            output_zip, metadata.property_files[property_files.name].strip())
+
+  def DumpMetadata():
+    # If requested, dump the metadata to a separate file.
+    output_metadata_path = OPTIONS.output_metadata_path
+    if output_metadata_path:
+      WriteMetadata(metadata, output_metadata_path)
+
+  # Unsigned packages keep the entries in place, so there's no need to predict
+  # the layout.
+  if not OPTIONS.no_signing and PlanAllPropertyFiles(
+      input_file, needed_property_files):
+    ReplaceMetadata(input_file)
+    SignOutput(input_file, output_file)
+    try:
+      VerifyAllPropertyFiles(output_file, needed_property_files)
+      DumpMetadata()
+      return
+    except AssertionError as e:
+      logger.warning(
+          "Mismatching layout of the signed package; signing it again: %s", e)
+
   # SignOutput(), which in turn calls signapk.jar, will possibly reorder the ZIP
   # entries, as well as padding the entry headers. We do a preliminary signing
   # (with an incomplete metadata entry) to allow that to happen. Then compute
@@ -111,10 +188,7 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
     FinalizeAllPropertyFiles(prelim_signing, needed_property_files)
 
   # Replace the METADATA entry.
-  ZipDelete(prelim_signing, [METADATA_NAME, METADATA_PROTO_NAME])
-  output_zip = zipfile.ZipFile(prelim_signing, 'a', allowZip64=True)
-  WriteMetadata(metadata, output_zip)
-  ZipClose(output_zip)
+  ReplaceMetadata(prelim_signing)
 
   # Re-sign the package after updating the metadata entry.
   if OPTIONS.no_signing:
@@ -123,15 +197,27 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
     SignOutput(prelim_signing, output_file)
 
   # Reopen the final signed zip to double check the streaming metadata.
-  with zipfile.ZipFile(output_file, allowZip64=True) as output_zip:
-    for property_files in needed_property_files:
-      property_files.Verify(
-          output_zip, metadata.property_files[property_files.name].strip())
+  VerifyAllPropertyFiles(output_file, needed_property_files)
+  DumpMetadata()
 
-  # If requested, dump the metadata to a separate file.
-  output_metadata_path = OPTIONS.output_metadata_path
-  if output_metadata_path:
-    WriteMetadata(metadata, output_metadata_path)
+
+def FormatLegacyOtaMetadata(metadata_proto):
+  """Returns the content of the legacy METADATA entry for the package."""
+  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
+  return "".join(["%s=%s\n" % kv for kv in sorted(metadata_dict.items())])
+
+
+def GetMetadataEntries(metadata_proto):
+  """Returns the (name, compress_type, size) of the METADATA entries.
+
+  This matches the entries that WriteMetadata() adds to a package.
+  """
+  return [
+      (METADATA_PROTO_NAME, zipfile.ZIP_STORED,
+       len(metadata_proto.SerializeToString())),
+      (METADATA_NAME, zipfile.ZIP_STORED,
+       len(FormatLegacyOtaMetadata(metadata_proto).encode())),
+  ]
 
 
 def WriteMetadata(metadata_proto, output):
@@ -144,9 +230,7 @@ def WriteMetadata(metadata_proto, output):
       {output}.pb, e.g. ota_metadata.pb
   """
 
-  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
-  legacy_metadata = "".join(["%s=%s\n" % kv for kv in
-                             sorted(metadata_dict.items())])
+  legacy_metadata = FormatLegacyOtaMetadata(metadata_proto)
   if isinstance(output, zipfile.ZipFile):
     ZipWriteStr(output, METADATA_PROTO_NAME, metadata_proto.SerializeToString(),
                 compress_type=zipfile.ZIP_STORED)
@@ -429,6 +513,64 @@ def GetZipEntryOffset(zfp, entry_info):
   return (offset, size)
 
 
+class SignedZipLayout(object):
+  """Predicts the offsets of the STORED entries in a whole-file signed package.
+
+  signapk.jar (with -w) rewrites the package in a deterministic way: it drops
+  the existing signature files, sorts the remaining entries by name, and writes
+  all the STORED entries ahead of the compressed ones. The local header of each
+  STORED entry carries a 6-byte alignment extra field, plus the 4-byte JAR magic
+  for the very first entry and a zip64 extra field for the entries of 4 GiB or
+  larger. This allows computing the final offsets of the STORED entries, which
+  are the ones listed in the property-files, before signing the package.
+  """
+
+  # The entries that signapk.jar strips (STRIP_PATTERN in SignApk.java).
+  STRIP_PATTERN = re.compile(
+      r'^(META-INF/((.*)[.](SF|RSA|DSA|EC)|com/android/otacert))|'
+      r'(META-INF/MANIFEST[.]MF)$')
+
+  ALIGNMENT_EXTRA_SIZE = 6
+  JAR_MAGIC_EXTRA_SIZE = 4
+  ZIP64_EXTRA_SIZE = 20
+  ZIP64_LIMIT = 0xFFFFFFFF
+
+  def __init__(self, entries):
+    """Initializes the layout.
+
+    Args:
+      entries: A list of (name, compress_type, size) tuples for all the entries
+          of the package, as they will be passed to signapk.jar.
+    """
+    stored_entries = sorted(
+        (name, size) for name, compress_type, size in entries
+        if compress_type == zipfile.ZIP_STORED and not name.endswith('/') and
+        not self.STRIP_PATTERN.match(name))
+
+    self._offsets = {}
+    offset = 0
+    for index, (name, size) in enumerate(stored_entries):
+      extra_length = self.ALIGNMENT_EXTRA_SIZE
+      if index == 0:
+        extra_length += self.JAR_MAGIC_EXTRA_SIZE
+      if size >= self.ZIP64_LIMIT:
+        extra_length += self.ZIP64_EXTRA_SIZE
+      offset += zipfile.sizeFileHeader + len(name.encode()) + extra_length
+      self._offsets[name] = (offset, size)
+      offset += size
+
+  def __contains__(self, name):
+    return name in self._offsets
+
+  def GetEntryOffset(self, name):
+    """Returns the (offset, size) of the entry data in the signed package.
+
+    Raises:
+      KeyError: If the entry isn't a STORED entry of the package.
+    """
+    return self._offsets[name]
+
+
 class PropertyFiles(object):
   """A class that computes the property-files string for an OTA package.
 
@@ -456,6 +598,13 @@ class PropertyFiles(object):
     property_files.Finalize()
     SignOutput()
 
+  Alternatively, both passes can be done on the unsigned package with the
+  offsets taken from a SignedZipLayout, which saves the initial signing.
+
+    property_files.Compute(layout=layout)
+    property_files.Finalize(layout=layout)
+    SignOutput()
+
   And the caller can additionally verify the final result.
 
     property_files.Verify()
@@ -466,7 +615,7 @@ class PropertyFiles(object):
     self.required = ()
     self.optional = ()
 
-  def Compute(self, input_zip):
+  def Compute(self, input_zip, layout=None):
     """Computes and returns a property-files string with placeholders.
 
     We reserve extra space for the offset and size of the metadata entry itself,
@@ -474,17 +623,19 @@ class PropertyFiles(object):
 
     Args:
       input_zip: The input ZIP file.
+      layout: An optional SignedZipLayout to take the entry offsets from.
 
     Returns:
       A string with placeholders for the metadata offset/size info, e.g.
       "payload.bin:679:343,payload_properties.txt:378:45,metadata:        ".
     """
-    return self.GetPropertyFilesString(input_zip, reserve_space=True)
+    return self.GetPropertyFilesString(
+        input_zip, reserve_space=True, layout=layout)
 
   class InsufficientSpaceException(Exception):
     pass
 
-  def Finalize(self, input_zip, reserved_length):
+  def Finalize(self, input_zip, reserved_length, layout=None):
     """Finalizes a property-files string with actual METADATA offset/size info.
 
     The input ZIP file has been signed, with the ZIP entries in the desired
@@ -499,6 +650,8 @@ class PropertyFiles(object):
       reserved_length: The reserved length of the property-files string during
           the call to Compute(). The final string must be no more than this
           size.
+      layout: An optional SignedZipLayout to take the entry offsets from,
+          instead of the (already signed) input ZIP file.
 
     Returns:
       A property-files string including the metadata offset/size info, e.g.
@@ -508,7 +661,8 @@ class PropertyFiles(object):
       InsufficientSpaceException: If the reserved length is insufficient to hold
           the final string.
     """
-    result = self.GetPropertyFilesString(input_zip, reserve_space=False)
+    result = self.GetPropertyFilesString(
+        input_zip, reserve_space=False, layout=layout)
     if len(result) > reserved_length:
       raise self.InsufficientSpaceException(
           'Insufficient reserved space: reserved={}, actual={}'.format(
@@ -531,13 +685,14 @@ class PropertyFiles(object):
     assert actual == expected, \
         "Mismatching streaming metadata: {} vs {}.".format(actual, expected)
 
-  def GetPropertyFilesString(self, zip_file, reserve_space=False):
+  def GetPropertyFilesString(self, zip_file, reserve_space=False, layout=None):
     """
     Constructs the property-files string per request.
 
     Args:
       zip_file: The input ZIP file.
       reserved_length: The reserved length of the property-files string.
+      layout: An optional SignedZipLayout to take the entry offsets from.
 
     Returns:
       A property-files string including the metadata offset/size info, e.g.
@@ -546,12 +701,15 @@ class PropertyFiles(object):
 
     def ComputeEntryOffsetSize(name):
       """Computes the zip entry offset and size."""
-      info = zip_file.getinfo(name)
-      (offset, size) = GetZipEntryOffset(zip_file, info)
+      if layout:
+        (offset, size) = layout.GetEntryOffset(name)
+      else:
+        info = zip_file.getinfo(name)
+        (offset, size) = GetZipEntryOffset(zip_file, info)
       return '%s:%d:%d' % (os.path.basename(name), offset, size)
 
     tokens = []
-    tokens.extend(self._GetPrecomputed(zip_file))
+    tokens.extend(self._GetPrecomputed(zip_file, layout=layout))
     for entry in self.required:
       tokens.append(ComputeEntryOffsetSize(entry))
     for entry in self.optional:
@@ -569,12 +727,12 @@ class PropertyFiles(object):
       tokens.append('metadata.pb:' + ' ' * 15)
     else:
       tokens.append(ComputeEntryOffsetSize(METADATA_NAME))
-      if METADATA_PROTO_NAME in zip_file.namelist():
+      if METADATA_PROTO_NAME in (layout or zip_file.namelist()):
           tokens.append(ComputeEntryOffsetSize(METADATA_PROTO_NAME))
 
     return ','.join(tokens)
 
-  def _GetPrecomputed(self, input_zip):
+  def _GetPrecomputed(self, input_zip, layout=None):
     """Computes the additional tokens to be included into the property-files.
 
     This applies to tokens without actual ZIP entries, such as
@@ -583,6 +741,7 @@ class PropertyFiles(object):
 
     Args:
       input_zip: The input zip file.
+      layout: An optional SignedZipLayout to take the entry offsets from.
 
     Returns:
       A list of strings (tokens) to be added to the property-files string.
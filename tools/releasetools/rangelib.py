@@ -14,16 +14,28 @@
 
 from __future__ import print_function
 
-import heapq
-import itertools
+import array
+import bisect
 
 
 __all__ = ["RangeSet"]
 
+# RangeSet endpoints are kept in a flat array of signed 64-bit integers, which
+# costs 8 bytes per endpoint instead of a tuple slot plus an int object.
+_TYPECODE = "q"
+
+
+def _new_array(values=()):
+  return array.array(_TYPECODE, values)
+
 
 class RangeSet(object):
   """A RangeSet represents a set of non-overlapping ranges on integers.
 
+  The ranges are stored as a flat, strictly increasing array of [start, end)
+  pairs in 'data', so that the set operations can skip over non-overlapping
+  parts with binary searches instead of walking every endpoint.
+
   Attributes:
     monotonic: Whether the input has all its integers in increasing order.
     extra: A dict that can be used by the caller, e.g. to store info that's
@@ -37,14 +49,23 @@ class RangeSet(object):
       self._parse_internal(data)
     elif data:
       assert len(data) % 2 == 0
-      self.data = tuple(self._remove_pairs(data))
+      self.data = _new_array(self._remove_pairs(data))
       self.monotonic = all(x < y for x, y in zip(self.data, self.data[1:]))
     else:
-      self.data = ()
+      self.data = _new_array()
+
+  @classmethod
+  def _from_array(cls, data):
+    """Wraps an already normalized array without re-validating it."""
+    out = cls()
+    out.data = data
+    out.monotonic = bool(data)
+    return out
 
   def __iter__(self):
-    for i in range(0, len(self.data), 2):
-      yield self.data[i:i+2]
+    data = self.data
+    for i in range(0, len(data), 2):
+      yield data[i], data[i+1]
 
   def __eq__(self, other):
     return self.data == other.data
@@ -123,7 +144,7 @@ class RangeSet(object):
         else:
           monotonic = False
     data.sort()
-    self.data = tuple(self._remove_pairs(data))
+    self.data = _new_array(self._remove_pairs(data))
     self.monotonic = monotonic
 
   @staticmethod
@@ -142,10 +163,21 @@ class RangeSet(object):
     if last is not None:
       yield last
 
+  @staticmethod
+  def _skip_to(data, p, lo=0):
+    """Returns the index of the first range in 'data' whose end is above 'p'.
+
+    The returned value is an index into the flat array (i.e. always even), or
+    len(data) if there is no such range.
+    """
+    # bisect_right() lands right after the last endpoint that is <= p. If that
+    # endpoint is a start, p falls into that range; otherwise p falls into the
+    # gap before the next range. Both cases round down to an even index.
+    return bisect.bisect_right(data, p, lo) & ~1
+
   def to_string(self):
     out = []
-    for i in range(0, len(self.data), 2):
-      s, e = self.data[i:i+2]
+    for s, e in self:
       if e == s+1:
         out.append(str(s))
       else:
@@ -165,14 +197,38 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").union(RangeSet("22 32"))
     <RangeSet("10-19 22 30-34")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    if not a or not b:
+      return RangeSet._from_array(_new_array(a or b))
+    # Make 'a' the one that starts first; everything in 'a' that ends before
+    # 'b' starts can then be copied over in one go.
+    if b[0] < a[0]:
+      a, b = b, a
+    i = RangeSet._skip_to(a, b[0] - 1)
+    out = a[:i]
+    j = 0
+    na, nb = len(a), len(b)
+    while i < na and j < nb:
+      if a[i] <= b[j]:
+        s, e = a[i], a[i+1]
+        i += 2
+      else:
+        s, e = b[j], b[j+1]
+        j += 2
+      if out and s <= out[-1]:
+        if e > out[-1]:
+          out[-1] = e
+      else:
+        out.append(s)
+        out.append(e)
+    rest, k = (a, i) if i < na else (b, j)
+    # The remaining ranges may still touch the last one emitted.
+    while k < len(rest) and rest[k] <= out[-1]:
+      if rest[k+1] > out[-1]:
+        out[-1] = rest[k+1]
+      k += 2
+    out.extend(rest[k:])
+    return RangeSet._from_array(out)
 
   def intersect(self, other):
     """Return a new RangeSet representing the intersection of this
@@ -183,14 +239,28 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").intersect(RangeSet("22-28"))
     <RangeSet("")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    out = _new_array()
+    i = j = 0
+    na, nb = len(a), len(b)
+    skip_to = RangeSet._skip_to
+    while i < na and j < nb:
+      if a[i+1] <= b[j]:
+        i = skip_to(a, b[j], i)
+      elif b[j+1] <= a[i]:
+        j = skip_to(b, a[i], j)
+      else:
+        out.append(max(a[i], b[j]))
+        ae, be = a[i+1], b[j+1]
+        if ae <= be:
+          out.append(ae)
+          i += 2
+          if ae == be:
+            j += 2
+        else:
+          out.append(be)
+          j += 2
+    return RangeSet._from_array(out)
 
   def subtract(self, other):
     """Return a new RangeSet representing subtracting the argument
@@ -201,15 +271,37 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").subtract(RangeSet("22-28"))
     <RangeSet("10-19 30-34")>
     """
-
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((-1, +1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    if not a or not b:
+      return RangeSet._from_array(_new_array(a))
+    # Ranges of 'a' that end before 'b' starts are kept as is.
+    i = RangeSet._skip_to(a, b[0])
+    out = a[:i]
+    j = 0
+    na, nb = len(a), len(b)
+    while i < na:
+      if j >= nb:
+        out.extend(a[i:])
+        break
+      s, e = a[i], a[i+1]
+      if b[j+1] <= s:
+        j = RangeSet._skip_to(b, s, j)
+      while j < nb and b[j] < e:
+        if b[j] > s:
+          out.append(s)
+          out.append(b[j])
+        if b[j+1] >= e:
+          # The rest of this range is covered; the same range of 'b' may
+          # cover the next range of 'a' as well.
+          s = e
+          break
+        s = max(s, b[j+1])
+        j += 2
+      if s < e:
+        out.append(s)
+        out.append(e)
+      i += 2
+    return RangeSet._from_array(out)
 
   def overlaps(self, other):
     """Returns true if the argument has a nonempty overlap with this
@@ -223,12 +315,19 @@ class RangeSet(object):
 
     # This is like intersect, but we can stop as soon as we discover the
     # output is going to be nonempty.
-    z = 0
-    for _, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
+    a, b = self.data, other.data
+    if not a or not b or a[-1] <= b[0] or b[-1] <= a[0]:
+      return False
+    i = j = 0
+    na, nb = len(a), len(b)
+    skip_to = RangeSet._skip_to
+    while i < na and j < nb:
+      if a[i+1] <= b[j]:
+        i = skip_to(a, b[j], i)
+      elif b[j+1] <= a[i]:
+        j = skip_to(b, a[i], j)
+      else:
         return True
-      z += d
     return False
 
   def size(self):
@@ -239,13 +338,7 @@ class RangeSet(object):
     15
     """
 
-    total = 0
-    for i, p in enumerate(self.data):
-      if i % 2:
-        total += p
-      else:
-        total -= p
-    return total
+    return sum(self.data[1::2]) - sum(self.data[0::2])
 
   def map_within(self, other):
     """'other' should be a subset of 'self'.  Returns a RangeSet
@@ -262,19 +355,27 @@ class RangeSet(object):
     <RangeSet("2-3 7-12")>
     """
 
-    out = []
+    a, b = self.data, other.data
+    out = _new_array()
     offset = 0
-    start = None
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((-5, +5))),
-                            zip(other.data, itertools.cycle((-1, +1)))):
-      if d == -5:
-        start = p
-      elif d == +5:
-        offset += p-start
-        start = None
+    i = 0
+    na = len(a)
+    for j in range(0, len(b), 2):
+      s, e = b[j], b[j+1]
+      while i < na and a[i+1] <= s:
+        offset += a[i+1] - a[i]
+        i += 2
+      assert i < na and a[i] <= s and e <= a[i+1], \
+          "{} is not a subset of {}".format(other, self)
+      s = offset + s - a[i]
+      e = offset + e - a[i]
+      # Ranges in adjacent source ranges become contiguous once mapped.
+      if out and out[-1] == s:
+        out[-1] = e
       else:
-        out.append(offset + p - start)
-    return RangeSet(data=out)
+        out.append(s)
+        out.append(e)
+    return RangeSet._from_array(out)
 
   def extend(self, n):
     """Extend the RangeSet by 'n' blocks.
@@ -290,13 +391,16 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-39").extend(10)
     <RangeSet("0-49")>
     """
-    out = self
-    for i in range(0, len(self.data), 2):
-      s, e = self.data[i:i+2]
-      s1 = max(0, s - n)
-      e1 = e + n
-      out = out.union(RangeSet(str(s1) + "-" + str(e1-1)))
-    return out
+    out = _new_array()
+    for s, e in self:
+      s = max(0, s - n)
+      e = e + n
+      if out and s <= out[-1]:
+        out[-1] = e
+      else:
+        out.append(s)
+        out.append(e)
+    return self.union(RangeSet._from_array(out))
 
   def first(self, n):
     """Return the RangeSet that contains at most the first 'n' integers.
@@ -320,15 +424,16 @@ class RangeSet(object):
     if self.size() <= n:
       return self
 
-    out = []
+    out = _new_array()
     for s, e in self:
       if e - s >= n:
-        out += (s, s+n)
+        if n:
+          out.extend((s, s+n))
         break
       else:
-        out += (s, e)
+        out.extend((s, e))
         n -= e - s
-    return RangeSet(data=out)
+    return RangeSet._from_array(out)
 
   def next_item(self):
     """Return the next integer represented by the RangeSet.
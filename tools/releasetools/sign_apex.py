@@ -45,6 +45,10 @@ Usage:  sign_apex [flags] input_apex_file output_apex_file
 
   --container_pw <name1=passwd,name2=passwd>
       A mapping of key_name to password
+
+  --apk_signing_jobs <jobs>
+      Sign up to <jobs> APKs in the apex payload image concurrently, each with
+      its own signapk.jar JVM (default: 1).
 """
 
 import logging
@@ -59,7 +63,8 @@ logger = logging.getLogger(__name__)
 
 
 def SignApexFile(avbtool, apex_file, payload_key, container_key, no_hashtree,
-                 apk_keys=None, signing_args=None, codename_to_api_level_map=None, sign_tool=None, container_pw=None):
+                 apk_keys=None, signing_args=None, codename_to_api_level_map=None, sign_tool=None, container_pw=None,
+                 apk_signing_jobs=1):
   """Signs the given apex file."""
   with open(apex_file, 'rb') as input_fp:
     apex_data = input_fp.read()
@@ -74,7 +79,8 @@ def SignApexFile(avbtool, apex_file, payload_key, container_key, no_hashtree,
       no_hashtree=no_hashtree,
       apk_keys=apk_keys,
       signing_args=signing_args,
-      sign_tool=sign_tool)
+      sign_tool=sign_tool,
+      apk_signing_jobs=apk_signing_jobs)
 
 
 def main(argv):
@@ -119,6 +125,10 @@ def main(argv):
         tokens = pair.split("=", maxsplit=1)
         passwords[tokens[0].strip()] = tokens[1].strip()
       options['container_pw'] = passwords
+    elif o == '--apk_signing_jobs':
+      if not a.isdigit() or int(a) < 1:
+        raise ValueError("Invalid --apk_signing_jobs: {}".format(a))
+      options['apk_signing_jobs'] = int(a)
     else:
       return False
     return True
@@ -135,6 +145,7 @@ def main(argv):
           'extra_apks=',
           'sign_tool=',
           'container_pw=',
+          'apk_signing_jobs=',
       ],
       extra_option_handler=option_handler)
 
@@ -157,6 +168,7 @@ def main(argv):
           'codename_to_api_level_map', {}),
       sign_tool=options.get('sign_tool', None),
       container_pw=options.get('container_pw'),
+      apk_signing_jobs=options.get('apk_signing_jobs', 1),
   )
   shutil.copyfile(signed_apex, args[1])
   logger.info("done.")
@@ -141,16 +141,42 @@ Usage:  sign_target_files_apks [flags] input_target_files output_target_files
       Allow the existence of the file 'userdebug_plat_sepolicy.cil' under
       (/system/system_ext|/system_ext)/etc/selinux.
       If not set, error out when the file exists.
+
+  --signing_jobs <jobs>
+      Sign up to <jobs> APKs and APEXes concurrently. The output is identical
+      to signing them one at a time (default: 1).
+
+  --apex_apk_signing_jobs <jobs>
+      Sign up to <jobs> APKs in each APEX concurrently. Each of them runs its
+      own signapk.jar JVM, on top of the ones of --signing_jobs (default: the
+      number of CPUs divided by --signing_jobs).
+
+  --signed_artifact_cache_dir <dir>
+      Cache the signed APKs and APEXes in the given directory, keyed by the
+      digest of the unsigned file, the signing keys and the signing args, so
+      that files unchanged since a previous run aren't signed again.
+
+  --signed_artifact_cache_size <bytes>
+      The size limit of the signed artifact cache (defaults to 16 GiB). The
+      least recently used files are evicted beyond that.
+
+  --reuse_unchanged_images
+      Copy the images of the partitions whose contents (and AVB signing args)
+      weren't changed by signing from the input target_files, instead of
+      rebuilding them. The vbmeta images are always rebuilt.
 """
 
 from __future__ import print_function
 
 import base64
+import collections
 import copy
 import errno
+import functools
 import gzip
 import io
 import itertools
+import json
 import logging
 import os
 import re
@@ -160,6 +186,8 @@ import subprocess
 import sys
 import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from xml.etree import ElementTree
 
 import add_img_to_target_files
@@ -197,6 +225,11 @@ OPTIONS.android_jar_path = None
 OPTIONS.vendor_partitions = set()
 OPTIONS.vendor_otatools = None
 OPTIONS.allow_gsi_debug_sepolicy = False
+OPTIONS.signing_jobs = 1
+OPTIONS.apex_apk_signing_jobs = None
+OPTIONS.signed_artifact_cache_dir = None
+OPTIONS.signed_artifact_cache_size = 16 * (1 << 30)
+OPTIONS.reuse_unchanged_images = False
 
 
 AVB_FOOTER_ARGS_BY_PARTITION = {
@@ -231,6 +264,25 @@ for partition in common.AVB_PARTITIONS:
 # vendor otatools package.
 ALLOWED_VENDOR_PARTITIONS = set(["vendor", "odm"])
 
+# The partition images built from each directory in target_files.
+PARTITIONS_BY_DIR = {
+    "SYSTEM": ("system",),
+    "ROOT": ("system",),
+    "SYSTEM_OTHER": ("system_other",),
+    "VENDOR": ("vendor",),
+    "PRODUCT": ("product",),
+    "SYSTEM_EXT": ("system_ext",),
+    "ODM": ("odm",),
+    "VENDOR_DLKM": ("vendor_dlkm",),
+    "ODM_DLKM": ("odm_dlkm",),
+    "SYSTEM_DLKM": ("system_dlkm",),
+    "BOOT": ("boot",),
+    "INIT_BOOT": ("init_boot",),
+    "VENDOR_BOOT": ("vendor_boot",),
+    "VENDOR_KERNEL_BOOT": ("vendor_kernel_boot",),
+    "RECOVERY": ("recovery",),
+}
+
 
 def IsApexFile(filename):
   return filename.endswith(".apex") or filename.endswith(".capex")
@@ -434,8 +486,105 @@ def CheckApkAndApexKeysAvailable(input_tf_zip, known_keys,
           "\n  ".join(invalid_apexes))
 
 
+class SignedArtifactCache(common.BlobCache):
+  """An on-disk cache of signed APKs and APEXes.
+
+  The signed files are stored by a key derived from the SHA-256 of the unsigned
+  file, the signing parameters, and the digests of the signing tools and of
+  the public certificates (or the key files if there's no certificate) of the
+  keys, so that a rotated key or an updated tool invalidates the entries. Key
+  passwords aren't part of the key, as they don't change the output.
+
+  Files whose keys or tools can't be found (e.g. keys loaded from a key store
+  via --extra_signapk_args) aren't cached.
+  """
+
+  DESCRIPTION = "Signed artifact cache"
+
+  def __init__(self, cache_dir, max_size):
+    super(SignedArtifactCache, self).__init__(cache_dir, max_size)
+    self._file_digests = {}
+
+  def _GetFileDigest(self, path):
+    """Returns the SHA-256 of the file, or None if it doesn't exist."""
+    with self._lock:
+      if path not in self._file_digests:
+        digest = None
+        if path and os.path.isfile(path):
+          h = sha256()
+          with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+              h.update(chunk)
+          digest = h.hexdigest()
+        self._file_digests[path] = digest
+      return self._file_digests[path]
+
+  def GetKey(self, kind, data, files, params):
+    """Returns the key of a signed artifact, or None if it can't be cached.
+
+    Args:
+      kind: The kind of the artifact, e.g. "apk".
+      data: The unsigned data.
+      files: A list of the key and tool files that determine the output.
+      params: A JSON-serializable dict of all the other signing parameters.
+    """
+    file_digests = [self._GetFileDigest(path) for path in files]
+    if None in file_digests:
+      return None
+    return sha256(json.dumps(
+        [kind, sha256(data).hexdigest(), file_digests, params],
+        sort_keys=True).encode()).hexdigest()
+
+
+_signed_artifact_cache = None
+
+
+def GetSignedArtifactCache():
+  """Returns the SignedArtifactCache for OPTIONS.signed_artifact_cache_dir.
+
+  Returns None if the option is unset.
+  """
+  global _signed_artifact_cache  # pylint: disable=global-statement
+  if not OPTIONS.signed_artifact_cache_dir:
+    return None
+  if (_signed_artifact_cache is None or
+      _signed_artifact_cache.cache_dir != OPTIONS.signed_artifact_cache_dir):
+    _signed_artifact_cache = SignedArtifactCache(
+        OPTIONS.signed_artifact_cache_dir, OPTIONS.signed_artifact_cache_size)
+  return _signed_artifact_cache
+
+
+def GetSignapkFiles(keynames):
+  """Returns the files that determine the output of signapk with the keys."""
+  return ([os.path.join(OPTIONS.search_path, OPTIONS.signapk_path)] +
+          [keyname + OPTIONS.public_key_suffix for keyname in keynames])
+
+
 def SignApk(data, keyname, pw, platform_api_level, codename_to_api_level_map,
             is_compressed, apk_name):
+  cache = GetSignedArtifactCache()
+  cache_key = None
+  if cache:
+    cache_key = cache.GetKey(
+        "apk", data, GetSignapkFiles([keyname]),
+        {"keyname": keyname,
+         "platform_api_level": platform_api_level,
+         "codename_to_api_level_map": codename_to_api_level_map,
+         "is_compressed": is_compressed,
+         "extra_signapk_args": OPTIONS.extra_signapk_args})
+    signed_data = cache.GetBlob(cache_key)
+    if signed_data is not None:
+      return signed_data
+
+  signed_data = _SignApk(data, keyname, pw, platform_api_level,
+                         codename_to_api_level_map, is_compressed, apk_name)
+  if cache:
+    cache.PutBlob(cache_key, signed_data)
+  return signed_data
+
+
+def _SignApk(data, keyname, pw, platform_api_level, codename_to_api_level_map,
+             is_compressed, apk_name):
   unsigned = tempfile.NamedTemporaryFile(suffix='_' + apk_name)
   unsigned.write(data)
   unsigned.flush()
@@ -497,6 +646,181 @@ def SignApk(data, keyname, pw, platform_api_level, codename_to_api_level_map,
   return data
 
 
+def GetApexApkSigningJobs():
+  """Returns the number of APKs in an APEX to sign concurrently.
+
+  Up to OPTIONS.signing_jobs APEXes get signed at the same time, so the CPUs
+  are shared among them by default.
+  """
+  if OPTIONS.apex_apk_signing_jobs:
+    return OPTIONS.apex_apk_signing_jobs
+  return max(1, (os.cpu_count() or 1) // OPTIONS.signing_jobs)
+
+
+# The host tools that unpack and repack an APEX, besides avbtool, sign_tool and
+# signapk.jar. apexer finds the filesystem tools on the PATH, and only uses the
+# ones for the payload's filesystem type.
+APEX_TOOLS = ("apexer", "deapexer", "aapt2")
+APEX_FILESYSTEM_TOOLS = ("mke2fs", "e2fsdroid", "resize2fs",
+                         "sefcontext_compile", "mkfs.erofs", "fsck.erofs")
+
+
+def GetApexToolFiles():
+  """Returns the files of the tools that determine the output of SignApex().
+
+  Returns:
+    A tuple of (tool_files, filesystem_tools). tool_files contains None for
+    any of APEX_TOOLS that can't be found. filesystem_tools lists the names of
+    the APEX_FILESYSTEM_TOOLS that are found, whose files are in tool_files.
+  """
+  tool_files = [shutil.which(common.FindHostToolPath(tool))
+                for tool in APEX_TOOLS]
+  tool_files.append(os.path.join(OPTIONS.search_path, "bin", "debugfs_static"))
+  filesystem_tools = []
+  for tool in APEX_FILESYSTEM_TOOLS:
+    tool_file = shutil.which(tool)
+    if tool_file:
+      tool_files.append(tool_file)
+      filesystem_tools.append(tool)
+  return tool_files, filesystem_tools
+
+
+def SignApexData(data, avbtool, payload_key, container_key, key_passwords,
+                 apk_keys, codename_to_api_level_map, sign_tool):
+  """Signs the given APEX data and returns the path to the signed APEX."""
+  cache = GetSignedArtifactCache()
+  cache_key = None
+  if cache:
+    # The APKs in the APEX are signed with apk_keys, and the payload is signed
+    # with avbtool or the given sign_tool, after being unpacked and repacked
+    # with the APEX_TOOLS.
+    key_files = GetSignapkFiles(
+        [container_key] + sorted(set(apk_keys.values()) -
+                                 set(common.SPECIAL_CERT_STRINGS)))
+    tools = [avbtool] + ([sign_tool] if sign_tool else [])
+    tool_files = [shutil.which(common.FindHostToolPath(tool)) for tool in tools]
+    apex_tool_files, filesystem_tools = GetApexToolFiles()
+    cache_key = cache.GetKey(
+        "apex", data, key_files + [payload_key] + tool_files + apex_tool_files,
+        {"payload_key": payload_key,
+         "filesystem_tools": filesystem_tools,
+         "container_key": container_key,
+         "apk_keys": apk_keys,
+         "codename_to_api_level_map": codename_to_api_level_map,
+         "sign_tool": sign_tool,
+         "signing_args": OPTIONS.avb_extra_args.get('apex'),
+         "extra_signapk_args": OPTIONS.extra_signapk_args})
+    signed_data = cache.GetBlob(cache_key)
+    if signed_data is not None:
+      signed_apex = common.MakeTempFile(prefix='apex-', suffix='.apex')
+      with open(signed_apex, 'wb') as f:
+        f.write(signed_data)
+      return signed_apex
+
+  signed_apex = apex_utils.SignApex(
+      avbtool,
+      data,
+      payload_key,
+      container_key,
+      key_passwords,
+      apk_keys,
+      codename_to_api_level_map,
+      no_hashtree=None,  # Let apex_util determine if hash tree is needed
+      signing_args=OPTIONS.avb_extra_args.get('apex'),
+      sign_tool=sign_tool,
+      apk_signing_jobs=GetApexApkSigningJobs())
+  if cache:
+    with open(signed_apex, 'rb') as f:
+      cache.PutBlob(cache_key, f.read())
+  return signed_apex
+
+
+class OrderedSigningPool(object):
+  """Signs APKs and APEXes in a bounded worker pool, in the original order.
+
+  ProcessTargetFiles() writes the output zip sequentially. The pool signs the
+  upcoming entries ahead of the writer, but hands the results back in the
+  order of the given tasks, so the output is byte-identical to signing them
+  one by one. At most 'lookahead' signed results are kept pending, which bounds
+  the memory held by results the writer hasn't consumed yet.
+
+  With jobs <= 1 no threads are started and each task runs when its result is
+  requested, on the data that the writer has read. Otherwise the tasks read the
+  entries themselves (see ReadsAhead()), so that the writer doesn't need to
+  read them again.
+
+  Args:
+    tasks: An iterable of (filename, sign_func) in the order the writer will
+        ask for them. sign_func(data) takes the entry's data and returns the
+        signed result.
+    read_func: A function that returns the data of an entry by its filename,
+        e.g. the input ZipFile's read().
+    jobs: The number of signing jobs to run concurrently.
+    lookahead: The maximum number of tasks submitted ahead of the writer;
+        defaults to 2 * jobs.
+  """
+
+  def __init__(self, tasks, read_func, jobs=1, lookahead=None):
+    self._tasks = iter(tasks)
+    self._read_func = read_func
+    self._jobs = jobs
+    self._lookahead = lookahead or 2 * jobs
+    self._pending = collections.OrderedDict()
+    self._executor = None
+    if jobs > 1:
+      self._executor = ThreadPoolExecutor(max_workers=jobs)
+      self._Fill()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def _Fill(self):
+    while len(self._pending) < self._lookahead:
+      task = next(self._tasks, None)
+      if task is None:
+        break
+      filename, sign_func = task
+      self._pending[filename] = self._executor.submit(
+          lambda f=filename, func=sign_func: func(self._read_func(f)))
+
+  def ReadsAhead(self, filename):
+    """Returns whether the entry is being read and signed by a worker."""
+    return self._executor is not None and filename in self._pending
+
+  def Get(self, filename, data):
+    """Returns the signed result of the entry.
+
+    Entries must be requested in the order of the tasks. 'data' is the entry's
+    data, which is used when signing sequentially; it can be None for the
+    entries that the pool ReadsAhead().
+    """
+    if self._executor is None:
+      task_filename, sign_func = next(self._tasks)
+      assert task_filename == filename, \
+          "Expected {}, got {}".format(task_filename, filename)
+      return sign_func(data)
+
+    assert self._pending, "No pending signing task for {}".format(filename)
+    task_filename, future = self._pending.popitem(last=False)
+    assert task_filename == filename, \
+        "Expected {}, got {}".format(task_filename, filename)
+    self._Fill()
+    return future.result()
+
+  def Close(self):
+    """Cancels the pending tasks and waits for the running ones to finish."""
+    if self._executor is None:
+      return
+    for future in self._pending.values():
+      future.cancel()
+    self._pending.clear()
+    self._executor.shutdown(wait=True)
+    self._executor = None
+
+
 def IsBuildPropFile(filename):
   return filename in (
       "SYSTEM/etc/prop.default",
@@ -532,216 +856,257 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
 
   system_root_image = misc_info.get("system_root_image") == "true"
 
-  for info in input_tf_zip.infolist():
-    filename = info.filename
-    if filename.startswith("IMAGES/"):
-      continue
+  def GetSigningTasks():
+    """Yields (filename, sign_func) for the entries to be signed, in order.
 
-    # Skip OTA-specific images (e.g. split super images), which will be
-    # re-generated during signing.
-    if filename.startswith("OTA/") and filename.endswith(".img"):
-      continue
+    The conditions must match the APK and APEX branches below, which fetch the
+    signed results from the pool in the same order.
+    """
+    for info in input_tf_zip.infolist():
+      filename = info.filename
+      if filename.startswith("IMAGES/"):
+        continue
+      if filename.startswith("OTA/") and filename.endswith(".img"):
+        continue
 
-    data = input_tf_zip.read(filename)
-    out_info = copy.copy(info)
-    (is_apk, is_compressed, should_be_skipped) = GetApkFileInfo(
-        filename, compressed_extension, OPTIONS.skip_apks_with_path_prefix)
+      (is_apk, is_compressed, should_be_skipped) = GetApkFileInfo(
+          filename, compressed_extension, OPTIONS.skip_apks_with_path_prefix)
+      if is_apk:
+        if should_be_skipped:
+          continue
+        name = os.path.basename(filename)
+        if is_compressed:
+          name = name[:-len(compressed_extension)]
+        key = apk_keys[name]
+        if key in common.SPECIAL_CERT_STRINGS:
+          continue
+        yield filename, functools.partial(
+            SignApk, keyname=key, pw=key_passwords[key],
+            platform_api_level=platform_api_level,
+            codename_to_api_level_map=codename_to_api_level_map,
+            is_compressed=is_compressed, apk_name=name)
+
+      elif IsApexFile(filename):
+        name = GetApexFilename(filename)
+        payload_key, container_key, sign_tool = apex_keys[name]
+        if (payload_key in common.SPECIAL_CERT_STRINGS or
+                container_key in common.SPECIAL_CERT_STRINGS):
+          continue
+        yield filename, functools.partial(
+            SignApexData,
+            avbtool=misc_info['avb_avbtool'],
+            payload_key=payload_key,
+            container_key=container_key,
+            key_passwords=key_passwords,
+            apk_keys=apk_keys,
+            codename_to_api_level_map=codename_to_api_level_map,
+            sign_tool=sign_tool)
 
-    if is_apk and should_be_skipped:
-      # Copy skipped APKs verbatim.
-      print(
-          "NOT signing: %s\n"
-          "        (skipped due to matching prefix)" % (filename,))
-      common.ZipWriteStr(output_tf_zip, out_info, data)
-
-    # Sign APKs.
-    elif is_apk:
-      name = os.path.basename(filename)
-      if is_compressed:
-        name = name[:-len(compressed_extension)]
-
-      key = apk_keys[name]
-      if key not in common.SPECIAL_CERT_STRINGS:
-        print("    signing: %-*s (%s)" % (maxsize, name, key))
-        signed_data = SignApk(data, key, key_passwords[key], platform_api_level,
-                              codename_to_api_level_map, is_compressed, name)
-        common.ZipWriteStr(output_tf_zip, out_info, signed_data)
-      else:
-        # an APK we're not supposed to sign.
-        print(
-            "NOT signing: %s\n"
-            "        (skipped due to special cert string)" % (name,))
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+  with OrderedSigningPool(
+      GetSigningTasks(), input_tf_zip.read, OPTIONS.signing_jobs) as signer:
+    for info in input_tf_zip.infolist():
+      filename = info.filename
+      if filename.startswith("IMAGES/"):
+        continue
 
-    # Sign bundled APEX files on all partitions
-    elif IsApexFile(filename):
-      name = GetApexFilename(filename)
-
-      payload_key, container_key, sign_tool = apex_keys[name]
-
-      # We've asserted not having a case with only one of them PRESIGNED.
-      if (payload_key not in common.SPECIAL_CERT_STRINGS and
-              container_key not in common.SPECIAL_CERT_STRINGS):
-        print("    signing: %-*s container (%s)" % (
-            maxsize, name, container_key))
-        print("           : %-*s payload   (%s)" % (
-            maxsize, name, payload_key))
-
-        signed_apex = apex_utils.SignApex(
-            misc_info['avb_avbtool'],
-            data,
-            payload_key,
-            container_key,
-            key_passwords,
-            apk_keys,
-            codename_to_api_level_map,
-            no_hashtree=None,  # Let apex_util determine if hash tree is needed
-            signing_args=OPTIONS.avb_extra_args.get('apex'),
-            sign_tool=sign_tool)
-        common.ZipWrite(output_tf_zip, signed_apex, filename)
+      # Skip OTA-specific images (e.g. split super images), which will be
+      # re-generated during signing.
+      if filename.startswith("OTA/") and filename.endswith(".img"):
+        continue
 
+      if signer.ReadsAhead(filename):
+        # The entry gets signed from the data read by the worker.
+        data = None
       else:
+        data = input_tf_zip.read(filename)
+      out_info = copy.copy(info)
+      (is_apk, is_compressed, should_be_skipped) = GetApkFileInfo(
+          filename, compressed_extension, OPTIONS.skip_apks_with_path_prefix)
+
+      if is_apk and should_be_skipped:
+        # Copy skipped APKs verbatim.
         print(
             "NOT signing: %s\n"
-            "        (skipped due to special cert string)" % (name,))
+            "        (skipped due to matching prefix)" % (filename,))
         common.ZipWriteStr(output_tf_zip, out_info, data)
 
-    # System properties.
-    elif IsBuildPropFile(filename):
-      print("Rewriting %s:" % (filename,))
-      if stat.S_ISLNK(info.external_attr >> 16):
-        new_data = data
-      else:
-        new_data = RewriteProps(data.decode())
-      common.ZipWriteStr(output_tf_zip, out_info, new_data)
-
-    # Replace the certs in *mac_permissions.xml (there could be multiple, such
-    # as {system,vendor}/etc/selinux/{plat,vendor}_mac_permissions.xml).
-    elif filename.endswith("mac_permissions.xml"):
-      print("Rewriting %s with new keys." % (filename,))
-      new_data = ReplaceCerts(data.decode())
-      common.ZipWriteStr(output_tf_zip, out_info, new_data)
-
-    # Ask add_img_to_target_files to rebuild the recovery patch if needed.
-    elif filename in ("SYSTEM/recovery-from-boot.p",
-                      "VENDOR/recovery-from-boot.p",
-
-                      "SYSTEM/etc/recovery.img",
-                      "VENDOR/etc/recovery.img",
-
-                      "SYSTEM/bin/install-recovery.sh",
-                      "VENDOR/bin/install-recovery.sh"):
-      OPTIONS.rebuild_recovery = True
-
-    # Don't copy OTA certs if we're replacing them.
-    # Replacement of update-payload-key.pub.pem was removed in b/116660991.
-    elif OPTIONS.replace_ota_keys and filename.endswith("/otacerts.zip"):
-      pass
-
-    # Skip META/misc_info.txt since we will write back the new values later.
-    elif filename == "META/misc_info.txt":
-      pass
-
-    # Skip verity public key if we will replace it.
-    elif (OPTIONS.replace_verity_public_key and
-          filename in ("BOOT/RAMDISK/verity_key",
-                       "ROOT/verity_key")):
-      pass
-    elif (OPTIONS.remove_avb_public_keys and
-          (filename.startswith("BOOT/RAMDISK/avb/") or
-           filename.startswith("BOOT/RAMDISK/first_stage_ramdisk/avb/"))):
-      matched_removal = False
-      for key_to_remove in OPTIONS.remove_avb_public_keys:
-        if filename.endswith(key_to_remove):
-          matched_removal = True
-          print("Removing AVB public key from ramdisk: %s" % filename)
-          break
-      if not matched_removal:
-        # Copy it verbatim if we don't want to remove it.
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+      # Sign APKs.
+      elif is_apk:
+        name = os.path.basename(filename)
+        if is_compressed:
+          name = name[:-len(compressed_extension)]
+
+        key = apk_keys[name]
+        if key not in common.SPECIAL_CERT_STRINGS:
+          print("    signing: %-*s (%s)" % (maxsize, name, key))
+          signed_data = signer.Get(filename, data)
+          common.ZipWriteStr(output_tf_zip, out_info, signed_data)
+        else:
+          # an APK we're not supposed to sign.
+          print(
+              "NOT signing: %s\n"
+              "        (skipped due to special cert string)" % (name,))
+          common.ZipWriteStr(output_tf_zip, out_info, data)
+
+      # Sign bundled APEX files on all partitions
+      elif IsApexFile(filename):
+        name = GetApexFilename(filename)
+
+        payload_key, container_key, sign_tool = apex_keys[name]
+
+        # We've asserted not having a case with only one of them PRESIGNED.
+        if (payload_key not in common.SPECIAL_CERT_STRINGS and
+                container_key not in common.SPECIAL_CERT_STRINGS):
+          print("    signing: %-*s container (%s)" % (
+              maxsize, name, container_key))
+          print("           : %-*s payload   (%s)" % (
+              maxsize, name, payload_key))
+
+          signed_apex = signer.Get(filename, data)
+          common.ZipWrite(output_tf_zip, signed_apex, filename)
+
+        else:
+          print(
+              "NOT signing: %s\n"
+              "        (skipped due to special cert string)" % (name,))
+          common.ZipWriteStr(output_tf_zip, out_info, data)
+
+      # System properties.
+      elif IsBuildPropFile(filename):
+        print("Rewriting %s:" % (filename,))
+        if stat.S_ISLNK(info.external_attr >> 16):
+          new_data = data
+        else:
+          new_data = RewriteProps(data.decode())
+        common.ZipWriteStr(output_tf_zip, out_info, new_data)
 
-    # Skip verity keyid (for system_root_image use) if we will replace it.
-    elif OPTIONS.replace_verity_keyid and filename == "BOOT/cmdline":
-      pass
-
-    # Skip the vbmeta digest as we will recalculate it.
-    elif filename == "META/vbmeta_digest.txt":
-      pass
-
-    # Skip the care_map as we will regenerate the system/vendor images.
-    elif filename in ["META/care_map.pb", "META/care_map.txt"]:
-      pass
-
-    # Skip apex_info.pb because we sign/modify apexes
-    elif filename == "META/apex_info.pb":
-      pass
-
-    # Updates system_other.avbpubkey in /product/etc/.
-    elif filename in (
-        "PRODUCT/etc/security/avb/system_other.avbpubkey",
-        "SYSTEM/product/etc/security/avb/system_other.avbpubkey"):
-      # Only update system_other's public key, if the corresponding signing
-      # key is specified via --avb_system_other_key.
-      signing_key = OPTIONS.avb_keys.get("system_other")
-      if signing_key:
-        public_key = common.ExtractAvbPublicKey(
-            misc_info['avb_avbtool'], signing_key)
-        print("    Rewriting AVB public key of system_other in /product")
-        common.ZipWrite(output_tf_zip, public_key, filename)
-
-    # Updates pvmfw embedded public key with the virt APEX payload key.
-    elif filename == "PREBUILT_IMAGES/pvmfw.img":
-      # Find the name of the virt APEX in the target files.
-      namelist = input_tf_zip.namelist()
-      apex_gen = (GetApexFilename(f) for f in namelist if IsApexFile(f))
-      virt_apex_re = re.compile("^com\.([^\.]+\.)?android\.virt\.apex$")
-      virt_apex = next((a for a in apex_gen if virt_apex_re.match(a)), None)
-      if not virt_apex:
-        print("Removing %s from ramdisk: virt APEX not found" % filename)
-      else:
-        print("Replacing %s embedded key with %s key" % (filename, virt_apex))
-        # Get the current and new embedded keys.
-        payload_key, container_key, sign_tool = apex_keys[virt_apex]
-        new_pubkey_path = common.ExtractAvbPublicKey(
-            misc_info['avb_avbtool'], payload_key)
-        with open(new_pubkey_path, 'rb') as f:
-          new_pubkey = f.read()
-        pubkey_info = copy.copy(
-            input_tf_zip.getinfo("PREBUILT_IMAGES/pvmfw_embedded.avbpubkey"))
-        old_pubkey = input_tf_zip.read(pubkey_info.filename)
-        # Validate the keys and image.
-        if len(old_pubkey) != len(new_pubkey):
-          raise common.ExternalError("pvmfw embedded public key size mismatch")
-        pos = data.find(old_pubkey)
-        if pos == -1:
-          raise common.ExternalError("pvmfw embedded public key not found")
-        # Replace the key and copy new files.
-        new_data = data[:pos] + new_pubkey + data[pos+len(old_pubkey):]
+      # Replace the certs in *mac_permissions.xml (there could be multiple, such
+      # as {system,vendor}/etc/selinux/{plat,vendor}_mac_permissions.xml).
+      elif filename.endswith("mac_permissions.xml"):
+        print("Rewriting %s with new keys." % (filename,))
+        new_data = ReplaceCerts(data.decode())
         common.ZipWriteStr(output_tf_zip, out_info, new_data)
-        common.ZipWriteStr(output_tf_zip, pubkey_info, new_pubkey)
-    elif filename == "PREBUILT_IMAGES/pvmfw_embedded.avbpubkey":
-      pass
-
-    # Should NOT sign boot-debug.img.
-    elif filename in (
-        "BOOT/RAMDISK/force_debuggable",
-        "BOOT/RAMDISK/first_stage_ramdisk/force_debuggable"):
-      raise common.ExternalError("debuggable boot.img cannot be signed")
-
-    # Should NOT sign userdebug sepolicy file.
-    elif filename in (
-        "SYSTEM_EXT/etc/selinux/userdebug_plat_sepolicy.cil",
-        "SYSTEM/system_ext/etc/selinux/userdebug_plat_sepolicy.cil"):
-      if not OPTIONS.allow_gsi_debug_sepolicy:
-        raise common.ExternalError("debug sepolicy shouldn't be included")
+
+      # Ask add_img_to_target_files to rebuild the recovery patch if needed.
+      elif filename in ("SYSTEM/recovery-from-boot.p",
+                        "VENDOR/recovery-from-boot.p",
+
+                        "SYSTEM/etc/recovery.img",
+                        "VENDOR/etc/recovery.img",
+
+                        "SYSTEM/bin/install-recovery.sh",
+                        "VENDOR/bin/install-recovery.sh"):
+        OPTIONS.rebuild_recovery = True
+
+      # Don't copy OTA certs if we're replacing them.
+      # Replacement of update-payload-key.pub.pem was removed in b/116660991.
+      elif OPTIONS.replace_ota_keys and filename.endswith("/otacerts.zip"):
+        pass
+
+      # Skip META/misc_info.txt since we will write back the new values later.
+      elif filename == "META/misc_info.txt":
+        pass
+
+      # Skip verity public key if we will replace it.
+      elif (OPTIONS.replace_verity_public_key and
+            filename in ("BOOT/RAMDISK/verity_key",
+                         "ROOT/verity_key")):
+        pass
+      elif (OPTIONS.remove_avb_public_keys and
+            (filename.startswith("BOOT/RAMDISK/avb/") or
+             filename.startswith("BOOT/RAMDISK/first_stage_ramdisk/avb/"))):
+        matched_removal = False
+        for key_to_remove in OPTIONS.remove_avb_public_keys:
+          if filename.endswith(key_to_remove):
+            matched_removal = True
+            print("Removing AVB public key from ramdisk: %s" % filename)
+            break
+        if not matched_removal:
+          # Copy it verbatim if we don't want to remove it.
+          common.ZipWriteStr(output_tf_zip, out_info, data)
+
+      # Skip verity keyid (for system_root_image use) if we will replace it.
+      elif OPTIONS.replace_verity_keyid and filename == "BOOT/cmdline":
+        pass
+
+      # Skip the vbmeta digest as we will recalculate it.
+      elif filename == "META/vbmeta_digest.txt":
+        pass
+
+      # Skip the care_map as we will regenerate the system/vendor images.
+      elif filename in ["META/care_map.pb", "META/care_map.txt"]:
+        pass
+
+      # Skip apex_info.pb because we sign/modify apexes
+      elif filename == "META/apex_info.pb":
+        pass
+
+      # Updates system_other.avbpubkey in /product/etc/.
+      elif filename in (
+          "PRODUCT/etc/security/avb/system_other.avbpubkey",
+          "SYSTEM/product/etc/security/avb/system_other.avbpubkey"):
+        # Only update system_other's public key, if the corresponding signing
+        # key is specified via --avb_system_other_key.
+        signing_key = OPTIONS.avb_keys.get("system_other")
+        if signing_key:
+          public_key = common.ExtractAvbPublicKey(
+              misc_info['avb_avbtool'], signing_key)
+          print("    Rewriting AVB public key of system_other in /product")
+          common.ZipWrite(output_tf_zip, public_key, filename)
+
+      # Updates pvmfw embedded public key with the virt APEX payload key.
+      elif filename == "PREBUILT_IMAGES/pvmfw.img":
+        # Find the name of the virt APEX in the target files.
+        namelist = input_tf_zip.namelist()
+        apex_gen = (GetApexFilename(f) for f in namelist if IsApexFile(f))
+        virt_apex_re = re.compile("^com\.([^\.]+\.)?android\.virt\.apex$")
+        virt_apex = next((a for a in apex_gen if virt_apex_re.match(a)), None)
+        if not virt_apex:
+          print("Removing %s from ramdisk: virt APEX not found" % filename)
+        else:
+          print("Replacing %s embedded key with %s key" % (filename, virt_apex))
+          # Get the current and new embedded keys.
+          payload_key, container_key, sign_tool = apex_keys[virt_apex]
+          new_pubkey_path = common.ExtractAvbPublicKey(
+              misc_info['avb_avbtool'], payload_key)
+          with open(new_pubkey_path, 'rb') as f:
+            new_pubkey = f.read()
+          pubkey_info = copy.copy(
+              input_tf_zip.getinfo("PREBUILT_IMAGES/pvmfw_embedded.avbpubkey"))
+          old_pubkey = input_tf_zip.read(pubkey_info.filename)
+          # Validate the keys and image.
+          if len(old_pubkey) != len(new_pubkey):
+            raise common.ExternalError("pvmfw embedded public key size mismatch")
+          pos = data.find(old_pubkey)
+          if pos == -1:
+            raise common.ExternalError("pvmfw embedded public key not found")
+          # Replace the key and copy new files.
+          new_data = data[:pos] + new_pubkey + data[pos+len(old_pubkey):]
+          common.ZipWriteStr(output_tf_zip, out_info, new_data)
+          common.ZipWriteStr(output_tf_zip, pubkey_info, new_pubkey)
+      elif filename == "PREBUILT_IMAGES/pvmfw_embedded.avbpubkey":
+        pass
+
+      # Should NOT sign boot-debug.img.
+      elif filename in (
+          "BOOT/RAMDISK/force_debuggable",
+          "BOOT/RAMDISK/first_stage_ramdisk/force_debuggable"):
+        raise common.ExternalError("debuggable boot.img cannot be signed")
+
+      # Should NOT sign userdebug sepolicy file.
+      elif filename in (
+          "SYSTEM_EXT/etc/selinux/userdebug_plat_sepolicy.cil",
+          "SYSTEM/system_ext/etc/selinux/userdebug_plat_sepolicy.cil"):
+        if not OPTIONS.allow_gsi_debug_sepolicy:
+          raise common.ExternalError("debug sepolicy shouldn't be included")
+        else:
+          # Copy it verbatim if we allow the file to exist.
+          common.ZipWriteStr(output_tf_zip, out_info, data)
+
+      # A non-APK file; copy it verbatim.
       else:
-        # Copy it verbatim if we allow the file to exist.
         common.ZipWriteStr(output_tf_zip, out_info, data)
 
-    # A non-APK file; copy it verbatim.
-    else:
-      common.ZipWriteStr(output_tf_zip, out_info, data)
-
   if OPTIONS.replace_ota_keys:
     ReplaceOtaKeys(input_tf_zip, output_tf_zip, misc_info)
 
@@ -1269,6 +1634,109 @@ def ReadApexKeysInfo(tf_zip):
   return keys
 
 
+def GetChangedPartitions(input_tf_zip, output_tf_zip, input_misc_info,
+                         misc_info):
+  """Returns the partitions whose images need to be rebuilt after signing.
+
+  A partition needs to be rebuilt if any entry in its directories has been
+  changed, added or removed (e.g. by signing APKs and APEXes, rewriting
+  build.prop, or replacing keys), or if any of its AVB signing args (e.g. the
+  key or the props) has changed in misc_info. Other misc_info changes, such as
+  a new verity key, affect all the partitions.
+
+  Args:
+    input_tf_zip: The input target_files ZipFile.
+    output_tf_zip: The output target_files ZipFile, with all the entries to be
+        signed written.
+    input_misc_info: The misc_info dict of the input, before signing.
+    misc_info: The misc_info dict after signing.
+
+  Returns:
+    A set of the partitions to be rebuilt.
+  """
+  all_partitions = set(itertools.chain(*PARTITIONS_BY_DIR.values()))
+
+  def GetEntries(tf_zip):
+    entries = collections.defaultdict(set)
+    for info in tf_zip.infolist():
+      directory = info.filename.split("/", 1)[0]
+      if directory in PARTITIONS_BY_DIR:
+        entries[directory].add(
+            (info.filename, info.CRC, info.file_size, info.external_attr))
+    return entries
+
+  input_entries = GetEntries(input_tf_zip)
+  output_entries = GetEntries(output_tf_zip)
+  changed = set()
+  for directory, partitions in PARTITIONS_BY_DIR.items():
+    if input_entries[directory] != output_entries[directory]:
+      changed.update(partitions)
+
+  # The system image contains the boot ramdisk with system-as-root.
+  if "boot" in changed and misc_info.get("system_root_image") == "true":
+    changed.add("system")
+
+  # The recovery patch is regenerated from the new boot and recovery images,
+  # which may also be rebuilt by BuildVendorPartitions().
+  if OPTIONS.rebuild_recovery:
+    changed.update(["boot", "recovery"])
+
+  # Match the longest names first, e.g. system_other before system.
+  partitions_by_length = sorted(all_partitions, key=len, reverse=True)
+  for key in set(input_misc_info) | set(misc_info):
+    old_value, new_value = input_misc_info.get(key), misc_info.get(key)
+    if old_value == new_value:
+      continue
+    if not isinstance(new_value if new_value is not None else old_value, str):
+      continue
+    # The vbmeta images are always rebuilt.
+    if key.startswith("avb_vbmeta"):
+      continue
+    partition = next(
+        (p for p in partitions_by_length
+         if key.startswith("avb_{}_".format(p))),
+        None)
+    if partition:
+      changed.add(partition)
+    elif key.startswith("gki_signing_"):
+      changed.update(["boot", "init_boot"])
+    else:
+      logger.info("Rebuilding all the images due to the change of %s", key)
+      return all_partitions
+  return changed
+
+
+def CopyUnchangedImages(input_tf_zip, output_tf_zip, changed_partitions,
+                        misc_info):
+  """Copies the images of the unchanged partitions from the input as is.
+
+  Returns:
+    A set of the partitions whose images have been copied.
+  """
+  images_by_partition = {
+      partition: ["IMAGES/{}.img".format(partition),
+                  "IMAGES/{}.map".format(partition)]
+      for partition in itertools.chain(*PARTITIONS_BY_DIR.values())}
+  images_by_partition["boot"] = [
+      "IMAGES/" + image
+      for image in misc_info.get("boot_images", "boot.img").split()]
+  images_by_partition["recovery"].append("OTA/recovery-two-step.img")
+
+  namelist = set(input_tf_zip.namelist())
+  copied = set()
+  for partition in sorted(images_by_partition):
+    if partition in changed_partitions:
+      continue
+    for name in images_by_partition[partition]:
+      if name in namelist:
+        common.ZipCopyRawEntry(
+            input_tf_zip, input_tf_zip.getinfo(name), output_tf_zip)
+        copied.add(partition)
+  if copied:
+    logger.info("Reusing the unchanged images of %s", ", ".join(sorted(copied)))
+  return copied
+
+
 def BuildVendorPartitions(output_zip_path):
   """Builds OPTIONS.vendor_partitions using OPTIONS.vendor_otatools."""
   if OPTIONS.vendor_partitions.difference(ALLOWED_VENDOR_PARTITIONS):
@@ -1497,6 +1965,24 @@ def main(argv):
       OPTIONS.vendor_partitions = set(a.split(","))
     elif o == "--allow_gsi_debug_sepolicy":
       OPTIONS.allow_gsi_debug_sepolicy = True
+    elif o == "--signing_jobs":
+      OPTIONS.signing_jobs = int(a)
+      if OPTIONS.signing_jobs < 1:
+        raise ValueError("Invalid --signing_jobs: {}".format(a))
+    elif o == "--apex_apk_signing_jobs":
+      OPTIONS.apex_apk_signing_jobs = int(a)
+      if OPTIONS.apex_apk_signing_jobs < 1:
+        raise ValueError("Invalid --apex_apk_signing_jobs: {}".format(a))
+    elif o == "--reuse_unchanged_images":
+      OPTIONS.reuse_unchanged_images = True
+    elif o == "--signed_artifact_cache_dir":
+      OPTIONS.signed_artifact_cache_dir = a
+    elif o == "--signed_artifact_cache_size":
+      if a.isdigit():
+        OPTIONS.signed_artifact_cache_size = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
     else:
       return False
     return True
@@ -1556,6 +2042,11 @@ def main(argv):
           "vendor_partitions=",
           "vendor_otatools=",
           "allow_gsi_debug_sepolicy",
+          "signing_jobs=",
+          "apex_apk_signing_jobs=",
+          "signed_artifact_cache_dir=",
+          "signed_artifact_cache_size=",
+          "reuse_unchanged_images",
       ],
       extra_option_handler=option_handler)
 
@@ -1593,11 +2084,23 @@ def main(argv):
   platform_api_level, _ = GetApiLevelAndCodename(input_zip)
   codename_to_api_level_map = GetCodenameToApiLevelMap(input_zip)
 
+  input_misc_info = copy.copy(misc_info)
   ProcessTargetFiles(input_zip, output_zip, misc_info,
                      apk_keys, apex_keys, key_passwords,
                      platform_api_level, codename_to_api_level_map,
                      compressed_extension)
 
+  if OPTIONS.reuse_unchanged_images:
+    changed_partitions = GetChangedPartitions(
+        input_zip, output_zip, input_misc_info, misc_info)
+    reused_partitions = CopyUnchangedImages(
+        input_zip, output_zip, changed_partitions, misc_info)
+    OPTIONS.vendor_partitions = OPTIONS.vendor_partitions - reused_partitions
+
+  signed_artifact_cache = GetSignedArtifactCache()
+  if signed_artifact_cache:
+    signed_artifact_cache.Report()
+
   common.ZipClose(input_zip)
   common.ZipClose(output_zip)
 
@@ -19,12 +19,12 @@ from __future__ import print_function
 import argparse
 import bisect
 import logging
+import mmap
 import os
 import struct
-import threading
-from hashlib import sha1
 
 import rangelib
+from images import RangeSha1Cache
 
 logger = logging.getLogger(__name__)
 
@@ -38,11 +38,19 @@ class SparseImage(object):
   of blocks that should be always written to the target regardless of the old
   contents (i.e. copying instead of patching). clobbered_blocks should be in
   the form of a string like "0" or "0 1-5 8".
+
+  The image data is served from a read-only memory map of the sparse file, so
+  reading ranges neither copies the data nor needs any locking.
   """
 
+  # The size (in blocks) of the shared buffer that data of fill chunks is
+  # served from.
+  FILL_BUFFER_BLOCKS = 256
+
   def __init__(self, simg_fn, file_map_fn=None, clobbered_blocks=None,
                mode="rb", build_map=True, allow_shared_blocks=False,
                hashtree_info_generator=None):
+    self.simg_fn = simg_fn
     self.simg_f = f = open(simg_fn, mode)
 
     header_bin = f.read(28)
@@ -117,7 +125,7 @@ class SparseImage(object):
         # Fills the don't care data ranges with zeros.
         # TODO(xunchang) pass the care_map to hashtree info generator.
         if hashtree_info_generator:
-          fill_data = '\x00' * 4
+          fill_data = b'\x00' * 4
           # In order to compute verity hashtree on device, we need to write
           # zeros explicitly to the don't care ranges. Because these ranges may
           # contain non-zero data from the previous build.
@@ -134,7 +142,8 @@ class SparseImage(object):
         raise ValueError("Unknown chunk type 0x%04X not supported" %
                          (chunk_type,))
 
-    self.generator_lock = threading.Lock()
+    self._MapImage()
+    self._sha1_cache = RangeSha1Cache()
 
     self.care_map = rangelib.RangeSet(care_data)
     self.offset_index = [i[0] for i in offset_map]
@@ -160,6 +169,27 @@ class SparseImage(object):
     else:
       self.file_map = {"__DATA": self.care_map}
 
+  def _MapImage(self):
+    self._data = memoryview(
+        mmap.mmap(self.simg_f.fileno(), 0, access=mmap.ACCESS_READ))
+    # Maps the 4-byte fill pattern to a buffer of FILL_BUFFER_BLOCKS blocks.
+    self._fill_buffers = {}
+
+  def __getstate__(self):
+    # File objects and memory maps can't be pickled. An unpickled copy (e.g. in
+    # a worker process) reopens the image read-only by its path instead.
+    state = self.__dict__.copy()
+    del state["simg_f"]
+    state.pop("_data", None)
+    state.pop("_fill_buffers", None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.simg_f = open(self.simg_fn, "rb")
+    if hasattr(self, "offset_map"):
+      self._MapImage()
+
   def AppendFillChunk(self, data, blocks):
     f = self.simg_f
 
@@ -175,10 +205,15 @@ class SparseImage(object):
     f.write(struct.pack("<2I", self.total_blocks, self.total_chunks))
 
   def RangeSha1(self, ranges):
-    h = sha1()
-    for data in self._GetRangeData(ranges):
-      h.update(data)
-    return h.hexdigest()
+    return self._sha1_cache.Get(ranges, self._GetRangeData)
+
+  def PrecomputeRangeSha1s(self, ranges_list, threads=None):
+    """Computes the digests of the given RangeSets in parallel.
+
+    The digests are cached, and later RangeSha1() calls on the same RangeSets
+    return them without reading the image again.
+    """
+    self._sha1_cache.Precompute(ranges_list, self._GetRangeData, threads)
 
   def ReadRangeSet(self, ranges):
     return [d for d in self._GetRangeData(ranges)]
@@ -197,44 +232,47 @@ class SparseImage(object):
     for data in self._GetRangeData(ranges):
       fd.write(data)
 
+  def _GetFillData(self, fill_data, blocks):
+    """Generator that produces 'blocks' blocks of the given fill pattern."""
+    fill_buffer = self._fill_buffers.get(fill_data)
+    if fill_buffer is None:
+      # Concurrent readers may race to create the same buffer, which is fine.
+      fill_buffer = memoryview(
+          fill_data * (self.FILL_BUFFER_BLOCKS * (self.blocksize >> 2)))
+      self._fill_buffers[fill_data] = fill_buffer
+    while blocks > 0:
+      this_read = min(blocks, self.FILL_BUFFER_BLOCKS)
+      yield fill_buffer[:this_read * self.blocksize]
+      blocks -= this_read
+
   def _GetRangeData(self, ranges):
     """Generator that produces all the image data in 'ranges'.  The
     number of individual pieces returned is arbitrary (and in
     particular is not necessarily equal to the number of ranges in
     'ranges'.
 
-    Use a lock to protect the generator so that we will not run two
-    instances of this generator on the same object simultaneously."""
-
-    f = self.simg_f
-    with self.generator_lock:
-      for s, e in ranges:
-        to_read = e-s
-        idx = bisect.bisect_right(self.offset_index, s) - 1
+    The pieces are memoryview slices of the memory-mapped image (or of a
+    shared buffer for fill chunks), which stay valid as long as the image
+    object is alive. As there is no shared file position, multiple
+    instances of this generator may run on the same object simultaneously."""
+
+    data = self._data
+    blocksize = self.blocksize
+    for s, e in ranges:
+      idx = bisect.bisect_right(self.offset_index, s) - 1
+      while s < e:
+        # The first chunk may start before s; continue with the following
+        # chunks if this range spans multiple chunks.
         chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-
-        # for the first chunk we may be starting partway through it.
-        remain = chunk_len - (s - chunk_start)
-        this_read = min(remain, to_read)
+        this_read = min(chunk_start + chunk_len, e) - s
         if filepos is not None:
-          p = filepos + ((s - chunk_start) * self.blocksize)
-          f.seek(p, os.SEEK_SET)
-          yield f.read(this_read * self.blocksize)
+          p = filepos + ((s - chunk_start) * blocksize)
+          yield data[p:p + this_read * blocksize]
         else:
-          yield fill_data * (this_read * (self.blocksize >> 2))
-        to_read -= this_read
-
-        while to_read > 0:
-          # continue with following chunks if this range spans multiple chunks.
-          idx += 1
-          chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-          this_read = min(chunk_len, to_read)
-          if filepos is not None:
-            f.seek(filepos, os.SEEK_SET)
-            yield f.read(this_read * self.blocksize)
-          else:
-            yield fill_data * (this_read * (self.blocksize >> 2))
-          to_read -= this_read
+          for piece in self._GetFillData(fill_data, this_read):
+            yield piece
+        s += this_read
+        idx += 1
 
   def LoadFileBlockMap(self, fn, clobbered_blocks, allow_shared_blocks):
     """Loads the given block map file.
@@ -16,13 +16,16 @@
 
 import os
 import os.path
+import threading
 import zipfile
 
 import common
 import test_utils
 from add_img_to_target_files import (
     AddPackRadioImages,
-    CheckAbOtaImages)
+    BuildPartitionImages,
+    CheckAbOtaImages,
+    OutputFile)
 from rangelib import RangeSet
 from common import AddCareMapForAbOta, GetCareMap
 
@@ -427,3 +430,97 @@ class AddImagesToTargetFilesTest(test_utils.ReleaseToolsTestCase):
     name, care_map = GetCareMap('system', 'foo')
     self.assertEqual('system', name)
     self.assertEqual(RangeSet("0-12").to_string_raw(), care_map)
+
+  @staticmethod
+  def _make_add_func(partition, before_write=None, running=None):
+    def AddFunc(output_zip):
+      if running is not None:
+        running.append(partition)
+        running_count = len(running)
+      if before_write:
+        before_write()
+      img = OutputFile(output_zip, OPTIONS.input_tmp, 'IMAGES',
+                       partition + '.img')
+      with open(img.name, 'wb') as image_fp:
+        image_fp.write(partition.encode())
+      img.Write()
+      if running is not None:
+        running.remove(partition)
+        return running_count
+      return img.name
+    return AddFunc
+
+  def test_BuildPartitionImages_deterministicZipOutput(self):
+    os.mkdir(os.path.join(OPTIONS.input_tmp, 'IMAGES'))
+    OPTIONS.info_dict = {}
+    OPTIONS.jobs = 2
+    self.addCleanup(setattr, OPTIONS, 'jobs', 1)
+
+    # 'system' only finishes after 'vendor'.
+    vendor_done = threading.Event()
+    build_calls = [
+        ('system', self._make_add_func(
+            'system', before_write=lambda: vendor_done.wait(10)), []),
+        ('vendor', self._make_add_func(
+            'vendor', before_write=vendor_done.set), []),
+    ]
+    output_file = common.MakeTempFile(suffix='.zip')
+    partitions = {}
+    with zipfile.ZipFile(output_file, 'w', allowZip64=True) as output_zip:
+      BuildPartitionImages(output_zip, build_calls, partitions)
+
+    self.assertEqual(
+        {partition: os.path.join(OPTIONS.input_tmp, 'IMAGES',
+                                 partition + '.img')
+         for partition in ('system', 'vendor')},
+        partitions)
+    with zipfile.ZipFile(output_file) as verify_zip:
+      self.assertEqual(['IMAGES/system.img', 'IMAGES/vendor.img'],
+                       verify_zip.namelist())
+      self.assertEqual(b'vendor', verify_zip.read('IMAGES/vendor.img'))
+
+  def test_BuildPartitionImages_zipWritesOnMainThread(self):
+    os.mkdir(os.path.join(OPTIONS.input_tmp, 'IMAGES'))
+    OPTIONS.info_dict = {}
+    OPTIONS.jobs = 2
+    self.addCleanup(setattr, OPTIONS, 'jobs', 1)
+
+    # common.ZipWrite() changes the global zipfile.ZIP64_LIMIT, so it must
+    # only run on the main thread.
+    writers = []
+    zip_write = common.ZipWrite
+
+    def ZipWrite(*args, **kwargs):
+      writers.append(threading.current_thread())
+      zip_write(*args, **kwargs)
+
+    build_calls = [
+        (partition, self._make_add_func(partition), [])
+        for partition in ('system', 'vendor')]
+    output_file = common.MakeTempFile(suffix='.zip')
+    common.ZipWrite = ZipWrite
+    try:
+      with zipfile.ZipFile(output_file, 'w', allowZip64=True) as output_zip:
+        BuildPartitionImages(output_zip, build_calls, {})
+    finally:
+      common.ZipWrite = zip_write
+
+    self.assertEqual([threading.main_thread()] * 2, writers)
+
+  def test_BuildPartitionImages_diskBudget(self):
+    os.mkdir(os.path.join(OPTIONS.input_tmp, 'IMAGES'))
+    # Images that don't fit in the disk together get built one at a time.
+    OPTIONS.info_dict = {
+        'system_size': 1 << 60,
+        'vendor_size': 1 << 60,
+    }
+    OPTIONS.jobs = 2
+    self.addCleanup(setattr, OPTIONS, 'jobs', 1)
+
+    running = []
+    build_calls = [
+        (partition, self._make_add_func(partition, running=running), [])
+        for partition in ('system', 'vendor')]
+    partitions = {}
+    BuildPartitionImages(None, build_calls, partitions)
+    self.assertEqual({'system': 1, 'vendor': 1}, partitions)
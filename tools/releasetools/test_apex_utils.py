@@ -18,6 +18,8 @@ import re
 import os
 import os.path
 import shutil
+import threading
+import time
 import zipfile
 
 import apex_utils
@@ -204,3 +206,74 @@ class ApexUtilsTest(test_utils.ReleaseToolsTestCase):
 
     the_exception = cm.exception
     self.assertIn('Failed to run command \'[\'false\'', str(the_exception))
+
+  def test_ApexApkSigner_SignPayloadApks(self):
+    # Doesn't need the external tools under the search path.
+    common.OPTIONS.search_path = common.MakeTempDir()
+    payload_dir = common.MakeTempDir()
+    apk_entries = ['app/{0}/{0}.apk'.format(name) for name in 'ABCD']
+    for entry in apk_entries:
+      os.makedirs(os.path.dirname(os.path.join(payload_dir, entry)))
+      with open(os.path.join(payload_dir, entry), 'w') as f:
+        f.write(entry)
+    apk_keys = {'A.apk': 'key1', 'B.apk': 'PRESIGNED', 'C.apk': 'key1',
+                'D.apk': 'key2'}
+
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def FakeSignFile(input_name, output_name, key, *_args, **_kwargs):
+      with lock:
+        running[0] += 1
+        running[1] = max(running)
+      time.sleep(0.05)
+      with open(input_name) as input_file, open(output_name, 'w') as f:
+        f.write(input_file.read() + ' ' + key)
+      with lock:
+        running[0] -= 1
+
+    sign_file = common.SignFile
+    common.SignFile = FakeSignFile
+    try:
+      signer = apex_utils.ApexApkSigner('foo.apex', None, None, jobs=4)
+      self.assertTrue(
+          signer.SignPayloadApks(payload_dir, apk_entries, apk_keys))
+    finally:
+      common.SignFile = sign_file
+
+    signed = []
+    for entry in apk_entries:
+      with open(os.path.join(payload_dir, entry)) as f:
+        signed.append(f.read())
+    self.assertEqual(
+        ['app/A/A.apk key1', 'app/B/B.apk', 'app/C/C.apk key1',
+         'app/D/D.apk key2'], signed)
+    self.assertEqual(3, running[1])
+
+    # Signs one APK at a time by default.
+    running[1] = 0
+    common.SignFile = FakeSignFile
+    try:
+      signer = apex_utils.ApexApkSigner('foo.apex', None, None)
+      self.assertTrue(
+          signer.SignPayloadApks(payload_dir, apk_entries, apk_keys))
+    finally:
+      common.SignFile = sign_file
+    self.assertEqual(1, running[1])
+
+  def test_ApexApkSigner_SignPayloadApks_onlyPresigned(self):
+    common.OPTIONS.search_path = common.MakeTempDir()
+    signer = apex_utils.ApexApkSigner('foo.apex', None, None)
+    self.assertFalse(signer.SignPayloadApks(
+        common.MakeTempDir(), ['app/A/A.apk'], {'A.apk': 'PRESIGNED'}))
+
+  def test_StageTimer(self):
+    timer = apex_utils.StageTimer()
+    with timer.Time('extract'):
+      pass
+    with self.assertRaises(ValueError):
+      with timer.Time('sign_apks'):
+        raise ValueError()
+    with timer.Time('extract'):
+      pass
+    self.assertEqual(['extract', 'sign_apks'], list(timer.timings))
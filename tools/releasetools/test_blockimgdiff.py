@@ -15,43 +15,49 @@
 #
 
 import os
+import pickle
+import random
+import tracemalloc
 from hashlib import sha1
 
+# common imports blockimgdiff, so it goes first to avoid an import cycle.
 import common
-from blockimgdiff import BlockImageDiff, HeapItem, ImgdiffStats, Transfer
-from images import DataImage, EmptyImage, FileImage
+import blockimgdiff
+from blockimgdiff import (
+    BlockImageDiff, ImgdiffStats, PatchDataWriter, PatchInfo,
+    SourceRangesIndex, Transfer)
+from images import DataImage, EmptyImage, FileImage, RangeSha1Cache
 from rangelib import RangeSet
-from test_utils import ReleaseToolsTestCase
+from test_utils import ReleaseToolsTestCase, SkipIfExternalToolsUnavailable
 
 
-class HealpItemTest(ReleaseToolsTestCase):
+class SourceRangesIndexTest(ReleaseToolsTestCase):
 
-  class Item(object):
-    def __init__(self, score):
-      self.score = score
-
-  def test_init(self):
-    item1 = HeapItem(self.Item(15))
-    item2 = HeapItem(self.Item(20))
-    item3 = HeapItem(self.Item(15))
-    self.assertTrue(item1)
-    self.assertTrue(item2)
-    self.assertTrue(item3)
-
-    self.assertNotEqual(item1, item2)
-    self.assertEqual(item1, item3)
-    # HeapItem uses negated scores.
-    self.assertGreater(item1, item2)
-    self.assertLessEqual(item1, item3)
-    self.assertTrue(item1 <= item3)
-    self.assertFalse(item2 >= item1)
-
-  def test_clear(self):
-    item = HeapItem(self.Item(15))
-    self.assertTrue(item)
-
-    item.clear()
-    self.assertFalse(item)
+  def setUp(self):
+    self.transfers = []
+    self.t0 = Transfer("t0", "t0", RangeSet("100-109"), RangeSet("0-5 20-25"),
+                       "t0hash", "t0hash", "move", self.transfers)
+    self.t1 = Transfer("t1", "t1", RangeSet("110-119"), RangeSet("3-9"),
+                       "t1hash", "t1hash", "move", self.transfers)
+    self.t2 = Transfer("t2", "t2", RangeSet("120-129"), RangeSet("6-7 10"),
+                       "t2hash", "t2hash", "move", self.transfers)
+    self.index = SourceRangesIndex(self.transfers)
+
+  def test_FindReaders(self):
+    self.assertEqual([self.t0, self.t1],
+                     list(self.index.FindReaders(RangeSet("4"))))
+    self.assertEqual([self.t1, self.t2],
+                     list(self.index.FindReaders(RangeSet("6-9"))))
+    self.assertEqual([], list(self.index.FindReaders(RangeSet("11-19 26-99"))))
+    self.assertEqual([], list(self.index.FindReaders(RangeSet(""))))
+
+  def test_FindReaders_orderedByFirstBlock(self):
+    # t2 comes first since it reads block 10, before t0 shows up at 21.
+    self.assertEqual([self.t2, self.t0],
+                     list(self.index.FindReaders(RangeSet("10 21"))))
+    # Readers of the same block follow the transfer order.
+    self.assertEqual([self.t0, self.t1, self.t2],
+                     list(self.index.FindReaders(RangeSet("0-99"))))
 
 
 class BlockImageDiffTest(ReleaseToolsTestCase):
@@ -174,6 +180,83 @@ class BlockImageDiffTest(ReleaseToolsTestCase):
     common.OPTIONS.cache_size = 15 * 4096
     self.assertEqual((15, 5), block_image_diff.ReviseStashSize())
 
+  @staticmethod
+  def _AddEdge(before, after, weight):
+    before.goes_before[after] = weight
+    after.goes_after[before] = weight
+
+  def test_FindVertexSequence(self):
+    """FindVertexSequence should drop the lightest edge of a cycle.
+
+    t0 -(5)-> t1 -(3)-> t2 -(1)-> t0
+    """
+    block_image_diff = BlockImageDiff(EmptyImage(), EmptyImage())
+    transfers = block_image_diff.transfers
+    t0, t1, t2 = [
+        Transfer(name, name, RangeSet(), RangeSet(), "hash", "hash", "diff",
+                 transfers) for name in ("t0", "t1", "t2")]
+    self._AddEdge(t0, t1, 5)
+    self._AddEdge(t1, t2, 3)
+    self._AddEdge(t2, t0, 1)
+
+    block_image_diff.FindVertexSequence()
+    self.assertEqual([t0, t1, t2], block_image_diff.transfers)
+    self.assertEqual([0, 1, 2], [xf.order for xf in (t0, t1, t2)])
+
+  def test_FindVertexSequence_repeatable(self):
+    """Vertices with the same score are taken in the transfer order."""
+    block_image_diff = BlockImageDiff(EmptyImage(), EmptyImage())
+    transfers = block_image_diff.transfers
+    t0, t1 = [
+        Transfer(name, name, RangeSet(), RangeSet(), "hash", "hash", "diff",
+                 transfers) for name in ("t0", "t1")]
+    self._AddEdge(t0, t1, 2)
+    self._AddEdge(t1, t0, 2)
+
+    block_image_diff.FindVertexSequence()
+    self.assertEqual([t0, t1], block_image_diff.transfers)
+
+    block_image_diff.transfers = [t1, t0]
+    block_image_diff.FindVertexSequence()
+    self.assertEqual([t1, t0], block_image_diff.transfers)
+
+  @staticmethod
+  def _MakeTransferGraph(count, seed):
+    """Returns a BlockImageDiff with 'count' synthetic "diff" transfers.
+
+    Transfer i writes block i and reads 4 blocks at random, which makes about
+    4 ordering dependencies per transfer, with plenty of cycles.
+    """
+    rng = random.Random(seed)
+    block_image_diff = BlockImageDiff(EmptyImage(), EmptyImage(), version=3)
+    transfers = block_image_diff.transfers
+    for index in range(count):
+      src_blocks = sorted(set(rng.randrange(count) for _ in range(4)))
+      src_ranges = RangeSet(data=[b for block in src_blocks
+                                  for b in (block, block + 1)])
+      Transfer("t%d" % index, "t%d" % index, RangeSet(data=(index, index + 1)),
+               src_ranges, "hash", "hash", "diff", transfers)
+    return block_image_diff
+
+  def _FindSequenceForTransfers(self, block_image_diff):
+    block_image_diff.FindSequenceForTransfers()
+    transfers = block_image_diff.transfers
+    self.assertEqual(list(range(len(transfers))),
+                     sorted(xf.id for xf in transfers))
+    for xf in transfers:
+      for u in xf.goes_before:
+        self.assertLess(xf.order, u.order)
+
+  def test_FindSequenceForTransfers(self):
+    block_image_diff = self._MakeTransferGraph(1000, 0)
+    self._FindSequenceForTransfers(block_image_diff)
+
+    # The same input always gives the same sequence.
+    other = self._MakeTransferGraph(1000, 0)
+    self._FindSequenceForTransfers(other)
+    self.assertEqual([xf.id for xf in block_image_diff.transfers],
+                     [xf.id for xf in other.transfers])
+
   def test_FileTypeSupportedByImgdiff(self):
     self.assertTrue(
         BlockImageDiff.FileTypeSupportedByImgdiff(
@@ -266,6 +349,205 @@ class ImgdiffStatsTest(ReleaseToolsTestCase):
                       "invalid reason")
 
 
+class WriteTransfersTest(ReleaseToolsTestCase):
+
+  @staticmethod
+  def _MakeImage(blocks):
+    return DataImage(b''.join(
+        sha1(b'%d' % index).digest() * 204 + b'\0' * 16
+        for index in range(blocks)))
+
+  def test_WriteTransfers(self):
+    src = self._MakeImage(10)
+    tgt = self._MakeImage(10)
+    block_image_diff = BlockImageDiff(tgt, src)
+    # Blocks 8-9 carry no data in the target.
+    tgt.care_map = RangeSet("0-7")
+    tgt.hashtree_info = None
+
+    transfers = block_image_diff.transfers
+    t0 = Transfer("t0", "t0", RangeSet("0-1"), RangeSet(), "t0hash", "t0hash",
+                  "new", transfers)
+    Transfer("t1", "t1", RangeSet("2-3"), RangeSet(), "t1hash", "t1hash",
+             "zero", transfers)
+    t2 = Transfer("t2", "t2", RangeSet("4-5"), RangeSet("6-7"), "t2hash",
+                  "t2hash", "move", transfers)
+    t0.stash_before.append((0, RangeSet("6-7")))
+    t2.use_stash.append((0, RangeSet("6-7")))
+
+    prefix = os.path.join(common.MakeTempDir(), 'system')
+    block_image_diff.WriteTransfers(prefix)
+
+    stash_sha1 = src.RangeSha1(RangeSet("6-7"))
+    with open(prefix + '.transfer.list') as transfer_list:
+      self.assertEqual([
+          '4',
+          '6',
+          '0',
+          '2',
+          'erase 2,8,10',
+          'stash {} 2,6,8'.format(stash_sha1),
+          'new 2,0,2',
+          'zero 2,2,4',
+          'move t2hash 2,4,6 2 - {}:2,0,2'.format(stash_sha1),
+          'free {}'.format(stash_sha1),
+      ], transfer_list.read().splitlines())
+    self.assertEqual(2 * 4096, block_image_diff.max_stashed_size)
+    self.assertEqual(['system.transfer.list'],
+                     os.listdir(os.path.dirname(prefix)))
+
+  def test_WriteTransfers_memory(self):
+    """Checks that a large transfer list isn't held in memory while written."""
+    tgt = EmptyImage()
+    block_image_diff = BlockImageDiff(tgt)
+    transfers = block_image_diff.transfers
+    # 5000 commands, each writing 40 fragmented ranges.
+    for index in range(5000):
+      start = index * 80
+      Transfer("t%d" % index, "t%d" % index,
+               RangeSet(data=range(start, start + 80)), RangeSet(), "hash",
+               "hash", "new" if index % 2 else "zero", transfers)
+    tgt.total_blocks = 5000 * 80
+    tgt.care_map = RangeSet(data=(0, tgt.total_blocks))
+
+    prefix = os.path.join(common.MakeTempDir(), 'system')
+    tracemalloc.start()
+    try:
+      block_image_diff.WriteTransfers(prefix)
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+
+    with open(prefix + '.transfer.list') as transfer_list:
+      self.assertEqual(5004, sum(1 for _ in transfer_list))
+    # The commands are written out as they're generated, rather than collected
+    # until the end, so the peak stays well below the size of the list.
+    self.assertLess(peak * 4, os.path.getsize(prefix + '.transfer.list'))
+
+
+class PatchDataWriterTest(ReleaseToolsTestCase):
+
+  def test_Add(self):
+    block_image_diff = BlockImageDiff(EmptyImage())
+    transfers = block_image_diff.transfers
+    for index in range(3):
+      Transfer("t%d" % index, "t%d" % index, RangeSet("0-1"), RangeSet("0-1"),
+               "tgthash", "srchash", "diff", transfers)
+
+    patch_file = common.MakeTempFile()
+    with open(patch_file, 'wb') as patch_fd:
+      patch_writer = PatchDataWriter(patch_fd, transfers, 4096)
+      # Out-of-order patches are held until their turn.
+      patch_writer.Add(1, 1, PatchInfo(False, b'patch1'))
+      self.assertRaises(AssertionError, patch_writer.Finish, 3)
+      patch_writer.Add(2, 2, PatchInfo(False, b'patch02'))
+      patch_writer.Add(0, 0, PatchInfo(False, b'0'))
+      patch_writer.Finish(3)
+
+    with open(patch_file, 'rb') as patch_fd:
+      self.assertEqual(b'0patch1patch02', patch_fd.read())
+    self.assertEqual([(0, 1), (1, 6), (7, 7)],
+                     [(xf.patch_start, xf.patch_len) for xf in transfers])
+    self.assertEqual(14, patch_writer.max_pending_bytes)
+    # The patches are dropped once written.
+    self.assertEqual([None] * 3, [xf.patch_info for xf in transfers])
+
+
+class ComputePatchesForInputListTest(ReleaseToolsTestCase):
+
+  def setUp(self):
+    tgt_file = common.MakeTempFile()
+    with open(tgt_file, 'wb') as f:
+      f.write(os.urandom(4096 * 4) + b'\0' * 4096 * 4)
+    self.tgt = FileImage(tgt_file)
+
+  def _ComputePatches(self, **kwargs):
+    block_image_diff = BlockImageDiff(self.tgt, **kwargs)
+    transfers = block_image_diff.transfers
+    diff_queue = []
+    for index, ranges in enumerate(("0-1", "2-3", "4-7")):
+      xf = Transfer("t%d" % index, "t%d" % index, RangeSet(ranges), RangeSet(),
+                    "tgthash", "srchash", "diff", transfers)
+      # Existing patches are kept as is; only the target gets compressed.
+      xf.patch_info = PatchInfo(False, b"patch%d" % index)
+      diff_queue.append((index, False, index))
+    return block_image_diff.ComputePatchesForInputList(diff_queue, True)
+
+  def test_threads(self):
+    patches = self._ComputePatches(threads=2)
+    self.assertEqual([0, 1, 2], [index for index, _, _ in patches])
+    self.assertEqual(b"patch1", patches[1][1].content)
+    # Random data doesn't compress, while zeros do.
+    self.assertGreater(patches[0][2], 4096 * 2)
+    self.assertLess(patches[2][2], 4096)
+
+  def test_patchWorkers(self):
+    self.assertEqual(self._ComputePatches(threads=2),
+                     self._ComputePatches(patch_workers=2))
+
+  def test_patchWorkers_failure(self):
+    def ComputeTransferPatch(*_args):
+      raise ValueError('patch failed')
+
+    # The forked workers inherit the replaced function.
+    saved = blockimgdiff._ComputeTransferPatch
+    blockimgdiff._ComputeTransferPatch = ComputeTransferPatch
+    try:
+      self.assertRaisesRegex(ValueError, 'patch failed', self._ComputePatches,
+                             patch_workers=2)
+    finally:
+      blockimgdiff._ComputeTransferPatch = saved
+
+  def test_PatchWorker_tempFiles(self):
+    inherited_file = common.MakeTempFile()
+    task_files = []
+
+    def ComputeTransferPatch(*_args):
+      task_files.append(common.MakeTempFile())
+      task_files.append(common.MakeTempDir())
+      return 'patch'
+
+    saved = (blockimgdiff._ComputeTransferPatch,
+             blockimgdiff._patch_worker_images)
+    blockimgdiff._ComputeTransferPatch = ComputeTransferPatch
+    blockimgdiff._patch_worker_images = (None, None)
+    try:
+      result = blockimgdiff._PatchWorker((3, ()))
+    finally:
+      (blockimgdiff._ComputeTransferPatch,
+       blockimgdiff._patch_worker_images) = saved
+
+    self.assertEqual((3, 'patch'), result[:2])
+    # Only the temp files of the task get removed.
+    self.assertTrue(os.path.exists(inherited_file))
+    self.assertIn(inherited_file, common.OPTIONS.tempfiles)
+    for path in task_files:
+      self.assertFalse(os.path.exists(path))
+      self.assertNotIn(path, common.OPTIONS.tempfiles)
+
+  @SkipIfExternalToolsUnavailable()
+  def test_patchWorkers_patchCacheStats(self):
+    common.OPTIONS.patch_cache_dir = common.MakeTempDir()
+    try:
+      block_image_diff = BlockImageDiff(self.tgt, self.tgt, patch_workers=2)
+      diff_queue = []
+      for index, ranges in enumerate(("0-1", "2-3", "4-7")):
+        Transfer("t%d" % index, "t%d" % index, RangeSet(ranges),
+                 RangeSet(ranges), "tgthash", "srchash", "diff",
+                 block_image_diff.transfers)
+        diff_queue.append((index, False, index))
+      block_image_diff.ComputePatchesForInputList(list(diff_queue), False)
+      for xf in block_image_diff.transfers:
+        xf.patch_info = None
+      block_image_diff.ComputePatchesForInputList(list(diff_queue), False)
+
+      # The lookups in the worker processes count towards the parent's stats.
+      patch_cache = common.GetPatchCache()
+      self.assertEqual((3, 3), (patch_cache.hits, patch_cache.misses))
+    finally:
+      common.OPTIONS.patch_cache_dir = None
+
+
 class DataImageTest(ReleaseToolsTestCase):
 
   def test_read_range_set(self):
@@ -308,3 +590,43 @@ class FileImageTest(ReleaseToolsTestCase):
   def test_read_all(self):
     data = b''.join(self.file.ReadRangeSet(self.file.care_map))
     self.assertEqual(self.data, data)
+
+  def test_pickle(self):
+    copied = pickle.loads(pickle.dumps(self.file))
+    self.assertEqual(self.file.care_map, copied.care_map)
+    self.assertEqual(self.data,
+                     b''.join(copied.ReadRangeSet(copied.care_map)))
+
+  def test_PrecomputeRangeSha1s(self):
+    blocksize = self.file.blocksize
+    ranges_list = [RangeSet("0"), RangeSet("1-3"), RangeSet("0 2"),
+                   RangeSet("1-3")]
+    self.file.PrecomputeRangeSha1s(ranges_list, threads=2)
+
+    # The digests now come from the cache, without touching the file.
+    self.file._GetRangeData = None
+    for ranges in ranges_list:
+      expected_data = b''.join(
+          self.data[s * blocksize : e * blocksize] for s, e in ranges)
+      self.assertEqual(sha1(expected_data).hexdigest(),
+                       self.file.RangeSha1(ranges))
+
+
+class RangeSha1CacheTest(ReleaseToolsTestCase):
+
+  def test_Get(self):
+    reads = []
+
+    def GetRangeData(ranges):
+      reads.append(ranges)
+      for s, e in ranges:
+        yield b'%d-%d' % (s, e)
+
+    cache = RangeSha1Cache()
+    digest = cache.Get(RangeSet("0-1 5"), GetRangeData)
+    self.assertEqual(sha1(b'0-25-6').hexdigest(), digest)
+    self.assertEqual(digest, cache.Get(RangeSet("0-1 5"), GetRangeData))
+    self.assertEqual(1, len(reads))
+
+    self.assertNotEqual(digest, cache.Get(RangeSet("0-1"), GetRangeData))
+    self.assertEqual(2, len(reads))
@@ -0,0 +1,306 @@
+#
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unittests for check_target_files_signatures.py."""
+
+import gzip
+import os
+import os.path
+import struct
+import zipfile
+
+import check_target_files_signatures
+import common
+import test_utils
+from check_target_files_signatures import (
+    ANDROID_NS, APK, GetApkIndex, GetApkSignerCerts, ParseBinaryManifest,
+    TargetFiles)
+
+
+# The SHA-1 digest of the cert that signs testdata/TestApp.apk.
+TEST_APP_CERT_SHA1 = '61ed377e85d386a8dfee6b864bd85b0bfaa5af81'
+
+
+class CheckTargetFilesSignaturesTest(test_utils.ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.testdata_dir = test_utils.get_testdata_dir()
+    self.test_app = os.path.join(self.testdata_dir, 'TestApp.apk')
+    self._problems = check_target_files_signatures.PROBLEMS[:]
+    self._certs = check_target_files_signatures.ALL_CERTS.certs.copy()
+
+  def tearDown(self):
+    common.OPTIONS.in_memory = False
+    common.OPTIONS.apk_workers = None
+    common.OPTIONS.cert_db_dir = None
+    check_target_files_signatures.PROBLEMS[:] = self._problems
+    check_target_files_signatures.ALL_CERTS.certs = self._certs
+    super(CheckTargetFilesSignaturesTest, self).tearDown()
+
+  def test_GetApkSignerCerts(self):
+    with open(self.test_app, 'rb') as f:
+      certs = GetApkSignerCerts(f.read())
+    self.assertEqual([TEST_APP_CERT_SHA1],
+                     [common.sha1(cert).hexdigest() for cert in certs])
+
+  def test_GetApkSignerCerts_v1Only(self):
+    with open(os.path.join(self.testdata_dir, 'foo.apex'), 'rb') as f:
+      self.assertIsNone(GetApkSignerCerts(f.read()))
+
+  def test_GetApkSignerCerts_invalidBlockSize(self):
+    with open(self.test_app, 'rb') as f:
+      data = bytearray(f.read())
+    # Corrupt the size in the footer of the APK Signing Block.
+    magic = data.find(b'APK Sig Block 42')
+    data[magic - 8:magic] = struct.pack('<Q', 1)
+    self.assertRaises(ValueError, GetApkSignerCerts, bytes(data))
+
+  def test_ParseBinaryManifest(self):
+    with zipfile.ZipFile(self.test_app) as apk:
+      manifest = apk.read('AndroidManifest.xml')
+    self.assertEqual(('com.android.cts.ctsshim', None),
+                     ParseBinaryManifest(manifest))
+
+  @staticmethod
+  def _MakeBinaryManifest(attrs, resource_ids=()):
+    """Returns a binary XML with a <manifest> element of the given attributes.
+
+    Args:
+      attrs: A list of (namespace, name, value) tuples, with None for no
+          namespace.
+      resource_ids: The resource IDs of the first attribute names.
+    """
+    strings = []
+
+    def StringIndex(string):
+      if string is None:
+        return 0xffffffff
+      if string not in strings:
+        strings.append(string)
+      return strings.index(string)
+
+    # Attribute names that have resource IDs come first in the string pool.
+    for _, name, _ in attrs[:len(resource_ids)]:
+      StringIndex(name)
+    attr_data = b''.join(
+        struct.pack('<3IHBBI', StringIndex(ns), StringIndex(name),
+                    StringIndex(value), 8, 0, 0x03, StringIndex(value))
+        for ns, name, value in attrs)
+    element = struct.pack(
+        '<2I2I6H', 1, 0xffffffff, 0xffffffff, StringIndex('manifest'), 20, 20,
+        len(attrs), 0, 0, 0) + attr_data
+    element = struct.pack('<HHI', 0x0102, 16, 8 + len(element)) + element
+
+    # A UTF-8 string pool.
+    string_data = b''
+    offsets = []
+    for string in strings:
+      offsets.append(len(string_data))
+      encoded = string.encode('utf-8')
+      string_data += struct.pack('<BB', len(string), len(encoded)) + encoded
+      string_data += b'\0'
+    string_data += b'\0' * (-len(string_data) % 4)
+    string_pool = struct.pack('<%dI' % len(strings), *offsets) + string_data
+    string_pool = struct.pack(
+        '<HHI5I', 0x0001, 28, 28 + len(string_pool), len(strings), 0, 1 << 8,
+        28 + 4 * len(strings), 0) + string_pool
+
+    resource_map = struct.pack(
+        '<HHI%dI' % len(resource_ids), 0x0180, 8, 8 + 4 * len(resource_ids),
+        *resource_ids)
+
+    body = string_pool + resource_map + element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+  def test_ParseBinaryManifest_sharedUserId(self):
+    manifest = self._MakeBinaryManifest(
+        [(ANDROID_NS, 'sharedUserId', 'android.uid.system'),
+         (None, 'package', 'com.android.foo')],
+        resource_ids=(0x0101000b,))
+    self.assertEqual(('com.android.foo', 'android.uid.system'),
+                     ParseBinaryManifest(manifest))
+
+  def test_ParseBinaryManifest_sharedUserIdWithoutResourceId(self):
+    manifest = self._MakeBinaryManifest(
+        [(None, 'package', 'com.android.foo'),
+         (ANDROID_NS, 'sharedUserId', 'android.uid.system')])
+    self.assertEqual(('com.android.foo', 'android.uid.system'),
+                     ParseBinaryManifest(manifest))
+
+  def test_ParseBinaryManifest_malformed(self):
+    manifest = self._MakeBinaryManifest([(None, 'package', 'com.android.foo')])
+    self.assertRaises(ValueError, ParseBinaryManifest, manifest[:-4])
+    self.assertRaises(ValueError, ParseBinaryManifest, b'\0' * 8)
+
+  def _MakeTargetFiles(self):
+    target_files = common.MakeTempFile(suffix='.zip')
+    with open(self.test_app, 'rb') as f:
+      test_app = f.read()
+    with open(os.path.join(self.testdata_dir, 'has_apk.apex'), 'rb') as f:
+      apex = f.read()
+    with zipfile.ZipFile(target_files, 'w') as target_files_zip:
+      target_files_zip.writestr(
+          'META/apkcerts.txt',
+          'name="TestApp.apk" certificate="PRESIGNED" private_key="" '
+          'compressed="gz"\n')
+      target_files_zip.writestr(
+          'SYSTEM/app/TestApp/TestApp.apk.gz', gzip.compress(test_app))
+      target_files_zip.writestr('SYSTEM/apex/has_apk.apex', apex)
+      target_files_zip.writestr('SYSTEM/etc/foo.txt', 'foo')
+    return target_files
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_LoadZipFile_inMemory(self):
+    common.OPTIONS.in_memory = True
+    common.OPTIONS.apk_workers = 2
+    target_files = TargetFiles()
+    target_files.LoadZipFile(self._MakeTargetFiles())
+
+    test_app = os.path.join('SYSTEM', 'app', 'TestApp', 'TestApp.apk')
+    apex = os.path.join('SYSTEM', 'apex', 'has_apk.apex')
+    self.assertEqual([apex, test_app], list(target_files.apks))
+    self.assertEqual(
+        'com.android.cts.ctsshim', target_files.apks[test_app].package)
+    self.assertEqual(
+        frozenset([TEST_APP_CERT_SHA1]),
+        target_files.apks[test_app].cert_digests)
+    self.assertEqual(
+        'com.google.android.wifi', target_files.apks[apex].package)
+    self.assertEqual(
+        {'TestApp.apk': 'PRESIGNED'}, target_files.certmap)
+
+    # The certs read by the workers are added to ALL_CERTS.
+    cert_name = check_target_files_signatures.ALL_CERTS.Get(
+        TEST_APP_CERT_SHA1)
+    self.assertTrue(cert_name.startswith('unknown cert 61ed377e85d3 ('))
+    self.assertEqual(self._problems, check_target_files_signatures.PROBLEMS)
+
+  def test_LoadZipFile_indexed(self):
+    common.OPTIONS.cert_db_dir = common.MakeTempDir()
+    target_files_zip = self._MakeTargetFiles()
+    index = GetApkIndex()
+
+    # Index the APKs as if an earlier run had parsed them.
+    test_app = os.path.join('SYSTEM', 'app', 'TestApp', 'TestApp.apk')
+    apex = os.path.join('SYSTEM', 'apex', 'has_apk.apex')
+    with zipfile.ZipFile(target_files_zip) as input_zip:
+      test_app_data = gzip.decompress(
+          input_zip.read('SYSTEM/app/TestApp/TestApp.apk.gz'))
+      apex_data = input_zip.read('SYSTEM/apex/has_apk.apex')
+    index.PutApk(
+        index.GetKey(test_app_data),
+        APK.FromIndexEntry(test_app, {
+            'package': 'com.android.cts.ctsshim',
+            'shared_uid': 'android.uid.shared',
+            'cert_digests': [TEST_APP_CERT_SHA1],
+            'cert_subjects': {TEST_APP_CERT_SHA1: 'CN=Android'},
+        }), [])
+    # The same APEX was found under another name.
+    index.PutApk(
+        index.GetKey(apex_data),
+        APK.FromIndexEntry(os.path.join('SYSTEM', 'apex', 'old.apex'), {
+            'package': 'com.google.android.wifi',
+            'shared_uid': None,
+            'cert_digests': [],
+            'cert_subjects': {},
+        }), ['No signature found'])
+
+    # No external tool gets run for the indexed APKs.
+    check_target_files_signatures.Push('input target_files:')
+    try:
+      target_files = TargetFiles()
+      target_files.LoadZipFile(target_files_zip)
+    finally:
+      check_target_files_signatures.Pop()
+
+    self.assertEqual(2, index.hits)
+    self.assertEqual([apex, test_app], list(target_files.apks))
+    self.assertEqual(
+        'android.uid.shared', target_files.apks[test_app].shared_uid)
+    self.assertEqual(
+        frozenset([TEST_APP_CERT_SHA1]),
+        target_files.apks[test_app].cert_digests)
+    self.assertEqual(
+        'unknown cert 61ed377e85d3 (CN=Android)',
+        check_target_files_signatures.ALL_CERTS.Get(TEST_APP_CERT_SHA1))
+    self.assertEqual(
+        self._problems +
+        ['input target_files: {}: No signature found'.format(apex)],
+        check_target_files_signatures.PROBLEMS)
+
+  def test_TakeProblems(self):
+    check_target_files_signatures.Push('input target_files:')
+    try:
+      start = len(check_target_files_signatures.PROBLEMS)
+      check_target_files_signatures.Push('Foo.apk:')
+      check_target_files_signatures.AddProblem('No signature found')
+      check_target_files_signatures.Pop()
+      problems = check_target_files_signatures.TakeProblems(start, 'Foo.apk')
+      self.assertEqual(['No signature found'], problems)
+
+      # The problems are added back under the given name.
+      check_target_files_signatures.AddProblems(problems, 'Bar.apk')
+    finally:
+      check_target_files_signatures.Pop()
+    self.assertEqual(
+        ['input target_files: Foo.apk: No signature found',
+         'input target_files: Bar.apk: No signature found'],
+        check_target_files_signatures.PROBLEMS[start:])
+
+  def test_ApkIndex_GetApk_unknownLocalCert(self):
+    common.OPTIONS.cert_db_dir = common.MakeTempDir()
+    index = GetApkIndex()
+    index.PutApk('1234', APK.FromIndexEntry('Foo.apk', {
+        'package': 'com.android.foo',
+        'shared_uid': None,
+        'cert_digests': ['abcd'],
+        'cert_subjects': {'abcd': None},
+    }), [])
+
+    # The cert named after a local cert is no longer known.
+    self.assertIsNone(index.GetApk('1234', 'Foo.apk'))
+
+    check_target_files_signatures.ALL_CERTS.Add('abcd', None, 'foo/key')
+    apk, problems = index.GetApk('1234', 'Foo.apk')
+    self.assertEqual('com.android.foo', apk.package)
+    self.assertEqual([], problems)
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_LoadZipFile_inMemory_indexed(self):
+    common.OPTIONS.in_memory = True
+    common.OPTIONS.apk_workers = 2
+    common.OPTIONS.cert_db_dir = common.MakeTempDir()
+    target_files_zip = self._MakeTargetFiles()
+
+    first = TargetFiles()
+    first.LoadZipFile(target_files_zip)
+    index = GetApkIndex()
+    self.assertEqual((0, 2), (index.hits, index.misses))
+
+    # The second run loads everything from the index, including the subjects
+    # of the unknown certs.
+    check_target_files_signatures.ALL_CERTS.certs = self._certs.copy()
+    second = TargetFiles()
+    second.LoadZipFile(target_files_zip)
+    self.assertEqual((2, 2), (index.hits, index.misses))
+    self.assertEqual(list(first.apks), list(second.apks))
+    for name, apk in first.apks.items():
+      self.assertEqual(apk.package, second.apks[name].package)
+      self.assertEqual(apk.shared_uid, second.apks[name].shared_uid)
+      self.assertEqual(apk.cert_digests, second.apks[name].cert_digests)
+    cert_name = check_target_files_signatures.ALL_CERTS.Get(
+        TEST_APP_CERT_SHA1)
+    self.assertTrue(cert_name.startswith('unknown cert 61ed377e85d3 ('))
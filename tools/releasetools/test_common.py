@@ -17,17 +17,24 @@
 import copy
 import json
 import os
+import pickle
+import random
 import subprocess
+import sys
 import tempfile
+import threading
 import time
 import unittest
 import zipfile
+import zlib
 from hashlib import sha1
 
 import common
+import edify_generator
+import sparse_img
 import test_utils
 import validate_target_files
-from images import EmptyImage, DataImage
+from images import EmptyImage, DataImage, FileImage
 from rangelib import RangeSet
 
 
@@ -557,6 +564,69 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     func(*args)
     self.assertEqual(default_limit, zipfile.ZIP64_LIMIT)
 
+  @staticmethod
+  def _GetCompressibleData(size):
+    # Text-like data that deflates to about a third, with long-range matches
+    # across the chunk boundaries.
+    words = [sha1(b'%d' % index).hexdigest()[:index % 7 + 2].encode()
+             for index in range(1000)]
+    random_words = random.Random(0)
+    data = b' '.join(random_words.choices(words, k=size // 2 + 1))
+    return data[:size]
+
+  def test_ParallelDeflater(self):
+    for size in (0, 1, 64 * KiB, 200 * KiB + 5):
+      data = self._GetCompressibleData(size)
+      input_file = common.MakeTempFile()
+      with open(input_file, 'wb') as f:
+        f.write(data)
+      output_file = common.MakeTempFile()
+      crc, input_size, output_size = common.ParallelDeflater(
+          3, chunk_size=32 * KiB).Compress(input_file, output_file)
+
+      with open(output_file, 'rb') as f:
+        compressed = f.read()
+      self.assertEqual(size, input_size)
+      self.assertEqual(len(compressed), output_size)
+      self.assertEqual(zlib.crc32(data), crc)
+      decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+      self.assertEqual(data, decompressor.decompress(compressed))
+      self.assertTrue(decompressor.eof)
+
+  def test_ZipWriteParallelDeflated(self):
+    data = self._GetCompressibleData(3 * MiB + 100) + os.urandom(MiB)
+    test_file_name = common.MakeTempFile()
+    with open(test_file_name, 'wb') as test_file:
+      test_file.write(data)
+    zip_file_name = common.MakeTempFile(suffix='.zip')
+
+    zip_file = zipfile.ZipFile(zip_file_name, 'w', allowZip64=True)
+    input_size, output_size, _ = common.ZipWriteParallelDeflated(
+        zip_file, test_file_name, 'system.new.dat', 4)
+    common.ZipWriteStr(zip_file, 'foo', b'bar')
+    common.ZipClose(zip_file)
+
+    self.assertEqual(len(data), input_size)
+    self._verify(zip_file, zip_file_name, 'system.new.dat',
+                 sha1(data).hexdigest(),
+                 expected_compress_type=zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(zip_file_name) as zip_file:
+      self.assertEqual(output_size,
+                       zip_file.getinfo('system.new.dat').compress_size)
+      self.assertEqual(b'bar', zip_file.read('foo'))
+
+    # The chunks cost little compared with a single stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    single_size = len(compressor.compress(data) + compressor.flush())
+    self.assertLess(output_size, single_size * 1.01)
+
+  def test_ZipWriteParallelDeflated_resets_ZIP64_LIMIT(self):
+    test_file_name = common.MakeTempFile()
+    zip_file = zipfile.ZipFile(common.MakeTempFile(suffix='.zip'), 'w')
+    self._test_reset_ZIP64_LIMIT(common.ZipWriteParallelDeflated, zip_file,
+                                 test_file_name, 'foo', 2)
+    zip_file.close()
+
   def test_ZipWrite(self):
     file_contents = os.urandom(1024)
     self._test_ZipWrite(file_contents)
@@ -673,7 +743,6 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file_name)
 
-  @test_utils.SkipIfExternalToolsUnavailable()
   def test_ZipDelete(self):
     zip_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     output_zip = zipfile.ZipFile(zip_file.name, 'w',
@@ -718,6 +787,86 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file.name)
 
+  @staticmethod
+  def _test_ZipRewriter_createZipFile():
+    zip_file = os.path.join(common.MakeTempDir(), 'test.zip')
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as output_zip:
+      output_zip.comment = b'comment'
+      common.ZipWriteStr(output_zip, 'Test1', b'1' * 4096)
+      common.ZipWriteStr(output_zip, 'Test2', os.urandom(1024),
+                         compress_type=zipfile.ZIP_STORED)
+      common.ZipWriteStr(output_zip, 'Test3', b'3' * 4096)
+    return zip_file
+
+  def test_ZipRewriter(self):
+    zip_file = self._test_ZipRewriter_createZipFile()
+    with zipfile.ZipFile(zip_file, 'r') as input_zip:
+      expected = {info.filename: (info, input_zip.read(info))
+                  for info in input_zip.infolist()}
+
+    with common.ZipRewriter(zip_file, ['Test1'],
+                            compress_types={'Test3': zipfile.ZIP_STORED},
+                            compression=zipfile.ZIP_DEFLATED) as output_zip:
+      common.ZipWriteStr(output_zip, 'Test1', b'4' * 4096)
+
+    with zipfile.ZipFile(zip_file, 'r') as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(['Test2', 'Test3', 'Test1'], check_zip.namelist())
+      self.assertEqual(b'comment', check_zip.comment)
+      self.assertEqual(b'4' * 4096, check_zip.read('Test1'))
+      self.assertEqual(
+          zipfile.ZIP_DEFLATED, check_zip.getinfo('Test1').compress_type)
+      for name in ('Test2', 'Test3'):
+        info = check_zip.getinfo(name)
+        self.assertEqual(expected[name][1], check_zip.read(info))
+        self.assertEqual(zipfile.ZIP_STORED, info.compress_type)
+        self.assertEqual(expected[name][0].external_attr, info.external_attr)
+        self.assertEqual(expected[name][0].date_time, info.date_time)
+
+  def test_ZipRewriter_dataDescriptors(self):
+    # Entries written to a non-seekable stream are followed by data
+    # descriptors.
+    class NonSeekableFile(object):
+      def __init__(self, f):
+        self._f = f
+
+      def write(self, data):
+        return self._f.write(data)
+
+      def flush(self):
+        self._f.flush()
+
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with open(zip_file, 'wb') as f:
+      with zipfile.ZipFile(NonSeekableFile(f), 'w',
+                           compression=zipfile.ZIP_DEFLATED) as output_zip:
+        for name in ('Test1', 'Test2', 'Test3'):
+          with output_zip.open(name, 'w') as entry:
+            entry.write(name.encode() * 1024)
+
+    common.ZipDelete(zip_file, 'Test2')
+    with zipfile.ZipFile(zip_file, 'r') as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(['Test1', 'Test3'], check_zip.namelist())
+      self.assertEqual(b'Test3' * 1024, check_zip.read('Test3'))
+
+  def test_ZipRewriter_failure(self):
+    zip_file = self._test_ZipRewriter_createZipFile()
+    with open(zip_file, 'rb') as f:
+      expected = f.read()
+
+    self.assertRaises(
+        common.ExternalError, common.ZipDelete, zip_file, ['Test4', 'Test5'])
+    with self.assertRaises(ValueError):
+      with common.ZipRewriter(zip_file, ['Test1']) as output_zip:
+        common.ZipWriteStr(output_zip, 'Test1', b'4' * 4096)
+        raise ValueError('Failed to write')
+
+    with open(zip_file, 'rb') as f:
+      self.assertEqual(expected, f.read())
+    self.assertEqual(['test.zip'], os.listdir(os.path.dirname(zip_file)))
+
   @staticmethod
   def _test_UnzipTemp_createZipFile():
     zip_file = common.MakeTempFile(suffix='.zip')
@@ -806,6 +955,52 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     self.assertFalse(os.path.exists(os.path.join(unzipped_dir, 'Dir5/Baz5')))
 
 
+  def test_TargetFiles(self):
+    zip_file = self._test_UnzipTemp_createZipFile()
+    with zipfile.ZipFile(zip_file) as input_zip:
+      contents = input_zip.read('Test1')
+
+    with common.TargetFiles(zip_file) as target_files:
+      self.assertIn('Dir5/Baz5', target_files)
+      self.assertNotIn('Dir5', target_files)
+      self.assertNotIn('Nonexistent', target_files)
+      self.assertEqual(contents, target_files.read('Dir5/Baz5'))
+      self.assertRaises(KeyError, target_files.read, 'Nonexistent')
+
+      # Entries are extracted on demand, once.
+      path = target_files.Extract('Dir5/Baz5')
+      self.assertTrue(path.endswith(os.path.join('Dir5', 'Baz5')))
+      with open(path, 'rb') as f:
+        self.assertEqual(contents, f.read())
+      self.assertEqual(path, target_files.Extract('Dir5/Baz5'))
+      self.assertEqual(
+          ['Baz5'], os.listdir(os.path.dirname(path)))
+      self.assertRaises(KeyError, target_files.Extract, 'Nonexistent')
+
+      extracted_dir = target_files.ExtractAll(['Test*'])
+      self.assertEqual(
+          ['Dir5', 'Test1', 'Test2'], sorted(os.listdir(extracted_dir)))
+      self.assertEqual(
+          contents.decode(), common.ReadFromInputFile(target_files, 'Test2'))
+
+  def test_TargetFiles_extractedDir(self):
+    zip_file = self._test_UnzipTemp_createZipFile()
+    unzipped_dir = common.UnzipTemp(zip_file)
+    with zipfile.ZipFile(zip_file) as input_zip:
+      contents = input_zip.read('Test1')
+      namelist = input_zip.namelist()
+
+    target_files = common.TargetFiles(unzipped_dir)
+    self.assertIsNone(target_files.zip_file)
+    self.assertEqual(sorted(namelist), sorted(target_files.namelist()))
+    self.assertIn('Dir5/Baz5', target_files)
+    self.assertNotIn('Dir5', target_files)
+    self.assertEqual(contents, target_files.read('Dir5/Baz5'))
+    self.assertRaises(KeyError, target_files.read, 'Nonexistent')
+    self.assertEqual(os.path.join(unzipped_dir, 'Dir5', 'Baz5'),
+                     target_files.Extract('Dir5/Baz5'))
+    self.assertEqual(unzipped_dir, target_files.ExtractAll())
+
 class CommonApkUtilsTest(test_utils.ReleaseToolsTestCase):
   """Tests the APK utils related functions."""
 
@@ -1039,6 +1234,80 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
         },
         sparse_image.file_map)
 
+  def test_SparseImage_readRanges(self):
+    image_file = test_utils.construct_sparse_image([
+        (0xCAC1, 2),
+        (0xCAC2, 300),
+        (0xCAC1, 2)])
+    with open(image_file, 'rb') as f:
+      image_data = f.read()
+    # Skip the file header and the chunk headers.
+    raw_0 = image_data[40:40 + 4096 * 2]
+    fill = image_data[40 + 4096 * 2 + 12:40 + 4096 * 2 + 16]
+    raw_1 = image_data[-4096 * 2:]
+    expected = raw_0 + fill * 1024 * 300 + raw_1
+
+    sparse_image = sparse_img.SparseImage(image_file)
+    for ranges in ("0-303", "1", "1-2", "100-301", "0 2 5-9 302-303"):
+      ranges = RangeSet(ranges)
+      data = b''.join(expected[s * 4096:e * 4096] for s, e in ranges)
+      self.assertEqual(data, b''.join(sparse_image.ReadRangeSet(ranges)))
+      self.assertEqual(sha1(data).hexdigest(), sparse_image.RangeSha1(ranges))
+
+      output_file = common.MakeTempFile()
+      with open(output_file, 'wb') as f:
+        sparse_image.WriteRangeDataToFd(ranges, f)
+      with open(output_file, 'rb') as f:
+        self.assertEqual(data, f.read())
+
+  def test_SparseImage_concurrentReaders(self):
+    image_file = test_utils.construct_sparse_image([
+        (0xCAC1, 64),
+        (0xCAC2, 64),
+        (0xCAC1, 64)])
+    sparse_image = sparse_img.SparseImage(image_file)
+    ranges = [RangeSet(data=(i, i + 67)) for i in range(0, 125, 3)]
+    expected = [sparse_image.RangeSha1(r) for r in ranges]
+
+    results = {}
+
+    def hash_all(index):
+      results[index] = [sparse_image.RangeSha1(r) for r in ranges]
+
+    threads = [threading.Thread(target=hash_all, args=(i,)) for i in range(4)]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+    self.assertEqual({i: expected for i in range(4)}, results)
+
+  def test_SparseImage_pickle(self):
+    image_file = test_utils.construct_sparse_image([
+        (0xCAC1, 6),
+        (0xCAC3, 3),
+        (0xCAC1, 4)])
+    sparse_image = sparse_img.SparseImage(image_file)
+    copied = pickle.loads(pickle.dumps(sparse_image))
+
+    self.assertEqual(sparse_image.care_map, copied.care_map)
+    self.assertEqual(sparse_image.file_map, copied.file_map)
+    for ranges in (RangeSet("0-5"), RangeSet("3-4 9-12"), copied.care_map):
+      self.assertEqual(sparse_image.RangeSha1(ranges), copied.RangeSha1(ranges))
+
+  def test_SparseImage_PrecomputeRangeSha1s(self):
+    image_file = test_utils.construct_sparse_image([
+        (0xCAC1, 6),
+        (0xCAC3, 3),
+        (0xCAC1, 4)])
+    sparse_image = sparse_img.SparseImage(image_file)
+    ranges_list = [RangeSet("0-5"), RangeSet("3-4 9-12"), RangeSet("6-8")]
+    expected = [sparse_img.SparseImage(image_file).RangeSha1(ranges)
+                for ranges in ranges_list]
+
+    sparse_image.PrecomputeRangeSha1s(ranges_list, threads=2)
+    self.assertEqual(
+        expected, [sparse_image.RangeSha1(ranges) for ranges in ranges_list])
+
   def test_PartitionMapFromTargetFiles(self):
     target_files_dir = common.MakeTempDir()
     os.makedirs(os.path.join(target_files_dir, 'SYSTEM'))
@@ -1664,6 +1933,442 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
     self.assertRaises(common.ExternalError, common._GenerateGkiCertificate,
                       test_file.name, 'generic_kernel')
 
+class BlobCacheTest(test_utils.ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.cache_dir = common.MakeTempDir()
+    self.blob_cache = common.BlobCache(self.cache_dir, 1024)
+
+  def _MakeTempFile(self, age):
+    temp_file = os.path.join(self.cache_dir, 'ab', '.tmp-' + str(age))
+    os.makedirs(os.path.dirname(temp_file), exist_ok=True)
+    with open(temp_file, 'wb') as f:
+      f.write(b'\0' * 600)
+    mtime = time.time() - age
+    os.utime(temp_file, (mtime, mtime))
+    return temp_file
+
+  def test_PutBlob_keepsTempFilesOfOtherWriters(self):
+    temp_file = self._MakeTempFile(0)
+    for key in ('ab01', 'ab02', 'ab03'):
+      self.blob_cache.PutBlob(key, b'\0' * 400)
+
+    # The temp file is neither evicted nor counted towards the size.
+    self.assertTrue(os.path.exists(temp_file))
+    self.assertIsNone(self.blob_cache.GetBlob('ab01'))
+    self.assertIsNotNone(self.blob_cache.GetBlob('ab02'))
+    self.assertIsNotNone(self.blob_cache.GetBlob('ab03'))
+
+  def test_PutBlob_evictsStaleTempFiles(self):
+    temp_file = self._MakeTempFile(common.BlobCache.STALE_TEMP_AGE * 2)
+    blob_cache = common.BlobCache(self.cache_dir, 1024)
+    blob_cache.PutBlob('ab01', b'\0' * 600)
+
+    self.assertFalse(os.path.exists(temp_file))
+    self.assertIsNotNone(blob_cache.GetBlob('ab01'))
+
+  def test_PutBlob_writeFailure(self):
+    # The entry directory can't be created over a file.
+    with open(os.path.join(self.cache_dir, 'ab'), 'wb') as f:
+      f.write(b'')
+    self.blob_cache.PutBlob('ab01', b'blob')
+    self.assertIsNone(self.blob_cache.GetBlob('ab01'))
+
+    self.blob_cache.PutBlob('cd01', b'blob')
+    self.assertEqual(b'blob', self.blob_cache.GetBlob('cd01'))
+
+
+class PatchCacheTest(test_utils.ReleaseToolsTestCase):
+
+  # A fake diff program whose "patch" is a copy of the target file.
+  DIFF_PROGRAM = ['sh', '-c', 'cat "$2" > "$3"', 'sh']
+
+  def setUp(self):
+    self.cache_dir = common.MakeTempDir()
+    self.patch_cache = common.PatchCache(self.cache_dir, 1024)
+
+  def test_GetPut(self):
+    self.assertIsNone(self.patch_cache.Get(['sh'], 'src', 'tgt'))
+    self.patch_cache.Put(['sh'], 'src', 'tgt', b'patch')
+    self.assertEqual(b'patch', self.patch_cache.Get(['sh'], 'src', 'tgt'))
+    self.assertIsNone(self.patch_cache.Get(['sh', '-x'], 'src', 'tgt'))
+    self.assertIsNone(self.patch_cache.Get(['sh'], 'src', 'tgt2'))
+    self.assertEqual((1, 3), (self.patch_cache.hits, self.patch_cache.misses))
+
+    # Entries are shared by another instance on the same directory.
+    patch_cache = common.PatchCache(self.cache_dir, 1024)
+    self.assertEqual(b'patch', patch_cache.Get(['sh'], 'src', 'tgt'))
+
+  def test_Get_missingTool(self):
+    self.patch_cache.Put(['nonexistent-diff-tool'], 'src', 'tgt', b'patch')
+    self.assertIsNone(
+        self.patch_cache.Get(['nonexistent-diff-tool'], 'src', 'tgt'))
+
+  def test_Put_evictsLeastRecentlyUsed(self):
+    for index in range(3):
+      self.patch_cache.Put(['sh'], 'src', str(index), b'\0' * 300)
+      # Keep the mtime order deterministic.
+      time.sleep(0.01)
+    # Refresh entry 0, so that entry 1 becomes the least recently used one.
+    self.assertIsNotNone(self.patch_cache.Get(['sh'], 'src', '0'))
+    self.patch_cache.Put(['sh'], 'src', '3', b'\0' * 300)
+
+    self.assertIsNotNone(self.patch_cache.Get(['sh'], 'src', '0'))
+    self.assertIsNone(self.patch_cache.Get(['sh'], 'src', '1'))
+    self.assertIsNotNone(self.patch_cache.Get(['sh'], 'src', '2'))
+    self.assertIsNotNone(self.patch_cache.Get(['sh'], 'src', '3'))
+
+  def test_Put_overwrite(self):
+    self.patch_cache.Put(['sh'], 'src', 'tgt', b'\0' * 600)
+    # Overwriting the entry doesn't count its size twice, which would evict it.
+    self.patch_cache.Put(['sh'], 'src', 'tgt', b'\1' * 600)
+    self.assertEqual(b'\1' * 600, self.patch_cache.Get(['sh'], 'src', 'tgt'))
+
+  def test_GetPut_bonusFile(self):
+    bonus_file = common.MakeTempFile()
+    with open(bonus_file, 'wb') as f:
+      f.write(b'bonus')
+    self.patch_cache.Put(['sh', '-b', bonus_file], 'src', 'tgt', b'patch')
+
+    # The bonus file is keyed by its content instead of its path.
+    other_bonus_file = common.MakeTempFile()
+    with open(other_bonus_file, 'wb') as f:
+      f.write(b'bonus')
+    self.assertEqual(
+        b'patch',
+        self.patch_cache.Get(['sh', '-b', other_bonus_file], 'src', 'tgt'))
+
+    with open(bonus_file, 'wb') as f:
+      f.write(b'new bonus')
+    self.assertIsNone(
+        self.patch_cache.Get(['sh', '-b', bonus_file], 'src', 'tgt'))
+
+  def test_AddStats(self):
+    self.patch_cache.Put(['sh'], 'src', 'tgt', b'patch')
+    self.patch_cache.Get(['sh'], 'src', 'tgt')
+    self.patch_cache.AddStats((2, 3, 10))
+    self.assertEqual((3, 3, 15), self.patch_cache.GetStats())
+
+  def test_Difference_usesPatchCache(self):
+    common.OPTIONS.patch_cache_dir = self.cache_dir
+    try:
+      tf = common.File('file', b'target')
+      sf = common.File('file', b'source')
+      _, _, patch = common.Difference(
+          tf, sf, diff_program=self.DIFF_PROGRAM).ComputePatch()
+      self.assertEqual(b'target', patch)
+
+      patch_cache = common.GetPatchCache()
+      self.assertEqual((0, 1), (patch_cache.hits, patch_cache.misses))
+      _, _, patch = common.Difference(
+          tf, sf, diff_program=self.DIFF_PROGRAM).ComputePatch()
+      self.assertEqual(b'target', patch)
+      self.assertEqual((1, 1), (patch_cache.hits, patch_cache.misses))
+    finally:
+      common.OPTIONS.patch_cache_dir = None
+
+
+class DiffSchedulerTest(test_utils.ReleaseToolsTestCase):
+
+  # A fake diff program whose "patch" is a copy of the target file.
+  DIFF_PROGRAM = ['sh', '-c', 'cat "$2" > "$3"', 'sh']
+
+  class FakeDifference(common.Difference):
+    """A Difference that sleeps instead of diffing, tracking concurrency."""
+
+    def __init__(self, name, size, memory, tracker, duration=0.05):
+      super(DiffSchedulerTest.FakeDifference, self).__init__(
+          common.File(name, b'\0' * size), common.File(name, b''))
+      self.memory = memory
+      self.tracker = tracker
+      self.duration = duration
+
+    def EstimateMemory(self):
+      return self.memory
+
+    def ComputePatch(self, timeout=None):
+      with self.tracker['lock']:
+        self.tracker['running'] += 1
+        self.tracker['max_running'] = max(self.tracker['max_running'],
+                                          self.tracker['running'])
+      time.sleep(self.duration)
+      with self.tracker['lock']:
+        self.tracker['running'] -= 1
+      self.patch = b'patch'
+      return self.GetPatch()
+
+  def setUp(self):
+    self.saved_options = (
+        common.OPTIONS.worker_threads, common.OPTIONS.diff_timeout,
+        common.OPTIONS.diff_memory_budget, common.OPTIONS.diff_stats_file)
+    self.saved_diff_stats = common._diff_stats
+    common._diff_stats = None
+    self.tracker = {'lock': threading.Lock(), 'running': 0, 'max_running': 0}
+
+  def tearDown(self):
+    (common.OPTIONS.worker_threads, common.OPTIONS.diff_timeout,
+     common.OPTIONS.diff_memory_budget, common.OPTIONS.diff_stats_file) = (
+         self.saved_options)
+    common._diff_stats = self.saved_diff_stats
+    super(DiffSchedulerTest, self).tearDown()
+
+  def test_ComputeDifferences(self):
+    common.OPTIONS.worker_threads = 3
+    common.OPTIONS.diff_stats_file = common.MakeTempFile(suffix='.json')
+    diffs = [
+        common.Difference(
+            common.File('file{}'.format(i), b'target' * (i + 1)),
+            common.File('file{}'.format(i), b'source'),
+            diff_program=self.DIFF_PROGRAM)
+        for i in range(8)]
+    stats = common.ComputeDifferences(diffs)
+
+    for i, diff in enumerate(diffs):
+      self.assertEqual(b'target' * (i + 1), diff.GetPatch()[2])
+    self.assertEqual(8, stats.ToDict()['status'][common.DiffStats.OK])
+
+    # The stats are aggregated over the calls.
+    common.ComputeDifferences(diffs[:2])
+    with open(common.OPTIONS.diff_stats_file) as stats_file:
+      stats = json.load(stats_file)
+    self.assertEqual(10, stats['count'])
+    self.assertEqual(10, len(stats['diffs']))
+    self.assertEqual(sum(6 * (i + 1) for i in range(8)) + 6 + 12,
+                     stats['patch_bytes'])
+
+  def test_ComputeDifferences_timeout(self):
+    common.OPTIONS.worker_threads = 2
+    common.OPTIONS.diff_timeout = 1
+    slow = common.Difference(
+        common.File('slow', b'target'), common.File('slow', b'source'),
+        diff_program=['sh', '-c', 'exec sleep 30', 'sh'])
+    fast = common.Difference(
+        common.File('fast', b'target'), common.File('fast', b'source'),
+        diff_program=self.DIFF_PROGRAM)
+
+    start = time.time()
+    stats = common.ComputeDifferences([slow, fast]).ToDict()
+    self.assertLess(time.time() - start, 20)
+
+    self.assertIsNone(slow.GetPatch()[2])
+    self.assertTrue(slow.timed_out)
+    self.assertEqual(b'target', fast.GetPatch()[2])
+    self.assertEqual(1, stats['status'][common.DiffStats.TIMED_OUT])
+    self.assertEqual(1, stats['status'][common.DiffStats.OK])
+
+  def test_Difference_EstimateMemory(self):
+    tf = common.File('file.zip', b'\0' * 10)
+    sf = common.File('file.zip', b'\0' * 100)
+    self.assertEqual(910, common.Difference(
+        tf, sf, diff_program=['bsdiff']).EstimateMemory())
+    # imgdiff is the default for zips.
+    self.assertEqual(3640, common.Difference(tf, sf).EstimateMemory())
+
+  def test_DiffScheduler_memoryBudget(self):
+    diffs = [self.FakeDifference('file{}'.format(i), 10, 60, self.tracker)
+             for i in range(4)]
+    stats = common.DiffScheduler(4, memory_budget=100).Run(diffs)
+    self.assertEqual(1, self.tracker['max_running'])
+    self.assertGreater(stats.admission_waits, 0)
+    self.assertEqual(60, stats.peak_memory)
+
+    diffs = [self.FakeDifference('file{}'.format(i), 10, 50, self.tracker)
+             for i in range(4)]
+    stats = common.DiffScheduler(4, memory_budget=100).Run(diffs)
+    self.assertEqual(2, self.tracker['max_running'])
+    self.assertEqual(100, stats.peak_memory)
+
+  def test_DiffScheduler_memoryBudget_oversizedDiff(self):
+    diffs = [self.FakeDifference('large', 10, 1000, self.tracker),
+             self.FakeDifference('small', 1, 10, self.tracker)]
+    stats = common.DiffScheduler(2, memory_budget=100).Run(diffs)
+    self.assertEqual(1, self.tracker['max_running'])
+    self.assertEqual(2, len(stats.diffs))
+
+  def test_DiffScheduler_workStealing(self):
+    # Diffs are dealt round-robin by size, so worker 0 gets the slow one and
+    # half of the quick ones, which worker 1 steals.
+    diffs = [self.FakeDifference('slow', 100, 1, self.tracker, duration=1)]
+    diffs += [self.FakeDifference('quick{}'.format(i), 10, 1, self.tracker)
+              for i in range(7)]
+    stats = common.DiffScheduler(2).Run(diffs)
+
+    self.assertEqual(8, len(stats.diffs))
+    self.assertEqual(3, stats.steals)
+    quick_workers = [d['worker'] for d in stats.diffs if d['name'] != 'slow']
+    self.assertEqual([1] * 7, quick_workers)
+
+  def test_DiffScheduler_workerFailure(self):
+    class FailingDifference(self.FakeDifference):
+      def ComputePatch(self, timeout=None):
+        raise ValueError('diff failed')
+
+    diffs = [FailingDifference('failing', 100, 1, self.tracker)]
+    diffs += [self.FakeDifference('file{}'.format(i), 10, 1, self.tracker)
+              for i in range(3)]
+    self.assertRaises(ValueError, common.DiffScheduler(2).Run, diffs)
+    # The other diffs are still computed.
+    for diff in diffs[1:]:
+      self.assertEqual(b'patch', diff.GetPatch()[2])
+
+
+class SignApkServerTest(test_utils.ReleaseToolsTestCase):
+
+  # A fake 'java -jar signapk.jar', which "signs" the input by appending the
+  # key name, and logs each launch. 'legacy.jar' doesn't support --server.
+  FAKE_JAVA = """#!{python}
+import os
+import sys
+
+def Sign(args):
+  if 'crash' in args[-1]:
+    sys.exit(1)
+  if 'fail' in args[-1]:
+    print('Failed to sign ' + args[-2], file=sys.stderr)
+    return 1
+  with open(args[-2], 'rb') as input_file:
+    data = input_file.read()
+  with open(args[-1], 'wb') as output_file:
+    output_file.write(data + args[-3].encode())
+  return 0
+
+jar = sys.argv[sys.argv.index('-jar') + 1]
+args = sys.argv[sys.argv.index('-jar') + 2:]
+with open(os.path.join(os.path.dirname(jar), 'launches'), 'a') as log:
+  log.write(' '.join(args) + '\\n')
+if args != ['--server']:
+  sys.exit(Sign(args))
+if jar.endswith('legacy.jar'):
+  sys.exit(2)
+for request in sys.stdin:
+  fields = request[:-1].split('\\0')
+  status = Sign(fields[1:])
+  output = ('password: ' + fields[0]).encode()
+  sys.stdout.buffer.write(b'%d %d\\n' % (status, len(output)) + output)
+  sys.stdout.buffer.flush()
+"""
+
+  def setUp(self):
+    self.tools_dir = common.MakeTempDir()
+    java = os.path.join(self.tools_dir, 'java')
+    with open(java, 'w') as java_file:
+      java_file.write(self.FAKE_JAVA.format(python=sys.executable))
+    os.chmod(java, 0o755)
+
+    self.saved_options = (
+        common.OPTIONS.java_path, common.OPTIONS.search_path,
+        common.OPTIONS.signapk_path, common.OPTIONS.signapk_server)
+    common.OPTIONS.java_path = java
+    common.OPTIONS.search_path = self.tools_dir
+    common.OPTIONS.signapk_path = 'signapk.jar'
+    common.OPTIONS.signapk_server = True
+
+  def tearDown(self):
+    (common.OPTIONS.java_path, common.OPTIONS.search_path,
+     common.OPTIONS.signapk_path, common.OPTIONS.signapk_server) = (
+         self.saved_options)
+    super(SignApkServerTest, self).tearDown()
+
+  def _GetLaunches(self):
+    with open(os.path.join(self.tools_dir, 'launches')) as log:
+      return log.read().splitlines()
+
+  def _SignFiles(self, count, password=None):
+    outputs = []
+    for index in range(count):
+      input_file = common.MakeTempFile()
+      with open(input_file, 'wb') as f:
+        f.write(b'file%d-' % index)
+      output_file = common.MakeTempFile()
+      common.SignFile(input_file, output_file, 'key', password, whole_file=True)
+      with open(output_file, 'rb') as f:
+        outputs.append(f.read())
+    return outputs
+
+  def test_SignFile(self):
+    self.assertEqual([b'file0-key.pk8', b'file1-key.pk8', b'file2-key.pk8'],
+                     self._SignFiles(3, password='secret'))
+    # All the files are signed by the same server.
+    self.assertEqual(['--server'], self._GetLaunches())
+
+  def test_SignFile_concurrentCallers(self):
+    threads = [threading.Thread(target=self._SignFiles, args=(2,))
+               for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # Busy servers aren't shared; at most one server is started per thread.
+    launches = self._GetLaunches()
+    self.assertEqual(set(['--server']), set(launches))
+    self.assertLessEqual(len(launches), 3)
+
+  def test_SignFile_failure(self):
+    input_file = common.MakeTempFile()
+    output_file = common.MakeTempFile(suffix='fail')
+    self.assertRaisesRegex(
+        common.ExternalError, 'password: -', common.SignFile, input_file,
+        output_file, 'key', None, whole_file=True)
+
+    # A failed request doesn't take down the server.
+    self.assertEqual([b'file0-key.pk8'], self._SignFiles(1))
+    self.assertEqual(['--server'], self._GetLaunches())
+
+  def test_SignFile_serverUnsupported(self):
+    common.OPTIONS.signapk_path = 'legacy.jar'
+    self.assertEqual([b'file0-key.pk8', b'file1-key.pk8'], self._SignFiles(2))
+
+    launches = self._GetLaunches()
+    self.assertEqual('--server', launches[0])
+    # Falls back to one signapk.jar per file, without retrying the server.
+    self.assertEqual(3, len(launches))
+    self.assertNotIn('--server', launches[1:])
+
+  def test_SignFile_serverCrashed(self):
+    input_file = common.MakeTempFile()
+    with open(input_file, 'wb') as f:
+      f.write(b'crash-')
+    output_file = common.MakeTempFile(suffix='crash')
+    self.assertRaises(
+        common.ExternalError, common.SignFile, input_file, output_file, 'key',
+        None, whole_file=True)
+
+    # The crashed server falls back to signapk.jar for that file only, and a
+    # new server gets started for the next one.
+    self.assertEqual([b'file0-key.pk8'], self._SignFiles(1))
+    launches = self._GetLaunches()
+    self.assertEqual(3, len(launches))
+    self.assertEqual('--server', launches[0])
+    self.assertNotIn('--server', launches[1])
+    self.assertEqual('--server', launches[2])
+
+  def test_SignFile_carriageReturn(self):
+    # The server would split the request at '\r'.
+    self.assertEqual([b'file0-key.pk8'], self._SignFiles(1, password='a\rb'))
+    launches = self._GetLaunches()
+    self.assertEqual(1, len(launches))
+    self.assertNotIn('--server', launches[0])
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_SignFile_signapkServerIdenticalOutputs(self):
+    common.OPTIONS.java_path, common.OPTIONS.search_path, \
+        common.OPTIONS.signapk_path, _ = self.saved_options
+    testdata_dir = test_utils.get_testdata_dir()
+    apk = os.path.join(testdata_dir, 'TestApp.apk')
+    key = os.path.join(testdata_dir, 'testkey')
+
+    outputs = {}
+    for use_server in (False, True):
+      common.OPTIONS.signapk_server = use_server
+      output_file = common.MakeTempFile(suffix='.apk')
+      common.SignFile(apk, output_file, key, None, min_api_level=23)
+      with open(output_file, 'rb') as f:
+        outputs[use_server] = f.read()
+
+    self.assertEqual(outputs[False], outputs[True])
+
+
 class InstallRecoveryScriptFormatTest(test_utils.ReleaseToolsTestCase):
   """Checks the format of install-recovery.sh.
 
@@ -1950,6 +2655,50 @@ super_group_foo_group_size={group_foo_size}
     self.assertEqual(lines, ["remove foo"])
 
 
+class BlockDifferenceTest(test_utils.ReleaseToolsTestCase):
+
+  INFO_DICT = {
+      'blockimgdiff_versions': '3,4',
+      'use_dynamic_partitions': 'true',
+      'dynamic_partition_list': 'foo',
+  }
+
+  def setUp(self):
+    self.saved_options = (
+        common.OPTIONS.info_dict, common.OPTIONS.source_info_dict,
+        common.OPTIONS.cache_size, common.OPTIONS.new_data_compression_threads)
+    common.OPTIONS.info_dict = self.INFO_DICT
+    common.OPTIONS.source_info_dict = None
+    common.OPTIONS.cache_size = 1024 * 4096
+    self.output_path = common.MakeTempFile(suffix='.zip')
+
+  def tearDown(self):
+    (common.OPTIONS.info_dict, common.OPTIONS.source_info_dict,
+     common.OPTIONS.cache_size,
+     common.OPTIONS.new_data_compression_threads) = self.saved_options
+    super(BlockDifferenceTest, self).tearDown()
+
+  def test_WriteScript_parallelDeflatedNewData(self):
+    common.OPTIONS.new_data_compression_threads = 2
+    data = os.urandom(4096 * 4)
+    image_file = common.MakeTempFile(suffix='.img')
+    with open(image_file, 'wb') as f:
+      f.write(data)
+    block_diff = common.BlockDifference('foo', FileImage(image_file))
+
+    script = edify_generator.EdifyGenerator(3, self.INFO_DICT)
+    with zipfile.ZipFile(self.output_path, 'w',
+                         compression=zipfile.ZIP_DEFLATED) as output_zip:
+      block_diff.WriteScript(script, output_zip)
+
+    with zipfile.ZipFile(self.output_path) as output_zip:
+      self.assertNotIn('foo.new.dat.br', output_zip.namelist())
+      self.assertEqual(data, output_zip.read('foo.new.dat'))
+      self.assertEqual(zipfile.ZIP_DEFLATED,
+                       output_zip.getinfo('foo.new.dat').compress_type)
+    self.assertIn('"foo.new.dat"', '\n'.join(script.script))
+
+
 class PartitionBuildPropsTest(test_utils.ReleaseToolsTestCase):
   def setUp(self):
     self.odm_build_prop = [
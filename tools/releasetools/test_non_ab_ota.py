@@ -14,12 +14,17 @@
 # limitations under the License.
 #
 
+import collections
 import copy
+import os
 import zipfile
+from hashlib import sha1
 
 import common
+import non_ab_ota
 import test_utils
 
+from images import FileImage
 from non_ab_ota import NonAbOtaPropertyFiles, WriteFingerprintAssertion
 from test_utils import PropertyFilesTestCase
 
@@ -170,3 +175,114 @@ class NonAbOTATest(test_utils.ReleaseToolsTestCase):
         [('AssertSomeThumbprint', 'build-thumbprint',
           'source-build-thumbprint')],
         script_writer.lines)
+
+
+class ComputeBlockDifferencesTest(test_utils.ReleaseToolsTestCase):
+
+  INFO_DICT = {
+      'blockimgdiff_versions': '3,4',
+      'use_dynamic_partitions': 'true',
+      'dynamic_partition_list': 'system vendor product',
+  }
+
+  def setUp(self):
+    self.saved_options = (
+        common.OPTIONS.info_dict, common.OPTIONS.source_info_dict,
+        common.OPTIONS.worker_threads, common.OPTIONS.partition_workers,
+        common.OPTIONS.patch_workers, common.OPTIONS.cache_size)
+    common.OPTIONS.info_dict = self.INFO_DICT
+    common.OPTIONS.source_info_dict = self.INFO_DICT
+    common.OPTIONS.worker_threads = 4
+    common.OPTIONS.cache_size = 1024 * 4096
+
+  def tearDown(self):
+    (common.OPTIONS.info_dict, common.OPTIONS.source_info_dict,
+     common.OPTIONS.worker_threads, common.OPTIONS.partition_workers,
+     common.OPTIONS.patch_workers, common.OPTIONS.cache_size) = (
+         self.saved_options)
+    super(ComputeBlockDifferencesTest, self).tearDown()
+
+  @staticmethod
+  def _MakeImage(blocks, seed):
+    path = common.MakeTempFile(suffix='.img')
+    with open(path, 'wb') as image_file:
+      for index in range(blocks):
+        image_file.write(sha1(b'%d-%d' % (seed, index)).digest() * 204 +
+                         b'\0' * 16)
+    return FileImage(path)
+
+  def _GetPartitionArgs(self):
+    partition_args = collections.OrderedDict()
+    # An incremental update (without diffs, as bsdiff may not be available),
+    # and full updates.
+    partition_args['system'] = (
+        self._MakeImage(48, 0), self._MakeImage(48, 0), {'version': 4})
+    partition_args['vendor'] = (self._MakeImage(8, 1), None, {'version': 4})
+    partition_args['product'] = (self._MakeImage(64, 2), None, {'version': 4})
+    return partition_args
+
+  @staticmethod
+  def _GetOutputs(block_diff_dict):
+    outputs = []
+    for partition, diff in block_diff_dict.items():
+      files = []
+      for suffix in ('.transfer.list', '.new.dat', '.patch.dat'):
+        with open(diff.path + suffix, 'rb') as output_file:
+          files.append(output_file.read())
+      outputs.append((partition, diff.device, diff.required_cache,
+                      diff.touched_src_sha1, files))
+    return outputs
+
+  def test_ComputeBlockDifferences(self):
+    common.OPTIONS.partition_workers = None
+    expected = self._GetOutputs(
+        non_ab_ota.ComputeBlockDifferences(self._GetPartitionArgs()))
+
+    common.OPTIONS.partition_workers = 3
+    block_diff_dict = non_ab_ota.ComputeBlockDifferences(
+        self._GetPartitionArgs())
+    self.assertEqual(['system', 'vendor', 'product'], list(block_diff_dict))
+    self.assertEqual(expected, self._GetOutputs(block_diff_dict))
+
+    # The outputs are owned (and cleaned up) by this process.
+    for diff in block_diff_dict.values():
+      self.assertIn(os.path.dirname(diff.path), common.OPTIONS.tempfiles)
+    self.assertEqual('map_partition("system")',
+                     block_diff_dict['system'].device)
+    self.assertEqual(
+        block_diff_dict['product'].tgt.TotalSha1(),
+        sha1(b''.join(block_diff_dict['product'].tgt.ReadRangeSet(
+            block_diff_dict['product'].tgt.care_map))).hexdigest())
+
+  def test_ComputeBlockDifferences_patchWorkers(self):
+    common.OPTIONS.partition_workers = None
+    expected = self._GetOutputs(
+        non_ab_ota.ComputeBlockDifferences(self._GetPartitionArgs()))
+
+    # Each partition process gets its share of the patch workers, which the
+    # (forked) wrapper records into the returned BlockDifference.
+    init = common.BlockDifference.__init__
+
+    def Init(diff, *args, **kwargs):
+      init(diff, *args, **kwargs)
+      diff.patch_workers = common.OPTIONS.patch_workers
+
+    common.OPTIONS.partition_workers = 2
+    common.OPTIONS.patch_workers = 5
+    common.BlockDifference.__init__ = Init
+    try:
+      block_diff_dict = non_ab_ota.ComputeBlockDifferences(
+          self._GetPartitionArgs())
+    finally:
+      common.BlockDifference.__init__ = init
+    self.assertEqual(expected, self._GetOutputs(block_diff_dict))
+    self.assertEqual([2, 2, 2], [diff.patch_workers
+                                 for diff in block_diff_dict.values()])
+    self.assertEqual(5, common.OPTIONS.patch_workers)
+
+  def test_ComputeBlockDifferences_failure(self):
+    common.OPTIONS.partition_workers = 2
+    partition_args = self._GetPartitionArgs()
+    partition_args['vendor'] = (self._MakeImage(8, 1), None, {'version': 2})
+    self.assertRaises(AssertionError, non_ab_ota.ComputeBlockDifferences,
+                      partition_args)
@@ -21,6 +21,7 @@ import zipfile
 
 import common
 import ota_metadata_pb2
+import ota_utils
 import test_utils
 from ota_utils import (
     BuildLegacyOtaMetadata, CalculateRuntimeDevicesAndFingerprints,
@@ -172,6 +173,7 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
     common.OPTIONS.timestamp = False
     common.OPTIONS.wipe_user_data = False
     common.OPTIONS.no_signing = False
+    common.OPTIONS.output_metadata_path = None
     common.OPTIONS.package_key = os.path.join(self.testdata_dir, 'testkey')
     common.OPTIONS.key_passwords = {
         common.OPTIONS.package_key: None,
@@ -708,6 +710,76 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
     self.assertIn('ota-test-property-files', metadata.property_files)
 
 
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_FinalizeMetadata_signsOnce(self):
+    entries = [
+        'required-entry1',
+        'required-entry2',
+        'optional-entry1',
+    ]
+    zip_file = PropertyFilesTest.construct_zip_package(entries)
+    with zipfile.ZipFile(zip_file, 'a', allowZip64=True) as zip_fp:
+      # Moves ahead of the other entries after the signing.
+      zip_fp.writestr('foo-entry1', 'A' * 1024 * 1024, zipfile.ZIP_STORED)
+
+    signed_files = []
+    sign_output = ota_utils.SignOutput
+
+    def SignOutput(input_file, output_file):
+      signed_files.append(input_file)
+      sign_output(input_file, output_file)
+
+    metadata = ota_metadata_pb2.OtaMetadata()
+    needed_property_files = (
+        TestPropertyFiles(),
+    )
+    output_file = common.MakeTempFile(suffix='.zip')
+    ota_utils.SignOutput = SignOutput
+    try:
+      FinalizeMetadata(metadata, zip_file, output_file, needed_property_files)
+    finally:
+      ota_utils.SignOutput = sign_output
+    self.assertEqual([zip_file], signed_files)
+    self.assertIn('ota-test-property-files', metadata.property_files)
+
+  def _test_FinalizeMetadata_outputMetadataPath(self, compressed=False):
+    zip_file = PropertyFilesTest.construct_zip_package(['required-entry2'])
+    with zipfile.ZipFile(zip_file, 'a', allowZip64=True) as zip_fp:
+      # The offset of a compressed entry can't be predicted, which makes
+      # FinalizeMetadata() sign the package twice.
+      zip_fp.writestr(
+          'required-entry1', 'A' * 1024,
+          zipfile.ZIP_DEFLATED if compressed else zipfile.ZIP_STORED)
+
+    output_metadata_path = os.path.join(common.MakeTempDir(), 'metadata')
+    common.OPTIONS.output_metadata_path = output_metadata_path
+    metadata = ota_metadata_pb2.OtaMetadata()
+    output_file = common.MakeTempFile(suffix='.zip')
+    FinalizeMetadata(
+        metadata, zip_file, output_file, (TestPropertyFiles(),))
+
+    with open(output_metadata_path) as f:
+      self.assertEqual(ota_utils.FormatLegacyOtaMetadata(metadata), f.read())
+    with open(output_metadata_path + '.pb', 'rb') as f:
+      self.assertEqual(metadata.SerializeToString(), f.read())
+    if not common.OPTIONS.no_signing:
+      with zipfile.ZipFile(output_file, allowZip64=True) as output_zip:
+        self.assertEqual(
+            ota_utils.FormatLegacyOtaMetadata(metadata),
+            output_zip.read(ota_utils.METADATA_NAME).decode())
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_FinalizeMetadata_outputMetadataPath(self):
+    self._test_FinalizeMetadata_outputMetadataPath()
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_FinalizeMetadata_outputMetadataPath_signedTwice(self):
+    self._test_FinalizeMetadata_outputMetadataPath(compressed=True)
+
+  def test_FinalizeMetadata_outputMetadataPath_withNoSigning(self):
+    common.OPTIONS.no_signing = True
+    self._test_FinalizeMetadata_outputMetadataPath()
+
 class TestPropertyFiles(PropertyFiles):
   """A class that extends PropertyFiles for testing purpose."""
 
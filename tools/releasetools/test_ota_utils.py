@@ -54,3 +54,33 @@ class TestZipEntryOffset(unittest.TestCase):
       (offset, size) = ota_utils.GetZipEntryOffset(zfp, zinfo)
       self.assertEqual(size, zinfo.file_size)
       self.assertEqual(offset, zipfile.sizeFileHeader+len(zinfo.filename) + 28)
+
+
+class TestSignedZipLayout(unittest.TestCase):
+  def test_offsets(self):
+    layout = ota_utils.SignedZipLayout([
+        ('b', zipfile.ZIP_STORED, 10),
+        ('c', zipfile.ZIP_DEFLATED, 100),
+        ('META-INF/CERT.RSA', zipfile.ZIP_STORED, 3),
+        ('META-INF/com/android/otacert', zipfile.ZIP_STORED, 3),
+        ('dir/', zipfile.ZIP_STORED, 0),
+        ('a', zipfile.ZIP_STORED, 5),
+    ])
+    # 'a' comes first, with the JAR magic and the alignment extra fields.
+    a_offset = zipfile.sizeFileHeader + 1 + 4 + 6
+    self.assertEqual((a_offset, 5), layout.GetEntryOffset('a'))
+    b_offset = a_offset + 5 + zipfile.sizeFileHeader + 1 + 6
+    self.assertEqual((b_offset, 10), layout.GetEntryOffset('b'))
+    for name in ('c', 'META-INF/CERT.RSA', 'META-INF/com/android/otacert',
+                 'dir/'):
+      self.assertNotIn(name, layout)
+      self.assertRaises(KeyError, layout.GetEntryOffset, name)
+
+  def test_zip64(self):
+    layout = ota_utils.SignedZipLayout([
+        ('a', zipfile.ZIP_STORED, 1 << 32),
+        ('b', zipfile.ZIP_STORED, 1),
+    ])
+    b_offset = (zipfile.sizeFileHeader + 1 + 4 + 6 + 20 + (1 << 32) +
+                zipfile.sizeFileHeader + 1 + 6)
+    self.assertEqual((b_offset, 1), layout.GetEntryOffset('b'))
@@ -25,22 +25,38 @@ class RangeSetTest(ReleaseToolsTestCase):
                      RangeSet("10-34"))
     self.assertEqual(RangeSet("10-19 30-34").union(RangeSet("22 32")),
                      RangeSet("10-19 22 30-34"))
+    self.assertEqual(RangeSet("0-49").union(RangeSet("10-19 30-39 60")),
+                     RangeSet("0-49 60"))
+    self.assertEqual(RangeSet("10-19").union(RangeSet("0-9 20-29")),
+                     RangeSet("0-29"))
+    self.assertEqual(RangeSet("").union(RangeSet("3")), RangeSet("3"))
 
   def test_intersect(self):
     self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("18-32")),
                      RangeSet("18-19 30-32"))
     self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("22-28")),
                      RangeSet(""))
+    self.assertEqual(
+        RangeSet("0-99").intersect(RangeSet("1 3 5-9 200-300")),
+        RangeSet("1 3 5-9"))
 
   def test_subtract(self):
     self.assertEqual(RangeSet("10-19 30-34").subtract(RangeSet("18-32")),
                      RangeSet("10-17 33-34"))
     self.assertEqual(RangeSet("10-19 30-34").subtract(RangeSet("22-28")),
                      RangeSet("10-19 30-34"))
+    self.assertEqual(RangeSet("0-9 20-29").subtract(RangeSet("5-25")),
+                     RangeSet("0-4 26-29"))
+    self.assertEqual(RangeSet("0-9 20-29 40-49").subtract(RangeSet("15")),
+                     RangeSet("0-9 20-29 40-49"))
+    self.assertEqual(RangeSet("").subtract(RangeSet("3")), RangeSet(""))
 
   def test_overlaps(self):
     self.assertTrue(RangeSet("10-19 30-34").overlaps(RangeSet("18-32")))
     self.assertFalse(RangeSet("10-19 30-34").overlaps(RangeSet("22-28")))
+    self.assertFalse(RangeSet("10-19").overlaps(RangeSet("20-29")))
+    self.assertFalse(RangeSet("").overlaps(RangeSet("0-9")))
+    self.assertTrue(RangeSet("0 2 4 6 8").overlaps(RangeSet("7-9")))
 
   def test_size(self):
     self.assertEqual(RangeSet("10-19 30-34").size(), 15)
@@ -125,6 +141,12 @@ class RangeSetTest(ReleaseToolsTestCase):
     self.assertTrue(RangeSet(data=[0, 5, 5, 10]).monotonic)
     self.assertFalse(RangeSet(data=[5, 10, 0, 5]).monotonic)
 
+    # Results of the set operations are always sorted.
+    self.assertTrue(
+        RangeSet("5-9 0-3").union(RangeSet("20 12")).monotonic)
+    self.assertTrue(
+        RangeSet("5-9 0-3").subtract(RangeSet("2")).monotonic)
+
   def test_parse_raw(self):
     self.assertEqual(
         RangeSet.parse_raw(RangeSet("0-9").to_string_raw()),
@@ -17,12 +17,17 @@
 import base64
 import io
 import os.path
+import threading
+import time
 import zipfile
 
+import apex_utils
 import common
+import sign_target_files_apks
 import test_utils
 from sign_target_files_apks import (
-    CheckApkAndApexKeysAvailable, EditTags, GetApkFileInfo, ReadApexKeysInfo,
+    CheckApkAndApexKeysAvailable, CopyUnchangedImages, EditTags,
+    GetApkFileInfo, GetChangedPartitions, OrderedSigningPool, ReadApexKeysInfo,
     ReplaceCerts, ReplaceGkiSigningKey, ReplaceVerityKeyId, RewriteAvbProps,
     RewriteProps, WriteOtacerts)
 
@@ -643,3 +648,288 @@ name="apex.apexd_test_different_app.apex" public_key="system/apex/apexd/apexd_te
     }
     ReplaceGkiSigningKey(misc_info)
     self.assertDictEqual(expected_dict, misc_info)
+
+  @staticmethod
+  def _GetSigningTasks(count, running, lock, max_running):
+    def Sign(index, data):
+      with lock:
+        running[0] += 1
+        max_running[0] = max(max_running[0], running[0])
+      # Finish the earlier entries last, to shuffle the completion order.
+      time.sleep(0.01 * (count - index))
+      with lock:
+        running[0] -= 1
+      return b'signed-' + data
+
+    return [('apk{}.apk'.format(i), lambda data, i=i: Sign(i, data))
+            for i in range(count)]
+
+  def test_OrderedSigningPool(self):
+    running, max_running = [0], [0]
+    tasks = self._GetSigningTasks(8, running, threading.Lock(), max_running)
+    read_func = lambda filename: filename.encode()
+    with OrderedSigningPool(tasks, read_func, jobs=4) as pool:
+      results = [pool.Get(filename, None) for filename, _ in tasks]
+
+    self.assertEqual(
+        ['signed-apk{}.apk'.format(i).encode() for i in range(8)],
+        results)
+    self.assertLessEqual(max_running[0], 4)
+    self.assertGreater(max_running[0], 1)
+
+  def test_OrderedSigningPool_ReadsAhead(self):
+    tasks = [('a.apk', lambda data: data), ('c.apk', lambda data: data)]
+    reads = []
+
+    def ReadFunc(filename):
+      reads.append(filename)
+      return filename.encode()
+
+    with OrderedSigningPool(tasks, ReadFunc, jobs=2) as pool:
+      self.assertTrue(pool.ReadsAhead('a.apk'))
+      self.assertFalse(pool.ReadsAhead('b.apk'))
+      self.assertEqual(b'a.apk', pool.Get('a.apk', None))
+      self.assertEqual(b'c.apk', pool.Get('c.apk', None))
+      self.assertFalse(pool.ReadsAhead('c.apk'))
+    # Each entry is read only once.
+    self.assertEqual(['a.apk', 'c.apk'], sorted(reads))
+
+    with OrderedSigningPool(tasks, ReadFunc, jobs=1) as pool:
+      self.assertFalse(pool.ReadsAhead('a.apk'))
+
+  def test_OrderedSigningPool_sequential(self):
+    running, max_running = [0], [0]
+    tasks = self._GetSigningTasks(3, running, threading.Lock(), max_running)
+
+    def ReadFunc(_):
+      raise AssertionError('Should use the given data when jobs == 1')
+
+    with OrderedSigningPool(tasks, ReadFunc, jobs=1) as pool:
+      results = [pool.Get(filename, b'data') for filename, _ in tasks]
+
+    self.assertEqual([b'signed-data'] * 3, results)
+    self.assertEqual(1, max_running[0])
+
+  def test_OrderedSigningPool_outOfOrder(self):
+    tasks = [('a.apk', lambda data: data), ('b.apk', lambda data: data)]
+    with OrderedSigningPool(tasks, lambda f: b'', jobs=2) as pool:
+      self.assertRaises(AssertionError, pool.Get, 'b.apk', None)
+
+  def test_OrderedSigningPool_failure(self):
+    def Fail(_):
+      raise common.ExternalError('Failed to sign')
+
+    tasks = [('a.apk', lambda data: data), ('b.apk', Fail)]
+    with OrderedSigningPool(tasks, lambda f: b'', jobs=2) as pool:
+      self.assertEqual(b'', pool.Get('a.apk', None))
+      self.assertRaises(common.ExternalError, pool.Get, 'b.apk', None)
+
+  def test_GetApexApkSigningJobs(self):
+    saved = (common.OPTIONS.signing_jobs, common.OPTIONS.apex_apk_signing_jobs)
+    try:
+      cpu_count = os.cpu_count() or 1
+      common.OPTIONS.signing_jobs = 1
+      common.OPTIONS.apex_apk_signing_jobs = None
+      self.assertEqual(
+          cpu_count, sign_target_files_apks.GetApexApkSigningJobs())
+
+      # The CPUs are shared among the APEXes being signed concurrently.
+      common.OPTIONS.signing_jobs = cpu_count * 2
+      self.assertEqual(1, sign_target_files_apks.GetApexApkSigningJobs())
+
+      common.OPTIONS.apex_apk_signing_jobs = 3
+      self.assertEqual(3, sign_target_files_apks.GetApexApkSigningJobs())
+    finally:
+      (common.OPTIONS.signing_jobs,
+       common.OPTIONS.apex_apk_signing_jobs) = saved
+
+  def _MakeTargetFiles(self, entries):
+    target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(target_files, 'w') as target_files_zip:
+      for name, data in sorted(entries.items()):
+        target_files_zip.writestr(name, data)
+    return target_files
+
+  def test_GetChangedPartitions(self):
+    input_entries = {
+        'SYSTEM/app/Foo.apk': 'unsigned',
+        'SYSTEM/build.prop': 'ro.build.tags=release-keys',
+        'VENDOR/build.prop': 'ro.vendor.build.tags=release-keys',
+        'PRODUCT/etc/foo': 'foo',
+        'ODM/etc/bar': 'bar',
+    }
+    output_entries = dict(input_entries)
+    output_entries['SYSTEM/app/Foo.apk'] = 'signed'
+    del output_entries['ODM/etc/bar']
+    misc_info = {
+        'avb_product_key_path': 'testkey',
+        'avb_system_other_key_path': 'testkey',
+        'recovery_api_version': 3,
+    }
+    signed_misc_info = dict(misc_info)
+    signed_misc_info['avb_system_other_key_path'] = 'releasekey'
+
+    with zipfile.ZipFile(self._MakeTargetFiles(input_entries)) as input_zip, \
+        zipfile.ZipFile(self._MakeTargetFiles(output_entries)) as output_zip:
+      self.assertEqual(
+          set(['system', 'odm', 'system_other']),
+          GetChangedPartitions(
+              input_zip, output_zip, misc_info, signed_misc_info))
+
+      # Changing any non-partition specific value rebuilds everything.
+      signed_misc_info['verity_key'] = 'releasekey'
+      changed_partitions = GetChangedPartitions(
+          input_zip, output_zip, misc_info, signed_misc_info)
+      self.assertIn('vendor', changed_partitions)
+      self.assertIn('product', changed_partitions)
+
+  def test_CopyUnchangedImages(self):
+    input_entries = {
+        'IMAGES/system.img': 'system',
+        'IMAGES/system.map': 'system map',
+        'IMAGES/vendor.img': 'vendor',
+        'IMAGES/vendor.map': 'vendor map',
+        'IMAGES/boot.img': 'boot',
+        'IMAGES/vbmeta.img': 'vbmeta',
+    }
+    input_file = self._MakeTargetFiles(input_entries)
+    output_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(input_file) as input_zip, \
+        zipfile.ZipFile(output_file, 'w') as output_zip:
+      output_zip.writestr('SYSTEM/build.prop', 'foo')
+      self.assertEqual(
+          set(['vendor', 'boot']),
+          CopyUnchangedImages(input_zip, output_zip, set(['system']), {}))
+
+    with zipfile.ZipFile(output_file) as output_zip:
+      self.assertIsNone(output_zip.testzip())
+      self.assertEqual(
+          ['SYSTEM/build.prop', 'IMAGES/boot.img', 'IMAGES/vendor.img',
+           'IMAGES/vendor.map'],
+          output_zip.namelist())
+      self.assertEqual(b'vendor map', output_zip.read('IMAGES/vendor.map'))
+
+
+class SignedArtifactCacheTest(test_utils.ReleaseToolsTestCase):
+
+  def setUp(self):
+    self.tools_dir = common.MakeTempDir()
+    self.key = os.path.join(self.tools_dir, 'testkey')
+    self._WriteFile(self.key + '.x509.pem', b'cert')
+    self._WriteFile(os.path.join(self.tools_dir, 'signapk.jar'), b'jar')
+
+    self.saved = (common.OPTIONS.search_path, common.OPTIONS.signapk_path,
+                  common.OPTIONS.signed_artifact_cache_dir,
+                  sign_target_files_apks._SignApk)
+    common.OPTIONS.search_path = self.tools_dir
+    common.OPTIONS.signapk_path = 'signapk.jar'
+    common.OPTIONS.signed_artifact_cache_dir = common.MakeTempDir()
+
+    self.sign_calls = []
+
+    def FakeSignApk(data, keyname, *_):
+      self.sign_calls.append(data)
+      return data + b'-signed-by-' + keyname.encode()
+
+    sign_target_files_apks._SignApk = FakeSignApk
+
+  def tearDown(self):
+    (common.OPTIONS.search_path, common.OPTIONS.signapk_path,
+     common.OPTIONS.signed_artifact_cache_dir,
+     sign_target_files_apks._SignApk) = self.saved
+    sign_target_files_apks._signed_artifact_cache = None
+    super(SignedArtifactCacheTest, self).tearDown()
+
+  @staticmethod
+  def _WriteFile(path, data):
+    with open(path, 'wb') as f:
+      f.write(data)
+
+  def _SignApk(self, data, platform_api_level=30):
+    return sign_target_files_apks.SignApk(
+        data, self.key, None, platform_api_level, {}, False, 'Test.apk')
+
+  def test_SignApk(self):
+    signed = self._SignApk(b'apk1')
+    self.assertEqual(signed, self._SignApk(b'apk1'))
+    self.assertEqual([b'apk1'], self.sign_calls)
+
+    # A different input or signing parameter misses the cache.
+    self._SignApk(b'apk2')
+    self._SignApk(b'apk1', platform_api_level=23)
+    self.assertEqual([b'apk1', b'apk2', b'apk1'], self.sign_calls)
+
+    cache = sign_target_files_apks.GetSignedArtifactCache()
+    self.assertEqual((1, 3), (cache.hits, cache.misses))
+
+  def test_SignApk_rotatedKey(self):
+    self._SignApk(b'apk1')
+    self._WriteFile(self.key + '.x509.pem', b'new cert')
+
+    # The next run picks up the new certificate.
+    sign_target_files_apks._signed_artifact_cache = None
+    self._SignApk(b'apk1')
+    self.assertEqual([b'apk1', b'apk1'], self.sign_calls)
+
+  def test_SignApk_uncacheable(self):
+    os.remove(self.key + '.x509.pem')
+    self._SignApk(b'apk1')
+    self._SignApk(b'apk1')
+    self.assertEqual([b'apk1', b'apk1'], self.sign_calls)
+
+  def test_SignApk_cacheDisabled(self):
+    common.OPTIONS.signed_artifact_cache_dir = None
+    self._SignApk(b'apk1')
+    self._SignApk(b'apk1')
+    self.assertEqual([b'apk1', b'apk1'], self.sign_calls)
+
+  def _SignApexData(self, data):
+    return sign_target_files_apks.SignApexData(
+        data, 'avbtool', self.key + '.pem', self.key, {}, {}, {}, None)
+
+  def _SetUpApexTools(self):
+    host_tools = {}
+    for tool in ('avbtool',) + sign_target_files_apks.APEX_TOOLS:
+      host_tools[tool] = os.path.join(self.tools_dir, tool)
+      self._WriteFile(host_tools[tool], tool.encode())
+      os.chmod(host_tools[tool], 0o755)
+    os.mkdir(os.path.join(self.tools_dir, 'bin'))
+    self._WriteFile(
+        os.path.join(self.tools_dir, 'bin', 'debugfs_static'), b'debugfs')
+    self._WriteFile(self.key + '.pem', b'payload key')
+
+    saved = (common.OPTIONS.host_tools, apex_utils.SignApex)
+    common.OPTIONS.host_tools = host_tools
+
+    def FakeSignApex(_avbtool, data, *_args, **_kwargs):
+      self.sign_calls.append(data)
+      signed_apex = common.MakeTempFile(suffix='.apex')
+      self._WriteFile(signed_apex, data + b'-signed')
+      return signed_apex
+
+    apex_utils.SignApex = FakeSignApex
+
+    def Restore():
+      common.OPTIONS.host_tools, apex_utils.SignApex = saved
+    self.addCleanup(Restore)
+    return host_tools
+
+  def test_SignApexData(self):
+    host_tools = self._SetUpApexTools()
+    self._SignApexData(b'apex1')
+    with open(self._SignApexData(b'apex1'), 'rb') as f:
+      self.assertEqual(b'apex1-signed', f.read())
+    self.assertEqual([b'apex1'], self.sign_calls)
+
+    # An updated apexer invalidates the signed APEXes.
+    self._WriteFile(host_tools['apexer'], b'new apexer')
+    sign_target_files_apks._signed_artifact_cache = None
+    self._SignApexData(b'apex1')
+    self.assertEqual([b'apex1', b'apex1'], self.sign_calls)
+
+  def test_SignApexData_missingTool(self):
+    host_tools = self._SetUpApexTools()
+    os.remove(host_tools['deapexer'])
+    self._SignApexData(b'apex1')
+    self._SignApexData(b'apex1')
+    self.assertEqual([b'apex1', b'apex1'], self.sign_calls)
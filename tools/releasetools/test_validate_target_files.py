@@ -22,6 +22,7 @@ import shutil
 import zipfile
 
 import common
+import sparse_img
 import test_utils
 from rangelib import RangeSet
 from validate_target_files import (ValidateVerifiedBootImages,
@@ -329,6 +330,69 @@ class ValidateTargetFilesTest(test_utils.ReleaseToolsTestCase):
       info_dict = {'extfs_sparse_flag': '-s'}
       ValidateFileConsistency(input_zip, input_tmp, info_dict)
 
+  def _make_target_files_with_images(self):
+    """Makes a target-files with sparse system and vendor images.
+
+    Returns:
+      A tuple of (input_file, input_tmp).
+    """
+    input_tmp = common.MakeTempDir()
+    os.mkdir(os.path.join(input_tmp, 'IMAGES'))
+    all_entries = ['IMAGES/']
+    file_maps = {
+        'system': {'/system/a': '1-2', '/system/b': '3'},
+        'vendor': {'/vendor/c': '4-6'},
+    }
+    for partition, file_map in file_maps.items():
+      image_file = test_utils.construct_sparse_image([(0xCAC1, 8)])
+      image_name = 'IMAGES/{}.img'.format(partition)
+      shutil.copy(image_file, os.path.join(input_tmp, image_name))
+      map_name = 'IMAGES/{}.map'.format(partition)
+      with open(os.path.join(input_tmp, map_name), 'w') as f:
+        for entry, ranges in sorted(file_map.items()):
+          f.write('{} {}\n'.format(entry, ranges))
+      all_entries.extend([image_name, map_name])
+
+      # Unpack the files from the image.
+      image = sparse_img.SparseImage(image_file)
+      unpacked_dir = partition.upper()
+      os.mkdir(os.path.join(input_tmp, unpacked_dir))
+      all_entries.append(unpacked_dir + '/')
+      for entry, ranges in file_map.items():
+        unpacked_name = unpacked_dir + entry[len(partition) + 1:]
+        with open(os.path.join(input_tmp, unpacked_name), 'wb') as f:
+          f.write(b''.join(image.ReadRangeSet(RangeSet(ranges))))
+        all_entries.append(unpacked_name)
+
+    input_file = common.MakeTempFile()
+    with zipfile.ZipFile(input_file, 'w', allowZip64=True) as input_zip:
+      for name in all_entries:
+        input_zip.write(os.path.join(input_tmp, name), arcname=name)
+    return input_file, input_tmp
+
+  def test_ValidateFileConsistency(self):
+    input_file, input_tmp = self._make_target_files_with_images()
+    info_dict = {'extfs_sparse_flag': '-s'}
+    with zipfile.ZipFile(input_file) as input_zip:
+      ValidateFileConsistency(input_zip, input_tmp, info_dict, 2)
+
+  def test_ValidateFileConsistency_mismatches(self):
+    input_file, input_tmp = self._make_target_files_with_images()
+    for name in ('SYSTEM/b', 'VENDOR/c'):
+      with open(os.path.join(input_tmp, name), 'r+b') as f:
+        f.write(b'x')
+
+    # All the mismatching files, across the partitions, should be reported.
+    info_dict = {'extfs_sparse_flag': '-s'}
+    with zipfile.ZipFile(input_file) as input_zip:
+      with self.assertRaises(AssertionError) as context:
+        ValidateFileConsistency(input_zip, input_tmp, info_dict, 2)
+    message = str(context.exception)
+    self.assertIn('2 mismatching file(s)', message)
+    self.assertIn('file: /system/b, range: 3', message)
+    self.assertIn('file: /vendor/c, range: 4-6', message)
+    self.assertNotIn('/system/a', message)
+
   @staticmethod
   def make_build_prop(build_prop):
     input_tmp = common.MakeTempDir()
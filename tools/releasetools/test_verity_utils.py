@@ -17,9 +17,13 @@
 """Unittests for verity_utils.py."""
 
 import copy
+import hashlib
 import math
 import os.path
 import random
+import stat
+import struct
+import sys
 
 import common
 import sparse_img
@@ -27,8 +31,9 @@ from rangelib import RangeSet
 from test_utils import (
     get_testdata_dir, ReleaseToolsTestCase, SkipIfExternalToolsUnavailable)
 from verity_utils import (
-    CalculateVbmetaDigest, CreateHashtreeInfoGenerator,
-    CreateVerityImageBuilder, HashtreeInfo,
+    BuildVerityImageError, BuildVerityTree, CalculateVbmetaDigest,
+    ComputeVerityTree, CreateHashtreeInfoGenerator, CreateVerityImageBuilder,
+    FIXED_SALT, GetAvbFecSize, GetAvbHashtreeSize, HashtreeInfo,
     VerifiedBootVersion1HashtreeInfoGenerator)
 
 BLOCK_SIZE = common.BLOCK_SIZE
@@ -171,6 +176,133 @@ class VerifiedBootVersion1HashtreeInfoGeneratorTest(ReleaseToolsTestCase):
     self.assertEqual(self.expected_root_hash, info.root_hash)
 
 
+class ComputeVerityTreeTest(ReleaseToolsTestCase):
+
+  @staticmethod
+  def _MakeSimg(chunks):
+    """Writes a sparse image of the given chunks.
+
+    Args:
+      chunks: A list of (chunk_type, blocks, data) tuples, where data is the
+          raw data, the 4-byte fill pattern, or None for don't care chunks.
+
+    Returns:
+      A tuple of the path to the sparse image and its unsparse data.
+    """
+    sparse_image = common.MakeTempFile(suffix='.img')
+    raw = b''
+    with open(sparse_image, 'wb') as f:
+      f.write(struct.pack(
+          '<I4H4I', 0xED26FF3A, 1, 0, 28, 12, BLOCK_SIZE,
+          sum(blocks for _, blocks, _ in chunks), len(chunks), 0))
+      for chunk_type, blocks, data in chunks:
+        data = data or b''
+        f.write(struct.pack('<2H2I', chunk_type, 0, blocks, 12 + len(data)))
+        f.write(data)
+        if chunk_type == 0xCAC1:
+          raw += data
+        elif chunk_type == 0xCAC2:
+          raw += data * (blocks * BLOCK_SIZE // 4)
+        else:
+          raw += b'\0' * (blocks * BLOCK_SIZE)
+    return sparse_image, raw
+
+  @staticmethod
+  def _ComputeVerityTree(raw, salt=FIXED_SALT):
+    """Computes the verity tree of the raw data block by block."""
+    salt = bytes.fromhex(salt)
+    levels = []
+    level = raw
+    while not levels or len(levels[-1]) > BLOCK_SIZE:
+      level = b''.join(
+          hashlib.sha256(salt + level[i:i + BLOCK_SIZE]).digest()
+          for i in range(0, len(level), BLOCK_SIZE))
+      level += b'\0' * (-len(level) % BLOCK_SIZE)
+      levels.append(level)
+    root_hash = hashlib.sha256(salt + levels[-1]).hexdigest()
+    return root_hash, b''.join(reversed(levels))
+
+  def test_ComputeVerityTree(self):
+    raw = bytes(ord('0') + i % 10 for i in range(991232))
+    sparse_image, _ = self._MakeSimg([(0xCAC1, 242, raw)])
+
+    root_hash, salt, tree = ComputeVerityTree(
+        sparse_img.SparseImage(sparse_image))
+    self.assertEqual(
+        '0b7c4565e87b1026e11fbab91c0bc29e185c847a5b44d40e6e86e461e8adf80d',
+        root_hash)
+    self.assertEqual(FIXED_SALT, salt)
+    self.assertEqual(12288, len(tree))
+
+  def test_ComputeVerityTree_sparseChunks(self):
+    sparse_image, raw = self._MakeSimg([
+        (0xCAC1, 3000, os.urandom(3000 * BLOCK_SIZE)),
+        (0xCAC2, 20000, b'\x01\x02\x03\x04'),
+        (0xCAC3, 10000, None),
+        (0xCAC2, 100, b'\0' * 4),
+        (0xCAC1, 1, os.urandom(BLOCK_SIZE)),
+        (0xCAC3, 5, None),
+    ])
+    image = sparse_img.SparseImage(sparse_image)
+    # Three levels of 259, 3 and 1 blocks.
+    expected = self._ComputeVerityTree(raw)
+    self.assertEqual(263 * BLOCK_SIZE, len(expected[1]))
+
+    for threads in (1, 4):
+      root_hash, _, tree = ComputeVerityTree(image, threads=threads)
+      self.assertEqual(expected, (root_hash, tree))
+
+    # A range that starts and ends in the middle of chunks.
+    ranges = RangeSet(data=(1000, 33050))
+    root_hash, _, tree = ComputeVerityTree(image, ranges)
+    self.assertEqual(
+        self._ComputeVerityTree(raw[1000 * BLOCK_SIZE:33050 * BLOCK_SIZE]),
+        (root_hash, tree))
+
+  def test_ComputeVerityTree_singleBlock(self):
+    salt = 'aa' * 16
+    sparse_image, raw = self._MakeSimg([
+        (0xCAC1, 1, os.urandom(BLOCK_SIZE))])
+    root_hash, _, tree = ComputeVerityTree(
+        sparse_img.SparseImage(sparse_image), salt=salt)
+    self.assertEqual(self._ComputeVerityTree(raw, salt), (root_hash, tree))
+    self.assertEqual(BLOCK_SIZE, len(tree))
+
+  def test_BuildVerityTree(self):
+    sparse_image, raw = self._MakeSimg([
+        (0xCAC1, 200, os.urandom(200 * BLOCK_SIZE)),
+        (0xCAC3, 100, None)])
+    verity_image = common.MakeTempFile()
+    root_hash, salt = BuildVerityTree(sparse_image, verity_image)
+
+    expected_root_hash, expected_tree = self._ComputeVerityTree(raw)
+    self.assertEqual(expected_root_hash, root_hash)
+    self.assertEqual(FIXED_SALT, salt)
+    with open(verity_image, 'rb') as f:
+      self.assertEqual(expected_tree, f.read())
+
+  def test_ValidateHashtree(self):
+    filesystem = os.urandom(300 * BLOCK_SIZE)
+    root_hash, tree = self._ComputeVerityTree(filesystem)
+    sparse_image, _ = self._MakeSimg([
+        (0xCAC1, 300, filesystem),
+        (0xCAC1, len(tree) // BLOCK_SIZE, tree)])
+
+    generator = VerifiedBootVersion1HashtreeInfoGenerator(
+        (300 * BLOCK_SIZE) + len(tree), BLOCK_SIZE, False)
+    generator.image = sparse_img.SparseImage(sparse_image)
+    generator.hashtree_info = info = HashtreeInfo()
+    info.filesystem_range = RangeSet(data=[0, 300])
+    info.hashtree_range = RangeSet(data=[300, 300 + len(tree) // BLOCK_SIZE])
+    info.hash_algorithm = 'sha256'
+    info.salt = FIXED_SALT
+    info.root_hash = root_hash
+    self.assertTrue(generator.ValidateHashtree())
+
+    info.root_hash = 'a' + root_hash[1:]
+    self.assertFalse(generator.ValidateHashtree())
+
+
 class VerifiedBootVersion1VerityImageBuilderTest(ReleaseToolsTestCase):
 
   DEFAULT_PARTITION_SIZE = 4096 * 1024
@@ -368,6 +500,134 @@ class VerifiedBootVersion2VerityImageBuilderTest(ReleaseToolsTestCase):
           _SizeCalculator(min_partition_size - BLOCK_SIZE),
           image_size)
 
+  @staticmethod
+  def _MakeFakeAvbtool(generate_fec=True):
+    """Returns a fake avbtool that only calculates max image sizes.
+
+    It follows avbtool for `add_hashtree_footer --calc_max_image_size`, with
+    the default SHA-1 hash tree and, if generate_fec, FEC data with 2 roots.
+    Each call is logged to the returned log file.
+    """
+    avbtool = common.MakeTempFile(suffix='.py')
+    log = common.MakeTempFile()
+    with open(avbtool, 'w') as f:
+      f.write('\n'.join([
+          '#!' + sys.executable,
+          'import sys',
+          'size = partition_size = int(sys.argv[3])',
+          'tree_size = 0',
+          'while size > 4096:',
+          '  size = -(-(-(-size // 4096) * 32) // 4096) * 4096',
+          '  tree_size += size',
+          'fec_size = (-(-partition_size // 4096 // 253) * 2 + 1) * 4096',
+          'if not {}:'.format(generate_fec),
+          '  fec_size = 0',
+          'with open({!r}, "a") as log:'.format(log),
+          '  log.write(" ".join(sys.argv[1:]) + "\\n")',
+          'print(partition_size - tree_size - fec_size - 69632)',
+          '']))
+    os.chmod(avbtool, stat.S_IRWXU)
+    return avbtool, log
+
+  def test_GetAvbHashtreeSize(self):
+    # 1024 digests of 32 bytes take 8 blocks, whose digests take one block.
+    self.assertEqual(9 * 4096, GetAvbHashtreeSize(4096 * 1024, 4096, 32))
+    self.assertEqual(0, GetAvbHashtreeSize(4096, 4096, 32))
+    self.assertEqual(4096, GetAvbHashtreeSize(4097, 4096, 32))
+
+  def test_GetAvbFecSize(self):
+    # 1024 blocks take 5 rounds of 253 blocks, plus a header block.
+    self.assertEqual(11 * 4096, GetAvbFecSize(4096 * 1024, 2))
+    self.assertEqual(3 * 4096, GetAvbFecSize(4096 * 253, 2))
+    self.assertEqual(5 * 4096, GetAvbFecSize(4096 * 253 + 1, 2))
+
+  def test_EstimateMaxImageSize(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertEqual(4096 * 1024 - 9 * 4096 - 11 * 4096 - 69632,
+                     builder.EstimateMaxImageSize(4096 * 1024))
+
+    prop_dict['avb_add_hashtree_footer_args'] = (
+        '--hash_algorithm sha512 --do_not_generate_fec --prop foo:bar')
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertEqual(4096 * 1024 - 17 * 4096 - 69632,
+                     builder.EstimateMaxImageSize(4096 * 1024))
+
+    prop_dict['avb_add_hashtree_footer_args'] = '--no_hashtree'
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertEqual(4096 * 1024 - 69632,
+                     builder.EstimateMaxImageSize(4096 * 1024))
+
+    prop_dict['avb_add_hashtree_footer_args'] = '--hash_algorithm=foo'
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertIsNone(builder.EstimateMaxImageSize(4096 * 1024))
+
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    del prop_dict['avb_hashtree_enable']
+    prop_dict['avb_hash_enable'] = 'true'
+    prop_dict['avb_add_hash_footer_args'] = '--hash_algorithm sha256'
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertEqual(4096 * 1024 - 69632,
+                     builder.EstimateMaxImageSize(4096 * 1024))
+    self.assertRaises(
+        BuildVerityImageError, builder.EstimateMaxImageSize, 65536)
+
+  def test_CalculateMinPartitionSize_estimated(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    prop_dict['avb_avbtool'], log = self._MakeFakeAvbtool()
+    builder = CreateVerityImageBuilder(prop_dict)
+
+    image_size = 200 * 1024 * 1024 + 1
+    partition_size = builder.CalculateMinPartitionSize(image_size)
+    self.assertGreaterEqual(
+        builder.EstimateMaxImageSize(partition_size), image_size)
+    self.assertLess(
+        builder.EstimateMaxImageSize(partition_size - BLOCK_SIZE), image_size)
+
+    # avbtool only checks the final partition size, whose max image size is
+    # cached for CalculateMaxImageSize().
+    builder.partition_size = partition_size
+    self.assertEqual(builder.image_size, builder.CalculateMaxImageSize())
+    with open(log) as f:
+      self.assertEqual(
+          ['add_hashtree_footer --partition_size {} --calc_max_image_size'
+           .format(partition_size)],
+          f.read().splitlines())
+
+  def test_CalculateMinPartitionSize_estimateMismatch(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    prop_dict['avb_avbtool'], log = self._MakeFakeAvbtool(generate_fec=False)
+    builder = CreateVerityImageBuilder(prop_dict)
+
+    # The FEC data that the estimates count for is missing with this avbtool,
+    # so the search falls back to avbtool.
+    image_size = 200 * 1024 * 1024 + 1
+    partition_size = builder.CalculateMinPartitionSize(image_size)
+    self.assertIsNone(builder.size_params)
+    self.assertGreaterEqual(
+        builder.CalculateMaxImageSize(partition_size), image_size)
+    self.assertLess(
+        builder.CalculateMaxImageSize(partition_size - BLOCK_SIZE), image_size)
+    with open(log) as f:
+      self.assertLess(1, len(f.read().splitlines()))
+
+  def test_CalculateMaxImageSize_noEstimate(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    del prop_dict['avb_hashtree_enable']
+    prop_dict['avb_hash_enable'] = 'true'
+    prop_dict['avb_add_hash_footer_args'] = '--hash_algorithm sha256'
+    # The footer alone is bigger than the partition, so there's no estimate.
+    prop_dict['avb_avbtool'] = common.MakeTempFile(suffix='.py')
+    with open(prop_dict['avb_avbtool'], 'w') as f:
+      f.write('#!{}\nprint(4096)\n'.format(sys.executable))
+    os.chmod(prop_dict['avb_avbtool'], stat.S_IRWXU)
+    builder = CreateVerityImageBuilder(prop_dict)
+
+    with self.assertLogs(level='WARNING') as logs:
+      self.assertEqual(4096, builder.CalculateMaxImageSize(65536))
+    self.assertIn('Estimated max image size None', logs.records[0].getMessage())
+    self.assertIsNone(builder.size_params)
+
   def test_CalculateMinPartitionSize_FasterGrowthFooterSize(self):
     """Tests with footer size which grows faster than partition size."""
 
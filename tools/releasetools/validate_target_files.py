@@ -37,6 +37,7 @@ import os.path
 import re
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hashlib import sha1
 from common import IsSparseImage
 
@@ -68,21 +69,68 @@ def ValidateFileAgainstSha1(input_tmp, file_name, file_path, expected_sha1):
           file_name, actual_sha1, expected_sha1)
 
 
-def ValidateFileConsistency(input_zip, input_tmp, info_dict):
-  """Compare the files from image files and unpacked folders."""
+def _FileSha1(unpacked_name):
+  """Returns the SHA-1 of the file, with its size rounded up to 4K."""
+  assert os.path.exists(unpacked_name)
+  h = sha1()
+  file_size = 0
+  with open(unpacked_name, 'rb') as f:
+    while True:
+      data = f.read(1024 * 1024)
+      if not data:
+        break
+      h.update(data)
+      file_size += len(data)
+  h.update(b'\0' * (common.RoundUpTo4K(file_size) - file_size))
+  return h.hexdigest()
+
+
+def _CheckFileConsistency(image, entry, file_ranges, unpacked_name):
+  """Compares a file in the image against the unpacked one.
+
+  Returns:
+    An error message if they mismatch, or None.
+  """
+  # If the file has non-monotonic ranges, read each range in order.
+  if not file_ranges.monotonic:
+    h = sha1()
+    for file_range in file_ranges.extra['text_str'].split(' '):
+      for data in image.ReadRangeSet(rangelib.RangeSet(file_range)):
+        h.update(data)
+    blocks_sha1 = h.hexdigest()
+  else:
+    blocks_sha1 = image.RangeSha1(file_ranges)
+
+  file_sha1 = _FileSha1(unpacked_name)
+  if blocks_sha1 == file_sha1:
+    return None
+  return 'file: %s, range: %s, blocks_sha1: %s, file_sha1: %s' % (
+      entry, file_ranges, blocks_sha1, file_sha1)
+
 
-  def CheckAllFiles(which):
+def ValidateFileConsistency(input_zip, input_tmp, info_dict, threads=None):
+  """Compare the files from image files and unpacked folders.
+
+  All the partitions that come with a block map are checked at the same time,
+  with the files being hashed by a pool of 'threads' workers (defaulting to
+  the number of CPUs). Mismatches are logged as soon as they are found, and
+  reported all together at the end.
+  """
+
+  def LoadImage(which):
     logging.info('Checking %s image.', which)
     path = os.path.join(input_tmp, "IMAGES", which + ".img")
     if not IsSparseImage(path):
       logging.info("%s is non-sparse image", which)
-      image = common.GetNonSparseImage(which, input_tmp)
-    else:
-      logging.info("%s is sparse image", which)
-      # Allow having shared blocks when loading the sparse image, because allowing
-      # that doesn't affect the checks below (we will have all the blocks on file,
-      # unless it's skipped due to the holes).
-      image = common.GetSparseImage(which, input_tmp, input_zip, True)
+      return common.GetNonSparseImage(which, input_tmp)
+    logging.info("%s is sparse image", which)
+    # Allow having shared blocks when loading the sparse image, because allowing
+    # that doesn't affect the checks below (we will have all the blocks on file,
+    # unless it's skipped due to the holes).
+    return common.GetSparseImage(which, input_tmp, input_zip, True)
+
+  def ListFiles(which, image):
+    """Yields the (entry, file_ranges, unpacked_name) of the files to check."""
     prefix = '/' + which
     for entry in image.file_map:
       # Skip entries like '__NONZERO-0'.
@@ -105,24 +153,10 @@ def ValidateFileConsistency(input_zip, input_tmp, info_dict):
         logging.warning('Skipping %s that has incomplete block list', entry)
         continue
 
-      # If the file has non-monotonic ranges, read each range in order.
-      if not file_ranges.monotonic:
-        h = sha1()
-        for file_range in file_ranges.extra['text_str'].split(' '):
-          for data in image.ReadRangeSet(rangelib.RangeSet(file_range)):
-            h.update(data)
-        blocks_sha1 = h.hexdigest()
-      else:
-        blocks_sha1 = image.RangeSha1(file_ranges)
-
       # The filename under unpacked directory, such as SYSTEM/bin/sh.
       unpacked_name = os.path.join(
           input_tmp, which.upper(), entry[(len(prefix) + 1):])
-      unpacked_file = _ReadFile(entry, unpacked_name, True)
-      file_sha1 = unpacked_file.sha1
-      assert blocks_sha1 == file_sha1, \
-          'file: %s, range: %s, blocks_sha1: %s, file_sha1: %s' % (
-              entry, file_ranges, blocks_sha1, file_sha1)
+      yield entry, file_ranges, unpacked_name
 
   logging.info('Validating file consistency.')
 
@@ -131,16 +165,43 @@ def ValidateFileConsistency(input_zip, input_tmp, info_dict):
     logging.warning('Skipped due to target using non-sparse images')
     return
 
-  # Verify IMAGES/system.img if applicable.
-  # Some targets, e.g., gki_arm64, gki_x86_64, etc., are system.img-less.
-  if 'IMAGES/system.img' in input_zip.namelist():
-    CheckAllFiles('system')
-
-  # Verify IMAGES/vendor.img if applicable.
-  if 'VENDOR/' in input_zip.namelist():
-    CheckAllFiles('vendor')
-
-  # Not checking IMAGES/system_other.img since it doesn't have the map file.
+  # Verify the images that have block maps and unpacked folders, e.g.
+  # IMAGES/system.img and IMAGES/vendor.img. Some targets, e.g., gki_arm64,
+  # gki_x86_64, etc., are system.img-less. Not checking IMAGES/system_other.img
+  # since it doesn't have the map file.
+  namelist = set(input_zip.namelist())
+  partitions = [
+      which for which in common.PARTITIONS_WITH_CARE_MAP
+      if 'IMAGES/{}.img'.format(which) in namelist and
+      'IMAGES/{}.map'.format(which) in namelist and
+      os.path.isdir(os.path.join(input_tmp, which.upper()))]
+
+  mismatches = []
+  checked_files = 0
+  with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+    futures = []
+    try:
+      for which, image in zip(partitions,
+                              executor.map(LoadImage, partitions)):
+        for entry, file_ranges, unpacked_name in ListFiles(which, image):
+          futures.append(executor.submit(
+              _CheckFileConsistency, image, entry, file_ranges,
+              unpacked_name))
+
+      for future in as_completed(futures):
+        error = future.result()
+        checked_files += 1
+        if error:
+          logging.error('Mismatching %s', error)
+          mismatches.append(error)
+    finally:
+      # Don't wait for the pending checks on errors.
+      for future in futures:
+        future.cancel()
+
+  logging.info('Checked %d files in %s', checked_files, ', '.join(partitions))
+  assert not mismatches, '{} mismatching file(s):\n{}'.format(
+      len(mismatches), '\n'.join(sorted(mismatches)))
 
 
 def ValidateInstallRecoveryScript(input_tmp, info_dict):
@@ -530,6 +591,10 @@ def main():
       '--verity_key_mincrypt',
       help='the verity public key in mincrypt format to verify the system '
            'images, if target using Verified Boot 1.0')
+  parser.add_argument(
+      '--worker_threads', type=int,
+      help='the number of threads used to check the file consistency; '
+           'defaults to the number of CPUs')
   args = parser.parse_args()
 
   # Unprovided args will have 'None' as the value.
@@ -545,7 +610,8 @@ def main():
 
   info_dict = common.LoadInfoDict(input_tmp)
   with zipfile.ZipFile(args.target_files, 'r', allowZip64=True) as input_zip:
-    ValidateFileConsistency(input_zip, input_tmp, info_dict)
+    ValidateFileConsistency(input_zip, input_tmp, info_dict,
+                            args.worker_threads)
 
   CheckBuildPropDuplicity(input_tmp)
 
@@ -22,11 +22,14 @@ Usage:  verity_utils properties_file output_image
 
 from __future__ import print_function
 
+import bisect
+import hashlib
 import logging
 import os.path
 import shlex
 import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import common
 import sparse_img
@@ -42,6 +45,14 @@ FIXED_SALT = "aee087a5be3b982978c923f566a94613496b417f2af592639bc80d141e34dfe7"
 MAX_VBMETA_SIZE = 64 * 1024
 MAX_FOOTER_SIZE = 4096
 
+# From system/extras/libfec/fec_private.h
+FEC_BLOCK_SIZE = 4096
+FEC_RSM = 255
+
+# The max image sizes reported by avbtool, keyed by the avbtool, the footer
+# type, the partition size and the footer arguments.
+_avb_max_image_sizes = {}
+
 class BuildVerityImageError(Exception):
   """An Exception raised during verity image building."""
 
@@ -77,6 +88,32 @@ def GetVeritySize(image_size, fec_supported):
   return verity_size
 
 
+def GetAvbHashtreeSize(image_size, block_size, digest_size):
+  """Returns the size of the hash tree that avbtool builds for an image.
+
+  Same as calc_hash_level_offsets() in avbtool, where digest_size includes the
+  padding to the next power of two.
+  """
+  tree_size = 0
+  size = image_size
+  while size > block_size:
+    num_blocks = (size + block_size - 1) // block_size
+    level_blocks = (num_blocks * digest_size + block_size - 1) // block_size
+    size = level_blocks * block_size
+    tree_size += size
+  return tree_size
+
+
+def GetAvbFecSize(image_size, num_roots):
+  """Returns the size of the FEC data that avbtool builds for an image.
+
+  Same as `fec --print-fec-size`, which avbtool runs for it.
+  """
+  blocks = (image_size + FEC_BLOCK_SIZE - 1) // FEC_BLOCK_SIZE
+  rounds = (blocks + FEC_RSM - num_roots - 1) // (FEC_RSM - num_roots)
+  return rounds * num_roots * FEC_BLOCK_SIZE + FEC_BLOCK_SIZE
+
+
 def GetSimgSize(image_file):
   simg = sparse_img.SparseImage(image_file, build_map=False)
   return simg.blocksize * simg.total_blocks
@@ -97,11 +134,137 @@ def BuildVerityFEC(sparse_image_path, verity_path, verity_fec_path,
 
 
 def BuildVerityTree(sparse_image_path, verity_image_path):
-  cmd = ["build_verity_tree", "-A", FIXED_SALT, sparse_image_path,
-         verity_image_path]
-  output = common.RunAndCheckOutput(cmd)
-  root, salt = output.split()
-  return root, salt
+  """Builds the verity tree of a sparse image, like build_verity_tree.
+
+  Returns:
+    A tuple of the root hash and the salt, as hex strings.
+  """
+  image = sparse_img.SparseImage(sparse_image_path)
+  root_hash, salt, tree = ComputeVerityTree(
+      image, threads=OPTIONS.worker_threads)
+  with open(verity_image_path, "wb") as f:
+    f.write(tree)
+  return root_hash, salt
+
+
+def _HashBlocks(salted, data, block_size):
+  """Returns the concatenated digests of the blocks in data.
+
+  Args:
+    salted: A hash object that has been fed the salt, which is copied for each
+        block.
+    data: A bytes-like object of a whole number of blocks.
+    block_size: The block size.
+  """
+  digests = []
+  for offset in range(0, len(data), block_size):
+    h = salted.copy()
+    h.update(data[offset:offset + block_size])
+    digests.append(h.digest())
+  return b"".join(digests)
+
+
+def _GetVerityTreeSegments(image, ranges, max_blocks):
+  """Yields the data of the given ranges in a SparseImage, chunk by chunk.
+
+  Yields:
+    Tuples of (filepos, blocks, fill_data). filepos is the offset of raw data
+    in the sparse file, which spans at most max_blocks blocks; it is None for
+    blocks that all hold the 4-byte pattern fill_data. Don't care blocks read
+    as zeros.
+  """
+  offset_map = image.offset_map
+  for s, e in ranges:
+    assert e <= image.total_blocks, \
+        "Range {}-{} is out of the image of {} blocks".format(
+            s, e, image.total_blocks)
+    while s < e:
+      idx = bisect.bisect_right(image.offset_index, s) - 1
+      if idx >= 0 and s < offset_map[idx][0] + offset_map[idx][1]:
+        chunk_start, chunk_len, filepos, fill_data = offset_map[idx]
+        end = min(chunk_start + chunk_len, e)
+      else:
+        # A don't care chunk, which isn't in the offset map.
+        filepos, fill_data = None, b"\0" * 4
+        end = e
+        if idx + 1 < len(offset_map):
+          end = min(offset_map[idx + 1][0], e)
+      if filepos is None:
+        yield None, end - s, fill_data
+        s = end
+        continue
+      filepos += (s - chunk_start) * image.blocksize
+      while s < end:
+        blocks = min(end - s, max_blocks)
+        yield filepos, blocks, None
+        filepos += blocks * image.blocksize
+        s += blocks
+
+
+def ComputeVerityTree(image, ranges=None, salt=FIXED_SALT,
+                      hash_algorithm="sha256", threads=None):
+  """Computes the dm-verity hash tree of a SparseImage.
+
+  The tree is the same as the one from build_verity_tree. Its bottom level has
+  the salted digest of each data block, and each level above has the digests
+  of the blocks of the level below, until a level fits in one block. Levels are
+  zero-padded to whole blocks, and are laid out from the top level down.
+
+  The bottom level is computed on 'threads' threads straight from the image
+  (hashlib releases the GIL while hashing). Blocks of fill and don't care
+  chunks all have the same digest, which is computed only once per chunk.
+
+  Args:
+    image: A SparseImage.
+    ranges: The RangeSet of the data blocks, which defaults to the whole image.
+    salt: The salt, as a hex string.
+    hash_algorithm: The name of the hash algorithm, e.g. "sha256".
+    threads: The number of threads to compute the bottom level with.
+
+  Returns:
+    A tuple of the root hash and the salt, as hex strings, and the hash tree.
+  """
+  if ranges is None:
+    ranges = RangeSet(data=(0, image.total_blocks))
+  assert ranges.size() > 0, "No data to compute the verity tree of"
+
+  block_size = image.blocksize
+  salted = hashlib.new(hash_algorithm)
+  salted.update(bytes.fromhex(salt))
+
+  fill_digests = {}
+
+  def GetDigests(segment):
+    filepos, blocks, fill_data = segment
+    if filepos is not None:
+      # pylint: disable=protected-access
+      return _HashBlocks(
+          salted, image._data[filepos:filepos + blocks * block_size],
+          block_size)
+    digest = fill_digests.get(fill_data)
+    if digest is None:
+      # Concurrent callers may compute the same digest, which is fine.
+      digest = _HashBlocks(
+          salted, fill_data * (block_size // len(fill_data)), block_size)
+      fill_digests[fill_data] = digest
+    return digest * blocks
+
+  # Each task hashes up to 1024 blocks of raw data.
+  segments = _GetVerityTreeSegments(image, ranges, 1024)
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    level = b"".join(executor.map(GetDigests, segments))
+
+  levels = []
+  while True:
+    level += b"\0" * (-len(level) % block_size)
+    levels.append(level)
+    if len(level) == block_size:
+      break
+    level = _HashBlocks(salted, level, block_size)
+
+  root = salted.copy()
+  root.update(levels[-1])
+  return root.hexdigest(), salt, b"".join(reversed(levels))
 
 
 def BuildVerityMetadata(image_size, verity_metadata_path, root_hash, salt,
@@ -387,6 +550,83 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     self.salt = salt
     self.signing_args = signing_args
     self.image_size = None
+    self.size_params = self._GetSizeParams()
+
+  def _GetSizeParams(self):
+    """Returns the footer arguments that the size of the metadata depends on.
+
+    Returns:
+      An empty tuple for hash footers. For hashtree footers, a tuple of the
+      padded digest size (0 with --no_hashtree), the hash tree block size and
+      the number of FEC roots (0 with --do_not_generate_fec). None if the
+      arguments can't be understood, in which case the sizes always come from
+      avbtool.
+    """
+    if self.footer_type == self.AVB_HASH_FOOTER:
+      return ()
+
+    hash_algorithm = "sha1"
+    block_size = 4096
+    fec_num_roots = 2
+    generate_fec = True
+    no_hashtree = False
+    args = iter(shlex.split(self.signing_args or ""))
+    try:
+      for arg in args:
+        name, sep, value = arg.partition("=")
+        if (name in ("--hash_algorithm", "--block_size", "--fec_num_roots") and
+            not sep):
+          value = next(args)
+        if name == "--hash_algorithm":
+          hash_algorithm = value
+        elif name == "--block_size":
+          block_size = int(value)
+        elif name == "--fec_num_roots":
+          fec_num_roots = int(value)
+        elif name == "--do_not_generate_fec":
+          generate_fec = False
+        elif name == "--generate_fec":
+          generate_fec = True
+        elif name == "--no_hashtree":
+          no_hashtree = True
+      digest_size = hashlib.new(hash_algorithm).digest_size
+    except (StopIteration, ValueError):
+      return None
+    if no_hashtree:
+      return (0, block_size, 0)
+    # avbtool pads each digest to the next power of two.
+    padded_digest_size = 1 << (digest_size - 1).bit_length()
+    return (padded_digest_size, block_size,
+            fec_num_roots if generate_fec else 0)
+
+  def EstimateMaxImageSize(self, partition_size):
+    """Calculates max image size for a given partition size without avbtool.
+
+    This computes the same sizes as `avbtool add_hash_footer` and
+    `add_hashtree_footer` with --calc_max_image_size.
+
+    Returns:
+      The maximum image size, or None if the footer arguments are not
+      understood.
+
+    Raises:
+      BuildVerityImageError: On getting invalid image size.
+    """
+    if self.size_params is None:
+      return None
+    max_metadata_size = MAX_VBMETA_SIZE + MAX_FOOTER_SIZE
+    if self.footer_type == self.AVB_HASHTREE_FOOTER:
+      digest_size, block_size, fec_num_roots = self.size_params
+      if digest_size:
+        max_metadata_size += GetAvbHashtreeSize(
+            partition_size, block_size, digest_size)
+      if fec_num_roots:
+        max_metadata_size += GetAvbFecSize(partition_size, fec_num_roots)
+    image_size = partition_size - max_metadata_size
+    if image_size <= 0:
+      raise BuildVerityImageError(
+          "Invalid max image size: {}".format(image_size))
+    return image_size
 
   def CalculateMinPartitionSize(self, image_size, size_calculator=None):
     """Calculates min partition size for a given image size.
@@ -395,6 +635,10 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     which should be cover the given image size (for filesystem files) as well as
     the verity metadata size.
 
+    By default, the search runs on EstimateMaxImageSize(), and only its result
+    is checked with avbtool. If avbtool disagrees, the search runs again on
+    CalculateMaxImageSize().
+
     Args:
       image_size: The size of the image in question.
       size_calculator: The function to calculate max image size
@@ -404,6 +648,13 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
       The minimum partition size required to accommodate the image size.
     """
     if size_calculator is None:
+      if self.size_params is not None:
+        partition_size = self.CalculateMinPartitionSize(
+            image_size, self.EstimateMaxImageSize)
+        # Also checks the estimate, and disables estimates on a mismatch.
+        self.CalculateMaxImageSize(partition_size)
+        if self.size_params is not None:
+          return partition_size
       size_calculator = self.CalculateMaxImageSize
 
     # Use image size as partition size to approximate final partition size.
@@ -473,21 +724,39 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     assert partition_size > 0, \
         "Invalid partition size: {}".format(partition_size)
 
-    add_footer = ("add_hash_footer" if self.footer_type == self.AVB_HASH_FOOTER
-                  else "add_hashtree_footer")
-    cmd = [self.avbtool, add_footer, "--partition_size",
-           str(partition_size), "--calc_max_image_size"]
-    cmd.extend(shlex.split(self.signing_args))
+    key = (self.avbtool, self.footer_type, partition_size, self.signing_args)
+    image_size = _avb_max_image_sizes.get(key)
+    if image_size is None:
+      add_footer = ("add_hash_footer"
+                    if self.footer_type == self.AVB_HASH_FOOTER
+                    else "add_hashtree_footer")
+      cmd = [self.avbtool, add_footer, "--partition_size",
+             str(partition_size), "--calc_max_image_size"]
+      cmd.extend(shlex.split(self.signing_args))
+
+      proc = common.Run(cmd)
+      output, _ = proc.communicate()
+      if proc.returncode != 0:
+        raise BuildVerityImageError(
+            "Failed to calculate max image size:\n{}".format(output))
+      image_size = int(output)
+      if image_size <= 0:
+        raise BuildVerityImageError(
+            "Invalid max image size: {}".format(output))
+      _avb_max_image_sizes[key] = image_size
+
+    if self.size_params is not None:
+      try:
+        estimate = self.EstimateMaxImageSize(partition_size)
+      except BuildVerityImageError:
+        estimate = None
+      if estimate != image_size:
+        logger.warning(
+            "Estimated max image size %s for partition size %d doesn't match "
+            "%d from avbtool; no longer estimating sizes for %s", estimate,
+            partition_size, image_size, self.partition_name)
+        self.size_params = None
 
-    proc = common.Run(cmd)
-    output, _ = proc.communicate()
-    if proc.returncode != 0:
-      raise BuildVerityImageError(
-          "Failed to calculate max image size:\n{}".format(output))
-    image_size = int(output)
-    if image_size <= 0:
-      raise BuildVerityImageError(
-          "Invalid max image size: {}".format(output))
     self.image_size = image_size
     return image_size
 
@@ -666,14 +935,10 @@ class VerifiedBootVersion1HashtreeInfoGenerator(HashtreeInfoGenerator):
   def ValidateHashtree(self):
     """Checks that we can reconstruct the verity hash tree."""
 
-    # Writes the filesystem section to a temp file; and calls the executable
-    # build_verity_tree to construct the hash tree.
-    adjusted_partition = common.MakeTempFile(prefix="adjusted_partition")
-    with open(adjusted_partition, "wb") as fd:
-      self.image.WriteRangeDataToFd(self.hashtree_info.filesystem_range, fd)
-
-    generated_verity_tree = common.MakeTempFile(prefix="verity")
-    root_hash, salt = BuildVerityTree(adjusted_partition, generated_verity_tree)
+    # Computes the hash tree straight from the filesystem section of the image.
+    root_hash, salt, tree = ComputeVerityTree(
+        self.image, self.hashtree_info.filesystem_range, FIXED_SALT,
+        self.hashtree_info.hash_algorithm, OPTIONS.worker_threads)
 
     # The salt should be always identical, as we use fixed value.
     assert salt == self.hashtree_info.salt, \
@@ -686,11 +951,10 @@ class VerifiedBootVersion1HashtreeInfoGenerator(HashtreeInfoGenerator):
           root_hash, self.hashtree_info.root_hash)
       return False
 
-    # Reads the generated hash tree and checks if it has the exact same bytes
-    # as the one in the sparse image.
-    with open(generated_verity_tree, 'rb') as fd:
-      return fd.read() == b''.join(self.image.ReadRangeSet(
-          self.hashtree_info.hashtree_range))
+    # Checks if the computed hash tree has the exact same bytes as the one in
+    # the sparse image.
+    return tree == b''.join(self.image.ReadRangeSet(
+        self.hashtree_info.hashtree_range))
 
   def Generate(self, image):
     """Parses and validates the hashtree info in a sparse image.
@@ -58,6 +58,7 @@ import java.io.IOException;
 import java.io.InputStream;
 import java.io.InputStreamReader;
 import java.io.OutputStream;
+import java.io.PrintStream;
 import java.io.RandomAccessFile;
 import java.lang.reflect.Constructor;
 import java.nio.ByteBuffer;
@@ -70,6 +71,7 @@ import java.security.KeyFactory;
 import java.security.KeyStore;
 import java.security.KeyStoreException;
 import java.security.KeyStore.PrivateKeyEntry;
+import java.security.MessageDigest;
 import java.security.PrivateKey;
 import java.security.Provider;
 import java.security.Security;
@@ -82,11 +84,14 @@ import java.security.cert.X509Certificate;
 import java.security.spec.InvalidKeySpecException;
 import java.security.spec.PKCS8EncodedKeySpec;
 import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.Collections;
 import java.util.Enumeration;
+import java.util.HashMap;
 import java.util.HashSet;
 import java.util.List;
 import java.util.Locale;
+import java.util.Map;
 import java.util.TimeZone;
 import java.util.jar.JarEntry;
 import java.util.jar.JarFile;
@@ -132,6 +137,33 @@ class SignApk {
      */
     private static final short ALIGNMENT_ZIP_EXTRA_DATA_FIELD_HEADER_ID = (short) 0xd935;
 
+    /**
+     * Set when running as a signing server (see {@link #runServer()}). The server keeps the parsed
+     * keys across requests, and takes the key password from the request instead of stdin, which
+     * carries the requests.
+     */
+    private static boolean sServerMode = false;
+    private static String sServerPassword = null;
+    private static final Map<String, X509Certificate> sPublicKeyCache = new HashMap<>();
+    private static final Map<String, PrivateKey> sPrivateKeyCache = new HashMap<>();
+
+    /**
+     * Thrown instead of calling System.exit(), so that the signing server can report the status of
+     * a failed request and keep serving.
+     */
+    private static class ExitException extends RuntimeException {
+        final int status;
+
+        ExitException(int status) {
+            super("exit status " + status);
+            this.status = status;
+        }
+    }
+
+    private static void exit(int status) {
+        throw new ExitException(status);
+    }
+
     /**
      * Minimum size (in bytes) of the extensible data block/field used for alignment of uncompressed
      * entries.
@@ -207,6 +239,9 @@ class SignApk {
      * @param keyFileName Name of the file containing the private key.  Used to prompt the user.
      */
     private static char[] readPassword(String keyFileName) {
+        if (sServerMode) {
+            return sServerPassword == null ? null : sServerPassword.toCharArray();
+        }
         Console console;
         if ((console = System.console()) == null) {
             System.out.print(
@@ -287,6 +322,60 @@ class SignApk {
         }
     }
 
+    /** Returns the key file's cache key, which changes whenever the file does. */
+    private static String getKeyCacheKey(File file) throws IOException {
+        return file.getCanonicalPath() + ":" + file.lastModified() + ":" + file.length();
+    }
+
+    /** Reads the public key, reusing the parsed key across the requests to a signing server. */
+    private static X509Certificate loadPublicKey(File file)
+        throws IOException, GeneralSecurityException {
+        if (!sServerMode) {
+            return readPublicKey(file);
+        }
+        String cacheKey = getKeyCacheKey(file);
+        X509Certificate publicKey = sPublicKeyCache.get(cacheKey);
+        if (publicKey == null) {
+            publicKey = readPublicKey(file);
+            sPublicKeyCache.put(cacheKey, publicKey);
+        }
+        return publicKey;
+    }
+
+    /**
+     * Returns the private key file's cache key. The key is decrypted with the request's password,
+     * so a hash of that password is part of the cache key too.
+     */
+    private static String getPrivateKeyCacheKey(File file)
+        throws IOException, GeneralSecurityException {
+        String cacheKey = getKeyCacheKey(file);
+        if (sServerPassword == null) {
+            return cacheKey + ":-";
+        }
+        byte[] digest = MessageDigest.getInstance("SHA-256").digest(
+                sServerPassword.getBytes(StandardCharsets.UTF_8));
+        StringBuilder passwordHash = new StringBuilder(digest.length * 2);
+        for (byte b : digest) {
+            passwordHash.append(String.format("%02x", b));
+        }
+        return cacheKey + ":+" + passwordHash;
+    }
+
+    /** Reads the private key, reusing the parsed key across the requests to a signing server. */
+    private static PrivateKey loadPrivateKey(File file)
+        throws IOException, GeneralSecurityException {
+        if (!sServerMode) {
+            return readPrivateKey(file);
+        }
+        String cacheKey = getPrivateKeyCacheKey(file);
+        PrivateKey privateKey = sPrivateKeyCache.get(cacheKey);
+        if (privateKey == null) {
+            privateKey = readPrivateKey(file);
+            sPrivateKeyCache.put(cacheKey, privateKey);
+        }
+        return privateKey;
+    }
+
     private static KeyStore createKeyStore(String keyStoreName, String keyStorePin) throws
             CertificateException,
             IOException,
@@ -916,7 +1005,7 @@ class SignApk {
             }
         } catch (ClassNotFoundException e) {
             e.printStackTrace();
-            System.exit(1);
+            exit(1);
             return;
         }
 
@@ -929,7 +1018,7 @@ class SignApk {
         }
         if (constructor == null) {
             System.err.println("No zero-arg constructor found for " + providerClassName);
-            System.exit(1);
+            exit(1);
             return;
         }
 
@@ -938,12 +1027,12 @@ class SignApk {
             o = constructor.newInstance();
         } catch (Exception e) {
             e.printStackTrace();
-            System.exit(1);
+            exit(1);
             return;
         }
         if (!(o instanceof Provider)) {
             System.err.println("Not a Provider class: " + providerClassName);
-            System.exit(1);
+            exit(1);
         }
 
         Security.insertProviderAt((Provider) o, 1);
@@ -1057,10 +1146,79 @@ class SignApk {
                            "publickey.x509[.pem] privatekey.pk8 " +
                            "[publickey2.x509[.pem] privatekey2.pk8 ...] " +
                            "input.jar output.jar [output-v4-file]");
-        System.exit(2);
+        exit(2);
     }
 
     public static void main(String[] args) {
+        if (args.length == 1 && "--server".equals(args[0])) {
+            try {
+                runServer();
+            } catch (IOException e) {
+                e.printStackTrace();
+                System.exit(1);
+            }
+            return;
+        }
+
+        try {
+            signApk(args);
+        } catch (ExitException e) {
+            System.exit(e.status);
+        }
+    }
+
+    /**
+     * Runs as a signing server, which signs files on requests read from stdin. This saves the JVM
+     * startup and the key loading when signing many files.
+     *
+     * Each request is a line of NUL-separated fields: the key password prefixed by '+' (or '-' if
+     * there's none), followed by the command line arguments of a regular signapk invocation. For
+     * each request, the server replies with a line of "<exit status> <output length>", followed by
+     * that many bytes of output (UTF-8) of the invocation. The server exits at the end of stdin.
+     */
+    private static void runServer() throws IOException {
+        PrintStream responses = System.out;
+        PrintStream stderr = System.err;
+        BufferedReader requests =
+                new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        // Only the responses may go to stdout.
+        System.setOut(stderr);
+        sServerMode = true;
+
+        String request;
+        while ((request = requests.readLine()) != null) {
+            String[] fields = request.split("\0", -1);
+            sServerPassword = fields[0].startsWith("+") ? fields[0].substring(1) : null;
+            String[] args = Arrays.copyOfRange(fields, 1, fields.length);
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            PrintStream outputStream = new PrintStream(output, true, "UTF-8");
+            System.setOut(outputStream);
+            System.setErr(outputStream);
+            int status = 0;
+            try {
+                signApk(args);
+            } catch (ExitException e) {
+                status = e.status;
+            } catch (Throwable e) {
+                // Uncaught exceptions terminate a regular invocation with status 1.
+                e.printStackTrace();
+                status = 1;
+            } finally {
+                System.setOut(stderr);
+                System.setErr(stderr);
+                sServerPassword = null;
+            }
+
+            outputStream.flush();
+            byte[] outputBytes = output.toByteArray();
+            responses.print(status + " " + outputBytes.length + "\n");
+            responses.write(outputBytes);
+            responses.flush();
+        }
+    }
+
+    private static void signApk(String[] args) {
         if (args.length < 4) usage();
 
         // Install Conscrypt as the highest-priority provider. Its crypto primitives are faster than
@@ -1160,7 +1318,7 @@ class SignApk {
         int numKeys = ((numArgsExcludeV4FilePath - argstart) / 2) - 1;
         if (signWholeFile && numKeys > 1) {
             System.err.println("Only one key may be used with -w.");
-            System.exit(2);
+            exit(2);
         }
 
         loadProviderIfNecessary(providerClass);
@@ -1182,11 +1340,11 @@ class SignApk {
             try {
                 for (int i = 0; i < numKeys; ++i) {
                     int argNum = argstart + i*2;
-                    publicKey[i] = readPublicKey(new File(args[argNum]));
+                    publicKey[i] = loadPublicKey(new File(args[argNum]));
                 }
             } catch (IllegalArgumentException e) {
                 System.err.println(e);
-                System.exit(1);
+                exit(1);
             }
 
             // Set all ZIP file timestamps to Jan 1 2009 00:00:00.
@@ -1203,7 +1361,7 @@ class SignApk {
             for (int i = 0; i < numKeys; ++i) {
                 int argNum = argstart + i*2 + 1;
                 if (keyStore == null) {
-                    privateKey[i] = readPrivateKey(new File(args[argNum]));
+                    privateKey[i] = loadPrivateKey(new File(args[argNum]));
                 } else {
                     final String keyAlias = args[argNum];
                     privateKey[i] = loadPrivateKeyFromKeyStore(keyStore, keyAlias);
@@ -1370,16 +1528,18 @@ class SignApk {
 
                 return;
             }
+        } catch (ExitException e) {
+            throw e;
         } catch (Exception e) {
             e.printStackTrace();
-            System.exit(1);
+            exit(1);
         } finally {
             try {
                 if (inputJar != null) inputJar.close();
                 if (outputFile != null) outputFile.close();
             } catch (IOException e) {
                 e.printStackTrace();
-                System.exit(1);
+                exit(1);
             }
         }
     }